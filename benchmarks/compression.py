@@ -0,0 +1,84 @@
+"""Compression throughput benchmark for the targz codecs.
+
+Generates a synthetic mongodump-like stream of BSON documents and reports compression
+and decompression speed (MB/s of uncompressed data) and the compression ratio for every
+available codec, level and worker count.
+
+Usage:
+    python benchmarks/compression.py [--size-mb 128] [--workers 1 4] [--levels gzip=1,6 zstd=1,3 lz4=0]
+"""
+import argparse
+import os
+import random
+import time
+
+import bson
+
+from mongogbackup import targz
+
+def _random_bytes(rng: random.Random, size: int) -> bytes:
+    # random.Random.randbytes() needs Python 3.9
+    return rng.getrandbits(8 * size).to_bytes(size, 'little')
+
+def synthetic_bson(size: int, seed: int = 0) -> bytes:
+    """Builds `size` bytes of BSON documents shaped like a typical application collection."""
+    rng = random.Random(seed)
+    words = ['alpha', 'bravo', 'charlie', 'delta', 'echo', 'foxtrot', 'golf', 'hotel', 'india', 'juliet']
+    docs = bytearray()
+    while len(docs) < size:
+        docs += bson.encode({
+            '_id': bson.ObjectId(),
+            'user_id': rng.randrange(1_000_000),
+            'name': ' '.join(rng.choice(words) for _ in range(3)),
+            'email': f"user{rng.randrange(100_000)}@example.com",
+            'score': rng.random() * 100,
+            'tags': rng.sample(words, 3),
+            'active': rng.random() < 0.8,
+            'payload': _random_bytes(rng, rng.randrange(16, 64)),
+        })
+    return bytes(docs[:size])
+
+def _chunks(data: bytes, size: int = 1 << 20):
+    for i in range(0, len(data), size):
+        yield data[i:i + size]
+
+def run(data: bytes, codec: str, level: int, workers: int) -> dict:
+    start = time.perf_counter()
+    compressed = b''.join(targz.compress_stream(_chunks(data), level=level, codec=codec, workers=workers))
+    compress_time = time.perf_counter() - start
+    start = time.perf_counter()
+    restored = sum(len(chunk) for chunk in targz.decompress_stream(_chunks(compressed)))
+    decompress_time = time.perf_counter() - start
+    assert restored == len(data)
+    mb = len(data) / (1 << 20)
+    return {
+        'codec': codec,
+        'level': level,
+        'workers': workers,
+        'compress_mbps': mb / compress_time,
+        'decompress_mbps': mb / decompress_time,
+        'ratio': len(data) / len(compressed),
+    }
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--size-mb', type=int, default=128)
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, os.cpu_count() or 1])
+    parser.add_argument('--levels', nargs='+', default=['gzip=1,6', 'zstd=1,3', 'lz4=0'])
+    args = parser.parse_args()
+
+    data = synthetic_bson(args.size_mb << 20)
+    print(f"{'codec':<6} {'level':>5} {'workers':>7} {'compress MB/s':>14} {'decompress MB/s':>16} {'ratio':>6}")
+    for spec in args.levels:
+        codec, levels = spec.split('=')
+        for level in [int(level) for level in levels.split(',')]:
+            for workers in sorted(set(args.workers)):
+                try:
+                    result = run(data, codec, level, workers)
+                except targz.CodecUnavailableError as e:
+                    print(f"{codec:<6} skipped: {e}")
+                    break
+                print(f"{codec:<6} {level:>5} {workers:>7} {result['compress_mbps']:>14.1f} {result['decompress_mbps']:>16.1f} {result['ratio']:>6.2f}")
+
+if __name__ == '__main__':
+    main()
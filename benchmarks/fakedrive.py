@@ -0,0 +1,347 @@
+"""In-process stand-in for the Google Drive v3 transfer endpoints.
+
+Implements enough of the REST API for GoogleDriveHandler's transfer methods to run
+offline: resumable upload sessions, file metadata, folder listings, the changes feed,
+ranged media downloads and deletes, alone or in batch requests. FakeDriveHandler.drive_service
+is a Drive API client for the same server.
+Per-request latency and per-connection bandwidth can be limited to imitate a real uplink.
+
+    with FakeDrive(latency=0.02, bandwidth=50 * 1024 * 1024) as drive:
+        gdrive = FakeDriveHandler(drive.api_root)
+        gdrive.upload_file('backup.encr', 'root')
+"""
+import datetime
+import email
+import hashlib
+import itertools
+import json
+import re
+import threading
+import time
+import uuid
+from collections import deque
+from functools import cached_property
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import httplib2
+import requests
+from googleapiclient.discovery import build_from_document
+from googleapiclient.discovery_cache import get_static_doc
+
+from mongogbackup.gdrive import GoogleDriveHandler
+from mongogbackup.retry import RetryPolicy
+
+def _unquote(value: str) -> str:
+    """Reverses gdrive.quote()."""
+    return re.sub(r"\\(.)", r"\1", value)
+
+class FakeDrive:
+    """Threaded HTTP server keeping uploaded files in memory."""
+
+    def __init__(self, latency: float = 0.0, bandwidth: float = None, host: str = '127.0.0.1', port: int = 0) -> None:
+        """Parameters:
+            latency -- Seconds added to every request.
+            bandwidth -- Bytes per second per request for request and response bodies (None for unlimited)."""
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.files = {}
+        self.sessions = {}
+        self.changes = []
+        self.requests = 0
+        self.faults = deque()
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), self._handler_class())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def api_root(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> 'FakeDrive':
+        self._thread = threading.Thread(target=self._server.serve_forever, args=(0.05,), daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self) -> 'FakeDrive':
+        return self.start()
+
+    def __exit__(self, *exc) -> None:
+        self.stop()
+
+    def _throttle(self, size: int) -> None:
+        delay = self.latency
+        if self.bandwidth:
+            delay += size / self.bandwidth
+        if delay:
+            time.sleep(delay)
+
+    def fail(self, status: int, count: int = 1, reason: str = None, retry_after: int = None) -> None:
+        """Answers the next `count` requests with an error instead of serving them, to exercise retries.
+
+        Parameters:
+            status -- HTTP status, e.g. 503, or 403 with reason='userRateLimitExceeded'.
+            reason -- (Optional) Error reason in the JSON body.
+            retry_after -- (Optional) Value of the Retry-After header.
+
+        Each call in a batch request takes its own fault."""
+        with self._lock:
+            self.faults.extend([(status, reason, retry_after)] * count)
+
+    def _new_id(self) -> str:
+        with self._lock:
+            return f"fake{next(self._ids):08d}"
+
+    def add_file(self, name: str, data: bytes, parent_id: str = 'root', app_properties: dict = None) -> dict:
+        """Stores a file directly, bypassing HTTP."""
+        file_id = self._new_id()
+        self.files[file_id] = {
+            'id': file_id,
+            'name': name,
+            'parents': [parent_id],
+            'data': bytes(data),
+            # millisecond precision, like Drive
+            'createdTime': datetime.datetime.now(datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z',
+        }
+        if app_properties:
+            self.files[file_id]['appProperties'] = dict(app_properties)
+        self.changes.append(file_id)
+        return self._resource(file_id)
+
+    def trash(self, file_id: str) -> None:
+        """Moves a file to the trash, bypassing HTTP. Trashed files are left out of listings."""
+        self.files[file_id]['trashed'] = True
+        self.changes.append(file_id)
+
+    def delete(self, file_id: str) -> bool:
+        """Deletes a file for good. Returns False if it does not exist."""
+        if self.files.pop(file_id, None) is None:
+            return False
+        self.changes.append(file_id)
+        return True
+
+    def _resource(self, file_id: str) -> dict:
+        file = self.files[file_id]
+        return {
+            'id': file_id,
+            'name': file['name'],
+            'parents': file['parents'],
+            'size': str(len(file['data'])),
+            'md5Checksum': hashlib.md5(file['data']).hexdigest(),
+            'createdTime': file['createdTime'],
+            **({'appProperties': file['appProperties']} if 'appProperties' in file else {}),
+            **({'trashed': True} if file.get('trashed') else {}),
+        }
+
+    def list_changes(self, page_token: str, page_size: int = 100) -> dict:
+        """A page of the changes feed: the current state of each file changed since page_token."""
+        start = int(page_token)
+        end = min(start + page_size, len(self.changes))
+        changes = []
+        for file_id in self.changes[start:end]:
+            if file_id in self.files:
+                changes.append({'fileId': file_id, 'removed': False, 'file': self._resource(file_id)})
+            else:
+                changes.append({'fileId': file_id, 'removed': True})
+        page = {'changes': changes}
+        if end < len(self.changes):
+            page['nextPageToken'] = str(end)
+        else:
+            page['newStartPageToken'] = str(end)
+        return page
+
+    def search(self, query: str) -> list:
+        """Files matching the "'<parent>' in parents", "name='<name>'" and "name contains '<text>'" terms of a Drive query."""
+        string = r"'((?:\\.|[^'\\])*)'"
+        parent = re.search(string + r" in parents", query)
+        name = re.search(r"name\s*=\s*" + string, query)
+        contains = re.search(r"name contains " + string, query)
+        parent, name, contains = (_unquote(term.group(1)) if term is not None else None for term in (parent, name, contains))
+        return [
+            self._resource(file_id) for file_id, file in list(self.files.items())
+            if not file.get('trashed')
+            and (parent is None or parent in file['parents']) and (name is None or name == file['name'])
+            and (contains is None or contains in file['name'])
+        ]
+
+    def _handler_class(self):
+        drive = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args) -> None:
+                pass
+
+            def _body(self) -> bytes:
+                length = int(self.headers.get('Content-Length') or 0)
+                data = self.rfile.read(length) if length else b''
+                drive._throttle(len(data))
+                return data
+
+            def _reply(self, status: int, body: bytes = b'', headers: dict = None) -> None:
+                drive._throttle(len(body))
+                self.send_response(status)
+                for key, value in (headers or {}).items():
+                    self.send_header(key, value)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                if body:
+                    self.wfile.write(body)
+
+            def _json(self, status: int, value) -> None:
+                self._reply(status, json.dumps(value).encode(), {'Content-Type': 'application/json'})
+
+            def _count(self, faults: bool = True) -> bool:
+                """Counts the request and answers it with an injected fault if one is queued."""
+                with drive._lock:
+                    drive.requests += 1
+                    fault = drive.faults.popleft() if faults and drive.faults else None
+                if fault is None:
+                    return False
+                status, reason, retry_after = fault
+                self._body()
+                body = {'error': {'code': status, 'errors': [{'reason': reason or 'backendError'}]}}
+                self._reply(status, json.dumps(body).encode(), {'Retry-After': str(retry_after)} if retry_after is not None else None)
+                return True
+
+            def _multipart(self, body: bytes) -> None:
+                """Creates a file from a multipart/related body of JSON metadata followed by the data."""
+                boundary = re.search(r'boundary=([^;]+)', self.headers['Content-Type']).group(1).encode()
+                parts = body.split(b'--' + boundary)[1:-1]
+                metadata, data = (part[part.index(b'\r\n\r\n') + 4:-2] for part in parts)
+                metadata = json.loads(metadata)
+                file = drive.add_file(metadata.get('name', 'untitled'), data,
+                                      metadata.get('parents', ['root'])[0], metadata.get('appProperties'))
+                self._json(200, file)
+
+            def _batch(self, body: bytes) -> None:
+                """Answers a multipart/mixed batch of DELETE calls with one application/http part per call."""
+                content_type = self.headers['Content-Type'].encode()
+                batch = email.message_from_bytes(b'Content-Type: ' + content_type + b'\r\n\r\n' + body)
+                boundary = uuid.uuid4().hex
+                parts = []
+                for request in batch.get_payload():
+                    method, path, _ = request.get_payload().splitlines()[0].split(' ', 2)
+                    match = re.match(r'/drive/v3/files/([^/?]+)', path)
+                    with drive._lock:
+                        fault = drive.faults.popleft() if drive.faults else None
+                    if fault is not None:
+                        code, reason, _ = fault
+                        error = json.dumps({'error': {'code': code, 'errors': [{'reason': reason or 'backendError'}]}})
+                        status = f"HTTP/1.1 {code} Error\r\nContent-Type: application/json\r\n\r\n{error}"
+                    elif method == 'DELETE' and match is not None and drive.delete(match.group(1)):
+                        status = 'HTTP/1.1 204 No Content\r\nContent-Length: 0\r\n\r\n'
+                    else:
+                        error = json.dumps({'error': {'code': 404, 'errors': [{'reason': 'notFound'}]}})
+                        status = f"HTTP/1.1 404 Not Found\r\nContent-Type: application/json\r\n\r\n{error}"
+                    content_id = request['Content-ID'].replace('<', '<response-', 1)
+                    parts.append(f"--{boundary}\r\nContent-Type: application/http\r\nContent-ID: {content_id}\r\n\r\n{status}\r\n")
+                reply = ''.join(parts) + f"--{boundary}--\r\n"
+                self._reply(200, reply.encode(), {'Content-Type': f'multipart/mixed; boundary={boundary}'})
+
+            def do_POST(self) -> None:
+                url = urlparse(self.path)
+                # faults in a batch are served to its calls, one each
+                if self._count(faults=url.path != '/batch/drive/v3'):
+                    return
+                body = self._body()
+                if url.path == '/batch/drive/v3':
+                    return self._batch(body)
+                if url.path != '/upload/drive/v3/files':
+                    return self._json(404, {'error': 'not found'})
+                if parse_qs(url.query).get('uploadType') == ['multipart']:
+                    return self._multipart(body)
+                metadata = json.loads(body or b'{}')
+                upload_id = drive._new_id()
+                drive.sessions[upload_id] = {'metadata': metadata, 'data': bytearray()}
+                location = f"{drive.api_root}/upload/drive/v3/files?uploadType=resumable&upload_id={upload_id}"
+                self._reply(200, headers={'Location': location})
+
+            def do_PUT(self) -> None:
+                if self._count():
+                    return
+                url = urlparse(self.path)
+                upload_id = parse_qs(url.query).get('upload_id', [None])[0]
+                data = self._body()
+                session = drive.sessions.get(upload_id)
+                if session is None:
+                    return self._json(404, {'error': 'upload session not found'})
+                match = re.match(r'bytes (\*|(\d+)-(\d+))/(\*|\d+)', self.headers.get('Content-Range', ''))
+                if match is None:
+                    return self._json(400, {'error': 'invalid Content-Range'})
+                committed = len(session['data'])
+                if match.group(2) is not None:
+                    start = int(match.group(2))
+                    if start > committed:
+                        return self._json(400, {'error': f'expected offset {committed}'})
+                    session['data'] += data[committed - start:]
+                    committed = len(session['data'])
+                total = match.group(4)
+                if total != '*' and committed == int(total):
+                    file = drive.add_file(session['metadata'].get('name', 'untitled'), session['data'],
+                                          (session['metadata'].get('parents') or ['root'])[0], session['metadata'].get('appProperties'))
+                    del drive.sessions[upload_id]
+                    return self._json(200, file)
+                headers = {'Range': f"bytes=0-{committed - 1}"} if committed else {}
+                self._reply(308, headers=headers)
+
+            def do_GET(self) -> None:
+                if self._count():
+                    return
+                url = urlparse(self.path)
+                query = parse_qs(url.query)
+                if url.path == '/drive/v3/files':
+                    return self._json(200, {'files': drive.search(query.get('q', [''])[0])})
+                if url.path == '/drive/v3/changes/startPageToken':
+                    return self._json(200, {'startPageToken': str(len(drive.changes))})
+                if url.path == '/drive/v3/changes':
+                    return self._json(200, drive.list_changes(query['pageToken'][0], int(query.get('pageSize', ['100'])[0])))
+                match = re.match(r'/drive/v3/files/([^/]+)$', url.path)
+                if match is None or match.group(1) not in drive.files:
+                    return self._json(404, {'error': 'file not found'})
+                file_id = match.group(1)
+                if query.get('alt') != ['media']:
+                    return self._json(200, drive._resource(file_id))
+                data = drive.files[file_id]['data']
+                range_match = re.match(r'bytes=(\d+)-(\d*)', self.headers.get('Range', ''))
+                if range_match is None:
+                    return self._reply(200, data)
+                start = int(range_match.group(1))
+                end = min(int(range_match.group(2) or len(data) - 1), len(data) - 1)
+                self._reply(206, data[start:end + 1], {'Content-Range': f"bytes {start}-{end}/{len(data)}"})
+
+            def do_DELETE(self) -> None:
+                if self._count():
+                    return
+                match = re.match(r'/drive/v3/files/([^/]+)$', urlparse(self.path).path)
+                if match is None or not drive.delete(match.group(1)):
+                    return self._json(404, {'error': 'file not found'})
+                self._reply(204)
+
+        return Handler
+
+class FakeDriveHandler(GoogleDriveHandler):
+    """GoogleDriveHandler pointed at a FakeDrive, without credentials or a connectivity check."""
+
+    def __init__(self, api_root: str, parent_id: str = 'root', file_name: str = 'backup') -> None:
+        self.api_root = api_root
+        self.parent_id = parent_id
+        self.file_name = file_name
+        self.retry = RetryPolicy()
+
+    @cached_property
+    def drive_service(self):
+        # the discovery document shipped with googleapiclient, with every endpoint on the fake
+        document = dict(json.loads(get_static_doc('drive', 'v3')), rootUrl=self.api_root + '/')
+        return build_from_document(document, http=httplib2.Http())
+
+    def _new_session(self) -> requests.Session:
+        return requests.Session()
@@ -0,0 +1,238 @@
+"""In-process stand-in for an S3-compatible object store.
+
+Implements the calls S3Storage makes (put, multipart uploads, ranged gets, head,
+ListObjectsV2 and DeleteObjects) on path-style URLs, keeping objects in memory, so the S3
+backend can be tested and benchmarked offline. Like FakeDrive, per-request latency and
+per-connection bandwidth can be limited, and error responses can be injected.
+
+    with FakeS3(bucket='backups') as s3:
+        storage = S3Storage('backups', client=s3.client(), part_size=8 * 1024 * 1024)
+        storage.upload_file('backup.encr')
+"""
+import hashlib
+import itertools
+import re
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlparse
+from xml.sax.saxutils import escape, unescape
+
+class FakeS3:
+    """Threaded HTTP server keeping the objects of one bucket in memory."""
+
+    def __init__(self, bucket: str = 'backups', latency: float = 0.0, bandwidth: float = None, host: str = '127.0.0.1', port: int = 0) -> None:
+        """Parameters:
+            bucket -- Name of the only bucket.
+            latency -- Seconds added to every request.
+            bandwidth -- Bytes per second per request for request and response bodies (None for unlimited)."""
+        self.bucket = bucket
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.objects = {}
+        self.uploads = {}
+        self.requests = 0
+        self.faults = deque()
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), self._handler_class())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def endpoint_url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def client(self):
+        """A boto3 S3 client for this server."""
+        import boto3
+        from botocore.config import Config
+        try:
+            # recent botocore versions add streaming checksums that this server does not parse
+            config = Config(s3={'addressing_style': 'path'}, request_checksum_calculation='when_required',
+                            response_checksum_validation='when_required')
+        except TypeError:
+            config = Config(s3={'addressing_style': 'path'})
+        return boto3.client('s3', endpoint_url=self.endpoint_url, region_name='us-east-1',
+                            aws_access_key_id='fake', aws_secret_access_key='fake', config=config)
+
+    def start(self) -> 'FakeS3':
+        self._thread = threading.Thread(target=self._server.serve_forever, args=(0.05,), daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self) -> 'FakeS3':
+        return self.start()
+
+    def __exit__(self, *exc) -> None:
+        self.stop()
+
+    def fail(self, status: int, count: int = 1, code: str = 'SlowDown') -> None:
+        """Answers the next `count` requests with an S3 error instead of serving them, to exercise retries."""
+        with self._lock:
+            self.faults.extend([(status, code)] * count)
+
+    def _throttle(self, size: int) -> None:
+        delay = self.latency
+        if self.bandwidth:
+            delay += size / self.bandwidth
+        if delay:
+            time.sleep(delay)
+
+    def _handler_class(self):
+        s3 = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args) -> None:
+                pass
+
+            def _body(self) -> bytes:
+                length = int(self.headers.get('Content-Length') or 0)
+                data = self.rfile.read(length) if length else b''
+                s3._throttle(len(data))
+                return data
+
+            def _reply(self, status: int, body: bytes = b'', headers: dict = None) -> None:
+                # a HEAD response announces the body's length but does not carry it
+                head = self.command == 'HEAD'
+                if not head:
+                    s3._throttle(len(body))
+                self.send_response(status)
+                for key, value in (headers or {}).items():
+                    self.send_header(key, value)
+                if 'Content-Length' not in (headers or {}):
+                    self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                if body and not head:
+                    self.wfile.write(body)
+
+            def _xml(self, status: int, body: str) -> None:
+                self._reply(status, f'<?xml version="1.0" encoding="UTF-8"?>\n{body}'.encode(), {'Content-Type': 'application/xml'})
+
+            def _error(self, status: int, code: str, message: str = '') -> None:
+                self._xml(status, f"<Error><Code>{code}</Code><Message>{escape(message)}</Message></Error>")
+
+            def _route(self):
+                """Counts the request and returns (key, query), or None if it was answered with an injected fault."""
+                with s3._lock:
+                    s3.requests += 1
+                    fault = s3.faults.popleft() if s3.faults else None
+                url = urlparse(self.path)
+                if fault is not None:
+                    self._body()
+                    self._error(fault[0], fault[1])
+                    return None
+                bucket, _, key = url.path.lstrip('/').partition('/')
+                if bucket != s3.bucket:
+                    self._body()
+                    self._error(404, 'NoSuchBucket', bucket)
+                    return None
+                return unquote(key), parse_qs(url.query, keep_blank_values=True)
+
+            def do_PUT(self) -> None:
+                route = self._route()
+                if route is None:
+                    return
+                key, query = route
+                data = self._body()
+                etag = f'"{hashlib.md5(data).hexdigest()}"'
+                if 'uploadId' in query:
+                    upload = s3.uploads.get(query['uploadId'][0])
+                    if upload is None:
+                        return self._error(404, 'NoSuchUpload')
+                    upload['parts'][int(query['partNumber'][0])] = data
+                else:
+                    s3.objects[key] = {'data': data, 'etag': etag, 'modified': time.time()}
+                self._reply(200, headers={'ETag': etag})
+
+            def do_POST(self) -> None:
+                route = self._route()
+                if route is None:
+                    return
+                key, query = route
+                body = self._body()
+                if 'delete' in query:
+                    for deleted in re.findall(rb'<Key>(.*?)</Key>', body):
+                        s3.objects.pop(unescape(deleted.decode()), None)
+                    return self._xml(200, '<DeleteResult></DeleteResult>')
+                if 'uploads' in query:
+                    upload_id = f"upload{next(s3._ids):08d}"
+                    s3.uploads[upload_id] = {'key': key, 'parts': {}}
+                    return self._xml(200, f"<InitiateMultipartUploadResult><Bucket>{s3.bucket}</Bucket><Key>{escape(key)}</Key>"
+                                          f"<UploadId>{upload_id}</UploadId></InitiateMultipartUploadResult>")
+                if 'uploadId' in query:
+                    upload = s3.uploads.pop(query['uploadId'][0], None)
+                    if upload is None:
+                        return self._error(404, 'NoSuchUpload')
+                    numbers = [int(number) for number in re.findall(rb'<PartNumber>(\d+)</PartNumber>', body)]
+                    if numbers != sorted(numbers) or any(number not in upload['parts'] for number in numbers):
+                        return self._error(400, 'InvalidPart')
+                    parts = [upload['parts'][number] for number in numbers]
+                    digest = hashlib.md5(b''.join(hashlib.md5(part).digest() for part in parts)).hexdigest()
+                    etag = f'"{digest}-{len(parts)}"'
+                    s3.objects[key] = {'data': b''.join(parts), 'etag': etag, 'modified': time.time()}
+                    return self._xml(200, f"<CompleteMultipartUploadResult><Key>{escape(key)}</Key><ETag>{escape(etag)}</ETag>"
+                                          f"</CompleteMultipartUploadResult>")
+                self._error(400, 'InvalidRequest')
+
+            def do_GET(self) -> None:
+                route = self._route()
+                if route is None:
+                    return
+                key, query = route
+                if not key:
+                    return self._list(query)
+                item = s3.objects.get(key)
+                if item is None:
+                    return self._error(404, 'NoSuchKey', key)
+                data = item['data']
+                headers = {'ETag': item['etag'], 'Content-Type': 'application/octet-stream'}
+                match = re.match(r'bytes=(\d+)-(\d*)', self.headers.get('Range', ''))
+                if match is None:
+                    headers['Content-Length'] = str(len(data))
+                    return self._reply(200, data, headers)
+                start = int(match.group(1))
+                end = min(int(match.group(2) or len(data) - 1), len(data) - 1)
+                headers['Content-Range'] = f"bytes {start}-{end}/{len(data)}"
+                self._reply(206, data[start:end + 1], headers)
+
+            def do_HEAD(self) -> None:
+                self.do_GET()
+
+            def _list(self, query: dict) -> None:
+                prefix = query.get('prefix', [''])[0]
+                limit = int(query.get('max-keys', ['1000'])[0])
+                after = query.get('continuation-token', [''])[0]
+                keys = sorted(key for key in list(s3.objects) if key.startswith(prefix) and key > after)
+                page, truncated = keys[:limit], len(keys) > limit
+                contents = ''.join(
+                    f"<Contents><Key>{escape(key)}</Key><Size>{len(s3.objects[key]['data'])}</Size>"
+                    f"<ETag>{escape(s3.objects[key]['etag'])}</ETag>"
+                    f"<LastModified>{time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime(s3.objects[key]['modified']))}</LastModified>"
+                    f"<StorageClass>STANDARD</StorageClass></Contents>"
+                    for key in page if key in s3.objects)
+                token = f"<NextContinuationToken>{escape(page[-1])}</NextContinuationToken>" if truncated else ''
+                self._xml(200, f"<ListBucketResult><Name>{s3.bucket}</Name><Prefix>{escape(prefix)}</Prefix><KeyCount>{len(page)}</KeyCount>"
+                               f"<MaxKeys>{limit}</MaxKeys><IsTruncated>{'true' if truncated else 'false'}</IsTruncated>{contents}{token}"
+                               f"</ListBucketResult>")
+
+            def do_DELETE(self) -> None:
+                route = self._route()
+                if route is None:
+                    return
+                key, query = route
+                if 'uploadId' in query:
+                    s3.uploads.pop(query['uploadId'][0], None)
+                else:
+                    s3.objects.pop(key, None)
+                self._reply(204)
+
+        return Handler
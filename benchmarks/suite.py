@@ -0,0 +1,424 @@
+"""End-to-end benchmark of a backup and restore against a local mongod and a fake Drive.
+
+Generates a synthetic dataset, then runs every stage of a backup and a restore and
+reports, for each step, the throughput, the peak resident memory of this process and its
+helpers (mongodump, mongorestore) and the peak scratch disk use. Per-stage numbers from
+mongogbackup.metrics (e.g. compression inside stream_backup) are recorded as well.
+
+Steps: dump, pack, encrypt, hash, upload, download, decrypt, unpack, restore, then the
+single-pass stream_backup and stream_restore.
+
+A throwaway mongod is started from PATH in a temporary directory unless --host/--port
+point at a running server (the benchmark database is dropped afterwards). Google Drive is
+replaced by the in-process server from fakedrive.py.
+
+Results are saved as JSON under benchmarks/results/ with --save. Compare a run with an
+earlier one with --compare; the exit status is 1 if a step got slower, or used more memory
+or disk, by more than --threshold percent.
+
+Usage:
+    python benchmarks/suite.py [--shape small|large|mixed] [--payload compressible|random] [--size-mb 256]
+                               [--collections 4] [--codec gzip] [--workers 4] [--save] [--compare results/<run>.json]
+"""
+import argparse
+import contextlib
+import datetime
+import json
+import os
+import platform
+import random
+import shutil
+import socket
+import string
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import bson
+from pymongo import MongoClient
+
+from fakedrive import FakeDrive, FakeDriveHandler
+from mongogbackup import MongoConfig, MongoGBackup, backups, metrics, pipeline
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+DB_NAME = 'mongogbackup_bench'
+KEY = 'uBn4K5K4j7jwOuGxOvW3BRjnF_yQtcHo_0_0ZfAq2yw='
+
+# shape -> (min, max) document size in bytes
+SHAPES = {
+    'small': (100, 400),
+    'large': (1 << 20, 4 << 20),
+    'mixed': (100, 256 * 1024),
+}
+
+def _documents(shape: str, payload: str, rng: random.Random):
+    """Endless documents of the given shape. Compressible payloads are text drawn from a
+    small vocabulary; random payloads are incompressible bytes."""
+    low, high = SHAPES[shape]
+    words = [''.join(rng.choice(string.ascii_lowercase) for _ in range(rng.randrange(3, 10))) for _ in range(500)]
+    while True:
+        size = rng.randrange(low, high)
+        if payload == 'random':
+            body = rng.getrandbits(8 * size).to_bytes(size, 'little')  # randbytes() needs Python 3.9
+        else:
+            text = []
+            length = 0
+            while length < size:
+                word = rng.choice(words)
+                text.append(word)
+                length += len(word) + 1
+            body = ' '.join(text)
+        yield {
+            'user_id': rng.randrange(1_000_000),
+            'created': datetime.datetime(2024, 1, 1) + datetime.timedelta(seconds=rng.randrange(10_000_000)),
+            'score': rng.random() * 100,
+            'active': rng.random() < 0.8,
+            'body': body,
+        }
+
+def generate(client: MongoClient, shape: str, payload: str, size: int, collections: int, seed: int = 0) -> dict:
+    """Fills DB_NAME with about `size` bytes of BSON spread over `collections` collections."""
+    rng = random.Random(seed)
+    database = client[DB_NAME]
+    database.command('dropDatabase')
+    documents = _documents(shape, payload, rng)
+    written = 0
+    count = 0
+    per_collection = size // collections
+    for index in range(collections):
+        collection = database[f"collection_{index}"]
+        target = per_collection * (index + 1)
+        batch, batch_bytes = [], 0
+        while written < target:
+            document = next(documents)
+            length = len(bson.encode(document))
+            batch.append(document)
+            batch_bytes += length
+            written += length
+            count += 1
+            if len(batch) >= 1000 or batch_bytes >= 16 << 20:
+                collection.insert_many(batch, ordered=False)
+                batch, batch_bytes = [], 0
+        if batch:
+            collection.insert_many(batch, ordered=False)
+    return {'shape': shape, 'payload': payload, 'bytes': written, 'documents': count, 'collections': collections}
+
+class LocalMongod:
+    """Throwaway mongod on a free port with its data in a temporary directory."""
+
+    def __init__(self, binary: str = 'mongod') -> None:
+        if shutil.which(binary) is None:
+            sys.exit(f"{binary} not found. Install MongoDB and add it to your PATH, or pass --host/--port of a running server.")
+        self.binary = binary
+        self.host = '127.0.0.1'
+        with socket.socket() as s:
+            s.bind((self.host, 0))
+            self.port = s.getsockname()[1]
+        self.process = None
+        self._dbpath = None
+
+    def __enter__(self) -> 'LocalMongod':
+        self._dbpath = tempfile.mkdtemp(prefix='mongogbackup-bench-db-')
+        self.process = subprocess.Popen(
+            [self.binary, '--dbpath', self._dbpath, '--port', str(self.port), '--bind_ip', self.host, '--quiet'],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        )
+        client = MongoClient(self.host, self.port, serverSelectionTimeoutMS=30_000)
+        client.admin.command('ping')
+        client.close()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.process.terminate()
+        self.process.wait()
+        shutil.rmtree(self._dbpath, ignore_errors=True)
+
+class ResourceSampler:
+    """Samples the resident memory of this process and its helper processes and the size of
+    the scratch directory in a background thread, keeping the peaks.
+
+    On Linux memory is read from /proc, so the peak is per step. Elsewhere it falls back to
+    getrusage(), which only knows the peak since the process started."""
+
+    def __init__(self, scratch: str, exclude: tuple = (), interval: float = 0.05) -> None:
+        self.scratch = scratch
+        self.exclude = set(exclude)
+        self.interval = interval
+        self.peak_rss = 0
+        self.peak_disk = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    @staticmethod
+    def _rss(pid) -> int:
+        with open(f"/proc/{pid}/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+    def _children(self, pid) -> list:
+        children = []
+        try:
+            for task in os.listdir(f"/proc/{pid}/task"):
+                with open(f"/proc/{pid}/task/{task}/children") as f:
+                    children.extend(int(child) for child in f.read().split())
+        except OSError:
+            pass
+        return [child for child in children if child not in self.exclude]
+
+    def _tree_rss(self) -> int:
+        total = 0
+        pending = [os.getpid()]
+        while pending:
+            pid = pending.pop()
+            try:
+                total += self._rss(pid)
+            except OSError:
+                continue
+            pending.extend(self._children(pid))
+        return total
+
+    def sample(self) -> None:
+        if os.path.exists('/proc/self/statm'):
+            self.peak_rss = max(self.peak_rss, self._tree_rss())
+        else:
+            import resource
+            scale = 1 if sys.platform == 'darwin' else 1024
+            usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss + resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+            self.peak_rss = max(self.peak_rss, usage * scale)
+        self.peak_disk = max(self.peak_disk, self._disk())
+
+    def _disk(self) -> int:
+        total = 0
+        for root, _, names in os.walk(self.scratch):
+            for name in names:
+                try:
+                    total += os.path.getsize(os.path.join(root, name))
+                except OSError:  # removed while walking
+                    pass
+        return total
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            self.sample()
+
+    def __enter__(self) -> 'ResourceSampler':
+        self.sample()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self._stop.set()
+        self._thread.join()
+        self.sample()
+
+class Benchmark:
+    """Runs the steps one after another in a scratch directory and collects their results."""
+
+    def __init__(self, handler: MongoGBackup, scratch: str, exclude_pids: tuple, codec: str, level: int, workers: int,
+                 chunk_size: int) -> None:
+        self.handler = handler
+        self.scratch = scratch
+        self.exclude_pids = exclude_pids
+        self.codec = codec
+        self.level = level
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.steps = []
+
+    def path(self, *names: str) -> str:
+        return os.path.join(self.scratch, *names)
+
+    def step(self, name: str, size, function, *args, **kwargs):
+        """Runs one step. `size` is the number of bytes it processes, or a function returning
+        it once the step has finished (for outputs of unknown size)."""
+        stages = []
+        metrics.registry.add_callback(stages.append)
+        try:
+            with ResourceSampler(self.scratch, self.exclude_pids) as sampler:
+                start = time.perf_counter()
+                result = function(*args, **kwargs)
+                seconds = time.perf_counter() - start
+        finally:
+            metrics.registry.remove_callback(stages.append)
+        size = size() if callable(size) else size
+        self.steps.append({
+            'step': name,
+            'seconds': seconds,
+            'bytes': size,
+            'mb_per_second': size / (1 << 20) / seconds if seconds else 0.0,
+            'peak_rss_mb': sampler.peak_rss / (1 << 20),
+            'peak_disk_mb': sampler.peak_disk / (1 << 20),
+            'stages': [
+                {key: event.get(key) for key in ('stage', 'pipeline', 'wall_seconds', 'cpu_seconds', 'bytes_in', 'bytes_out',
+                                                  'mb_per_second', 'stall_in_seconds', 'stall_out_seconds', 'queue_depth_max')}
+                for event in stages if event['event'] == 'stage'
+            ],
+        })
+        print(_format_step(self.steps[-1]))
+        return result
+
+    def run(self, dataset_bytes: int) -> list:
+        handler = self.handler
+        dump_dir = self.path('dump')
+        os.makedirs(dump_dir)
+        size_of = backups.MongoBackupHandler._directory_size
+        self.step('dump', lambda: size_of(dump_dir), handler.backups.backup, dir=dump_dir)
+        dump_bytes = size_of(dump_dir)
+
+        archive = self.path('backup.tar')
+        self.step('pack', dump_bytes, handler.targz.pack, dump_dir, archive, codec=self.codec, level=self.level, workers=self.workers)
+        shutil.rmtree(dump_dir)
+        encrypted = self.path('backup.encr')
+        self.step('encrypt', os.path.getsize(archive), handler.encrypt.encrypt_file, archive, encrypted)
+        os.remove(archive)
+        self.step('hash', os.path.getsize(encrypted), handler.hash.generate_file_hash, encrypted)
+        uploaded = self.step('upload', os.path.getsize(encrypted), handler.gdrive.upload_file, encrypted, 'root',
+                             chunk_size=self.chunk_size, resume=False)
+        os.remove(encrypted)
+
+        downloaded = self.path('download.encr')
+        self.step('download', int(uploaded['size']), handler.gdrive.download_file, uploaded['id'], downloaded,
+                  chunk_size=self.chunk_size, resume=False)
+        self.step('decrypt', os.path.getsize(downloaded), handler.encrypt.decrypt_file, downloaded, archive)
+        os.remove(downloaded)
+        restore_dir = self.path('restore')
+        self.step('unpack', os.path.getsize(archive), handler.targz.unpack, archive, restore_dir)
+        os.remove(archive)
+        handler.backups._client()[DB_NAME].command('dropDatabase')
+        self.step('restore', size_of(restore_dir), handler.backups.restore, bck_dir=_bson_directory(restore_dir))
+        shutil.rmtree(restore_dir)
+
+        streamed = self.step('stream_backup', dataset_bytes, handler.stream_backup, file_name='stream.gz.encr', parent_id='root',
+                             codec=self.codec, level=self.level, workers=self.workers, chunk_size=self.chunk_size)
+        handler.backups._client()[DB_NAME].command('dropDatabase')
+        self.step('stream_restore', int(streamed['size']), handler.stream_restore, file_name='stream.gz.encr', parent_id='root',
+                  chunk_size=self.chunk_size, progress=pipeline.ProgressMeter('Restore', callback=lambda snapshot: None))
+        return self.steps
+
+def _bson_directory(path: str) -> str:
+    """The directory holding the .bson files of an unpacked dump."""
+    for root, _, names in os.walk(path):
+        if any(name.endswith('.bson') for name in names):
+            return root
+    return path
+
+def _format_step(step: dict) -> str:
+    return (f"{step['step']:<15} {step['seconds']:>8.2f} {step['mb_per_second']:>9.1f} "
+            f"{step['peak_rss_mb']:>9.1f} {step['peak_disk_mb']:>9.1f}")
+
+def _environment(tools: str) -> dict:
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    try:
+        dump_version = subprocess.run(['mongodump', '--version'], capture_output=True, text=True).stdout.splitlines()[0]
+    except (OSError, IndexError):
+        dump_version = None
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'commit': commit,
+        'mongodump': dump_version,
+        'mongod': tools,
+    }
+
+def compare(current: dict, baseline: dict, threshold: float) -> bool:
+    """Prints the change of every step against a baseline run. Returns True if any step
+    regressed by more than `threshold` percent."""
+    if current['dataset'] != baseline['dataset'] or current['config'] != baseline['config']:
+        print("Warning: the baseline was run with a different dataset or configuration")
+    earlier = {step['step']: step for step in baseline['steps']}
+    regressed = False
+    print(f"\n{'step':<15} {'MB/s':>9} {'peak RSS':>9} {'peak disk':>9}   (change against {baseline['time']})")
+    for step in current['steps']:
+        before = earlier.get(step['step'])
+        if before is None:
+            continue
+        changes = []
+        flagged = []
+        # throughput: lower is worse; memory and disk: higher is worse
+        for key, worse_if_lower in (('mb_per_second', True), ('peak_rss_mb', False), ('peak_disk_mb', False)):
+            if not before[key]:
+                changes.append(f"{'-':>9}")
+                continue
+            change = (step[key] - before[key]) / before[key] * 100
+            changes.append(f"{change:>+8.1f}%")
+            if (-change if worse_if_lower else change) > threshold:
+                flagged.append(key)
+        regressed = regressed or bool(flagged)
+        print(f"{step['step']:<15} {' '.join(changes)}" + (f"   REGRESSION: {', '.join(flagged)}" if flagged else ''))
+    return regressed
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--shape', choices=sorted(SHAPES), default='small')
+    parser.add_argument('--payload', choices=['compressible', 'random'], default='compressible')
+    parser.add_argument('--size-mb', type=int, default=256)
+    parser.add_argument('--collections', type=int, default=4)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--codec', default='gzip')
+    parser.add_argument('--level', type=int, default=None)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--chunk-mb', type=int, default=8)
+    parser.add_argument('--latency-ms', type=float, default=0, help='added to every fake Drive request')
+    parser.add_argument('--bandwidth-mbps', type=float, default=None, help='fake Drive bandwidth per connection, in MB/s')
+    parser.add_argument('--host', default=None, help='use a running mongod instead of starting one')
+    parser.add_argument('--port', type=int, default=27017)
+    parser.add_argument('--mongod', default='mongod', help='mongod binary to start')
+    parser.add_argument('--scratch', default=None, help='directory for temporary files')
+    parser.add_argument('--save', action='store_true', help=f'store the results in {RESULTS_DIR}')
+    parser.add_argument('--output', default=None, help='store the results in this file')
+    parser.add_argument('--compare', default=None, help='earlier results file to compare with')
+    parser.add_argument('--threshold', type=float, default=10.0, help='regression threshold in percent')
+    args = parser.parse_args()
+
+    config = {key: getattr(args, key) for key in ('codec', 'level', 'workers', 'chunk_mb', 'latency_ms', 'bandwidth_mbps')}
+    bandwidth = args.bandwidth_mbps * (1 << 20) if args.bandwidth_mbps else None
+    server = LocalMongod(args.mongod) if args.host is None else None
+    with (server or contextlib.nullcontext()), FakeDrive(latency=args.latency_ms / 1000, bandwidth=bandwidth) as drive, \
+            tempfile.TemporaryDirectory(prefix='mongogbackup-bench-', dir=args.scratch) as scratch:
+        host, port = (server.host, server.port) if server else (args.host, args.port)
+        handler = MongoGBackup(MongoConfig(DB_NAME, host=host, port=port), None, 'root', 'stream.gz.encr', KEY)
+        handler.gdrive = FakeDriveHandler(drive.api_root)
+
+        client = handler.backups._client()
+        print(f"Generating {args.size_mb}Mb of {args.shape} {args.payload} documents...")
+        dataset = generate(client, args.shape, args.payload, args.size_mb << 20, args.collections, args.seed)
+        print(f"{dataset['documents']} documents in {dataset['collections']} collections\n")
+        print(f"{'step':<15} {'seconds':>8} {'MB/s':>9} {'RSS MB':>9} {'disk MB':>9}")
+        try:
+            steps = Benchmark(handler, scratch, (server.process.pid,) if server else (), args.codec, args.level,
+                              args.workers, args.chunk_mb << 20).run(dataset['bytes'])
+        finally:
+            client[DB_NAME].command('dropDatabase')
+
+    results = {
+        'version': 1,
+        'time': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        'environment': _environment('started' if server else f"{args.host}:{args.port}"),
+        'dataset': dataset,
+        'config': config,
+        'steps': steps,
+    }
+    output = args.output
+    if output is None and args.save:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        stamp = datetime.datetime.now().strftime('%Y%m%d-%H%M%S')
+        output = os.path.join(RESULTS_DIR, f"{stamp}-{args.shape}-{args.payload}-{args.size_mb}mb.json")
+    if output is not None:
+        with open(output, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"\nResults saved to {output}")
+    if args.compare is not None:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if compare(results, baseline, args.threshold):
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+"""Transfer throughput benchmark for GoogleDriveHandler against a local fake Drive server.
+
+Measures upload and download MB/s for several chunk sizes and worker counts, so the
+transfer settings can be tuned offline. Use --latency-ms and --bandwidth-mbps to imitate
+the round-trip time and per-connection throughput of the real uplink.
+
+Usage:
+    python benchmarks/transfer.py [--size-mb 256] [--chunk-mb 1 8 32] [--workers 1 4 8] [--latency-ms 20] [--bandwidth-mbps 40]
+"""
+import argparse
+import os
+import tempfile
+import time
+
+from fakedrive import FakeDrive, FakeDriveHandler
+
+def _timed(function, *args, **kwargs) -> float:
+    start = time.perf_counter()
+    function(*args, **kwargs)
+    return time.perf_counter() - start
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--size-mb', type=int, default=256)
+    parser.add_argument('--chunk-mb', type=int, nargs='+', default=[1, 8, 32])
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 4, 8])
+    parser.add_argument('--latency-ms', type=float, default=0)
+    parser.add_argument('--bandwidth-mbps', type=float, default=None, help='per connection, in MB/s')
+    args = parser.parse_args()
+
+    bandwidth = args.bandwidth_mbps * (1 << 20) if args.bandwidth_mbps else None
+    with FakeDrive(latency=args.latency_ms / 1000, bandwidth=bandwidth) as drive, tempfile.TemporaryDirectory() as tmp:
+        source = os.path.join(tmp, 'backup.bin')
+        with open(source, 'wb') as f:
+            f.write(os.urandom(args.size_mb << 20))
+        gdrive = FakeDriveHandler(drive.api_root)
+        mb = args.size_mb
+
+        print(f"{'operation':<16} {'chunk MB':>8} {'workers':>7} {'MB/s':>8} {'requests':>8}")
+        for chunk_mb in args.chunk_mb:
+            chunk_size = chunk_mb << 20
+            drive.requests = 0
+            seconds = _timed(gdrive.upload_file, source, 'root', chunk_size=chunk_size, resume=False)
+            print(f"{'upload_file':<16} {chunk_mb:>8} {1:>7} {mb / seconds:>8.1f} {drive.requests:>8}")
+            file_id = next(iter(drive.files))
+            for workers in args.workers:
+                drive.requests = 0
+                part_size = max(chunk_size, (args.size_mb << 20) // workers)
+                part_size -= part_size % (256 * 1024)
+                seconds = _timed(gdrive.upload_parts, source, 'root', part_size=part_size, workers=workers, chunk_size=chunk_size, resume=False)
+                print(f"{'upload_parts':<16} {chunk_mb:>8} {workers:>7} {mb / seconds:>8.1f} {drive.requests:>8}")
+                drive.requests = 0
+                seconds = _timed(gdrive.download_file, file_id, os.path.join(tmp, 'download.bin'), chunk_size=chunk_size, workers=workers, resume=False)
+                print(f"{'download_file':<16} {chunk_mb:>8} {workers:>7} {mb / seconds:>8.1f} {drive.requests:>8}")
+                drive.requests = 0
+                seconds = _timed(lambda: sum(len(c) for c in gdrive.download_stream(file_id, chunk_size, workers)))
+                print(f"{'download_stream':<16} {chunk_mb:>8} {workers:>7} {mb / seconds:>8.1f} {drive.requests:>8}")
+            drive.files.clear()
+
+if __name__ == '__main__':
+    main()
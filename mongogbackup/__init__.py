@@ -1,12 +1,25 @@
-__all__ = ('backups', 'files', 'gdrive', 'targz')
+from __future__ import annotations
 
-from mongogbackup import backups, files, gdrive, targz
+import os
+import importlib
+from functools import cached_property
+
+__all__ = ('aio', 'backups', 'dedup', 'files', 'gdrive', 'incremental', 'indexed', 'lowimpact', 'manifest', 'metrics', 'native', 'pipeline', 'retention', 'retry', 'scheduler', 'storage', 'targz')
+
+def __getattr__(name: str):
+    """Imports submodules on first use, so `from mongogbackup import targz` does not load the
+    MongoDB and Google client libraries."""
+    if name in __all__:
+        return importlib.import_module(f"{__name__}.{name}")
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 class MongoConfig:
     """Configuration for MongoDB connection"""
-    def __init__(self, db_name:str, host:str='localhost', port:int=27017, username:str=None, password:str=None, auth_db:str=None) -> None:
+    def __init__(self, db_name:str, host:str='localhost', port:int=27017, username:str=None, password:str=None, auth_db:str=None, engine:str='tools', low_impact:'lowimpact.LowImpactMode'=None) -> None:
         """"""
         self.db_name = db_name
+        self.engine = engine
+        self.low_impact = low_impact
         self.host = host
         self.port = port
         self.username = username
@@ -14,17 +27,306 @@ class MongoConfig:
         self.auth_db = auth_db
 
 class MongoGBackup:
-    """Main class for handling MongoDB backups on Google Drive"""
-    def __init__(self, mongoConfig:MongoConfig, credentials_file:str, parent_id:str, file_name:str, key:str) -> None:
-        self. backups = backups.MongoBackupHandler(
-            db_name=mongoConfig.db_name,
-            host=mongoConfig.host,
-            port=mongoConfig.port,
-            username=mongoConfig.username,
-            password=mongoConfig.password,
-            auth_db=mongoConfig.auth_db
+    """Main class for handling MongoDB backups on Google Drive
+
+    The MongoDB, Google Drive and encryption handlers are created on first use, so
+    constructing it does no I/O and a run only loads the libraries it needs. Configuration
+    errors (missing tools, bad credentials) are raised when the handler is first used.
+
+    Backups are stored in the Google Drive folder parent_id unless another storage backend
+    is given, e.g. storage.S3Storage, storage.LocalStorage, or storage.FanOutStorage to write
+    to several at once. Without Google Drive, credentials_file and parent_id may be None."""
+    def __init__(self, mongoConfig:MongoConfig, credentials_file:str, parent_id:str, file_name:str, key:str, storage:'storage.StorageBackend'=None) -> None:
+        self.mongoConfig = mongoConfig
+        self.credentials_file = credentials_file
+        self.parent_id = parent_id
+        self.file_name = file_name
+        self._key = key
+        if storage is not None:
+            self.storage = storage
+
+    @cached_property
+    def backups(self) -> backups.MongoBackupHandler:
+        from mongogbackup import backups
+        config = self.mongoConfig
+        return backups.MongoBackupHandler(
+            db_name=config.db_name,
+            host=config.host,
+            port=config.port,
+            username=config.username,
+            password=config.password,
+            auth_db=config.auth_db,
+            engine=config.engine,
+            low_impact=config.low_impact
         )
-        self.gdrive = gdrive.GoogleDriveHandler(credentials_file, parent_id, file_name)
-        self.hash = files.HashVerifier()
-        self.encrypt = files.FileEncryptor(generate_key=False, key=key)
-        self.targz = targz
\ No newline at end of file
+
+    @cached_property
+    def gdrive(self) -> gdrive.GoogleDriveHandler:
+        from mongogbackup import gdrive
+        return gdrive.GoogleDriveHandler(self.credentials_file, self.parent_id, self.file_name)
+
+    @cached_property
+    def storage(self) -> storage.StorageBackend:
+        from mongogbackup import storage
+        return storage.DriveStorage(self.gdrive, self.parent_id)
+
+    def _storage(self, parent_id:str=None) -> storage.StorageBackend:
+        """The configured storage, or the given Google Drive folder."""
+        if parent_id is None:
+            return self.storage
+        from mongogbackup import storage
+        return storage.DriveStorage(self.gdrive, parent_id)
+
+    @cached_property
+    def hash(self) -> files.HashVerifier:
+        from mongogbackup import files
+        return files.HashVerifier()
+
+    @cached_property
+    def encrypt(self) -> files.FileEncryptor:
+        from mongogbackup import files
+        return files.FileEncryptor(generate_key=False, key=self._key)
+
+    @cached_property
+    def targz(self):
+        from mongogbackup import targz
+        return targz
+
+    @cached_property
+    def dedup(self) -> dedup.DedupStore:
+        from mongogbackup import dedup
+        return dedup.DedupStore(self._storage(self.parent_id), self.encrypt, self.hash)
+
+    def stream_backup(self, file_name:str=None, parent_id:str=None, codec:str='gzip', level:int=None, workers:int=None, chunk_size:int=8 * 1024 * 1024, queue_size:int=8, rate_limit:pipeline.RateLimiter=None) -> dict:
+        """Dumps, compresses, encrypts and uploads the database in a single pass, without intermediate files.
+
+        mongodump --archive, compression, encryption and the resumable Drive upload all
+        run at the same time, connected by bounded queues, so scratch disk use is zero and
+        memory use is bounded by queue_size and chunk_size. The uploaded bytes are hashed on
+        the way; the checksum is available from self.hash.last_hash() afterwards.
+
+        Parameters:
+            file_name [type:String] -- Name of the uploaded file. Defaults to the handler's file_name.
+            parent_id [type:String] -- (Optional) Google Drive folder ID to use instead of the configured storage.
+            codec [type:String] -- Compression codec, 'gzip', 'zstd' or 'lz4'. Defaults to 'gzip'.
+            level [type:int] -- Compression level. Defaults to the codec's default.
+            workers [type:int] -- Number of compression threads. Defaults to the number of CPUs.
+            chunk_size [type:int] -- Upload chunk size, a multiple of 256Kb. Defaults to 8Mb.
+            queue_size [type:int] -- Maximum number of chunks buffered between two stages. Defaults to 8.
+            rate_limit [type:pipeline.RateLimiter] -- (Optional) Limits the upload bandwidth; may be shared between backups.
+
+        Returns:
+            dict -- The stored file (a Google Drive file resource with the default storage)."""
+        from mongogbackup import pipeline, targz
+        file_name = file_name if file_name is not None else self.file_name
+        target = self._storage(parent_id)
+        stages = [
+            ('compress', lambda chunks: targz.compress_stream(chunks, level, codec, workers)),
+            ('encrypt', self.encrypt.encrypt_stream),
+            ('hash', self.hash.stream),
+        ]
+        if rate_limit is not None:
+            stages.append(('throttle', rate_limit.throttle))
+        return pipeline.Pipeline(
+            source=self.backups.dump_stream(),
+            stages=stages,
+            sink=lambda chunks: target.upload_stream(chunks, file_name, chunk_size=chunk_size),
+            queue_size=queue_size,
+            name='backup',
+        ).run()
+
+    def dedup_backup(self, name:str) -> dict:
+        """Streams mongodump --archive into the deduplicated chunk store.
+
+        Only chunks that are not already stored are uploaded; the backup itself is a small
+        manifest named after `name`. See dedup.DedupStore.
+
+        Returns:
+            dict -- The backup manifest with upload statistics."""
+        # dump one collection at a time so unchanged collections produce identical chunks
+        return self.dedup.backup(self.backups.dump_stream(parallel_collections=1), name)
+
+    def fetch_backup(self, output_path:str, file_name:str=None, parent_id:str=None, chunk_size:int=8 * 1024 * 1024, workers:int=4) -> str:
+        """Downloads the latest backup with the given name and decrypts it while it streams in.
+
+        The file is fetched with parallel ranged reads and written decrypted to output_path,
+        ready for targz.unpack().
+
+        Parameters:
+            output_path [type:String] -- Path of the decrypted (still compressed) archive.
+            file_name [type:String] -- Name of the backup in the storage. Defaults to the handler's file_name.
+            parent_id [type:String] -- (Optional) Google Drive folder ID to use instead of the configured storage.
+            chunk_size [type:int] -- Bytes per ranged request. Defaults to 8Mb.
+            workers [type:int] -- Number of concurrent ranged requests. Defaults to 4."""
+        file_name = file_name if file_name is not None else self.file_name
+        target = self._storage(parent_id)
+        remote = target.find_latest(file_name)
+        with open(output_path, 'wb') as output:
+            for data in self.encrypt.decrypt_stream(target.download_stream(remote['id'], chunk_size, workers)):
+                output.write(data)
+        print(f"Backup fetched and decrypted to: {output_path}")
+        return output_path
+
+    def archive_backup(self, dir:str, file_name:str=None, parent_id:str=None, codec:str='gzip', level:int=None, workers:int=None) -> manifest.BackupManifest:
+        """Dumps the database, builds an encrypted archive with a signed manifest and uploads both.
+
+        The manifest is uploaded next to the archive as <file_name>.manifest.json; see
+        manifest.BackupManifest and verify_backup().
+
+        Parameters:
+            dir [type:String] -- Scratch directory for the dump and the archive.
+            file_name [type:String] -- Name of the uploaded archive. Defaults to the handler's file_name.
+            parent_id [type:String] -- (Optional) Google Drive folder ID to use instead of the configured storage.
+            codec, level, workers -- Compression settings (see targz.pack()).
+
+        Returns:
+            BackupManifest -- The signed manifest of the uploaded archive."""
+        from mongogbackup import manifest, storage
+        file_name = file_name if file_name is not None else self.file_name
+        target = self._storage(parent_id)
+        dump_dir = os.path.dirname(self.backups.backup_parallel(dir, workers=workers))
+        archive_path = os.path.join(dir, file_name)
+        backup_manifest = manifest.create_archive(dump_dir, archive_path, self.encrypt, self.backups.db_name, codec, level, workers)
+        uploaded = target.upload_file(archive_path, file_name)
+        if 'md5Checksum' in uploaded and not backup_manifest.verify_remote(uploaded)['ok']:
+            raise storage.StorageError(target.name, f"the uploaded file {file_name} does not match its manifest")
+        target.upload_bytes(backup_manifest.to_bytes(), file_name + manifest.BackupManifest.SUFFIX)
+        return backup_manifest
+
+    def load_manifest(self, file_name:str=None, parent_id:str=None) -> manifest.BackupManifest:
+        """Downloads the manifest of the latest backup with the given name and checks its signature."""
+        from mongogbackup import manifest
+        file_name = file_name if file_name is not None else self.file_name
+        target = self._storage(parent_id)
+        remote = target.find_latest(file_name + manifest.BackupManifest.SUFFIX)
+        return manifest.BackupManifest.from_bytes(target.download_bytes(remote['id']), self.encrypt)
+
+    def verify_backup(self, file_name:str=None, parent_id:str=None) -> dict:
+        """Verifies the latest backup with the given name against its signed manifest without downloading it.
+
+        Returns:
+            dict -- {"ok": bool, "size": bool, "md5": bool}"""
+        file_name = file_name if file_name is not None else self.file_name
+        target = self._storage(parent_id)
+        backup_manifest = self.load_manifest(file_name, parent_id)
+        return backup_manifest.verify_remote(target.find_latest(file_name))
+
+    def prune(self, policy:retention.RetentionPolicy, file_name:str=None, parent_id:str=None, db:str=None, dry_run:bool=False,
+              cache_path:str=None, batch_size:int=100) -> retention.RetentionPlan:
+        """Deletes the backups with the given name that the retention policy does not keep.
+
+        Only backups with a manifest signed with this handler's key are considered, so other
+        files in the storage are left alone. The plan is printed before anything is deleted.
+
+        Parameters:
+            policy -- Which backups to keep, e.g. retention.RetentionPolicy(daily=7, weekly=4, monthly=12).
+            file_name -- (Optional) Name of the backups. Defaults to the handler's file_name.
+            parent_id -- (Optional) Google Drive folder to prune instead of the configured storage.
+            db -- (Optional) Only prune backups of this database.
+            dry_run [type:bool] -- Only print what would be deleted. Defaults to False.
+            cache_path [type:String] -- (Optional) JSON file keeping manifest metadata between runs.
+            batch_size [type:int] -- Files deleted per storage call. Defaults to 100.
+
+        Returns:
+            RetentionPlan -- The backups kept and deleted."""
+        from mongogbackup import retention
+        file_name = file_name if file_name is not None else self.file_name
+        pruner = retention.Retention(self._storage(parent_id), policy, names=[file_name], db=db, encryptor=self.encrypt, cache_path=cache_path)
+        return pruner.prune(dry_run=dry_run, batch_size=batch_size)
+
+    def indexed_backup(self, dir:str, file_name:str=None, parent_id:str=None, collections:list=None, codec:str='gzip', level:int=None, workers:int=None) -> manifest.BackupManifest:
+        """Dumps the database into an indexed archive, one independently readable segment per collection, and uploads it with its signed manifest.
+
+        Collections can then be restored one by one with restore_collections(), which only
+        downloads their segments.
+
+        Parameters:
+            dir [type:String] -- Scratch directory for the archive.
+            file_name [type:String] -- Name of the uploaded archive. Defaults to the handler's file_name.
+            parent_id [type:String] -- (Optional) Google Drive folder ID to use instead of the configured storage.
+            collections [type:list] -- (Optional) Only archive these collections.
+            codec, level, workers -- Compression settings (see targz.compress_stream()).
+
+        Returns:
+            BackupManifest -- The signed manifest of the uploaded archive."""
+        from mongogbackup import indexed, manifest
+        file_name = file_name if file_name is not None else self.file_name
+        target = self._storage(parent_id)
+        archive_path = os.path.join(dir, file_name)
+        backup_manifest = indexed.write_archive(self.backups, self.encrypt, archive_path, collections, codec, level, workers)
+        target.upload_file(archive_path, file_name)
+        target.upload_bytes(backup_manifest.to_bytes(), file_name + manifest.BackupManifest.SUFFIX)
+        return backup_manifest
+
+    def restore_collections(self, collections:list=None, ns_filter:str=None, file_name:str=None, parent_id:str=None, local_path:str=None, drop:bool=False, workers:int=1) -> list:
+        """Restores individual collections from an indexed archive, fetching only the byte ranges they need.
+
+        Parameters:
+            collections [type:list] -- (Optional) Names of the collections to restore.
+            ns_filter [type:String] -- (Optional) Glob on "<db>.<collection>", e.g. "shop.orders_*".
+                Without collections or ns_filter, every collection is restored.
+            file_name [type:String] -- Name of the archive in the storage. Defaults to the handler's file_name.
+            parent_id [type:String] -- (Optional) Google Drive folder ID to use instead of the configured storage.
+            local_path [type:String] -- (Optional) Read a local copy of the archive instead of the storage.
+            drop [type:bool] -- Drop each collection before restoring it. Defaults to False.
+            workers [type:int] -- Number of collections restored at the same time. Defaults to 1.
+
+        Returns:
+            list -- Names of the restored collections."""
+        from mongogbackup import indexed
+        if local_path is not None:
+            archive = indexed.LocalArchive(local_path)
+        else:
+            file_name = file_name if file_name is not None else self.file_name
+            target = self._storage(parent_id)
+            archive = indexed.StorageArchive(target, target.find_latest(file_name))
+        return indexed.restore(self.backups, self.encrypt, archive, collections, ns_filter, drop, workers)
+
+    def stream_restore(self, file_name:str=None, parent_id:str=None, local_path:str=None, drop:bool=False, chunk_size:int=8 * 1024 * 1024,
+                       workers:int=4, queue_size:int=8, progress:pipeline.ProgressMeter=None) -> dict:
+        """Restores a backup written by stream_backup() without intermediate files.
+
+        Download (parallel ranged reads), decryption, decompression and mongorestore --archive
+        all run at the same time, connected by bounded queues, so documents start arriving in
+        the database as soon as the first chunk is downloaded.
+
+        Parameters:
+            file_name [type:String] -- Name of the backup in the storage. Defaults to the handler's file_name.
+            parent_id [type:String] -- (Optional) Google Drive folder ID to use instead of the configured storage.
+            local_path [type:String] -- (Optional) Restore from a local copy instead of the storage.
+            drop [type:bool] -- Drop each collection before restoring it. Defaults to False.
+            chunk_size [type:int] -- Bytes per ranged request or local read. Defaults to 8Mb.
+            workers [type:int] -- Number of concurrent ranged requests. Defaults to 4.
+            queue_size [type:int] -- Maximum number of chunks buffered between two stages. Defaults to 8.
+            progress [type:pipeline.ProgressMeter] -- (Optional) Receives progress; defaults to printing a line every second.
+
+        Returns:
+            dict -- The final progress snapshot: bytes, throughput and time to first byte per stage."""
+        from mongogbackup import pipeline, targz
+        if local_path is not None:
+            total = os.path.getsize(local_path)
+            def read_local():
+                with open(local_path, 'rb') as f:
+                    yield from iter(lambda: f.read(chunk_size), b'')
+            source = read_local()
+        else:
+            file_name = file_name if file_name is not None else self.file_name
+            target = self._storage(parent_id)
+            remote = target.find_latest(file_name)
+            total = int(remote['size']) if 'size' in remote else None
+            source = target.download_stream(remote['id'], chunk_size, workers)
+        meter = progress if progress is not None else pipeline.ProgressMeter('Restore', total)
+        if meter.total is None:
+            meter.total = total
+        pipeline.Pipeline(
+            source=meter.count('downloaded', source),
+            stages=[
+                ('decrypt', self.encrypt.decrypt_stream),
+                ('decompress', targz.decompress_stream),
+                ('progress', lambda chunks: meter.count('restored', chunks)),
+            ],
+            sink=lambda chunks: self.backups.restore_stream(chunks, drop=drop),
+            queue_size=queue_size,
+            name='restore',
+        ).run()
+        return meter.finish()
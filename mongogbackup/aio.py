@@ -0,0 +1,286 @@
+import asyncio
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import AsyncIterable, AsyncIterator, Callable, Iterable, Iterator, List, Optional
+
+from mongogbackup import targz
+from mongogbackup.backups import UnexpectedError
+
+_END = object()
+
+class _Failure:
+    """Carries an exception from one side of a stage to the other."""
+    def __init__(self, error: BaseException) -> None:
+        self.error = error
+
+class _Aborted(Exception):
+    """Raised inside a worker thread when the consuming coroutine has gone away."""
+
+async def _to_thread(function: Callable, *args):
+    """Runs a blocking function in its own thread and awaits its result.
+
+    A dedicated thread is used rather than a pool, because pipeline stages block for the
+    whole transfer and could otherwise exhaust a shared executor when many backups run."""
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+
+    def resolve(result, error) -> None:
+        if future.cancelled():
+            return
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    def run() -> None:
+        try:
+            result = function(*args)
+        except BaseException as e:
+            loop.call_soon_threadsafe(resolve, None, e)
+        else:
+            loop.call_soon_threadsafe(resolve, result, None)
+
+    threading.Thread(target=run, daemon=True).start()
+    return await future
+
+class _AsyncToSync:
+    """Feeds an async iterator into a bounded queue read as a blocking iterator by a worker thread."""
+
+    def __init__(self, source: Optional[AsyncIterable[bytes]], loop: asyncio.AbstractEventLoop, maxsize: int) -> None:
+        self._source = source
+        self._loop = loop
+        self._queue = asyncio.Queue(maxsize)
+
+    async def feed(self) -> None:
+        try:
+            if self._source is not None:
+                async for chunk in self._source:
+                    await self._queue.put(chunk)
+            await self._queue.put(_END)
+        except asyncio.CancelledError:
+            raise
+        except BaseException as e:
+            await self._queue.put(_Failure(e))
+        finally:
+            close = getattr(self._source, 'aclose', None)
+            if close is not None:
+                await close()
+
+    def __iter__(self) -> Iterator[bytes]:
+        while True:
+            item = asyncio.run_coroutine_threadsafe(self._queue.get(), self._loop).result()
+            if item is _END:
+                return
+            if isinstance(item, _Failure):
+                raise item.error
+            yield item
+
+    def abort(self) -> None:
+        """Wakes the worker thread with an error; must be called from the event loop."""
+        while not self._queue.empty():
+            self._queue.get_nowait()
+        self._queue.put_nowait(_Failure(_Aborted()))
+
+async def _in_thread(transform: Callable[[Iterable[bytes]], Iterable[bytes]], source: Optional[AsyncIterable[bytes]], maxsize: int = 8) -> AsyncIterator[bytes]:
+    """Runs a synchronous streaming stage (iterator in, iterator out) in a worker thread.
+
+    Input and output are connected to the event loop through bounded queues, so the
+    existing compression, encryption and transfer code is reused without blocking the loop."""
+    loop = asyncio.get_running_loop()
+    inbox = _AsyncToSync(source, loop, maxsize)
+    outbox = asyncio.Queue(maxsize)
+    stop = threading.Event()
+
+    def work() -> None:
+        try:
+            for data in transform(iter(inbox)):
+                if stop.is_set():
+                    return
+                asyncio.run_coroutine_threadsafe(outbox.put(data), loop).result()
+            item = _END
+        except BaseException as e:
+            item = _Failure(e)
+        if not stop.is_set():
+            asyncio.run_coroutine_threadsafe(outbox.put(item), loop).result()
+
+    feeder = asyncio.ensure_future(inbox.feed())
+    threading.Thread(target=work, daemon=True).start()
+    try:
+        while True:
+            item = await outbox.get()
+            if item is _END:
+                break
+            if isinstance(item, _Failure):
+                raise item.error
+            yield item
+        await feeder
+    finally:
+        stop.set()
+        if not feeder.done():
+            feeder.cancel()
+        inbox.abort()
+        while not outbox.empty():
+            outbox.get_nowait()
+        # the feeder closes the upstream stages on its way out
+        await asyncio.gather(feeder, return_exceptions=True)
+
+async def _sink_in_thread(function: Callable[[Iterable[bytes]], object], source: AsyncIterable[bytes], maxsize: int = 8):
+    """Runs a synchronous consumer of a byte stream in a worker thread and returns its result."""
+    inbox = _AsyncToSync(source, asyncio.get_running_loop(), maxsize)
+    feeder = asyncio.ensure_future(inbox.feed())
+    try:
+        result = await _to_thread(function, iter(inbox))
+        await feeder
+        return result
+    finally:
+        if not feeder.done():
+            feeder.cancel()
+            inbox.abort()
+
+class AsyncMongoGBackup:
+    """asyncio interface to a MongoGBackup.
+
+    mongodump and mongorestore run as asyncio subprocesses, compression, encryption and
+    Drive transfers run in worker threads connected by bounded queues, so many backups can
+    share one event loop. Use backup_many() to back up several databases at once."""
+
+    def __init__(self, backup, executor: ThreadPoolExecutor = None, queue_size: int = 8) -> None:
+        """Parameters:
+            backup [type:MongoGBackup] -- The synchronous handler whose configuration is used.
+            executor -- (Optional) Executor for one-off blocking calls. Defaults to the loop's default executor.
+            queue_size [type:int] -- Maximum number of chunks buffered between two stages. Defaults to 8."""
+        self.backup_handler = backup
+        self.executor = executor
+        self.queue_size = queue_size
+
+    async def _run(self, function: Callable, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, functools.partial(function, *args, **kwargs))
+
+    async def dump_stream(self, buf_size: int = 1 << 20, parallel_collections: int = None) -> AsyncIterator[bytes]:
+        """Runs mongodump --archive as an asyncio subprocess and yields its output.
+
+        In low-impact mode, the source member is selected in a worker thread and the output
+        is throttled with asyncio.sleep(), so the event loop is never blocked."""
+        backups = self.backup_handler.backups
+        # selecting a low-impact source member queries the server
+        command = await _to_thread(backups._archive_command, 'mongodump')
+        if parallel_collections:
+            command.extend(['--numParallelCollections', str(parallel_collections)])
+        throttle = await _to_thread(backups.throttle().__enter__)
+        process = await asyncio.create_subprocess_exec(*command, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+        stderr = asyncio.ensure_future(process.stderr.read())
+        try:
+            while True:
+                data = await process.stdout.read(buf_size)
+                if not data:
+                    break
+                if throttle is not None:
+                    await asyncio.sleep(throttle.reserve(len(data)))
+                yield data
+            await process.wait()
+        finally:
+            if process.returncode is None:
+                process.kill()
+                await process.wait()
+            if throttle is not None:
+                await _to_thread(throttle.__exit__, None, None, None)
+        errors = await stderr
+        if process.returncode != 0:
+            raise UnexpectedError(errors.decode(errors='replace'))
+
+    async def restore_stream(self, chunks: AsyncIterable[bytes], drop: bool = False) -> None:
+        """Feeds a mongodump archive stream into mongorestore --archive as an asyncio subprocess."""
+        command = self.backup_handler.backups._restore_archive_command(drop)
+        process = await asyncio.create_subprocess_exec(*command, stdin=asyncio.subprocess.PIPE,
+                                                       stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE)
+        stderr = asyncio.ensure_future(process.stderr.read())
+        try:
+            async for chunk in chunks:
+                process.stdin.write(chunk)
+                await process.stdin.drain()
+            process.stdin.close()
+            await process.wait()
+        finally:
+            if process.returncode is None:
+                process.kill()
+                await process.wait()
+        errors = await stderr
+        if process.returncode != 0:
+            raise UnexpectedError(errors.decode(errors='replace'))
+
+    async def backup(self, file_name: str = None, parent_id: str = None, codec: str = 'gzip', level: int = None,
+                     workers: int = None, chunk_size: int = 8 * 1024 * 1024) -> dict:
+        """Async counterpart of MongoGBackup.stream_backup(): dump, compress, encrypt and upload concurrently.
+
+        The uploaded bytes are hashed on the way; the checksum is available from the handler's hash.last_hash() afterwards."""
+        handler = self.backup_handler
+        file_name = file_name if file_name is not None else handler.file_name
+        target = handler._storage(parent_id)
+        compressed = _in_thread(lambda chunks: targz.compress_stream(chunks, level, codec, workers), self.dump_stream(), self.queue_size)
+        encrypted = _in_thread(handler.encrypt.encrypt_stream, compressed, self.queue_size)
+        hashed = _in_thread(handler.hash.stream, encrypted, self.queue_size)
+        return await _sink_in_thread(
+            lambda chunks: target.upload_stream(chunks, file_name, chunk_size=chunk_size),
+            hashed, self.queue_size)
+
+    async def restore(self, file_name: str = None, parent_id: str = None, chunk_size: int = 8 * 1024 * 1024,
+                      workers: int = 4, drop: bool = False) -> None:
+        """Downloads, decrypts and decompresses the latest backup with the given name straight into mongorestore."""
+        handler = self.backup_handler
+        file_name = file_name if file_name is not None else handler.file_name
+        target = handler._storage(parent_id)
+        remote = await self._run(target.find_latest, file_name)
+        downloaded = _in_thread(lambda _: target.download_stream(remote['id'], chunk_size, workers), None, self.queue_size)
+        decrypted = _in_thread(handler.encrypt.decrypt_stream, downloaded, self.queue_size)
+        decompressed = _in_thread(targz.decompress_stream, decrypted, self.queue_size)
+        try:
+            await self.restore_stream(decompressed, drop=drop)
+        finally:
+            # stop the worker threads now if mongorestore gave up before the end of the stream
+            for stage in (decompressed, decrypted, downloaded):
+                await stage.aclose()
+
+    async def pack(self, source_path: str, output_path: str, **options) -> str:
+        """targz.pack() on an executor."""
+        return await self._run(targz.pack, source_path, output_path, **options)
+
+    async def unpack(self, source_path: str, output_path: str) -> str:
+        """targz.unpack() on an executor."""
+        return await self._run(targz.unpack, source_path, output_path)
+
+    async def encrypt_file(self, source_file_path: str, encrypted_file_path: str) -> str:
+        """FileEncryptor.encrypt_file() on an executor."""
+        return await self._run(self.backup_handler.encrypt.encrypt_file, source_file_path, encrypted_file_path)
+
+    async def decrypt_file(self, encrypted_file_path: str, decrypted_file_path: str) -> str:
+        """FileEncryptor.decrypt_file() on an executor."""
+        return await self._run(self.backup_handler.encrypt.decrypt_file, encrypted_file_path, decrypted_file_path)
+
+    async def upload_file(self, file_path: str, parent_id: str = None, **options) -> dict:
+        """GoogleDriveHandler.upload_file() on an executor."""
+        parent_id = parent_id if parent_id is not None else self.backup_handler.gdrive.parent_id
+        return await self._run(self.backup_handler.gdrive.upload_file, file_path, parent_id, **options)
+
+    async def download_file(self, file_id: str, destination: str, **options) -> str:
+        """GoogleDriveHandler.download_file() on an executor."""
+        return await self._run(self.backup_handler.gdrive.download_file, file_id, destination, **options)
+
+async def backup_many(backups: Iterable, max_concurrency: int = 8, **options) -> List:
+    """Backs up many databases concurrently, at most max_concurrency at a time.
+
+    Parameters:
+        backups -- MongoGBackup handlers, one per database. Each uploads under its own file_name.
+        max_concurrency -- Global limit on backups running at the same time.
+        options -- Passed to AsyncMongoGBackup.backup().
+
+    Returns:
+        list -- One result per handler, in order: the uploaded file resource, or the exception raised."""
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def run(backup):
+        async with semaphore:
+            return await AsyncMongoGBackup(backup).backup(**options)
+
+    return await asyncio.gather(*(run(backup) for backup in backups), return_exceptions=True)
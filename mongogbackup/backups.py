@@ -1,7 +1,12 @@
-import subprocess, os, sys
+import subprocess, os, sys, shutil, tempfile, json, time, datetime, contextlib, threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, Iterator, List, Optional
 from pymongo import MongoClient
 from pymongo.errors import OperationFailure, ConnectionFailure
 
+from mongogbackup.metrics import logger, redact_command, registry
+from mongogbackup.native import NativeEngine
+
 class MongoCommandUnavailableError(Exception):
     """Raised when the required MongoDB command is not available."""
     def __init__(self, command:str):
@@ -37,6 +42,54 @@ class UnexpectedError(Exception):
     def __str__(self):
         return f"An unexpected error occured. Refer to: {self.error}"
 
+_clients: Dict[tuple, MongoClient] = {}
+_clients_lock = threading.Lock()
+
+_tool_versions: Dict[tuple, str] = {}
+_TOOL_CACHE = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache'), 'mongogbackup', 'tools.json')
+
+def tool_version(binary:str) -> Optional[str]:
+    """Returns the first line of `<binary> --version`, or None if the tool is not installed or fails to run.
+
+    A successful probe is cached in memory and in ~/.cache/mongogbackup/tools.json, keyed by
+    the binary's path, size and modification time, so the tool only runs again after it
+    changes. A failed probe is not cached and is tried again on the next call."""
+    path = shutil.which(binary)
+    if path is None:
+        return None
+    stat = os.stat(path)
+    key = (path, stat.st_size, stat.st_mtime_ns)
+    if key in _tool_versions:
+        return _tool_versions[key]
+    cache_key = ':'.join(map(str, key))
+    try:
+        with open(_TOOL_CACHE) as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        cache = {}
+    version = cache.get(cache_key)
+    if version is None:
+        result = subprocess.run([path, '--version'], capture_output=True, text=True)
+        if result.returncode != 0:
+            return None
+        version = (result.stdout.splitlines() or [binary])[0]
+        cache[cache_key] = version
+        try:
+            os.makedirs(os.path.dirname(_TOOL_CACHE), exist_ok=True)
+            # a unique temporary file, so processes probing at the same time do not write into each other's
+            handle, temp_path = tempfile.mkstemp(prefix='.tools-', suffix='.tmp', dir=os.path.dirname(_TOOL_CACHE))
+            try:
+                with os.fdopen(handle, 'w') as f:
+                    json.dump(cache, f)
+                os.replace(temp_path, _TOOL_CACHE)
+            except BaseException:
+                os.remove(temp_path)
+                raise
+        except OSError:
+            pass  # read-only home, e.g. serverless; the in-memory cache still applies
+    _tool_versions[key] = version
+    return version
+
 class MongoBackupHandler:
     """Handles backup and restore operations for MongoDB databases."""
 
@@ -47,7 +100,9 @@ class MongoBackupHandler:
         port:int=27017,
         username:str=None,
         password:str=None, 
-        auth_db:str='Admin'
+        auth_db:str='Admin',
+        engine:str='tools',
+        low_impact=None
         ):
         """Initializes the MongoBackupHandler object with database details and 
         checks if mongodump and mongorestore are installed and added to PATH.
@@ -58,12 +113,18 @@ class MongoBackupHandler:
             port [type:int] -- MongoDb port number. Defaults to 27017. 
             username [type:String] -- (Optional) MongoDb username for user authentication.
             password [type:String] -- (Optional but required if username is mentioned) MongoDb password for user authentication.
-            auth_db [type:String] -- (Optional but required if username is mentioned) MongoDB database to authenticate the user details."""
-            
-        mongodump_available = self.check_mongodump()
-        mongorestore_available = self.check_mongoerstore()
-        if not  mongodump_available or not mongorestore_available:      
-            raise MongoCommandUnavailableError("mongodump" if not mongodump_available else "mongorestore")
+            auth_db [type:String] -- (Optional but required if username is mentioned) MongoDB database to authenticate the user details.
+            engine [type:String] -- 'tools' runs mongodump/mongorestore; 'native' dumps and restores with PyMongo
+                                    (see native.NativeEngine) and does not need the tools. Defaults to 'tools'.
+            low_impact [type:lowimpact.LowImpactMode] -- (Optional) Dump from a secondary at a limited, load-adaptive rate."""
+        if engine not in ('tools', 'native'):
+            raise ValueError("engine must be 'tools' or 'native'")
+        self.engine = engine
+        if engine == 'tools':
+            mongodump_available = self.check_mongodump()
+            mongorestore_available = self.check_mongoerstore()
+            if not  mongodump_available or not mongorestore_available:      
+                raise MongoCommandUnavailableError("mongodump" if not mongodump_available else "mongorestore")
 
         self.db_name=db_name
         self.host=host
@@ -74,53 +135,29 @@ class MongoBackupHandler:
         self.password=password
         self.auth_db=auth_db
         
+        self.low_impact = low_impact
+        self.native = NativeEngine(self)
         self.check_connection()
     
     def check_mongodump(self) -> bool:
         """Check mongodump command availability"""
-        command =[ 'mongodump', '--version']
-        result= subprocess.run(command, capture_output=True, text=True)
-        if result.returncode != 0:  
-            return False
-        return True
+        return tool_version('mongodump') is not None
         
     def check_mongoerstore(self) -> bool:
         """Check mongorestore command availability"""
-        command =[ 'mongorestore', '--version']
-        result= subprocess.run(command, capture_output=True, text=True)
-        if result.returncode != 0:  
-            return False
-        return True  
+        return tool_version('mongorestore') is not None
 
     def check_connection(self) -> None:
         """Checks if the connection to the database is succesful or not. Also checks if the password provided is correct or not."""
         if self.username is not None and self.password is None:
             raise MongoAdminError(3)
-        
-        if self.username is None and self.password is None:
-            try:
-                client = MongoClient(host=self.host, port=self.port)
-                list = client.admin.command('listDatabases')
-            except ConnectionFailure:
-                raise MongoConnectionError()
-            except OperationFailure:
-                raise MongoAdminError(1)
-            finally:
-                client.close()
-        
-        else:
-            try:
-                client= MongoClient(host=self.host, port=self.port,
-                                    username=self.username,
-                                    password=self.password,
-                                    authSource=self.auth_db)
-                client.admin.command('listDatabases')
-            except ConnectionFailure:
-                raise MongoConnectionError()
-            except OperationFailure:
-                raise MongoAdminError(2)
-            finally:
-                client.close()
+        try:
+            # the pooled client stays connected for the operations that follow
+            self._client().admin.command('listDatabases', nameOnly=True)
+        except ConnectionFailure:
+            raise MongoConnectionError()
+        except OperationFailure:
+            raise MongoAdminError(1 if self.username is None and self.password is None else 2)
 
     def check_directory(self, dir:str) -> bool:
         """Checks if the specified directory exists or not."""
@@ -128,44 +165,57 @@ class MongoBackupHandler:
             return False
         return True
 
-    def backup(self, dir:str) -> None:
-        """Executes mongodump and saves backup files to the specified directory(dir)."""
+    def backup(self, dir:str, parallel_collections:int=None) -> None:
+        """Executes mongodump and saves backup files to the specified directory(dir).
+
+        Parameters:
+            dir [type:String] -- Output directory.
+            parallel_collections [type:int] -- (Optional) Number of collections mongodump dumps in parallel (--numParallelCollections)."""
         
         formatted_dir = dir.replace("\\", "/")
         check_dir= self.check_directory(formatted_dir)
         if not check_dir:
             raise DirectoryNotFoundError(dir)
 
-        command = [
-            'mongodump', 
-            '--host', self.host, 
-            '--port', str(self.port), 
-            '--db', self.db_name, 
-            '--out', formatted_dir
-            ]
+        if self.engine == 'native':
+            self.native.dump(formatted_dir, workers=parallel_collections)
+            print(f"Backup successful; added to: {formatted_dir}")
+            return
 
-        if self.username and self.password :
-            command.extend([
-                '--username', self.username, 
-                '--password', self.password, 
-                '--authenticationDatabase', self.auth_db
-                ])
+        command = self._base_command('mongodump') + ['--out', formatted_dir]
+        if self.low_impact is not None and not parallel_collections:
+            # a directory dump cannot be throttled; read one collection at a time instead
+            parallel_collections = 1
+        if parallel_collections:
+            command.extend(['--numParallelCollections', str(parallel_collections)])
 
-        print("Executing command:", " ".join(command))  #for testing purposes
-        result=subprocess.run(command, capture_output=True,text=True)
+        logger.debug("Executing command: %s", redact_command(command))
+        with registry.timed('mongodump') as stats:
+            result=subprocess.run(command, capture_output=True,text=True)
+            stats.bytes_out = self._directory_size(os.path.join(formatted_dir, self.db_name))
         if result.returncode == 0:
             print(f"Backup successful; added to: {formatted_dir}")
             return
         raise UnexpectedError(result.stderr)
         
 
-    def restore(self,bck_dir:str) -> None:
-        """Executes mongorestore and loads backupfiles from the specified directory(bck_dir)."""
+    def restore(self,bck_dir:str, parallel_collections:int=None, insertion_workers:int=None) -> None:
+        """Executes mongorestore and loads backupfiles from the specified directory(bck_dir).
+
+        Parameters:
+            bck_dir [type:String] -- Directory containing the dumped collection files.
+            parallel_collections [type:int] -- (Optional) Number of collections restored in parallel (--numParallelCollections).
+            insertion_workers [type:int] -- (Optional) Insertion workers per collection (--numInsertionWorkersPerCollection)."""
         
         formatted_bck_dir = bck_dir.replace("\\", "/")
         check_dir= self.check_directory(formatted_bck_dir)
         if not check_dir:
             raise DirectoryNotFoundError(dir)
+
+        if self.engine == 'native':
+            self.native.restore(formatted_bck_dir, self._restore_targets(formatted_bck_dir), parallel_collections, insertion_workers)
+            print(f"Restore succesful; restored from: {bck_dir}")
+            return
         
         command= [
             'mongorestore', 
@@ -174,6 +224,10 @@ class MongoBackupHandler:
             '--db', self.db_name, 
             formatted_bck_dir
             ]
+        if parallel_collections:
+            command.extend(['--numParallelCollections', str(parallel_collections)])
+        if insertion_workers:
+            command.extend(['--numInsertionWorkersPerCollection', str(insertion_workers)])
         
         if self.username and self.password:
             command.extend([
@@ -182,11 +236,315 @@ class MongoBackupHandler:
                 '--authenticationDatabase', self.auth_db
                 ])
         
-        print("Executing command:", " ".join(command))  #for testing purposes
-        result= subprocess.run(command, capture_output= True, text=True)
+        logger.debug("Executing command: %s", redact_command(command))
+        with registry.timed('mongorestore') as stats:
+            stats.bytes_in = self._directory_size(formatted_bck_dir)
+            result= subprocess.run(command, capture_output= True, text=True)
         
         if result.returncode == 0:
             print(f"Restore succesful; restored from: {bck_dir}")
             return 
         raise UnexpectedError(result.stderr)
-    
\ No newline at end of file
+
+    @staticmethod
+    def _directory_size(path:str) -> int:
+        return sum(os.path.getsize(os.path.join(root, file)) for root, _, files in os.walk(path) for file in files)
+
+    def _base_command(self, binary:str, with_db:bool=True) -> List[str]:
+        """Builds a mongodump/mongorestore command with the connection and authentication options."""
+        if self.engine == 'native' and shutil.which(binary) is None:
+            # archive streams need the tools even with the native engine
+            raise MongoCommandUnavailableError(binary)
+        host, port = self.dump_source() if binary == 'mongodump' and self.low_impact is not None else (self.host, self.port)
+        command = [
+            binary,
+            '--host', host,
+            '--port', str(port),
+            ]
+        if with_db:
+            command.extend(['--db', self.db_name])
+        if self.username and self.password:
+            command.extend([
+                '--username', self.username,
+                '--password', self.password,
+                '--authenticationDatabase', self.auth_db
+                ])
+        if binary == 'mongodump' and self.low_impact is not None:
+            command.extend(['--readPreference', self.low_impact.read_preference_argument()])
+        return command
+
+    def _archive_command(self, binary:str) -> List[str]:
+        """Builds a mongodump/mongorestore command that reads or writes an archive on stdin/stdout."""
+        return self._base_command(binary) + ['--archive']
+
+    def dump_stream(self, buf_size:int=1 << 20, parallel_collections:int=None, collection:str=None) -> Iterator[bytes]:
+        """Executes mongodump --archive and yields the archive in chunks as it is written to stdout.
+
+        Nothing is written to disk. Closing the generator early terminates mongodump.
+
+        Parameters:
+            buf_size [type:int] -- Size of the chunks read from mongodump's stdout. Defaults to 1MB.
+            parallel_collections [type:int] -- (Optional) Collections dumped in parallel. Use 1 to keep
+                each collection contiguous in the archive (needed for deduplication).
+            collection [type:String] -- (Optional) Only dump this collection."""
+        command = self._archive_command('mongodump')
+        if parallel_collections:
+            command.extend(['--numParallelCollections', str(parallel_collections)])
+        if collection is not None:
+            command.extend(['--collection', collection])
+        with tempfile.TemporaryFile() as stderr, self.throttle() as throttle:
+            process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=stderr)
+            try:
+                while True:
+                    data = process.stdout.read(buf_size)
+                    if not data:
+                        break
+                    if throttle is not None:
+                        # mongodump blocks on the full pipe, so this slows its reads as well
+                        throttle.acquire(len(data))
+                    yield data
+                process.wait()
+            finally:
+                if process.poll() is None:
+                    process.kill()
+                    process.wait()
+                process.stdout.close()
+            if process.returncode != 0:
+                stderr.seek(0)
+                raise UnexpectedError(stderr.read().decode(errors='replace'))
+
+    def _restore_archive_command(self, drop:bool=False) -> List[str]:
+        """Builds a mongorestore command reading an archive of this database from stdin."""
+        # --db is deprecated with --archive; select the namespaces instead
+        command = self._base_command('mongorestore', with_db=False) + ['--archive', '--nsInclude', f"{self.db_name}.*"]
+        if drop:
+            command.append('--drop')
+        return command
+
+    def restore_stream(self, chunks:Iterable[bytes], drop:bool=False) -> None:
+        """Executes mongorestore --archive and writes a mongodump archive stream to its stdin.
+
+        Nothing is written to disk. If the stream raises, mongorestore is terminated and the
+        error is re-raised.
+
+        Parameters:
+            chunks [type:Iterable] -- The archive, as produced by dump_stream().
+            drop [type:bool] -- Drop each collection before restoring it. Defaults to False."""
+        with tempfile.TemporaryFile() as stderr:
+            process = subprocess.Popen(self._restore_archive_command(drop), stdin=subprocess.PIPE,
+                                       stdout=subprocess.DEVNULL, stderr=stderr)
+            try:
+                for chunk in chunks:
+                    process.stdin.write(chunk)
+                process.stdin.close()
+                process.wait()
+            except BrokenPipeError:
+                # mongorestore exited early; its exit code and stderr explain why
+                process.wait()
+            finally:
+                if process.poll() is None:
+                    process.kill()
+                    process.wait()
+            if process.returncode != 0:
+                stderr.seek(0)
+                raise UnexpectedError(stderr.read().decode(errors='replace'))
+        print(f"Restore succesful; restored {self.db_name} from archive stream")
+
+    def _client(self, **options) -> MongoClient:
+        """Returns the shared MongoClient for the handler's connection, authentication and read preference settings.
+
+        Clients are pooled per process and settings, so every operation and handler with the
+        same settings reuses one connection pool. Do not close the returned client.
+        Keyword arguments are passed to MongoClient and override the settings, e.g. host,
+        port and directConnection=True to talk to a single member."""
+        settings = {'host': self.host, 'port': self.port}
+        if self.username is not None or self.password is not None:
+            settings.update(username=self.username, password=self.password, authSource=self.auth_db)
+        if self.low_impact is not None:
+            settings.update(self.low_impact.client_options())
+        settings.update(options)
+        # a MongoClient must not be used across fork(), so the pool is per process
+        key = (os.getpid(), json.dumps(settings, sort_keys=True, default=str))
+        with _clients_lock:
+            client = _clients.get(key)
+            if client is None:
+                client = _clients[key] = MongoClient(**settings)
+        return client
+
+    def dump_source(self) -> tuple:
+        """Address of the member dumps read from: the one selected by the low-impact read
+        preference, or the configured host.
+
+        Returns:
+            tuple -- (host, port)"""
+        if self.low_impact is None:
+            return self.host, self.port
+        client = self._client()
+        try:
+            return self.low_impact.select_source(client)
+        except ConnectionFailure:
+            raise MongoConnectionError()
+
+    def throttle(self):
+        """Context manager returning the low-impact throttle of one dump, or None without low-impact mode."""
+        if self.low_impact is None:
+            return contextlib.nullcontext()
+        return self.low_impact.throttle(self)
+
+    def list_collections(self) -> List[Dict]:
+        """Lists the database's collections with their size and document count, largest first.
+
+        Returns:
+            list -- [{"name": str, "size": int, "count": int}, ...] sorted by size, descending."""
+        client = self._client()
+        try:
+            db = client[self.db_name]
+            collections = []
+            for name in db.list_collection_names(filter={'type': 'collection'}):
+                try:
+                    stats = next(db[name].aggregate([{'$collStats': {'storageStats': {}}}]))['storageStats']
+                    collections.append({'name': name, 'size': int(stats.get('size', 0)), 'count': int(stats.get('count', 0))})
+                except (OperationFailure, StopIteration):
+                    collections.append({'name': name, 'size': 0, 'count': 0})
+        except ConnectionFailure:
+            raise MongoConnectionError()
+        return sorted(collections, key=lambda c: c['size'], reverse=True)
+
+    def _run_collection(self, command:List[str], collection:Dict) -> Dict:
+        """Runs one per-collection mongodump/mongorestore and returns its result."""
+        start = time.monotonic()
+        with registry.timed(command[0], pipeline='per_collection', collection=collection['name']) as stats:
+            result = subprocess.run(command, capture_output=True, text=True)
+            # sizes are estimates from collStats (dump) or the .bson file (restore)
+            if command[0] == 'mongorestore':
+                stats.bytes_in = collection.get('size', 0)
+            else:
+                stats.bytes_out = collection.get('size', 0)
+        return dict(collection,
+                    seconds=round(time.monotonic() - start, 3),
+                    returncode=result.returncode,
+                    error=result.stderr if result.returncode != 0 else None)
+
+    def _run_parallel(self, commands:List[tuple], workers:Optional[int]) -> List[Dict]:
+        """Runs (command, collection) pairs on a worker pool in the given order and raises if any failed."""
+        workers = workers or os.cpu_count() or 1
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            # the pool starts tasks in submission order, so the largest collections go first
+            futures = [executor.submit(self._run_collection, command, collection) for command, collection in commands]
+            results = [future.result() for future in futures]
+        failed = [r for r in results if r['returncode'] != 0]
+        if failed:
+            raise UnexpectedError("; ".join(f"{r['name']}: {r['error'].strip()}" for r in failed))
+        return results
+
+    def backup_parallel(self, dir:str, workers:int=None, collections:List[str]=None) -> str:
+        """Dumps every collection with its own mongodump process, scheduled on a worker pool.
+
+        Collections are dumped largest first so the longest jobs do not end up running
+        alone at the end. The per-collection results are merged into one manifest,
+        written to <dir>/<db_name>/manifest.json. With the native engine, workers is the
+        number of _id ranges scanned at the same time.
+
+        Parameters:
+            dir [type:String] -- Output directory; files are written to <dir>/<db_name>/.
+            workers [type:int] -- Number of concurrent mongodump processes. Defaults to the number of CPUs, and to 1 in low-impact mode.
+            collections [type:list] -- (Optional) Only dump these collections.
+
+        Returns:
+            str -- Path of the manifest file."""
+        formatted_dir = dir.replace("\\", "/")
+        if not self.check_directory(formatted_dir):
+            raise DirectoryNotFoundError(dir)
+
+        if self.engine == 'native':
+            manifest_path = self.native.dump(formatted_dir, workers, collections)
+            print(f"Backup successful; added to: {os.path.dirname(manifest_path)}")
+            return manifest_path
+
+        targets = self.list_collections()
+        if collections is not None:
+            targets = [c for c in targets if c['name'] in collections]
+        if self.low_impact is not None:
+            # directory dumps cannot be throttled; read one collection at a time instead
+            workers = 1
+        # built once, so the low-impact member is chosen once for the whole dump
+        base_command = self._base_command('mongodump')
+        commands = [
+            (base_command + ['--collection', c['name'], '--out', formatted_dir], c)
+            for c in targets
+            ]
+        started = datetime.datetime.now(datetime.timezone.utc)
+        results = self._run_parallel(commands, workers)
+
+        manifest = {
+            'db': self.db_name,
+            'created': started.isoformat(),
+            'collections': [
+                {
+                    'name': r['name'],
+                    'size': r['size'],
+                    'count': r['count'],
+                    'files': [f"{r['name']}.bson", f"{r['name']}.metadata.json"],
+                    'seconds': r['seconds'],
+                }
+                for r in results
+                ],
+            }
+        db_dir = os.path.join(formatted_dir, self.db_name)
+        os.makedirs(db_dir, exist_ok=True)
+        manifest_path = os.path.join(db_dir, 'manifest.json')
+        with open(manifest_path, 'w') as f:
+            json.dump(manifest, f, indent=2)
+        print(f"Backup successful; {len(results)} collections added to: {db_dir}")
+        return manifest_path
+
+    @staticmethod
+    def _restore_targets(bck_dir:str, collections:List[str]=None) -> List[Dict]:
+        """Collections to restore from a dump directory, largest first.
+
+        Read from the manifest written by backup_parallel(); without a manifest, from the
+        .bson files in bck_dir, sized by file size."""
+        manifest_path = os.path.join(bck_dir, 'manifest.json')
+        if os.path.exists(manifest_path):
+            with open(manifest_path) as f:
+                targets = json.load(f)['collections']
+        else:
+            targets = [
+                {'name': file[:-len('.bson')], 'size': os.path.getsize(os.path.join(bck_dir, file))}
+                for file in os.listdir(bck_dir) if file.endswith('.bson')
+                ]
+        if collections is not None:
+            targets = [c for c in targets if c['name'] in collections]
+        return sorted(targets, key=lambda c: c['size'], reverse=True)
+
+    def restore_parallel(self, bck_dir:str, workers:int=None, insertion_workers:int=None, collections:List[str]=None) -> None:
+        """Restores every collection with its own mongorestore process, scheduled on a worker pool.
+
+        The collection list and sizes are read from the manifest written by backup_parallel();
+        without a manifest, the .bson files in bck_dir are restored by file size. Largest
+        collections are restored first.
+
+        Parameters:
+            bck_dir [type:String] -- Directory containing the dumped collection files.
+            workers [type:int] -- Number of concurrent mongorestore processes. Defaults to the number of CPUs.
+            insertion_workers [type:int] -- (Optional) Insertion workers per collection (--numInsertionWorkersPerCollection).
+            collections [type:list] -- (Optional) Only restore these collections."""
+        formatted_bck_dir = bck_dir.replace("\\", "/")
+        if not self.check_directory(formatted_bck_dir):
+            raise DirectoryNotFoundError(bck_dir)
+
+        targets = self._restore_targets(formatted_bck_dir, collections)
+        if self.engine == 'native':
+            self.native.restore(formatted_bck_dir, targets, workers, insertion_workers)
+            print(f"Restore succesful; {len(targets)} collections restored from: {bck_dir}")
+            return
+
+        commands = []
+        for c in targets:
+            command = self._base_command('mongorestore') + ['--collection', c['name']]
+            if insertion_workers:
+                command.extend(['--numInsertionWorkersPerCollection', str(insertion_workers)])
+            command.append(os.path.join(formatted_bck_dir, f"{c['name']}.bson"))
+            commands.append((command, c))
+        results = self._run_parallel(commands, workers)
+        print(f"Restore succesful; {len(results)} collections restored from: {bck_dir}")
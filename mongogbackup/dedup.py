@@ -0,0 +1,261 @@
+import base64
+import datetime
+import hashlib
+import hmac
+import json
+import random
+import zlib
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING, Dict, Iterable, Iterator, List
+
+from mongogbackup import targz
+from mongogbackup.files import FileEncryptor, HashVerifier
+
+if TYPE_CHECKING:
+    from mongogbackup.storage import StorageBackend
+
+_ARCHIVE_MAGIC = b'\x6d\xe2\x99\x81'  # mongodump --archive header
+_TERMINATOR = b'\xff\xff\xff\xff'  # mongodump --archive end of block
+_MAX_RECORD = 16 * 1024 * 1024 + 16 * 1024  # largest BSON document plus archive framing
+_GEAR = tuple(map(random.Random(0x6d676263).getrandbits, [64] * 256))  # fixed table so chunk boundaries are stable across runs
+_MASK_64 = (1 << 64) - 1
+
+class ChunkIntegrityError(Exception):
+    """Raised when a downloaded chunk does not match its content address."""
+    def __init__(self, chunk_id: str):
+        self.chunk_id = chunk_id
+    def __str__(self):
+        return f"Chunk {self.chunk_id} is corrupted: its content does not match its hash."
+
+class ManifestNotFoundError(Exception):
+    """Raised when a backup manifest does not exist in the storage."""
+    def __init__(self, name: str):
+        self.name = name
+    def __str__(self):
+        return f"No deduplicated backup named {self.name} was found."
+
+def content_defined_chunks(chunks: Iterable[bytes], min_size: int = 256 * 1024, avg_size: int = 1024 * 1024, max_size: int = 4 * 1024 * 1024) -> Iterator[bytes]:
+    """Splits a byte stream into chunks whose boundaries depend on the content, not on offsets.
+
+    mongodump output (.bson files and --archive streams) is a sequence of BSON documents,
+    so boundaries are placed between documents: after `min_size` bytes, a document ends a
+    chunk when its CRC32 falls below a threshold proportional to its length, which gives
+    chunks of about `avg_size` bytes. An inserted or deleted document therefore only
+    changes the chunk it belongs to. Hashing whole documents with zlib keeps this fast.
+    Streams that are not BSON fall back to byte-wise Gear hashing (FastCDC style), which
+    is much slower in pure Python. A chunk is cut at the first boundary after `max_size`."""
+    if not 0 < min_size < avg_size < max_size:
+        raise ValueError("Chunk sizes must satisfy 0 < min_size < avg_size < max_size")
+    scale = (1 << 32) / (avg_size - min_size)
+    bits = (avg_size - min_size).bit_length() - 1
+    gear_mask = ((1 << bits) - 1) << (64 - bits)  # the high bits of a Gear hash mix the most input bytes
+    buffer = bytearray()
+    pos = 0
+    gear_hash = 0
+    bson_mode = True
+
+    def cut_points():
+        nonlocal pos, bson_mode, gear_hash
+        while True:
+            if bson_mode:
+                if len(buffer) - pos < 4:
+                    return
+                head = bytes(buffer[pos:pos + 4])
+                if head == _TERMINATOR or head == _ARCHIVE_MAGIC:
+                    length = 4
+                else:
+                    length = int.from_bytes(head, 'little')
+                    if length < 5 or length > _MAX_RECORD:
+                        bson_mode = False
+                        continue
+                    if len(buffer) - pos < length:
+                        return
+                    if buffer[pos + length - 1] != 0:
+                        bson_mode = False
+                        continue
+                end = pos + length
+                with memoryview(buffer) as view:
+                    checksum = zlib.crc32(view[pos:end])
+                pos = end
+                if pos >= max_size or (pos >= min_size and checksum < length * scale):
+                    yield pos
+            else:
+                if pos < min_size:
+                    pos = min(min_size, len(buffer))
+                    gear_hash = 0
+                end = len(buffer)
+                while pos < end:
+                    gear_hash = ((gear_hash << 1) + _GEAR[buffer[pos]]) & _MASK_64
+                    pos += 1
+                    if (gear_hash & gear_mask) == 0 or pos >= max_size:
+                        yield pos
+                        break
+                else:
+                    return
+
+    for incoming in chunks:
+        buffer += incoming
+        for cut in cut_points():
+            yield bytes(buffer[:cut])
+            del buffer[:cut]
+            pos = 0
+            gear_hash = 0
+    if buffer:
+        yield bytes(buffer)
+
+class DedupStore:
+    """Deduplicating backup storage on any storage.StorageBackend.
+
+    Backups are split with content_defined_chunks(). Each chunk is addressed by the
+    HMAC-SHA256 of its plaintext (keyed with the encryption key, so the names reveal
+    nothing about the content), compressed, encrypted and stored once as a file named
+    chunks/<hash>. Each backup is a small encrypted manifest, <name>.manifest, listing
+    its chunks, so a nightly backup only uploads the chunks that changed.
+
+    Retention is reference-counted garbage collection: deleting a backup removes its
+    manifest, and chunks no longer referenced by any remaining manifest are deleted.
+    Do not run collect_garbage() while a backup to the same storage is in progress."""
+
+    _CHUNK_PREFIX = 'chunks/'
+    _MANIFEST_SUFFIX = '.manifest'
+    VERSION = 1
+
+    def __init__(self, storage: 'StorageBackend', encryptor: FileEncryptor, hasher: HashVerifier,
+                 codec: str = 'gzip', level: int = None, min_size: int = 256 * 1024, avg_size: int = 1024 * 1024,
+                 max_size: int = 4 * 1024 * 1024, workers: int = 4) -> None:
+        """Parameters:
+            storage -- Backend holding the manifests and the chunks.
+            encryptor -- Encryptor for chunks and manifests.
+            hasher -- HashVerifier used to address chunks.
+            codec, level -- Compression applied to each chunk (see targz).
+            min_size, avg_size, max_size -- Content-defined chunking sizes.
+            workers -- Number of chunks compressed, encrypted and uploaded in parallel."""
+        self.storage = storage
+        self.encryptor = encryptor
+        self.hasher = hasher
+        self.codec = codec
+        self.level = level
+        self.min_size = min_size
+        self.avg_size = avg_size
+        self.max_size = max_size
+        self.workers = workers
+        self._id_key = hmac.new(base64.urlsafe_b64decode(encryptor.get_key()), b'mongogbackup chunk id', hashlib.sha256).digest()
+
+    def remote_index(self) -> Dict[str, Dict]:
+        """Returns the stored chunks, keyed by chunk ID."""
+        prefix = self._CHUNK_PREFIX
+        return {f['name'][len(prefix):]: f for f in self.storage.list_files() if f['name'].startswith(prefix)}
+
+    def _pack(self, data: bytes) -> bytes:
+        compressed = targz.compress_stream([data], self.level, self.codec, workers=1)
+        return b''.join(self.encryptor.encrypt_stream(compressed))
+
+    def _unpack(self, blob: bytes) -> bytes:
+        return b''.join(targz.decompress_stream(self.encryptor.decrypt_stream([blob])))
+
+    def backup(self, chunks: Iterable[bytes], name: str) -> Dict:
+        """Stores a byte stream as a deduplicated backup and returns its manifest.
+
+        Only chunks missing from the remote index are uploaded."""
+        index = self.remote_index()
+        entries = []
+        known = set(index)
+        pending = deque()
+        stats = {'uploaded': 0, 'uploaded_bytes': 0, 'reused': 0}
+        size = 0
+
+        def store(chunk_id, data):
+            blob = self._pack(data)
+            self.storage.upload_bytes(blob, self._CHUNK_PREFIX + chunk_id)
+            return len(blob)
+
+        def uploaded(future):
+            stats['uploaded'] += 1
+            stats['uploaded_bytes'] += future.result()
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for data in content_defined_chunks(chunks, self.min_size, self.avg_size, self.max_size):
+                chunk_id = self.hasher.generate_hash(data, self._id_key)
+                entries.append([chunk_id, len(data)])
+                size += len(data)
+                if chunk_id in known:
+                    stats['reused'] += 1
+                    continue
+                known.add(chunk_id)
+                # packing and uploading both run on the pool; the cap bounds the chunks held in memory
+                pending.append(executor.submit(store, chunk_id, data))
+                while len(pending) > 2 * self.workers:
+                    uploaded(pending.popleft())
+            while pending:
+                uploaded(pending.popleft())
+
+        manifest = {
+            'version': self.VERSION,
+            'name': name,
+            'created': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            'codec': self.codec,
+            'size': size,
+            'chunks': entries,
+        }
+        manifest_blob = b''.join(self.encryptor.encrypt_stream([json.dumps(manifest).encode()]))
+        self.storage.upload_bytes(manifest_blob, name + self._MANIFEST_SUFFIX)
+        print(f"Deduplicated backup {name}: {len(entries)} chunks, {stats['uploaded']} uploaded ({stats['uploaded_bytes']} bytes), {stats['reused']} reused")
+        return dict(manifest, **stats)
+
+    def list_backups(self) -> List[Dict]:
+        """Lists the manifest files in the storage, oldest first."""
+        files = self.storage.list_files()
+        manifests = [f for f in files if f['name'].endswith(self._MANIFEST_SUFFIX)]
+        return sorted(manifests, key=lambda f: f['createdTime'])
+
+    def load_manifest(self, name: str, manifests: List[Dict] = None) -> Dict:
+        """Downloads and decrypts the manifest of the named backup."""
+        manifests = manifests if manifests is not None else self.list_backups()
+        matches = [f for f in manifests if f['name'] == name + self._MANIFEST_SUFFIX]
+        if not matches:
+            raise ManifestNotFoundError(name)
+        blob = self.storage.download_bytes(matches[-1]['id'])
+        return json.loads(b''.join(self.encryptor.decrypt_stream([blob])))
+
+    def restore_stream(self, name: str) -> Iterator[bytes]:
+        """Downloads, verifies and yields the chunks of the named backup in order."""
+        manifest = self.load_manifest(name)
+        index = self.remote_index()
+        for chunk_id, _ in manifest['chunks']:
+            if chunk_id not in index:
+                raise ChunkIntegrityError(chunk_id)
+            data = self._unpack(self.storage.download_bytes(index[chunk_id]['id']))
+            if self.hasher.generate_hash(data, self._id_key) != chunk_id:
+                raise ChunkIntegrityError(chunk_id)
+            yield data
+
+    def collect_garbage(self, keep: int, dry_run: bool = False) -> Dict:
+        """Keeps the `keep` newest backups and deletes older manifests and unreferenced chunks.
+
+        Parameters:
+            keep -- Number of newest backups to keep.
+            dry_run -- Only report what would be deleted.
+
+        Returns:
+            dict -- {"deleted_backups": [...], "deleted_chunks": int, "live_chunks": int}"""
+        manifests = self.list_backups()
+        expired = manifests[:max(len(manifests) - keep, 0)]
+        live = manifests[len(expired):]
+
+        references = Counter()
+        for manifest_file in live:
+            name = manifest_file['name'][:-len(self._MANIFEST_SUFFIX)]
+            references.update(chunk_id for chunk_id, _ in self.load_manifest(name, [manifest_file])['chunks'])
+        index = self.remote_index()
+        garbage = [f for chunk_id, f in index.items() if references[chunk_id] == 0]
+
+        if not dry_run:
+            # manifests go first, so an interrupted run never leaves a manifest pointing at deleted chunks
+            self.storage.delete_files(expired)
+            self.storage.delete_files(garbage)
+        return {
+            'deleted_backups': [f['name'] for f in expired],
+            'deleted_chunks': len(garbage),
+            'live_chunks': len(index) - len(garbage),
+        }
@@ -1,13 +1,157 @@
 from hashlib import sha256
 import datetime
-from cryptography.fernet import Fernet
+import hmac
+import base64
+import json
+import os
+import struct
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import BinaryIO, Dict, Iterable, Iterator, List, Optional, Union
+from cryptography.fernet import Fernet, InvalidToken
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+
+from mongogbackup.metrics import registry
+
+_TREE_LEAF = 1 << 20  # 1Mb leaves; fixed, so tree hashes stay comparable
+_TREE_SEGMENT = 64  # leaves read and hashed by one worker when hashing a file
+
+def _leaf_digest(data) -> bytes:
+    leaf = sha256(b'\x00')
+    leaf.update(data)
+    return leaf.digest()
+
+def _tree_root(leaves: Iterable[bytes], size: int) -> str:
+    root = sha256(b'\x01' + size.to_bytes(8, 'big'))
+    for leaf in leaves:
+        root.update(leaf)
+    return root.hexdigest()
+
+class HashCache:
+    """Persistent cache of file hashes keyed by path, size, modification time and inode.
+
+    A cached hash is returned only while all of them, and the hash mode, are unchanged."""
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._lock = threading.Lock()
+        self._entries: Dict[str, dict] = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                self._entries = json.load(f)
+
+    @staticmethod
+    def _key(file_path: str) -> str:
+        return os.path.abspath(file_path)
+
+    @staticmethod
+    def _signature(file_path: str) -> dict:
+        stat = os.stat(file_path)
+        return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'inode': stat.st_ino}
+
+    def get(self, file_path: str, mode: str) -> Optional[str]:
+        """Returns the cached hash of a file, or None if it is missing or stale."""
+        with self._lock:
+            entry = self._entries.get(self._key(file_path))
+        if entry is None or entry['mode'] != mode:
+            return None
+        signature = self._signature(file_path)
+        if any(entry[field] != value for field, value in signature.items()):
+            return None
+        return entry['hash']
+
+    def put(self, file_path: str, mode: str, digest: str) -> None:
+        """Records the hash of a file as it is now on disk."""
+        entry = dict(self._signature(file_path), mode=mode, hash=digest)
+        with self._lock:
+            self._entries[self._key(file_path)] = entry
+            temp_path = self.path + '.tmp'
+            with open(temp_path, 'w') as f:
+                json.dump(self._entries, f)
+            os.replace(temp_path, self.path)
+
+class StreamingHash:
+    """Incremental hash of data as it flows past, created by HashVerifier.streaming().
+
+    In tree mode 1Mb leaves are hashed concurrently on a thread pool (hashlib releases
+    the GIL), so hashing keeps up with fast pipelines on many cores."""
+
+    def __init__(self, verifier: 'HashVerifier') -> None:
+        self._verifier = verifier
+        self._size = 0
+        if verifier.mode == 'tree':
+            self._buffer = bytearray()
+            self._leaves = []
+            self._pending = deque()
+            self._executor = ThreadPoolExecutor(max_workers=verifier.workers)
+        else:
+            self._sha = sha256()
+
+    def update(self, data: bytes) -> None:
+        self._size += len(data)
+        if self._verifier.mode != 'tree':
+            self._sha.update(data)
+            return
+        self._buffer += data
+        while len(self._buffer) >= _TREE_LEAF:
+            self._submit(bytes(self._buffer[:_TREE_LEAF]))
+            del self._buffer[:_TREE_LEAF]
+
+    def _submit(self, leaf: bytes) -> None:
+        self._pending.append(self._executor.submit(_leaf_digest, leaf))
+        while len(self._pending) > 2 * self._verifier.workers:
+            self._leaves.append(self._pending.popleft().result())
+
+    def finish(self, file_path: str = None) -> str:
+        """Returns the hex digest and records it as the verifier's last hash.
+
+        Parameters:
+            file_path [type:String] -- (Optional) File holding exactly the hashed bytes. Its hash is stored in the verifier's cache."""
+        if self._verifier.mode == 'tree':
+            try:
+                if self._buffer or not self._size:
+                    self._submit(bytes(self._buffer))
+                    self._buffer.clear()
+                while self._pending:
+                    self._leaves.append(self._pending.popleft().result())
+            finally:
+                self._executor.shutdown(wait=True)
+            digest = _tree_root(self._leaves, self._size)
+        else:
+            digest = self._sha.hexdigest()
+        self._verifier._record(digest)
+        if file_path is not None and self._verifier.cache is not None:
+            self._verifier.cache.put(file_path, self._verifier.mode, digest)
+        return digest
 
 class HashVerifier:
-    """Generates and verifies sha-256 checksums for files."""
-        
-    def __init__(self):
-        """Initializes the HashVerifier class."""
-        self._BUF_SIZE: int = 65336 # 64Kb
+    """Generates and verifies sha-256 checksums for files.
+
+    In 'sha256' mode (the default) the checksum is the plain SHA-256 of the content. In
+    'tree' mode the content is split into 1Mb leaves that are hashed in parallel and the
+    checksum is the SHA-256 of the leaf hashes; it is only comparable with other tree hashes.
+    Data can also be hashed while it is written (see stream() and streaming()), so files
+    produced by pack() or encrypt_file() need no second read pass."""
+
+    MODES = ('sha256', 'tree')
+
+    def __init__(self, mode: str = 'sha256', workers: int = None, cache_path: str = None):
+        """Initializes the HashVerifier class.
+
+        Keyword Arguments:
+            mode -- 'sha256' or 'tree'. Defaults to 'sha256'.
+            workers -- Number of hashing threads in tree mode. Defaults to the number of CPUs.
+            cache_path -- (Optional) JSON file caching the hashes of unchanged files."""
+        if mode not in self.MODES:
+            raise ValueError(f"mode must be one of {self.MODES}")
+        self.mode = mode
+        self.workers = workers if workers is not None else (os.cpu_count() or 1)
+        self.cache = HashCache(cache_path) if cache_path is not None else None
+        self._BUF_SIZE: int = 1 << 20 # 1Mb
         self._last_hash: str = None
         self._last_hash_time:datetime.datetime = None
         
@@ -27,23 +171,79 @@ class HashVerifier:
         """Settings for the HashVerifier class.
 
         Keword Arguments:
-            buf_size -- The buffer size to use when reading the file. Default is 64Kb.
+            buf_size -- The buffer size to use when reading the file. Default is 1Mb.
         """
         self._BUF_SIZE = buf_size if buf_size is not None else self._BUF_SIZE
 
-    def generate_file_hash(self, file_path: str) -> str:
-        """Generates and caches SHA-256 checksum for a file."""
-        sha = sha256()
-        with open(file_path, 'rb') as f:
-            while True:
-                data = f.read(self._BUF_SIZE)
-                if not data:
-                    break
-                sha.update(data)
-        self._last_hash = sha.hexdigest()
+    def _record(self, digest: str) -> str:
+        self._last_hash = digest
         self._last_hash_time = datetime.datetime.now()
-        return self._last_hash
+        return digest
+
+    def generate_file_hash(self, file_path: str) -> str:
+        """Generates and caches the checksum of a file, reusing the hash cache when the file is unchanged."""
+        if self.cache is not None:
+            cached = self.cache.get(file_path, self.mode)
+            if cached is not None:
+                return self._record(cached)
+        if self.mode == 'tree':
+            digest = self._tree_file_hash(file_path)
+        else:
+            sha = sha256()
+            with open(file_path, 'rb') as f:
+                while True:
+                    data = f.read(self._BUF_SIZE)
+                    if not data:
+                        break
+                    sha.update(data)
+            digest = sha.hexdigest()
+        if self.cache is not None:
+            self.cache.put(file_path, self.mode, digest)
+        return self._record(digest)
+
+    def _tree_file_hash(self, file_path: str) -> str:
+        size = os.path.getsize(file_path)
+        segment_size = _TREE_LEAF * _TREE_SEGMENT
+
+        def hash_segment(offset: int) -> List[bytes]:
+            leaves = []
+            with open(file_path, 'rb') as f:
+                f.seek(offset)
+                for _ in range(_TREE_SEGMENT):
+                    data = f.read(_TREE_LEAF)
+                    if not data:
+                        break
+                    leaves.append(_leaf_digest(data))
+            return leaves
+
+        if size == 0:
+            return _tree_root([_leaf_digest(b'')], 0)
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            segments = executor.map(hash_segment, range(0, size, segment_size))
+            return _tree_root((leaf for segment in segments for leaf in segment), size)
+
+    def streaming(self) -> StreamingHash:
+        """Returns an incremental hash; call update() with the data and finish() for the digest."""
+        return StreamingHash(self)
+
+    def stream(self, chunks: Iterable[bytes]) -> Iterator[bytes]:
+        """Passes a stream of chunks through unchanged, hashing it on the way.
+
+        The hash becomes the last generated hash once the stream is exhausted."""
+        digest = self.streaming()
+        for chunk in chunks:
+            digest.update(chunk)
+            yield chunk
+        digest.finish()
     
+    def generate_hash(self, data: bytes, key: bytes = None) -> str:
+        """Generates the SHA-256 checksum of in-memory data, keyed (HMAC-SHA256) when a key is given.
+
+        The last generated file hash is not changed."""
+        if key is not None:
+            return hmac.new(key, data, sha256).hexdigest()
+        return sha256(data).hexdigest()
+
     def compare_generated(self, hash: str) -> bool:
         """Compares input hash with the last generated hash."""
         return hash == self._last_hash
@@ -59,52 +259,225 @@ class HashVerifier:
         with open(file_name, 'w') as f:
             f.writelines(file_output)
         
+class DecryptionError(Exception):
+    """Raised when an encrypted stream is corrupted, truncated, reordered or the key is wrong."""
+    def __init__(self, message: str):
+        self.message = message
+    def __str__(self):
+        return f"Decryption failed: {self.message}"
+
+def _iter_chunks(source: Union[BinaryIO, Iterable[bytes]], size: int) -> Iterator[bytes]:
+    """Yields chunks from a binary file object, or passes an iterable of chunks through."""
+    if hasattr(source, 'read'):
+        while True:
+            data = source.read(size)
+            if not data:
+                return
+            yield data
+    else:
+        yield from source
+
 class FileEncryptor:
-    """Encrypts and decrypts files using Fernet symmetric encryption."""
-    
-    def __init__(self, generate_key=False, key:str = None):
-        """Initializes the Encryptor class."""
+    """Encrypts and decrypts files and streams.
+
+    Data is written in a chunked AES-256-GCM container:
+
+        header:  b"MGBK" | version (1 byte) | algorithm (1 byte) | chunk size (4 bytes) | salt (16 bytes)
+        chunks:  ciphertext length (4 bytes) | ciphertext + 16 byte tag
+
+    A per-file key is derived from the Fernet key and the random salt with HKDF-SHA256.
+    Each chunk's nonce is its index plus a final-chunk flag and the header is authenticated
+    with every chunk, so decryption detects tampering, reordering and truncation (the last
+    chunk, possibly empty, is the authenticated end marker). Files written by older versions
+    as a single Fernet token are still decrypted."""
+
+    MAGIC = b"MGBK"
+    VERSION = 1
+    _AES_256_GCM = 1
+    _HEADER = struct.Struct(">4sBBI16s")
+    _LENGTH = struct.Struct(">I")
+    _TAG_SIZE = 16
+    # the chunk size comes from the unauthenticated header, so it bounds the memory a stream may claim
+    MAX_CHUNK_SIZE = 64 << 20
+
+    def __init__(self, generate_key=False, key:str = None, chunk_size:int = 1 << 20):
+        """Initializes the Encryptor class.
+
+        Parameters:
+            generate_key -- Generate a new Fernet key instead of using `key`.
+            key -- Fernet key (url-safe base64 encoded 32 bytes).
+            chunk_size -- Plaintext bytes per encrypted chunk, at most 64Mb. Defaults to 1Mb."""
         
         if(not generate_key and key is None):
             raise ValueError("Either provide a key or generate_key must be set to True.")
+        if not 0 < chunk_size <= self.MAX_CHUNK_SIZE:
+            raise ValueError(f"chunk_size must be between 1 and {self.MAX_CHUNK_SIZE} bytes, got {chunk_size}")
         
         self._FERNET_KEY = Fernet.generate_key() if generate_key  else key
+        self._chunk_size = chunk_size
     
     def get_key(self) ->str:
         """Returns the encryption key."""
         return self._FERNET_KEY
-    
-    def encrypt_file(self, source_file_path:str, encrypted_file_path:str) -> str:
-        """Encrypts a file using Fernet symmetric encryption."""
-       
-        # Create a Fernet Instance
-        key = self._FERNET_KEY 
-        f = Fernet(key)
-        
-        # Encrypt the file
-        with open(source_file_path, 'rb') as file:
-            data = file.read()
-        encrypted = f.encrypt(data)
-        
-        # Write the encrypted file
-        with open(encrypted_file_path, 'wb') as file:
-            file.write(encrypted)
-        
+
+    def parameters(self) -> dict:
+        """Describes the container format written by encrypt_stream(), for backup manifests."""
+        return {
+            'container': self.MAGIC.decode(),
+            'version': self.VERSION,
+            'algorithm': 'AES-256-GCM',
+            'kdf': 'HKDF-SHA256',
+            'chunk_size': self._chunk_size,
+        }
+
+    def _derive_cipher(self, salt: bytes) -> AESGCM:
+        """Derives the per-file AES-256-GCM cipher from the Fernet key and the file salt."""
+        master = base64.urlsafe_b64decode(self._FERNET_KEY)
+        hkdf = HKDF(algorithm=hashes.SHA256(), length=32, salt=salt, info=b"mongogbackup chunked v1")
+        return AESGCM(hkdf.derive(master))
+
+    @staticmethod
+    def _nonce(index: int, final: bool) -> bytes:
+        return struct.pack(">QI", index, 1 if final else 0)
+
+    def encrypt_stream(self, chunks: Union[BinaryIO, Iterable[bytes]]) -> Iterator[bytes]:
+        """Encrypts a file object or an iterable of byte chunks, yielding the encrypted container.
+
+        Memory use is bounded by the chunk size regardless of the stream length."""
+        salt = os.urandom(16)
+        header = self._HEADER.pack(self.MAGIC, self.VERSION, self._AES_256_GCM, self._chunk_size, salt)
+        cipher = self._derive_cipher(salt)
+        yield header
+
+        index = 0
+        pending = None
+        buffer = bytearray()
+        for chunk in _iter_chunks(chunks, self._chunk_size):
+            buffer += chunk
+            while len(buffer) >= self._chunk_size:
+                # hold one chunk back so the final one can be flagged as the end marker
+                if pending is not None:
+                    sealed = cipher.encrypt(self._nonce(index, False), pending, header)
+                    yield self._LENGTH.pack(len(sealed)) + sealed
+                    index += 1
+                pending = bytes(buffer[:self._chunk_size])
+                del buffer[:self._chunk_size]
+        if pending is not None and buffer:
+            sealed = cipher.encrypt(self._nonce(index, False), pending, header)
+            yield self._LENGTH.pack(len(sealed)) + sealed
+            index += 1
+            pending = None
+        final = bytes(buffer) if pending is None else pending
+        sealed = cipher.encrypt(self._nonce(index, True), final, header)
+        yield self._LENGTH.pack(len(sealed)) + sealed
+
+    def decrypt_stream(self, chunks: Union[BinaryIO, Iterable[bytes]]) -> Iterator[bytes]:
+        """Decrypts a file object or an iterable of byte chunks, yielding the plaintext chunks.
+
+        Raises DecryptionError if the data was tampered with, reordered or truncated."""
+        source = _iter_chunks(chunks, self._chunk_size)
+        buffer = bytearray()
+        for chunk in source:
+            buffer += chunk
+            if len(buffer) >= self._HEADER.size:
+                break
+        if buffer[:len(self.MAGIC)] != self.MAGIC:
+            yield from self._decrypt_fernet(buffer, source)
+            return
+        if len(buffer) < self._HEADER.size:
+            raise DecryptionError("stream ended inside the header")
+
+        header = bytes(buffer[:self._HEADER.size])
+        _, version, algorithm, chunk_size, salt = self._HEADER.unpack(header)
+        if version != self.VERSION or algorithm != self._AES_256_GCM:
+            raise DecryptionError(f"unsupported container version {version} / algorithm {algorithm}")
+        if not 0 < chunk_size <= self.MAX_CHUNK_SIZE:
+            raise DecryptionError(f"invalid chunk size {chunk_size} in the header")
+        del buffer[:self._HEADER.size]
+        cipher = self._derive_cipher(salt)
+        max_length = chunk_size + self._TAG_SIZE
+
+        index = 0
+        finished = False
+        exhausted = False
+        while True:
+            # read until the next chunk is complete and at least one byte past it is known,
+            # which tells whether this chunk has to be the final one. An oversized length is
+            # rejected as soon as it is read, not after buffering that many bytes.
+            while not exhausted and (len(buffer) < self._LENGTH.size or (
+                    self._LENGTH.unpack_from(buffer)[0] <= max_length and len(buffer) <= self._LENGTH.size + self._LENGTH.unpack_from(buffer)[0])):
+                data = next(source, None)
+                if data is None:
+                    exhausted = True
+                else:
+                    buffer += data
+            if not buffer:
+                break
+            if finished:
+                raise DecryptionError("unexpected data after the end marker")
+            if len(buffer) < self._LENGTH.size:
+                raise DecryptionError("stream is truncated")
+            length = self._LENGTH.unpack_from(buffer)[0]
+            if length > max_length or length < self._TAG_SIZE:
+                raise DecryptionError(f"invalid length for chunk {index}")
+            if len(buffer) < self._LENGTH.size + length:
+                raise DecryptionError("stream is truncated")
+            sealed = bytes(buffer[self._LENGTH.size:self._LENGTH.size + length])
+            del buffer[:self._LENGTH.size + length]
+            # a chunk that is not final when the input ends fails to authenticate with
+            # final=True, and a final chunk moved earlier fails with final=False
+            final = exhausted and not buffer
+            try:
+                plain = cipher.decrypt(self._nonce(index, final), sealed, header)
+            except InvalidTag:
+                if final:
+                    raise DecryptionError("stream is truncated or chunk failed authentication")
+                raise DecryptionError(f"chunk {index} failed authentication (tampered, reordered or wrong key)")
+            finished = final
+            index += 1
+            if plain:
+                yield plain
+        if not finished:
+            raise DecryptionError("stream is truncated (missing end marker)")
+
+    def _decrypt_fernet(self, buffer: bytearray, source: Iterator[bytes]) -> Iterator[bytes]:
+        """Compatibility path for data encrypted as Fernet tokens (one token per file or per line)."""
+        fernet = Fernet(self._FERNET_KEY)
+        try:
+            for chunk in source:
+                buffer += chunk
+                while True:
+                    end = buffer.find(b"\n")
+                    if end < 0:
+                        break
+                    yield fernet.decrypt(bytes(buffer[:end]))
+                    del buffer[:end + 1]
+            if buffer.strip():
+                yield fernet.decrypt(bytes(buffer.strip()))
+        except InvalidToken:
+            raise DecryptionError("invalid Fernet token (tampered data or wrong key)")
+
+    def encrypt_file(self, source_file_path:str, encrypted_file_path:str, hasher:HashVerifier=None) -> str:
+        """Encrypts a file in constant memory using the chunked container format.
+
+        With a hasher, the encrypted file is hashed while it is written (see HashVerifier.last_hash())."""
+        digest = hasher.streaming() if hasher is not None else None
+        with registry.timed('encrypt') as stats, open(source_file_path, 'rb') as source, open(encrypted_file_path, 'wb') as destination:
+            for data in self.encrypt_stream(source):
+                destination.write(data)
+                if digest is not None:
+                    digest.update(data)
+            stats.bytes_in = source.tell()
+            stats.bytes_out = destination.tell()
+        if digest is not None:
+            digest.finish(encrypted_file_path)
         return encrypted_file_path
         
     def decrypt_file(self, encrypted_file_path, decrypted_file_path) -> str:
-        """Decrypts a file using Fernet symmetric encryption."""
-        
-        # Create a Fernet Instance
-        key = self._FERNET_KEY
-        fernet = Fernet(key)
-        
-        # Decrypt the file
-        with open(encrypted_file_path, 'rb') as enc_file:
-            encrypted = enc_file.read()
-        decrypted = fernet.decrypt(encrypted)
-        
-        # Write the decrypted file
-        with open(decrypted_file_path, 'wb') as dec_file:
-            dec_file.write(decrypted)
-        return decrypted_file_path
\ No newline at end of file
+        """Decrypts a file written by encrypt_file(), including legacy whole-file Fernet files."""
+        with registry.timed('decrypt') as stats, open(encrypted_file_path, 'rb') as source, open(decrypted_file_path, 'wb') as destination:
+            for data in self.decrypt_stream(source):
+                destination.write(data)
+            stats.bytes_in = source.tell()
+            stats.bytes_out = destination.tell()
+        return decrypted_file_path
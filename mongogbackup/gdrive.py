@@ -1,10 +1,24 @@
 from google.oauth2 import service_account
-from googleapiclient.discovery import build
-from googleapiclient.http import MediaFileUpload, MediaIoBaseUpload, HttpError
-from typing import Dict, Optional, List
+from google.auth.transport.requests import AuthorizedSession
+from googleapiclient.discovery import build_from_document
+from googleapiclient.discovery_cache import get_static_doc
+from googleapiclient.http import MediaIoBaseDownload, HttpError
+from typing import Dict, Iterable, Iterator, Optional, List
+from collections import deque
+from functools import cached_property, lru_cache
+from concurrent.futures import ThreadPoolExecutor
+import io
+import os
+import hashlib
 import json
+import threading
+import time
+import uuid
 import requests
 
+from mongogbackup.metrics import registry
+from mongogbackup.retry import RETRYABLE_ERRORS, RetryPolicy, TransientError, classify, raise_for_transient
+
 class LoadCredentialsError(Exception):
     """Raised when there is an error loading credentials from file."""
     def __init__(self, message: str):
@@ -39,7 +53,15 @@ class FileUploadError(Exception):
         self.file_name = file_name
         self.message = message
     def __str__(self):
-        return f"Error deleting file {self.file_name}: {self.message}"
+        return f"Error uploading file {self.file_name}: {self.message}"
+
+class FileDownloadError(Exception):
+    """Raised when there is an error during file download."""
+    def __init__(self, file_id: str, message: str):
+        self.file_id = file_id
+        self.message = message
+    def __str__(self):
+        return f"Error downloading file {self.file_id}: {self.message}"
 
 class FileDeletionError(Exception):
     """Raised when there is an error during file deletion."""
@@ -65,22 +87,58 @@ class InternetConnectivityError(Exception):
         return "No internet connection"
 
 
+def quote(value: str) -> str:
+    """Escapes a value for use in a single-quoted string of a Drive query."""
+    return value.replace('\\', '\\\\').replace("'", "\\'")
+
+@lru_cache(maxsize=None)
+def _discovery_document() -> dict:
+    """The Drive v3 discovery document, read and parsed once per process."""
+    return json.loads(get_static_doc('drive', 'v3'))
+
 class GoogleDriveHandler:
-    def __init__(self, credentials_file: str, parent_id: str, file_name: str) -> None:
+    api_root = 'https://www.googleapis.com'
+    _CHUNK_ALIGNMENT = 256 * 1024  # resumable upload chunks must be multiples of 256Kb
+    _BATCH_SIZE = 100  # maximum number of calls in one Drive batch request
+    # appProperties of the files written by upload_parts()
+    _PARTS_RUN = 'mongogbackupRun'
+    _PARTS_COUNT = 'mongogbackupParts'
+
+    def __init__(self, credentials_file: str, parent_id: str, file_name: str, check_connectivity: bool = False,
+                 retry: RetryPolicy = None) -> None:
+        """Loads the service account credentials. No request is made until the handler is used.
+
+        Parameters:
+            credentials_file -- Service account key file.
+            parent_id -- Default target folder ID.
+            file_name -- Default file name.
+            check_connectivity -- Fail early with InternetConnectivityError when Google is unreachable. Defaults to False.
+            retry -- (Optional) Retry policy for transient errors and rate limits. Defaults to RetryPolicy()."""
         self.parent_id = parent_id
         self.file_name = file_name
-        if self.check_internet_connectivity() == False:
+        self.retry = retry if retry is not None else RetryPolicy()
+        if check_connectivity and self.check_internet_connectivity() == False:
             raise InternetConnectivityError()
         try:
             self.credentials = service_account.Credentials.from_service_account_file(credentials_file, scopes=['https://www.googleapis.com/auth/drive'])
-            self.drive_service = build('drive', 'v3', credentials=self.credentials)
         except (FileNotFoundError, json.JSONDecodeError) as e:
             raise LoadCredentialsError(str(e))
         except (IOError, ValueError) as e:
             raise InvalidCredentialsError(str(e))
+
+    @cached_property
+    def drive_service(self):
+        """Drive v3 API client, built on first use from the discovery document shipped with googleapiclient."""
+        try:
+            return build_from_document(_discovery_document(), credentials=self.credentials)
         except HttpError as e:
             raise GoogleDriveAPIError(str(e))
         
+    @property
+    def _num_retries(self) -> int:
+        # googleapiclient requests retry 5xx responses, 429 and 403 rate limits with their own backoff
+        return self.retry.max_attempts - 1
+
     def check_internet_connectivity(self) -> bool:
         """Checks if there is an active internet connection."""
         try:
@@ -89,73 +147,597 @@ class GoogleDriveHandler:
         except requests.ConnectionError:
             return False
             
+    def folder_index(self, parent_id: str, cache_path: str = None) -> 'DriveFolderIndex':
+        """Returns the cached index of a folder, creating it on first use.
+
+        Parameters:
+            parent_id -- ID of the indexed folder.
+            cache_path -- (Optional) JSON file persisting the index between runs. Only used when the index is created."""
+        if getattr(self, '_indexes', None) is None:
+            self._indexes = {}
+        if parent_id not in self._indexes:
+            self._indexes[parent_id] = DriveFolderIndex(self, parent_id, cache_path)
+        return self._indexes[parent_id]
+
     def find_existing_files(self, file_name: str, parent_id: str) -> Optional[List[Dict[str, str]]]:
         """Finds all existing files with the same name in the target folder"""
-        try: 
-            query = f"name='{file_name}' and '{parent_id}' in parents and trashed=false"
-            response = self.drive_service.files().list(q=query, fields='files(id, name)').execute()
-            files = response.get('files', [])
-            print(f'Existing files: {files}')
-            return files if files else None
-        except HttpError as e:
-            if e.resp.status in [403, 404]:
-                raise InvalidParentIDError(parent_id)
-            raise FileQueryError(str(e))
+        index = self.folder_index(parent_id)
+        index.refresh()
+        files = index.find(file_name)
+        print(f'Existing files: {files}')
+        return files if files else None
 
     def delete_files(self, files: List[dict]) -> None:
-        """Deletes files from Google Drive"""
-        for file in files:
-            try:
-                self.drive_service.files().delete(fileId=file['id']).execute()
-                print(f"Deleted file: {file['name']} (ID: {file['id']})")
-            except HttpError as e:
-                FileDeletionError(file['name'], file['id'], str(e))
+        """Deletes files from Google Drive, up to 100 per batch request.
+
+        Deletes that fail with a transient error or a rate limit are sent again in a later
+        batch, after a backoff. A file that no longer exists counts as deleted. Once every
+        file has been tried, FileDeletionError is raised for the first one that could not be
+        deleted."""
+        deleted = []
+        failed = []
+        backoff = self.retry.backoff('delete')
+        pending = list(range(len(files)))
+        while pending:
+            retry = []
+            reasons = set()
+
+            def callback(request_id, response, exception):
+                position = int(request_id)
+                file = files[position]
+                status = exception.resp.status if isinstance(exception, HttpError) else None
+                reason = classify(status, exception.content.decode(errors='replace')) if status is not None else None
+                if status == 404:
+                    deleted.append(file)  # deleted by an earlier attempt, or by someone else
+                elif reason is not None:
+                    retry.append(position)
+                    reasons.add(reason)
+                elif exception is not None:
+                    failed.append(FileDeletionError(file['name'], file['id'], str(exception)))
+                else:
+                    deleted.append(file)
+                    print(f"Deleted file: {file['name']} (ID: {file['id']})")
+
+            for start in range(0, len(pending), self._BATCH_SIZE):
+                positions = pending[start:start + self._BATCH_SIZE]
+                batch = self.drive_service.new_batch_http_request(callback=callback)
+                for position in positions:
+                    batch.add(self.drive_service.files().delete(fileId=files[position]['id']), request_id=str(position))
+                self.retry.wait_for_rate_limit()
+                try:
+                    batch.execute()
+                except HttpError as e:
+                    reason = classify(e.resp.status, e.content.decode(errors='replace'))
+                    if reason is None:
+                        raise GoogleDriveAPIError(str(e))
+                    retry.extend(positions)
+                    reasons.add(reason)
+            pending = retry
+            # a rate limit pauses the other requests as well
+            reason = 'rate_limit' if 'rate_limit' in reasons else min(reasons, default='server_error')
+            if pending and not backoff.wait(TransientError(None, reason, f"{len(pending)} deletes failed")):
+                failed.extend(FileDeletionError(files[p]['name'], files[p]['id'], 'retries exhausted') for p in pending)
+                break
+        for index in getattr(self, '_indexes', {}).values():
+            index.remove(file['id'] for file in deleted)
+        if failed:
+            raise failed[0]
     
     def delete_older_files(self, parent_id: str, num_files: int) -> None:
-        """Deletes older files if there are more than 3 files in the target folder"""
-        try:
-            query = f"'{parent_id}' in parents and trashed=false"
-            response = self.drive_service.files().list(q=query, fields='files(id, name)', orderBy='createdTime asc').execute()
-            files = response.get('files', [])
-            if len(files) > num_files:
-                for file in files[0:len(files)-num_files]:
-                    try:
-                        self.drive_service.files().delete(fileId=file['id']).execute()
-                        print(f"Deleted file: {file['name']}")
-                    except HttpError as e:
-                        FileDeletionError(file['name'], file['id'], str(e))
+        """Deletes older files if there are more than num_files files in the target folder"""
+        index = self.folder_index(parent_id)
+        index.refresh()
+        files = index.files()
+        if len(files) > num_files:
+            self.delete_files(files[0:len(files)-num_files])
+
+    def upload_file_to_drive(self, file_name: str, parent_id: str, chunk_size: int = 8 * 1024 * 1024) -> dict:
+        """Uploads a file to Google Drive, named after its path.
+
+        This is upload_file() with a gzip mime type: transient errors are retried and, if
+        the process stops mid-upload, calling it again resumes from the last committed byte."""
+        return self.upload_file(file_name, parent_id, file_name=file_name, chunk_size=chunk_size, mimetype='application/gzip')
+    
+    def list_files(self, parent_id: str, query: str = None, fields: str = 'id, name, size, createdTime, md5Checksum') -> List[Dict[str, str]]:
+        """Lists every file in the target folder, following all result pages.
+
+        Parameters:
+            parent_id -- ID of the folder to list.
+            query -- (Optional) Additional Drive query, combined with 'and'.
+            fields -- File fields to return."""
+        q = f"'{quote(parent_id)}' in parents and trashed=false"
+        if query:
+            q += f" and {query}"
+        files = []
+        page_token = None
+        try:
+            while True:
+                response = self.drive_service.files().list(
+                    q=q, fields=f'nextPageToken, files({fields})', pageSize=1000, pageToken=page_token
+                ).execute(num_retries=self._num_retries)
+                files.extend(response.get('files', []))
+                page_token = response.get('nextPageToken')
+                if page_token is None:
+                    return files
         except HttpError as e:
             if e.resp.status in [403, 404]:
                 raise InvalidParentIDError(parent_id)
             raise FileQueryError(str(e))
 
-    def upload_file_to_drive(self, file_name: str, parent_id: str) -> dict:
-        """Uploads a file to Google Drive"""
-        media = MediaFileUpload(file_name, mimetype='application/gzip', resumable=True)
-        file_metadata = {
-            'name': file_name,
-            'parents': [parent_id]
-        }
-        
+    def find_or_create_folder(self, name: str, parent_id: str) -> str:
+        """Returns the ID of the named folder inside parent_id, creating it if it does not exist."""
+        folders = self.list_files(parent_id, query=f"name='{quote(name)}' and mimeType='application/vnd.google-apps.folder'", fields='id, name')
+        if folders:
+            return folders[0]['id']
         try:
-            request = self.drive_service.files().create(
-                body=file_metadata,
-                media_body=media,
+            folder = self.drive_service.files().create(
+                body={'name': name, 'parents': [parent_id], 'mimeType': 'application/vnd.google-apps.folder'},
                 fields='id'
-            )
-            response = None
-            while response is None:
-                status, response = request.next_chunk()
-                if status:
-                    print(f"Uploaded {int(status.progress() * 100)}%")
-            print(f"File uploaded successfully! File Id: {response.get('id')}")
-            return response
+            ).execute(num_retries=self._num_retries)
         except HttpError as e:
             if e.resp.status in [403, 404]:
                 raise InvalidParentIDError(parent_id)
-            FileUploadError(file_name, str(e))
-            raise e
-    
+            raise GoogleDriveAPIError(str(e))
+        return folder['id']
+
+    def upload_bytes(self, data: bytes, file_name: str, parent_id: str, mimetype: str = 'application/octet-stream') -> dict:
+        """Uploads in-memory data as a new file to Google Drive in a single multipart request.
+
+        The request goes through the calling thread's session, so several threads may
+        upload at once."""
+        boundary = uuid.uuid4().hex
+        metadata = json.dumps({'name': file_name, 'parents': [parent_id]}).encode()
+        body = b''.join([
+            f"--{boundary}\r\nContent-Type: application/json; charset=UTF-8\r\n\r\n".encode(), metadata,
+            f"\r\n--{boundary}\r\nContent-Type: {mimetype}\r\n\r\n".encode(), data,
+            f"\r\n--{boundary}--\r\n".encode(),
+        ])
+        try:
+            response = self.retry.call('upload_bytes', lambda: raise_for_transient(self._authorized_session().post(
+                f"{self.api_root}/upload/drive/v3/files",
+                params={'uploadType': 'multipart', 'fields': 'id, name, size, createdTime'},
+                data=body,
+                headers={'Content-Type': f"multipart/related; boundary={boundary}"},
+            )))
+        except RETRYABLE_ERRORS as e:
+            raise FileUploadError(file_name, str(e))
+        if response.status_code in [403, 404]:
+            raise InvalidParentIDError(parent_id)
+        if response.status_code != 200:
+            raise FileUploadError(file_name, response.text)
+        registry.increment('drive_bytes_total', len(data), direction='upload')
+        return response.json()
+
+    def download_bytes(self, file_id: str) -> bytes:
+        """Downloads a file from Google Drive into memory"""
+        buffer = io.BytesIO()
+        try:
+            downloader = MediaIoBaseDownload(buffer, self.drive_service.files().get_media(fileId=file_id))
+            done = False
+            while not done:
+                _, done = downloader.next_chunk(num_retries=self._num_retries)
+        except HttpError as e:
+            raise GoogleDriveAPIError(str(e))
+        return buffer.getvalue()
+
+    def _new_session(self) -> requests.Session:
+        """Creates a requests session authorized with the service account credentials."""
+        return AuthorizedSession(self.credentials)
+
+    def _authorized_session(self) -> requests.Session:
+        """Returns this thread's authorized session; sessions are not shared between threads."""
+        if getattr(self, '_local', None) is None:
+            self._local = threading.local()
+        if getattr(self._local, 'session', None) is None:
+            self._local.session = self._new_session()
+        return self._local.session
+
+    def _create_upload_session(self, file_name: str, parent_id: str, mimetype: str, size: Optional[int] = None,
+                               app_properties: Optional[Dict[str, str]] = None) -> str:
+        """Starts a resumable upload session and returns its URI."""
+        metadata = {'name': file_name, 'parents': [parent_id]}
+        if app_properties:
+            metadata['appProperties'] = app_properties
+        headers = {'X-Upload-Content-Type': mimetype}
+        if size is not None:
+            headers['X-Upload-Content-Length'] = str(size)
+        try:
+            response = self.retry.call('create_session', lambda: raise_for_transient(self._authorized_session().post(
+                f"{self.api_root}/upload/drive/v3/files",
+                params={'uploadType': 'resumable', 'fields': 'id, name, size, md5Checksum'},
+                json=metadata,
+                headers=headers,
+            )))
+        except RETRYABLE_ERRORS as e:
+            raise FileUploadError(file_name, str(e))
+        if response.status_code in [403, 404]:
+            raise InvalidParentIDError(parent_id)
+        if response.status_code != 200 or 'Location' not in response.headers:
+            raise FileUploadError(file_name, response.text)
+        return response.headers['Location']
+
+    def _put_chunk(self, session_uri: str, data: bytes, offset: int, total: str) -> requests.Response:
+        """Sends one chunk of a resumable upload; an empty chunk finalizes or queries the session."""
+        headers = {'Content-Length': str(len(data))}
+        if data:
+            headers['Content-Range'] = f"bytes {offset}-{offset + len(data) - 1}/{total}"
+        else:
+            headers['Content-Range'] = f"bytes */{total}"
+        self.retry.wait_for_rate_limit()
+        started = time.perf_counter()
+        response = self._authorized_session().put(session_uri, data=data, headers=headers)
+        registry.increment('drive_requests_total', operation='upload_chunk', status=response.status_code)
+        registry.increment('drive_request_seconds_total', time.perf_counter() - started, operation='upload_chunk')
+        registry.increment('drive_bytes_total', len(data), direction='upload')
+        return response
+
+    @staticmethod
+    def _committed_offset(response: requests.Response) -> int:
+        """Number of bytes the server has committed, from a 308 response's Range header."""
+        if 'Range' not in response.headers:
+            return 0
+        return int(response.headers['Range'].split('-')[1]) + 1
+
+    def _query_upload_offset(self, session_uri: str, size: int) -> Optional[int]:
+        """Returns the committed offset of an interrupted session, or None if the session has expired."""
+        try:
+            response = self.retry.call('query_upload', lambda: raise_for_transient(self._put_chunk(session_uri, b'', 0, str(size))))
+        except RETRYABLE_ERRORS:
+            return None
+        if response.status_code == 308:
+            return self._committed_offset(response)
+        if response.status_code in [200, 201]:
+            return size
+        return None
+
+    def _send_chunk(self, session_uri: str, data: bytes, offset: int, total: str, backoff) -> requests.Response:
+        """Sends one chunk of a resumable upload, retrying transient failures.
+
+        After a failure the chunk may have been partly committed, so the session is asked
+        for its committed offset and that status response (308, or 200/201 if the upload is
+        complete) is returned instead; the caller then sends the rest from the committed
+        offset. An expired session shows up as a 404 or 410 response."""
+        try:
+            response = raise_for_transient(self._put_chunk(session_uri, data, offset, total))
+            backoff.reset()
+            return response
+        except RETRYABLE_ERRORS as e:
+            if not backoff.wait(e):
+                raise
+        return self.retry.call('query_upload', lambda: raise_for_transient(self._put_chunk(session_uri, b'', 0, total)))
+
+    @staticmethod
+    def _drop_committed(buffer: bytearray, offset: int, committed: int, file_name: str) -> int:
+        """Removes the bytes the server committed from the front of the buffer and returns the new offset.
+
+        Bytes before `offset` are no longer held, so a session that reports fewer committed
+        bytes (e.g. a 308 response without a Range header after a restart) cannot be
+        continued and raises FileUploadError."""
+        if committed < offset:
+            raise FileUploadError(file_name, f"the server reports {committed} committed bytes after {offset} were confirmed")
+        del buffer[:committed - offset]
+        return committed
+
+    def upload_stream(self, chunks: Iterable[bytes], file_name: str, parent_id: str, chunk_size: int = 8 * 1024 * 1024, mimetype: str = 'application/octet-stream') -> dict:
+        """Uploads a stream of byte chunks of unknown length to Google Drive through a resumable upload session.
+
+        Unlike upload_file_to_drive(), the data never has to exist as a file: at most one
+        chunk (plus the incoming piece) is held in memory at a time.
+
+        Parameters:
+            chunks -- Iterable yielding the bytes to upload.
+            file_name -- Name of the file created on Google Drive.
+            parent_id -- ID of the target folder.
+            chunk_size -- Bytes sent per request, a multiple of 256Kb. Defaults to 8Mb.
+            mimetype -- Mime type of the uploaded file.
+
+        Returns:
+            dict -- The created file resource.
+        """
+        self._check_chunk_size(chunk_size)
+        try:
+            return self._upload_stream(chunks, file_name, parent_id, chunk_size, mimetype)
+        except RETRYABLE_ERRORS as e:
+            raise FileUploadError(file_name, str(e))
+
+    def _upload_stream(self, chunks: Iterable[bytes], file_name: str, parent_id: str, chunk_size: int, mimetype: str) -> dict:
+        session_uri = self._create_upload_session(file_name, parent_id, mimetype)
+        backoff = self.retry.backoff('upload_chunk')
+        offset = 0
+        buffer = bytearray()
+        for chunk in chunks:
+            buffer += chunk
+            # only send full chunks while more data is known to follow, so the final
+            # request always carries the total size. Uncommitted bytes stay in the buffer
+            # until the server confirms them, so a failed chunk can be sent again.
+            while len(buffer) > chunk_size:
+                response = self._send_chunk(session_uri, bytes(buffer[:chunk_size]), offset, '*', backoff)
+                if response.status_code != 308:
+                    raise FileUploadError(file_name, response.text)
+                committed = self._committed_offset(response)
+                if committed > offset:
+                    print(f"Uploaded {committed} bytes")
+                offset = self._drop_committed(buffer, offset, committed, file_name)
+
+        total = offset + len(buffer)
+        while True:
+            response = self._send_chunk(session_uri, bytes(buffer), offset, str(total), backoff)
+            if response.status_code in [200, 201]:
+                break
+            if response.status_code != 308:
+                raise FileUploadError(file_name, response.text)
+            offset = self._drop_committed(buffer, offset, self._committed_offset(response), file_name)
+        result = response.json()
+        print(f"File uploaded successfully! File Id: {result.get('id')}")
+        return result
+
+    def _check_chunk_size(self, chunk_size: int) -> None:
+        if chunk_size <= 0 or chunk_size % self._CHUNK_ALIGNMENT != 0:
+            raise ValueError(f"chunk_size must be a positive multiple of {self._CHUNK_ALIGNMENT} bytes")
+
+    def _upload_range(self, file_path: str, start: int, length: int, file_name: str, parent_id: str,
+                      chunk_size: int, mimetype: str, state_path: Optional[str], app_properties: Optional[Dict[str, str]] = None) -> dict:
+        """Uploads `length` bytes of a file from `start` as one Drive file.
+
+        The session URI is saved to state_path, so an interrupted upload of the same byte
+        range continues from the last offset the server committed. Transient failures are
+        retried within the session; an expired session is replaced by a new one."""
+        session_uri = None
+        offset = 0
+        stat = os.stat(file_path)
+        state = {'file_name': file_name, 'parent_id': parent_id, 'start': start, 'length': length, 'mtime': stat.st_mtime,
+                 'app_properties': app_properties}
+        if state_path is not None and os.path.exists(state_path):
+            with open(state_path) as f:
+                saved = json.load(f)
+            if {k: saved.get(k) for k in state} == state:
+                offset = self._query_upload_offset(saved['session_uri'], length)
+                if offset is not None:
+                    session_uri = saved['session_uri']
+                    registry.increment('retries_total', operation='resume_upload')
+                    print(f"Resuming upload of {file_name} at byte {offset}")
+
+        def new_session() -> str:
+            uri = self._create_upload_session(file_name, parent_id, mimetype, length, app_properties)
+            if state_path is not None:
+                temp_path = state_path + '.tmp'
+                with open(temp_path, 'w') as f:
+                    json.dump(dict(state, session_uri=uri), f)
+                os.replace(temp_path, state_path)
+            return uri
+
+        if session_uri is None:
+            offset = 0
+            session_uri = new_session()
+
+        backoff = self.retry.backoff('upload_chunk')
+        with open(file_path, 'rb') as source:
+            while True:
+                source.seek(start + offset)
+                data = source.read(min(chunk_size, length - offset))
+                response = self._send_chunk(session_uri, data, offset, str(length), backoff)
+                if response.status_code in [200, 201]:
+                    break
+                if response.status_code in [404, 410]:
+                    # sessions expire after a week, or when the server abandons them
+                    if not backoff.wait(TransientError(response.status_code, 'session_expired', response.text)):
+                        raise FileUploadError(file_name, response.text)
+                    session_uri = new_session()
+                    offset = 0
+                    continue
+                if response.status_code != 308:
+                    raise FileUploadError(file_name, response.text)
+                offset = self._committed_offset(response)
+        if state_path is not None and os.path.exists(state_path):
+            os.remove(state_path)
+        return response.json()
+
+    def upload_file(self, file_path: str, parent_id: str, file_name: str = None, chunk_size: int = 8 * 1024 * 1024,
+                    mimetype: str = 'application/octet-stream', resume: bool = True) -> dict:
+        """Uploads a local file through a resumable session that survives interruptions.
+
+        If a previous upload of the same file was interrupted (crash, lost connection),
+        calling this again continues from the last committed byte instead of byte zero.
+
+        Parameters:
+            file_path -- Path of the file to upload.
+            parent_id -- ID of the target folder.
+            file_name -- Name on Google Drive. Defaults to the file's base name.
+            chunk_size -- Bytes sent per request, a multiple of 256Kb. Defaults to 8Mb.
+            resume -- Save the session next to the file (<file_path>.upload-session) and reuse it."""
+        self._check_chunk_size(chunk_size)
+        file_name = file_name if file_name is not None else os.path.basename(file_path)
+        state_path = file_path + '.upload-session' if resume else None
+        try:
+            result = self._upload_range(file_path, 0, os.path.getsize(file_path), file_name, parent_id, chunk_size, mimetype, state_path)
+        except RETRYABLE_ERRORS as e:
+            raise FileUploadError(file_name, str(e))
+        print(f"File uploaded successfully! File Id: {result.get('id')}")
+        return result
+
+    def upload_parts(self, file_path: str, parent_id: str, file_name: str = None, part_size: int = 256 * 1024 * 1024,
+                     workers: int = 4, chunk_size: int = 8 * 1024 * 1024, mimetype: str = 'application/octet-stream',
+                     resume: bool = True) -> List[dict]:
+        """Splits a large file into parts and uploads them concurrently, one resumable session per part.
+
+        Parts are named <file_name>.part0001, <file_name>.part0002, ... and can be joined
+        back with download_parts(). Interrupted parts resume like upload_file(). Every part
+        records the upload it belongs to and the number of parts in its appProperties, so
+        download_parts() never mixes the parts of two uploads with the same name.
+
+        Parameters:
+            part_size -- Bytes per part. Defaults to 256Mb.
+            workers -- Number of parts uploaded at the same time. Defaults to 4.
+
+        Returns:
+            list -- The created file resources, in part order."""
+        self._check_chunk_size(chunk_size)
+        file_name = file_name if file_name is not None else os.path.basename(file_path)
+        size = os.path.getsize(file_path)
+        ranges = [(start, min(part_size, size - start)) for start in range(0, size, part_size)] or [(0, 0)]
+        # the same file split the same way gets the same ID, so a resumed upload stays one set of parts
+        stat = os.stat(file_path)
+        run = hashlib.sha256(f"{os.path.abspath(file_path)}:{size}:{stat.st_mtime_ns}:{part_size}".encode()).hexdigest()[:16]
+        app_properties = {self._PARTS_RUN: run, self._PARTS_COUNT: str(len(ranges))}
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = []
+            for index, (start, length) in enumerate(ranges, 1):
+                part_name = f"{file_name}.part{index:04d}"
+                state_path = f"{file_path}.part{index:04d}.upload-session" if resume else None
+                futures.append(executor.submit(self._upload_range, file_path, start, length, part_name, parent_id, chunk_size,
+                                               mimetype, state_path, app_properties))
+            try:
+                results = [future.result() for future in futures]
+            except RETRYABLE_ERRORS as e:
+                raise FileUploadError(file_name, str(e))
+        print(f"Uploaded {len(results)} parts of {file_name}")
+        return results
+
+    def get_file_metadata(self, file_id: str, fields: str = 'id, name, size, md5Checksum') -> dict:
+        """Returns metadata of a Google Drive file"""
+        try:
+            response = self.retry.call('get_metadata', lambda: raise_for_transient(
+                self._authorized_session().get(f"{self.api_root}/drive/v3/files/{file_id}", params={'fields': fields})))
+        except RETRYABLE_ERRORS as e:
+            raise FileDownloadError(file_id, str(e))
+        if response.status_code != 200:
+            raise FileDownloadError(file_id, response.text)
+        return response.json()
+
+    def find_latest_file(self, file_name: str, parent_id: str) -> dict:
+        """Returns the most recently created file with the given name in the target folder"""
+        files = self.list_files(parent_id, query=f"name='{quote(file_name)}'", fields='id, name, size, createdTime, md5Checksum')
+        if not files:
+            raise FileQueryError(f"No file named {file_name} in folder {parent_id}")
+        return max(files, key=lambda f: f['createdTime'])
+
+    def _get_range(self, file_id: str, start: int, end: int) -> bytes:
+        """Downloads bytes start..end (inclusive) of a file, retrying transient failures."""
+        try:
+            return self.retry.call('download_range', self._fetch_range, file_id, start, end)
+        except RETRYABLE_ERRORS as e:
+            raise FileDownloadError(file_id, str(e))
+
+    def _fetch_range(self, file_id: str, start: int, end: int) -> bytes:
+        started = time.perf_counter()
+        response = self._authorized_session().get(
+            f"{self.api_root}/drive/v3/files/{file_id}",
+            params={'alt': 'media'},
+            headers={'Range': f"bytes={start}-{end}"},
+        )
+        registry.increment('drive_requests_total', operation='download_range', status=response.status_code)
+        registry.increment('drive_request_seconds_total', time.perf_counter() - started, operation='download_range')
+        registry.increment('drive_bytes_total', len(response.content), direction='download')
+        raise_for_transient(response)
+        if response.status_code not in [200, 206]:
+            raise FileDownloadError(file_id, response.text)
+        data = response.content
+        if response.status_code == 200:
+            data = data[start:end + 1]
+        if len(data) != end - start + 1:
+            # a connection closed early; the range is fetched again
+            raise TransientError(response.status_code, 'short_read', f"expected {end - start + 1} bytes at offset {start}, received {len(data)}")
+        return data
+
+    def download_stream(self, file_id: str, chunk_size: int = 8 * 1024 * 1024, workers: int = 4, start: int = 0, end: int = None) -> Iterator[bytes]:
+        """Downloads a file as a stream of chunks, fetching several byte ranges in parallel.
+
+        Chunks are yielded in order and at most 2 x workers chunks are held in memory,
+        so the output can be fed straight into decryption and decompression.
+
+        Parameters:
+            file_id -- ID of the file to download.
+            chunk_size -- Bytes per ranged request. Defaults to 8Mb.
+            workers -- Number of concurrent ranged requests. Defaults to 4.
+            start -- Offset to start from, to resume an interrupted stream.
+            end -- (Optional) Offset to stop at, exclusive. Defaults to the end of the file."""
+        size = end if end is not None else int(self.get_file_metadata(file_id, fields='size')['size'])
+        ranges = iter(range(start, size, chunk_size))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            pending = deque()
+            for offset in ranges:
+                pending.append(executor.submit(self._get_range, file_id, offset, min(offset + chunk_size, size) - 1))
+                if len(pending) >= 2 * workers:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+
+    def download_file(self, file_id: str, destination: str, chunk_size: int = 8 * 1024 * 1024, workers: int = 4, resume: bool = True) -> str:
+        """Downloads a file to disk with parallel ranged reads.
+
+        Data is written to <destination>.partial and finished ranges are recorded in
+        <destination>.progress, so an interrupted download only fetches the missing ranges
+        when called again. The file is moved to `destination` once complete."""
+        size = int(self.get_file_metadata(file_id, fields='size')['size'])
+        partial_path = destination + '.partial'
+        progress_path = destination + '.progress'
+        done = set()
+        if resume and os.path.exists(progress_path) and os.path.exists(partial_path):
+            with open(progress_path) as f:
+                progress = json.load(f)
+            if progress.get('file_id') == file_id and progress.get('size') == size and progress.get('chunk_size') == chunk_size:
+                done = set(progress['done'])
+                registry.increment('retries_total', operation='resume_download')
+                print(f"Resuming download of {file_id}: {len(done)} ranges already present")
+        if not done:
+            with open(partial_path, 'wb') as f:
+                f.truncate(size)
+
+        lock = threading.Lock()
+
+        def fetch(offset: int) -> None:
+            data = self._get_range(file_id, offset, min(offset + chunk_size, size) - 1)
+            with open(partial_path, 'r+b') as f:
+                f.seek(offset)
+                f.write(data)
+            with lock:
+                done.add(offset)
+                if resume:
+                    with open(progress_path, 'w') as f:
+                        json.dump({'file_id': file_id, 'size': size, 'chunk_size': chunk_size, 'done': sorted(done)}, f)
+
+        missing = [offset for offset in range(0, size, chunk_size) if offset not in done]
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for future in [executor.submit(fetch, offset) for offset in missing]:
+                future.result()
+
+        os.replace(partial_path, destination)
+        if os.path.exists(progress_path):
+            os.remove(progress_path)
+        print(f"File downloaded successfully: {destination}")
+        return destination
+
+    def download_parts(self, file_name: str, parent_id: str, destination: str, chunk_size: int = 8 * 1024 * 1024, workers: int = 4) -> str:
+        """Downloads the parts written by upload_parts() and joins them into one file.
+
+        When the folder holds the parts of several uploads with the same name, only the most
+        recent complete upload is joined."""
+        files = self.list_files(parent_id, query=f"name contains '{quote(file_name + '.part')}'", fields='id, name, size, createdTime, appProperties')
+        runs: Dict[Optional[str], List[dict]] = {}
+        for f in files:
+            if f['name'].startswith(f"{file_name}.part") and f['name'][len(file_name) + 5:].isdigit():
+                runs.setdefault((f.get('appProperties') or {}).get(self._PARTS_RUN), []).append(f)
+        complete = []
+        for run, run_files in runs.items():
+            # a part uploaded twice in the same run holds the same bytes, either copy will do
+            latest = {}
+            for f in sorted(run_files, key=lambda f: f.get('createdTime') or ''):
+                latest[int(f['name'][len(file_name) + 5:])] = f
+            parts = [latest[number] for number in sorted(latest)]
+            count = (parts[0].get('appProperties') or {}).get(self._PARTS_COUNT)
+            # parts uploaded before runs were recorded carry no run and are only used if nothing else is complete
+            if run is None or (count is not None and sorted(latest) == list(range(1, int(count) + 1))):
+                newest = max(f.get('createdTime') or '' for f in parts)
+                complete.append((run is not None, newest, parts))
+        if not complete:
+            raise FileQueryError(f"No complete set of parts of {file_name} in folder {parent_id}")
+        parts = max(complete, key=lambda c: c[:2])[2]
+        with open(destination, 'wb') as output:
+            for part in parts:
+                for data in self.download_stream(part['id'], chunk_size, workers):
+                    output.write(data)
+        return destination
+
     # this implementation overwrites any previous files with the same name in the target folder, essentially keeping only the latest file
     def overwrite_and_upload_to_drive(self, file_name: str, parent_id: str) -> None:
         """Uploads a file to Google Drive and deletes any previous files with the same name in the target folder"""
@@ -181,6 +763,96 @@ class GoogleDriveHandler:
 
 
 
+class DriveFolderIndex:
+    """Local index of the files in a Google Drive folder.
+
+    Files are keyed by ID with their name, creation time, size and md5 checksum. The
+    first refresh lists the folder once (all pages); later refreshes only read the
+    Drive changes feed from the saved page token, which usually takes a single request
+    however many files the folder holds. With a cache_path the index and the page token
+    are persisted, so the next run starts from the feed as well."""
+
+    FIELDS = 'id, name, parents, createdTime, size, md5Checksum, trashed'
+
+    def __init__(self, gdrive: GoogleDriveHandler, parent_id: str, cache_path: str = None) -> None:
+        self.gdrive = gdrive
+        self.parent_id = parent_id
+        self.cache_path = cache_path
+        self._files: Dict[str, Dict[str, str]] = {}
+        self._page_token: Optional[str] = None
+        if cache_path is not None and os.path.exists(cache_path):
+            with open(cache_path) as f:
+                cache = json.load(f)
+            if cache.get('parent_id') == parent_id:
+                self._files = cache['files']
+                self._page_token = cache['page_token']
+
+    def _save(self) -> None:
+        if self.cache_path is None:
+            return
+        temp_path = self.cache_path + '.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump({'parent_id': self.parent_id, 'page_token': self._page_token, 'files': self._files}, f)
+        os.replace(temp_path, self.cache_path)
+
+    def refresh(self) -> None:
+        """Brings the index up to date, from the changes feed when a page token is known."""
+        changes = self.gdrive.drive_service.changes()
+        try:
+            if self._page_token is None:
+                # take the token first so changes made during the listing are replayed next time
+                token = changes.getStartPageToken().execute(num_retries=self.gdrive._num_retries)['startPageToken']
+                files = self.gdrive.list_files(self.parent_id, fields=self.FIELDS)
+                self._files = {f['id']: self._entry(f) for f in files}
+                self._page_token = token
+            else:
+                page_token = self._page_token
+                while page_token is not None:
+                    response = changes.list(
+                        pageToken=page_token, pageSize=1000, includeRemoved=True, spaces='drive',
+                        fields=f'nextPageToken, newStartPageToken, changes(fileId, removed, file({self.FIELDS}))'
+                    ).execute(num_retries=self.gdrive._num_retries)
+                    for change in response.get('changes', []):
+                        self._apply(change)
+                    page_token = response.get('nextPageToken')
+                    if 'newStartPageToken' in response:
+                        self._page_token = response['newStartPageToken']
+        except HttpError as e:
+            if e.resp.status in [403, 404]:
+                raise InvalidParentIDError(self.parent_id)
+            raise FileQueryError(str(e))
+        self._save()
+
+    @staticmethod
+    def _entry(file: Dict) -> Dict[str, str]:
+        return {key: file.get(key) for key in ('id', 'name', 'createdTime', 'size', 'md5Checksum')}
+
+    def _apply(self, change: Dict) -> None:
+        file = change.get('file')
+        if change.get('removed') or file is None or file.get('trashed') or self.parent_id not in file.get('parents', []):
+            self._files.pop(change['fileId'], None)
+        else:
+            self._files[file['id']] = self._entry(file)
+
+    def remove(self, file_ids: Iterable[str]) -> None:
+        """Drops files from the index without waiting for the changes feed."""
+        for file_id in file_ids:
+            self._files.pop(file_id, None)
+        self._save()
+
+    def files(self) -> List[Dict[str, str]]:
+        """Indexed files, oldest first."""
+        return sorted(self._files.values(), key=lambda f: f['createdTime'] or '')
+
+    def find(self, name: str) -> List[Dict[str, str]]:
+        """Indexed files with the given name, oldest first."""
+        return [f for f in self.files() if f['name'] == name]
+
+    def get(self, file_id: str) -> Optional[Dict[str, str]]:
+        """Indexed file by ID."""
+        return self._files.get(file_id)
+
+
 if __name__ == "__main__":
     credentials_file = 'mongogbackup/credentials.json'
     parent_id = '1kIvfXUgB7QnXfhoaueMKJjsYCLGr1zUU'  # Replace with your desired target folder ID
@@ -0,0 +1,331 @@
+import os
+import re
+import shutil
+import tempfile
+import datetime
+import subprocess
+from typing import Dict, List, Optional, Union
+
+import bson
+from bson import json_util
+from bson.codec_options import CodecOptions
+from bson.raw_bson import RawBSONDocument
+from bson.timestamp import Timestamp
+from pymongo.errors import OperationFailure, ConnectionFailure
+
+from mongogbackup.backups import MongoBackupHandler, MongoConnectionError, DirectoryNotFoundError, UnexpectedError
+
+class IncrementalUnavailableError(Exception):
+    """Raised when the server does not provide an oplog or change streams."""
+    def __init__(self, message: str):
+        self.message = message
+    def __str__(self):
+        return f"Incremental backups are not available: {self.message}. MongoDB must run as a replica set."
+
+class ResumePointLostError(Exception):
+    """Raised when the changes since the last resume point are no longer available on the server."""
+    def __init__(self, resume_point: str):
+        self.resume_point = resume_point
+    def __str__(self):
+        return f"Changes since {self.resume_point} are no longer in the oplog. Take a new base backup with backup(full=True)."
+
+class ChainNotFoundError(Exception):
+    """Raised when the backup directory does not contain a backup chain."""
+    def __init__(self, dir: str):
+        self.dir = dir
+    def __str__(self):
+        return f"Error: No incremental backup chain found in {self.dir}. Run backup() first to create a base backup."
+
+class IncrementalBackupHandler:
+    """Full base backups followed by incremental segments of the changes made since the previous run.
+
+    A backup chain lives in one directory:
+
+        chain.json              -- the chain: base backup, resume point and ordered segments
+        base/<db_name>/         -- mongodump of the database
+        segment-000001.bson     -- changes, in mongodump's oplog.bson format
+
+    In 'oplog' mode the changes are read from local.oplog.rs after the last recorded
+    timestamp. In 'changestream' mode they are read from a change stream after the last
+    resume token (for users without access to the local database) and converted to oplog
+    entries. Either way, segments are replayed with mongorestore --oplogReplay, which is
+    idempotent, so the resume point is recorded before the base dump starts and changes
+    made while it runs are replayed on top of it."""
+
+    MODES = ('oplog', 'changestream')
+    _CHAIN_FILE = 'chain.json'
+    _RAW = CodecOptions(document_class=RawBSONDocument)
+
+    def __init__(self, backup_handler: MongoBackupHandler, chain_dir: str, mode: str = 'oplog',
+                 max_segment_changes: int = None, max_segment_bytes: int = None) -> None:
+        """Parameters:
+            backup_handler [type:MongoBackupHandler] -- Handler for the database to back up.
+            chain_dir [type:String] -- Directory holding the backup chain.
+            mode [type:String] -- 'oplog' or 'changestream'. Defaults to 'oplog'.
+            max_segment_changes [type:int] -- (Optional) Changes written to one segment at most; the rest go into the next one.
+            max_segment_bytes [type:int] -- (Optional) Bytes written to one segment at most, checked after each change."""
+        if mode not in self.MODES:
+            raise ValueError(f"mode must be one of {self.MODES}")
+        self.backups = backup_handler
+        self.chain_dir = chain_dir.replace("\\", "/")
+        self.mode = mode
+        self.max_segment_changes = max_segment_changes
+        self.max_segment_bytes = max_segment_bytes
+
+    def _chain_path(self) -> str:
+        return os.path.join(self.chain_dir, self._CHAIN_FILE)
+
+    def load_chain(self) -> Optional[Dict]:
+        """Returns the backup chain, or None if no base backup has been taken yet."""
+        if not os.path.exists(self._chain_path()):
+            return None
+        with open(self._chain_path()) as f:
+            return json_util.loads(f.read())
+
+    def _save_chain(self, chain: Dict) -> None:
+        temp_path = self._chain_path() + '.tmp'
+        with open(temp_path, 'w') as f:
+            f.write(json_util.dumps(chain, indent=2))
+        os.replace(temp_path, self._chain_path())
+
+    def _namespace_filter(self) -> Dict:
+        """Oplog entries of the database, including transactions (applyOps on admin.$cmd) touching it."""
+        pattern = '^' + re.escape(self.backups.db_name) + r'\.'
+        return {'$or': [
+            {'ns': {'$regex': pattern}},
+            {'ns': 'admin.$cmd', 'o.applyOps.ns': {'$regex': pattern}},
+        ]}
+
+    def _oplog(self, client):
+        if 'oplog.rs' not in client.local.list_collection_names():
+            raise IncrementalUnavailableError("local.oplog.rs does not exist")
+        return client.local.get_collection('oplog.rs', codec_options=self._RAW)
+
+    def _current_resume_point(self, client) -> Dict:
+        """Returns the position changes must be read from to follow a backup taken now."""
+        if self.mode == 'oplog':
+            latest = next(self._oplog(client).find().sort('$natural', -1).limit(1), None)
+            if latest is None:
+                raise IncrementalUnavailableError("the oplog is empty")
+            return {'ts': latest['ts']}
+        with client[self.backups.db_name].watch() as stream:
+            return {'token': stream.resume_token, 'ts': client.admin.command('ping').get('operationTime')}
+
+    def backup(self, full: bool = False) -> Dict:
+        """Takes a base backup if there is no chain yet (or full=True), otherwise an incremental segment.
+
+        Returns:
+            dict -- The updated backup chain."""
+        chain = None if full else self.load_chain()
+        if chain is not None and chain.get('mode', 'oplog') != self.mode:
+            raise ValueError(f"The chain in {self.chain_dir} was created in {chain['mode']} mode")
+        if chain is None:
+            return self._backup_base()
+        return self._backup_segment(chain)
+
+    def _backup_base(self) -> Dict:
+        os.makedirs(self.chain_dir, exist_ok=True)
+        base_dir = os.path.join(self.chain_dir, 'base')
+        if os.path.exists(base_dir):
+            shutil.rmtree(base_dir)
+        for file in os.listdir(self.chain_dir):
+            if file.startswith('segment-'):
+                os.remove(os.path.join(self.chain_dir, file))
+        os.makedirs(base_dir)
+
+        client = self.backups._client()
+        try:
+            resume = self._current_resume_point(client)
+        except ConnectionFailure:
+            raise MongoConnectionError()
+        except OperationFailure as e:
+            raise IncrementalUnavailableError(str(e))
+
+        self.backups.backup(dir=base_dir)
+        chain = {
+            'db': self.backups.db_name,
+            'mode': self.mode,
+            'base': {'dir': 'base', 'ts': resume.get('ts'), 'created': datetime.datetime.now(datetime.timezone.utc)},
+            'resume': resume,
+            'segments': [],
+        }
+        self._save_chain(chain)
+        print(f"Base backup successful; chain started in: {self.chain_dir}")
+        return chain
+
+    def _backup_segment(self, chain: Dict) -> Dict:
+        number = len(chain['segments']) + 1
+        file_name = f"segment-{number:06d}.bson"
+        path = os.path.join(self.chain_dir, file_name)
+        temp_path = path + '.tmp'
+
+        client = self.backups._client()
+        try:
+            with open(temp_path, 'wb') as output:
+                if self.mode == 'oplog':
+                    first_ts, last_ts, count = self._write_oplog_segment(client, chain['resume'], output)
+                    resume = {'ts': last_ts} if count else chain['resume']
+                else:
+                    first_ts, last_ts, count, token = self._write_changestream_segment(client, chain['resume'], output)
+                    resume = {'token': token, 'ts': last_ts if count else chain['resume'].get('ts')}
+        except ConnectionFailure:
+            raise MongoConnectionError()
+        except OperationFailure as e:
+            if self.mode == 'changestream' and e.code == 286:  # ChangeStreamHistoryLost
+                raise ResumePointLostError(json_util.dumps(chain['resume']))
+            raise UnexpectedError(str(e))
+
+        if count == 0:
+            os.remove(temp_path)
+            if self.mode == 'changestream':
+                chain['resume'] = resume
+                self._save_chain(chain)
+            print("No changes since the last backup")
+            return chain
+
+        os.replace(temp_path, path)
+        chain['segments'].append({
+            'file': file_name,
+            'first_ts': first_ts,
+            'last_ts': last_ts,
+            'count': count,
+            'size': os.path.getsize(path),
+            'created': datetime.datetime.now(datetime.timezone.utc),
+        })
+        chain['resume'] = resume
+        self._save_chain(chain)
+        print(f"Incremental backup successful; {count} changes added to: {path}")
+        return chain
+
+    def _segment_full(self, count: int, size: int) -> bool:
+        """Whether a segment holding `count` changes in `size` bytes has reached its limits."""
+        full = (self.max_segment_changes is not None and count >= self.max_segment_changes) \
+            or (self.max_segment_bytes is not None and size >= self.max_segment_bytes)
+        if full:
+            print(f"Segment limit reached after {count} changes; the remaining changes go into the next segment")
+        return full
+
+    def _write_oplog_segment(self, client, resume: Dict, output) -> tuple:
+        oplog = self._oplog(client)
+        oldest = next(oplog.find().sort('$natural', 1).limit(1), None)
+        if oldest is None or oldest['ts'] > resume['ts']:
+            raise ResumePointLostError(str(resume['ts']))
+
+        first_ts = last_ts = None
+        count = size = 0
+        query = dict(self._namespace_filter(), ts={'$gt': resume['ts']})
+        with oplog.find(query).sort('$natural', 1).batch_size(10000) as cursor:
+            for entry in cursor:
+                output.write(entry.raw)
+                if first_ts is None:
+                    first_ts = entry['ts']
+                last_ts = entry['ts']
+                count += 1
+                size += len(entry.raw)
+                if self._segment_full(count, size):
+                    break
+        return first_ts, last_ts, count
+
+    def _write_changestream_segment(self, client, resume: Dict, output) -> tuple:
+        """Writes the changes made up to now, or up to the segment limits, and returns the token to resume after.
+
+        A change stream never ends by itself, so the cluster time is read before it is
+        opened and the segment ends with the first change after it. The token of the last
+        change read is returned, so a change that ended the segment is read again by the
+        next one."""
+        first_ts = last_ts = None
+        count = size = 0
+        end = client.admin.command('ping')['operationTime']
+        token = resume['token']
+        db = client[self.backups.db_name]
+        with db.watch(resume_after=resume['token'], full_document='updateLookup', max_await_time_ms=1000) as stream:
+            while stream.alive:
+                change = stream.try_next()
+                if change is None:
+                    # nothing newer is waiting; the stream's token also covers events it filtered out
+                    token = stream.resume_token
+                    break
+                if change['clusterTime'] > end:
+                    break
+                token = change['_id']
+                entry = self._change_to_oplog(change)
+                if entry is None:
+                    continue
+                data = bson.encode(entry)
+                output.write(data)
+                if first_ts is None:
+                    first_ts = entry['ts']
+                last_ts = entry['ts']
+                count += 1
+                size += len(data)
+                if self._segment_full(count, size):
+                    break
+        return first_ts, last_ts, count, token
+
+    @staticmethod
+    def _change_to_oplog(change: Dict) -> Optional[Dict]:
+        """Converts a change event into an oplog entry that mongorestore --oplogReplay can apply."""
+        operation = change['operationType']
+        database = change['ns']['db']
+        namespace = f"{database}.{change['ns'].get('coll')}"
+        entry = {'ts': change['clusterTime'], 'v': 2, 'wall': change.get('wallTime', datetime.datetime.now(datetime.timezone.utc))}
+        if operation == 'insert':
+            entry.update(op='i', ns=namespace, o=change['fullDocument'])
+        elif operation in ('update', 'replace'):
+            if change.get('fullDocument') is None:
+                return None  # deleted after the update; a delete event follows
+            entry.update(op='u', ns=namespace, o=change['fullDocument'], o2=change['documentKey'])
+        elif operation == 'delete':
+            entry.update(op='d', ns=namespace, o=change['documentKey'])
+        elif operation == 'drop':
+            entry.update(op='c', ns=f"{database}.$cmd", o={'drop': change['ns']['coll']})
+        elif operation == 'rename':
+            target = change['to']
+            entry.update(op='c', ns='admin.$cmd', o={'renameCollection': namespace, 'to': f"{target['db']}.{target['coll']}"})
+        elif operation == 'dropDatabase':
+            entry.update(op='c', ns=f"{database}.$cmd", o={'dropDatabase': 1})
+        else:
+            return None
+        return entry
+
+    def restore(self, until: Union[datetime.datetime, Timestamp, None] = None) -> None:
+        """Restores the base backup and replays the segments in order, up to a point in time.
+
+        Parameters:
+            until [type:datetime|Timestamp] -- (Optional) Last point in time to restore, inclusive.
+                Defaults to the end of the chain."""
+        chain = self.load_chain()
+        if chain is None:
+            raise ChainNotFoundError(self.chain_dir)
+        limit = None
+        if isinstance(until, datetime.datetime):
+            # oplog timestamps have a resolution of one second; --oplogLimit is exclusive
+            limit = Timestamp(int(until.timestamp()) + 1, 0)
+        elif isinstance(until, Timestamp):
+            limit = Timestamp(until.time, until.inc + 1)
+
+        base_dir = os.path.join(self.chain_dir, chain['base']['dir'], chain['db'])
+        if not os.path.exists(base_dir):
+            raise DirectoryNotFoundError(base_dir)
+        self.backups.restore(bck_dir=base_dir)
+
+        segments = [s for s in chain['segments'] if limit is None or s['first_ts'] < limit]
+        with tempfile.TemporaryDirectory() as empty_dir:
+            for segment in segments:
+                command = self.backups._base_command('mongorestore', with_db=False) + [
+                    '--oplogReplay',
+                    '--oplogFile', os.path.join(self.chain_dir, segment['file']),
+                    ]
+                if limit is not None and segment['last_ts'] >= limit:
+                    command.extend(['--oplogLimit', f"{limit.time}:{limit.inc}"])
+                command.append(empty_dir)
+                result = subprocess.run(command, capture_output=True, text=True)
+                if result.returncode != 0:
+                    raise UnexpectedError(result.stderr)
+                print(f"Replayed {segment['file']} ({segment['count']} changes)")
+        print(f"Restore succesful; restored base and {len(segments)} incremental segments from: {self.chain_dir}")
+
+    def segments(self) -> List[Dict]:
+        """Returns the ordered list of incremental segments in the chain."""
+        chain = self.load_chain()
+        return chain['segments'] if chain else []
@@ -0,0 +1,233 @@
+import os
+import json
+import struct
+import fnmatch
+import hashlib
+import datetime
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING, Dict, Iterable, Iterator, List
+
+from mongogbackup import targz
+from mongogbackup.backups import MongoBackupHandler
+from mongogbackup.files import FileEncryptor
+from mongogbackup.manifest import BackupManifest
+
+if TYPE_CHECKING:
+    from mongogbackup.gdrive import GoogleDriveHandler
+    from mongogbackup.storage import StorageBackend
+
+_TRAILER = struct.Struct(">4sQQ")
+_TRAILER_MAGIC = b"MGBI"
+
+class NotIndexedError(Exception):
+    """Raised when a file is not an indexed archive."""
+    def __init__(self, name: str):
+        self.name = name
+    def __str__(self):
+        return f"{self.name} is not an indexed archive. Create it with MongoGBackup.indexed_backup()."
+
+class CollectionNotInBackupError(Exception):
+    """Raised when requested collections are not part of the backup."""
+    def __init__(self, collections: List[str]):
+        self.collections = collections
+    def __str__(self):
+        return f"The backup does not contain: {', '.join(self.collections)}"
+
+class LocalArchive:
+    """Random access to an indexed archive on the local disk."""
+
+    def __init__(self, path: str, chunk_size: int = 8 * 1024 * 1024) -> None:
+        self.path = path
+        self.name = os.path.basename(path)
+        self.chunk_size = chunk_size
+
+    def size(self) -> int:
+        return os.path.getsize(self.path)
+
+    def read(self, start: int, length: int) -> bytes:
+        with open(self.path, 'rb') as f:
+            f.seek(start)
+            return f.read(length)
+
+    def stream(self, start: int, length: int) -> Iterator[bytes]:
+        with open(self.path, 'rb') as f:
+            f.seek(start)
+            while length > 0:
+                data = f.read(min(self.chunk_size, length))
+                if not data:
+                    return
+                length -= len(data)
+                yield data
+
+class DriveArchive:
+    """Random access to an indexed archive on Google Drive through ranged downloads."""
+
+    def __init__(self, gdrive: 'GoogleDriveHandler', file: Dict, chunk_size: int = 8 * 1024 * 1024, workers: int = 4) -> None:
+        """Parameters:
+            gdrive -- Google Drive handler.
+            file -- Drive file resource with 'id', 'name' and 'size' (see GoogleDriveHandler.find_latest_file()).
+            chunk_size, workers -- Ranged request size and concurrency."""
+        self.gdrive = gdrive
+        self.file_id = file['id']
+        self.name = file.get('name', file['id'])
+        self._size = int(file['size']) if 'size' in file else None
+        self.chunk_size = chunk_size
+        self.workers = workers
+
+    def size(self) -> int:
+        if self._size is None:
+            self._size = int(self.gdrive.get_file_metadata(self.file_id, fields='size')['size'])
+        return self._size
+
+    def read(self, start: int, length: int) -> bytes:
+        return self.gdrive._get_range(self.file_id, start, start + length - 1)
+
+    def stream(self, start: int, length: int) -> Iterator[bytes]:
+        return self.gdrive.download_stream(self.file_id, self.chunk_size, self.workers, start=start, end=start + length)
+
+class StorageArchive:
+    """Random access to an indexed archive in any storage backend through ranged reads."""
+
+    def __init__(self, storage: 'StorageBackend', file: Dict, chunk_size: int = 8 * 1024 * 1024, workers: int = 4) -> None:
+        """Parameters:
+            storage -- Storage backend holding the archive.
+            file -- Stored file with 'id', 'name' and 'size' (see StorageBackend.find_latest()).
+            chunk_size, workers -- Ranged read size and concurrency."""
+        self.storage = storage
+        self.file_id = file['id']
+        self.name = file.get('name', file['id'])
+        self._size = int(file['size']) if 'size' in file else None
+        self.chunk_size = chunk_size
+        self.workers = workers
+
+    def size(self) -> int:
+        if self._size is None:
+            self._size = self.storage.size(self.file_id)
+        return self._size
+
+    def read(self, start: int, length: int) -> bytes:
+        return self.storage.read_range(self.file_id, start, start + length - 1)
+
+    def stream(self, start: int, length: int) -> Iterator[bytes]:
+        return self.storage.download_stream(self.file_id, self.chunk_size, self.workers, start=start, end=start + length)
+
+def write_archive(backups: MongoBackupHandler, encryptor: FileEncryptor, output_path: str, collections: List[str] = None,
+                  codec: str = 'gzip', level: int = None, workers: int = None) -> BackupManifest:
+    """Dumps a database into an indexed archive and returns its signed manifest.
+
+    Layout:
+
+        segment per collection  -- mongodump --archive of one collection, compressed and
+                                   encrypted as an independent container
+        index                   -- encrypted JSON listing every segment's byte range
+        trailer                 -- b"MGBI" | index offset (8 bytes) | index length (8 bytes)
+
+    Each segment can be fetched, decrypted and decompressed on its own and is a complete
+    archive that mongorestore --archive accepts on stdin."""
+    targets = backups.list_collections()
+    if collections is not None:
+        targets = [c for c in targets if c['name'] in collections]
+    md5 = hashlib.md5()
+    sha = hashlib.sha256()
+    entries = []
+    offset = 0
+    with open(output_path, 'wb') as output:
+        def write(data: bytes) -> None:
+            nonlocal offset
+            output.write(data)
+            md5.update(data)
+            sha.update(data)
+            offset += len(data)
+
+        for collection in targets:
+            start = offset
+            plain = hashlib.sha256()
+            size = 0
+            def dumped():
+                nonlocal size
+                for chunk in backups.dump_stream(collection=collection['name']):
+                    plain.update(chunk)
+                    size += len(chunk)
+                    yield chunk
+            for data in encryptor.encrypt_stream(targz.compress_stream(dumped(), level, codec, workers)):
+                write(data)
+            entries.append({
+                'name': collection['name'],
+                'size': size,
+                'count': collection['count'],
+                'sha256': plain.hexdigest(),
+                'segment': {'offset': start, 'length': offset - start},
+            })
+            print(f"Archived {collection['name']} ({size} bytes)")
+
+        index = {'db': backups.db_name, 'segments': [{'name': e['name'], **e['segment']} for e in entries]}
+        index_offset = offset
+        for data in encryptor.encrypt_stream([json.dumps(index).encode()]):
+            write(data)
+        write(_TRAILER.pack(_TRAILER_MAGIC, index_offset, offset - index_offset))
+
+    manifest = BackupManifest({
+        'version': BackupManifest.VERSION,
+        'db': backups.db_name,
+        'created': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        'archive': {
+            'name': os.path.basename(output_path),
+            'format': 'indexed',
+            'codec': codec,
+            'level': level,
+            'size': offset,
+            'md5': md5.hexdigest(),
+            'sha256': sha.hexdigest(),
+            'encryption': encryptor.parameters(),
+        },
+        'collections': entries,
+    })
+    return manifest.sign(encryptor)
+
+def read_index(archive, encryptor: FileEncryptor) -> Dict:
+    """Reads and decrypts the index of an indexed archive with two small ranged reads."""
+    size = archive.size()
+    if size < _TRAILER.size:
+        raise NotIndexedError(archive.name)
+    magic, index_offset, index_length = _TRAILER.unpack(archive.read(size - _TRAILER.size, _TRAILER.size))
+    if magic != _TRAILER_MAGIC or index_offset + index_length != size - _TRAILER.size:
+        raise NotIndexedError(archive.name)
+    blob = archive.read(index_offset, index_length)
+    return json.loads(b''.join(encryptor.decrypt_stream([blob])))
+
+def select_segments(index: Dict, collections: Iterable[str] = None, ns_filter: str = None) -> List[Dict]:
+    """Picks the segments of the requested collections.
+
+    Parameters:
+        collections -- (Optional) Collection names. Every name must be in the archive.
+        ns_filter -- (Optional) Glob pattern on "<db>.<collection>", e.g. "shop.orders_*"."""
+    segments = index['segments']
+    if collections is not None:
+        wanted = list(collections)
+        known = {s['name'] for s in segments}
+        missing = [name for name in wanted if name not in known]
+        if missing:
+            raise CollectionNotInBackupError(missing)
+        segments = [s for s in segments if s['name'] in wanted]
+    if ns_filter is not None:
+        segments = [s for s in segments if fnmatch.fnmatchcase(f"{index['db']}.{s['name']}", ns_filter)]
+    return segments
+
+def restore(backups: MongoBackupHandler, encryptor: FileEncryptor, archive, collections: Iterable[str] = None,
+            ns_filter: str = None, drop: bool = False, workers: int = 1) -> List[str]:
+    """Restores selected collections from an indexed archive, reading only their byte ranges.
+
+    Each segment is streamed through decryption and decompression into its own
+    mongorestore --archive process; `workers` segments are restored at the same time.
+
+    Returns:
+        list -- Names of the restored collections."""
+    segments = select_segments(read_index(archive, encryptor), collections, ns_filter)
+
+    def restore_segment(segment: Dict) -> str:
+        chunks = archive.stream(segment['offset'], segment['length'])
+        backups.restore_stream(targz.decompress_stream(encryptor.decrypt_stream(chunks)), drop=drop)
+        return segment['name']
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(restore_segment, segments))
@@ -0,0 +1,219 @@
+import json
+import time
+import threading
+from typing import Dict, Iterable, Iterator, List, Tuple
+
+from pymongo import MongoClient
+from pymongo.errors import OperationFailure, PyMongoError
+
+from mongogbackup.metrics import logger, registry
+from mongogbackup.pipeline import RateLimiter
+
+_MODES = ('primary', 'primaryPreferred', 'secondary', 'secondaryPreferred', 'nearest')
+
+class LowImpactMode:
+    """Settings for dumping with as little effect on production traffic as possible.
+
+    Dumps read from a member chosen by read preference and tags instead of the configured
+    host, at no more than a fixed number of bytes or documents per second. With
+    adaptive=True the rate is halved whenever the source server shows load, and raised again
+    step by step while it is healthy. Load means replication lag, queued operations or
+    WiredTiger cache pressure, read from replSetGetStatus and serverStatus every `interval`
+    seconds.
+
+    The byte cap applies to streaming dumps (dump_stream(), stream_backup()) and to the native
+    engine. The document cap needs the native engine, which sees individual documents.
+    mongodump writing to a directory cannot be throttled; it is only pointed at the
+    secondary and limited to one collection at a time."""
+
+    def __init__(self, read_preference: str = 'secondary', tags: List[Dict[str, str]] = None, max_mb_per_second: float = None,
+                 max_docs_per_second: float = None, adaptive: bool = True, interval: float = 5.0, max_replication_lag: float = 10.0,
+                 max_queued_operations: int = 10, max_cache_fill: float = 0.9, max_cache_dirty: float = 0.1,
+                 min_rate_fraction: float = 0.1) -> None:
+        """Parameters:
+            read_preference [type:String] -- 'secondary', 'secondaryPreferred', 'nearest', ... Defaults to 'secondary'.
+            tags [type:list] -- (Optional) Tag sets in order of preference, e.g. [{"use": "backup"}, {}].
+            max_mb_per_second [type:float] -- (Optional) Read throughput cap in Mb/s.
+            max_docs_per_second [type:float] -- (Optional) Read throughput cap in documents/s (native engine).
+            adaptive [type:bool] -- Adjust the rate to the load of the source server. Defaults to True.
+            interval [type:float] -- Seconds between load checks. Defaults to 5.
+            max_replication_lag [type:float] -- Seconds of lag of the source member considered load. Defaults to 10.
+            max_queued_operations [type:int] -- Operations queued for locks or tickets considered load. Defaults to 10.
+            max_cache_fill [type:float] -- WiredTiger cache fill ratio considered load. Defaults to 0.9.
+            max_cache_dirty [type:float] -- WiredTiger dirty cache ratio considered load. Defaults to 0.1.
+            min_rate_fraction [type:float] -- The rate is never lowered below this fraction of the cap. Defaults to 0.1."""
+        if read_preference not in _MODES:
+            raise ValueError(f"read_preference must be one of {', '.join(_MODES)}")
+        self.read_preference = read_preference
+        self.tags = tags
+        self.max_bytes_per_second = max_mb_per_second * 1024 * 1024 if max_mb_per_second else None
+        self.max_docs_per_second = max_docs_per_second
+        self.adaptive = adaptive
+        self.interval = interval
+        self.max_replication_lag = max_replication_lag
+        self.max_queued_operations = max_queued_operations
+        self.max_cache_fill = max_cache_fill
+        self.max_cache_dirty = max_cache_dirty
+        self.min_rate_fraction = min_rate_fraction
+
+    def client_options(self) -> Dict:
+        """MongoClient keyword arguments selecting the read preference and tags."""
+        options = {'readPreference': self.read_preference}
+        if self.tags:
+            options['readPreferenceTags'] = [','.join(f"{key}:{value}" for key, value in tag_set.items()) for tag_set in self.tags]
+        return options
+
+    def read_preference_argument(self) -> str:
+        """Value of mongodump's --readPreference option."""
+        preference = {'mode': self.read_preference}
+        if self.tags:
+            preference['tagSets'] = self.tags
+        return json.dumps(preference)
+
+    def select_source(self, client: MongoClient) -> Tuple[str, int]:
+        """Asks a member matching the read preference for its own address.
+
+        Parameters:
+            client [type:MongoClient] -- Client opened with client_options().
+
+        Returns:
+            tuple -- (host, port) of the member to dump from."""
+        # Database.command() ignores the client's read preference unless it is passed
+        hello = client.admin.command('hello', read_preference=client.read_preference)
+        address = hello.get('me')
+        if address is None:  # not a replica set
+            return client.address
+        host, _, port = address.rpartition(':')
+        return host, int(port)
+
+    @staticmethod
+    def server_load(client: MongoClient) -> Dict:
+        """Reads the load signals of the server a direct client is connected to.
+
+        Returns:
+            dict -- replication_lag (seconds), queued_operations, cache_fill and cache_dirty
+                    (ratios of the configured cache size). Signals the server does not report are None."""
+        load = {'replication_lag': None, 'queued_operations': None, 'cache_fill': None, 'cache_dirty': None}
+        status = client.admin.command('serverStatus', repl=0, metrics=0, locks=0, tcmalloc=0)
+        queue = status.get('globalLock', {}).get('currentQueue')
+        if queue is not None:
+            load['queued_operations'] = int(queue.get('total', 0))
+        cache = status.get('wiredTiger', {}).get('cache', {})
+        size = cache.get('maximum bytes configured')
+        if size:
+            load['cache_fill'] = cache.get('bytes currently in the cache', 0) / size
+            load['cache_dirty'] = cache.get('tracked dirty bytes in the cache', 0) / size
+        try:
+            members = client.admin.command('replSetGetStatus')['members']
+            primary = next((m for m in members if m.get('stateStr') == 'PRIMARY'), None)
+            this = next((m for m in members if m.get('self')), None)
+            if primary is not None and this is not None:
+                load['replication_lag'] = max(0.0, (primary['optimeDate'] - this['optimeDate']).total_seconds())
+        except OperationFailure:
+            pass  # not a replica set, or no clusterMonitor role
+        return load
+
+    def pressure(self, load: Dict) -> List[str]:
+        """Names of the signals above their limits."""
+        limits = {
+            'replication_lag': self.max_replication_lag,
+            'queued_operations': self.max_queued_operations,
+            'cache_fill': self.max_cache_fill,
+            'cache_dirty': self.max_cache_dirty,
+        }
+        return [name for name, limit in limits.items() if load.get(name) is not None and limit is not None and load[name] > limit]
+
+    def throttle(self, handler) -> 'Throttle':
+        """Throttle for one dump of the handler's database. Use it as a context manager."""
+        return Throttle(self, handler)
+
+class Throttle:
+    """Limits the read rate of one dump and, in adaptive mode, adjusts it to the server's load.
+
+    Without a configured cap, the first sign of load sets the cap to the throughput
+    measured until then, and adaptation continues from there."""
+
+    def __init__(self, mode: LowImpactMode, handler) -> None:
+        self.mode = mode
+        self.handler = handler
+        self.factor = 1.0
+        self.max_bytes = mode.max_bytes_per_second
+        self.max_docs = mode.max_docs_per_second
+        self.bytes = RateLimiter(self.max_bytes) if self.max_bytes else None
+        self.documents = RateLimiter(self.max_docs) if self.max_docs else None
+        self._read = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def reserve(self, size: int, documents: int = 0) -> float:
+        """Accounts for `size` bytes and `documents` documents and returns the seconds to wait."""
+        with self._lock:
+            self._read += size
+        wait = 0
+        if self.bytes is not None:
+            wait = self.bytes.reserve(size)
+        if self.documents is not None and documents:
+            wait = max(wait, self.documents.reserve(documents))
+        return wait
+
+    def acquire(self, size: int, documents: int = 0) -> None:
+        """Blocks until `size` bytes and `documents` documents may be read."""
+        wait = self.reserve(size, documents)
+        if wait:
+            time.sleep(wait)
+
+    def throttle(self, chunks: Iterable[bytes]) -> Iterator[bytes]:
+        """Passes chunks through at the throttled rate."""
+        for chunk in chunks:
+            self.acquire(len(chunk))
+            yield chunk
+
+    def adjust(self, load: Dict, seconds: float) -> None:
+        """Halves the rate if the load is too high, otherwise raises it by a tenth of the cap."""
+        with self._lock:
+            observed = self._read / seconds if seconds else 0
+            self._read = 0
+        reasons = self.mode.pressure(load)
+        if reasons:
+            if self.max_bytes is None and observed:
+                self.max_bytes = observed
+                self.bytes = RateLimiter(observed)
+            factor = max(self.mode.min_rate_fraction, self.factor / 2)
+        else:
+            factor = min(1.0, self.factor + 0.1)
+        if factor == self.factor:
+            return
+        self.factor = factor
+        if self.bytes is not None:
+            self.bytes.set_rate(self.max_bytes * factor)
+        if self.documents is not None:
+            self.documents.set_rate(self.max_docs * factor)
+        registry.event('throttle', db=self.handler.db_name, factor=factor, reasons=reasons,
+                       mb_per_second=self.max_bytes * factor / 1048576 if self.max_bytes else None,
+                       docs_per_second=self.max_docs * factor if self.max_docs else None, **load)
+
+    def _monitor(self, client: MongoClient) -> None:
+        checked = time.monotonic()
+        while not self._stop.wait(self.mode.interval):
+            try:
+                load = self.mode.server_load(client)
+            except PyMongoError as e:
+                logger.warning("Could not read the server load: %s", e)
+                continue
+            now = time.monotonic()
+            self.adjust(load, now - checked)
+            checked = now
+
+    def __enter__(self) -> 'Throttle':
+        if self.mode.adaptive:
+            host, port = self.handler.dump_source()
+            client = self.handler._client(host=host, port=port, directConnection=True)
+            self._thread = threading.Thread(target=self._monitor, args=(client,), daemon=True)
+            self._thread.start()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
@@ -0,0 +1,241 @@
+import os
+import hmac
+import json
+import base64
+import hashlib
+import datetime
+import tempfile
+from typing import Dict, Iterable, List, Optional
+
+from mongogbackup import targz
+from mongogbackup.files import FileEncryptor
+
+class ManifestSignatureError(Exception):
+    """Raised when a manifest is unsigned or its signature does not match its content."""
+    def __init__(self, name: str):
+        self.name = name
+    def __str__(self):
+        return f"The signature of manifest {self.name} is missing or invalid. The manifest was modified or signed with another key."
+
+class CorruptedDumpError(Exception):
+    """Raised when a .bson file is not a sequence of complete BSON documents."""
+    def __init__(self, file_path: str):
+        self.file_path = file_path
+    def __str__(self):
+        return f"{self.file_path} is truncated or is not a BSON file."
+
+def bson_file_stats(file_path: str, buf_size: int = 1 << 20) -> Dict:
+    """Returns the size, document count and SHA-256 of a .bson file in a single read.
+
+    Documents are counted by walking their length prefixes, without decoding them."""
+    sha = hashlib.sha256()
+    buffer = bytearray()
+    base = 0  # file offset of buffer[0]
+    next_document = 0
+    count = 0
+    with open(file_path, 'rb') as f:
+        while True:
+            data = f.read(buf_size)
+            if not data:
+                break
+            sha.update(data)
+            buffer += data
+            while next_document + 4 <= base + len(buffer):
+                start = next_document - base
+                length = int.from_bytes(buffer[start:start + 4], 'little')
+                if length < 5:
+                    raise CorruptedDumpError(file_path)
+                next_document += length
+                count += 1
+            consumed = min(next_document - base, len(buffer))
+            del buffer[:consumed]
+            base += consumed
+    if next_document != base + len(buffer):
+        raise CorruptedDumpError(file_path)
+    return {'size': next_document, 'count': count, 'sha256': sha.hexdigest()}
+
+def _file_stats(file_path: str) -> Dict:
+    sha = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for data in iter(lambda: f.read(1 << 20), b''):
+            sha.update(data)
+    return {'size': os.path.getsize(file_path), 'sha256': sha.hexdigest()}
+
+def collection_entries(dump_dir: str, collections: Iterable[str] = None) -> List[Dict]:
+    """Describes the collections of a mongodump output directory (<dir>/<db_name>/)."""
+    entries = []
+    wanted = set(collections) if collections is not None else None
+    for file in sorted(os.listdir(dump_dir)):
+        if not file.endswith('.bson'):
+            continue
+        name = file[:-len('.bson')]
+        if wanted is not None and name not in wanted:
+            continue
+        entry = dict(bson_file_stats(os.path.join(dump_dir, file)), name=name, file=file)
+        metadata_file = f"{name}.metadata.json"
+        if os.path.exists(os.path.join(dump_dir, metadata_file)):
+            entry['metadata'] = dict(_file_stats(os.path.join(dump_dir, metadata_file)), file=metadata_file)
+        entries.append(entry)
+    return entries
+
+class BackupManifest:
+    """Structured, signed description of a backup, stored next to it as <file_name>.manifest.json.
+
+    The manifest records every collection's size, document count and SHA-256, where its
+    files are in the archive, the compression codec, the encryption parameters and the
+    size, MD5 and SHA-256 of the uploaded file. It is signed with an HMAC-SHA256 key
+    derived from the encryption key, so it can be read without the key but not modified.
+
+    With it, a backup can be checked against the size and MD5 Google Drive reports without
+    downloading it (verify_remote()), collections that changed since an earlier backup can
+    be listed (changed_collections()) and individual collections of an extracted dump can
+    be verified (verify_dump())."""
+
+    VERSION = 1
+    SUFFIX = '.manifest.json'
+
+    def __init__(self, data: Dict) -> None:
+        self.data = data
+
+    @property
+    def name(self) -> str:
+        return self.data.get('archive', {}).get('name', '')
+
+    @property
+    def collections(self) -> List[Dict]:
+        return self.data.get('collections', [])
+
+    def collection(self, name: str) -> Optional[Dict]:
+        """Returns the entry of a collection, or None if the backup does not contain it."""
+        return next((c for c in self.collections if c['name'] == name), None)
+
+    @staticmethod
+    def _signing_key(encryptor: FileEncryptor) -> bytes:
+        master = base64.urlsafe_b64decode(encryptor.get_key())
+        return hmac.new(master, b'mongogbackup manifest', hashlib.sha256).digest()
+
+    def _canonical(self) -> bytes:
+        unsigned = {key: value for key, value in self.data.items() if key != 'signature'}
+        return json.dumps(unsigned, sort_keys=True, separators=(',', ':')).encode()
+
+    def sign(self, encryptor: FileEncryptor) -> 'BackupManifest':
+        """Signs the manifest with a key derived from the encryption key."""
+        self.data['signature'] = hmac.new(self._signing_key(encryptor), self._canonical(), hashlib.sha256).hexdigest()
+        return self
+
+    def verify_signature(self, encryptor: FileEncryptor) -> None:
+        """Raises ManifestSignatureError unless the manifest was signed with this key and not modified since."""
+        expected = hmac.new(self._signing_key(encryptor), self._canonical(), hashlib.sha256).hexdigest()
+        if not hmac.compare_digest(expected, self.data.get('signature', '')):
+            raise ManifestSignatureError(self.name)
+
+    def to_bytes(self) -> bytes:
+        return json.dumps(self.data, indent=2, sort_keys=True).encode()
+
+    @classmethod
+    def from_bytes(cls, data: bytes, encryptor: FileEncryptor = None) -> 'BackupManifest':
+        """Parses a manifest, verifying its signature when an encryptor is given."""
+        manifest = cls(json.loads(data))
+        if encryptor is not None:
+            manifest.verify_signature(encryptor)
+        return manifest
+
+    def save(self, path: str) -> str:
+        with open(path, 'wb') as f:
+            f.write(self.to_bytes())
+        return path
+
+    @classmethod
+    def load(cls, path: str, encryptor: FileEncryptor = None) -> 'BackupManifest':
+        with open(path, 'rb') as f:
+            return cls.from_bytes(f.read(), encryptor)
+
+    def verify_remote(self, metadata: Dict) -> Dict:
+        """Compares the archive with the size and MD5 that the storage reports for the uploaded file.
+
+        Parameters:
+            metadata -- Stored file with 'size' and 'md5Checksum' (see GoogleDriveHandler.get_file_metadata()
+                        and storage.StorageBackend.find_latest()).
+
+        Returns:
+            dict -- {"ok": bool, "size": bool, "md5": bool}. md5 is None when the storage does not
+                    report an MD5 (S3 multipart objects); ok then only reflects the size."""
+        archive = self.data['archive']
+        size_ok = int(metadata.get('size', -1)) == archive['size']
+        md5_ok = metadata['md5Checksum'] == archive['md5'] if 'md5Checksum' in metadata else None
+        return {'ok': size_ok and md5_ok is not False, 'size': size_ok, 'md5': md5_ok}
+
+    def changed_collections(self, previous: Optional['BackupManifest']) -> List[str]:
+        """Names of the collections that are new or whose content differs from an earlier backup."""
+        if previous is None:
+            return [c['name'] for c in self.collections]
+        earlier = {c['name']: c['sha256'] for c in previous.collections}
+        return [c['name'] for c in self.collections if earlier.get(c['name']) != c['sha256']]
+
+    def verify_dump(self, dump_dir: str, collections: Iterable[str] = None) -> Dict[str, bool]:
+        """Checks collections of an extracted dump against the manifest, reading only their files.
+
+        Returns:
+            dict -- True or False for every checked collection."""
+        names = list(collections) if collections is not None else [c['name'] for c in self.collections]
+        results = {}
+        for name in names:
+            expected = self.collection(name)
+            path = os.path.join(dump_dir, f"{name}.bson")
+            if expected is None or not os.path.exists(path):
+                results[name] = False
+                continue
+            try:
+                actual = bson_file_stats(path)
+            except CorruptedDumpError:
+                results[name] = False
+                continue
+            results[name] = actual['sha256'] == expected['sha256'] and actual['count'] == expected['count']
+        return results
+
+def create_archive(dump_dir: str, archive_path: str, encryptor: FileEncryptor, db_name: str = None,
+                   codec: str = 'gzip', level: int = None, workers: int = None) -> BackupManifest:
+    """Packs, compresses and encrypts a mongodump output directory and returns its signed manifest.
+
+    The MD5 and SHA-256 of the encrypted archive are computed while it is written."""
+    entries = collection_entries(dump_dir)
+    members = []
+    handle, compressed_path = tempfile.mkstemp(suffix='.tar', dir=os.path.dirname(os.path.abspath(archive_path)))
+    os.close(handle)
+    try:
+        targz.pack(dump_dir, compressed_path, codec=codec, level=level, workers=workers, index=members)
+        compressed_size = os.path.getsize(compressed_path)
+        md5 = hashlib.md5()
+        sha = hashlib.sha256()
+        with open(compressed_path, 'rb') as source, open(archive_path, 'wb') as destination:
+            for data in encryptor.encrypt_stream(source):
+                destination.write(data)
+                md5.update(data)
+                sha.update(data)
+    finally:
+        os.remove(compressed_path)
+
+    offsets = {os.path.basename(member['name']): member for member in members}
+    for entry in entries:
+        member = offsets.get(entry['file'])
+        if member is not None:
+            entry['tar'] = {'offset': member['offset'], 'data_offset': member['data_offset']}
+
+    manifest = BackupManifest({
+        'version': BackupManifest.VERSION,
+        'db': db_name if db_name is not None else os.path.basename(os.path.normpath(dump_dir)),
+        'created': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        'archive': {
+            'name': os.path.basename(archive_path),
+            'format': 'tar',
+            'codec': codec,
+            'level': level,
+            'compressed_size': compressed_size,
+            'size': os.path.getsize(archive_path),
+            'md5': md5.hexdigest(),
+            'sha256': sha.hexdigest(),
+            'encryption': encryptor.parameters(),
+        },
+        'collections': entries,
+    })
+    return manifest.sign(encryptor)
@@ -0,0 +1,205 @@
+import os
+import json
+import time
+import logging
+import datetime
+import threading
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+logger = logging.getLogger('mongogbackup')
+
+class StageStats:
+    """Timing, volume and backpressure of one stage (a pipeline stage or a standalone operation).
+
+    stall_in is time spent waiting for input from the previous stage, stall_out time spent
+    blocked because the next stage's queue was full. Together with the queue depths they
+    show which stage is the bottleneck: it is the one the others stall on."""
+
+    FIELDS = ('runs', 'wall_seconds', 'cpu_seconds', 'bytes_in', 'bytes_out', 'chunks_in', 'chunks_out',
+              'stall_in_seconds', 'stall_out_seconds', 'queue_depth_max', 'queue_depth_sum', 'queue_samples')
+
+    def __init__(self, stage: str, pipeline: str = None) -> None:
+        self.stage = stage
+        self.pipeline = pipeline
+        for field in self.FIELDS:
+            setattr(self, field, 0)
+
+    def sample_queue(self, depth: int) -> None:
+        self.queue_depth_max = max(self.queue_depth_max, depth)
+        self.queue_depth_sum += depth
+        self.queue_samples += 1
+
+    def merge(self, other: 'StageStats') -> None:
+        for field in self.FIELDS:
+            if field == 'queue_depth_max':
+                self.queue_depth_max = max(self.queue_depth_max, other.queue_depth_max)
+            else:
+                setattr(self, field, getattr(self, field) + getattr(other, field))
+
+    def as_dict(self) -> Dict:
+        data = {field: getattr(self, field) for field in self.FIELDS if field not in ('queue_depth_sum', 'queue_samples')}
+        data.update(
+            stage=self.stage,
+            pipeline=self.pipeline,
+            queue_depth_avg=self.queue_depth_sum / self.queue_samples if self.queue_samples else 0.0,
+            mb_per_second=(max(self.bytes_in, self.bytes_out) / 1048576 / self.wall_seconds) if self.wall_seconds else 0.0,
+        )
+        return data
+
+class Metrics:
+    """Collects stage statistics and counters and publishes them.
+
+    Every finished stage or operation is published as an event to the registered callbacks
+    and as a structured log record on the 'mongogbackup' logger (the JSON event is the
+    message and is also attached as record.mongogbackup). The accumulated values can be
+    written as a Prometheus text exposition file, e.g. for node_exporter's textfile
+    collector."""
+
+    def __init__(self, prefix: str = 'mongogbackup', prometheus_path: str = None, log_level: int = logging.INFO) -> None:
+        """Parameters:
+            prefix -- Prefix of the Prometheus metric names.
+            prometheus_path -- (Optional) File rewritten after every event.
+            log_level -- Level of the structured log records. Defaults to INFO."""
+        self.prefix = prefix
+        self.prometheus_path = prometheus_path
+        self.log_level = log_level
+        self._stages: Dict[Tuple[Optional[str], str], StageStats] = {}
+        self._counters: Dict[Tuple[str, Tuple], float] = {}
+        self._callbacks: List[Callable[[Dict], None]] = []
+        self._lock = threading.Lock()
+
+    def add_callback(self, callback: Callable[[Dict], None]) -> None:
+        """Registers a function called with every event (a dict with at least 'event' and 'time')."""
+        self._callbacks.append(callback)
+
+    def remove_callback(self, callback: Callable[[Dict], None]) -> None:
+        self._callbacks.remove(callback)
+
+    def record_stage(self, stats: StageStats, **fields) -> None:
+        """Adds the statistics of a finished stage run to the totals and publishes them."""
+        with self._lock:
+            key = (stats.pipeline, stats.stage)
+            total = self._stages.setdefault(key, StageStats(stats.stage, stats.pipeline))
+            total.merge(stats)
+        self.event('stage', **stats.as_dict(), **fields)
+
+    def increment(self, name: str, value: float = 1, **labels) -> None:
+        """Adds to a counter, e.g. increment('retries_total', operation='upload_chunk')."""
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def event(self, kind: str, **fields) -> Dict:
+        """Publishes an event to the callbacks and the log."""
+        record = dict(event=kind, time=datetime.datetime.now(datetime.timezone.utc).isoformat(), **fields)
+        for callback in list(self._callbacks):
+            try:
+                callback(record)
+            except Exception:
+                logger.exception("Metrics callback failed")
+        if logger.isEnabledFor(self.log_level):
+            logger.log(self.log_level, json.dumps(record, default=str), extra={'mongogbackup': record})
+        if self.prometheus_path is not None:
+            self.write_prometheus()
+        return record
+
+    @contextmanager
+    def timed(self, stage: str, pipeline: str = None, **fields) -> Iterator[StageStats]:
+        """Measures a standalone operation. Set bytes_in/bytes_out on the yielded stats.
+
+        CPU time is the process CPU time spent during the operation, so it includes helper
+        threads (e.g. compression workers)."""
+        stats = StageStats(stage, pipeline)
+        stats.runs = 1
+        wall, cpu = time.perf_counter(), time.process_time()
+        error = None
+        try:
+            yield stats
+        except BaseException as e:
+            error = repr(e)
+            raise
+        finally:
+            stats.wall_seconds = time.perf_counter() - wall
+            stats.cpu_seconds = time.process_time() - cpu
+            if error is not None:
+                fields['error'] = error
+            self.record_stage(stats, **fields)
+
+    def stages(self) -> List[Dict]:
+        """Totals per stage since the start of the process."""
+        with self._lock:
+            return [stats.as_dict() for stats in self._stages.values()]
+
+    def counters(self) -> Dict[str, float]:
+        with self._lock:
+            return {name + self._labels(dict(labels)): value for (name, labels), value in self._counters.items()}
+
+    @staticmethod
+    def _labels(labels: Dict) -> str:
+        if not labels:
+            return ''
+        def escape(value) -> str:
+            return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+        return '{' + ','.join(f'{key}="{escape(value)}"' for key, value in labels.items()) + '}'
+
+    def prometheus(self) -> str:
+        """Renders the totals in the Prometheus text exposition format."""
+        series = {
+            'stage_runs_total': ('counter', 'Completed runs of the stage.', lambda s: s.runs),
+            'stage_wall_seconds_total': ('counter', 'Wall time spent in the stage.', lambda s: s.wall_seconds),
+            'stage_cpu_seconds_total': ('counter', 'CPU time spent in the stage.', lambda s: s.cpu_seconds),
+            'stage_bytes_in_total': ('counter', 'Bytes consumed by the stage.', lambda s: s.bytes_in),
+            'stage_bytes_out_total': ('counter', 'Bytes produced by the stage.', lambda s: s.bytes_out),
+            'stage_stall_in_seconds_total': ('counter', 'Time the stage waited for input.', lambda s: s.stall_in_seconds),
+            'stage_stall_out_seconds_total': ('counter', 'Time the stage was blocked on a full output queue.', lambda s: s.stall_out_seconds),
+            'stage_queue_depth_max': ('gauge', 'Deepest output queue observed.', lambda s: s.queue_depth_max),
+        }
+        with self._lock:
+            stages = list(self._stages.values())
+            counters = dict(self._counters)
+        lines = []
+        for name, (kind, help_text, value) in series.items():
+            metric = f"{self.prefix}_{name}"
+            lines.append(f"# HELP {metric} {help_text}")
+            lines.append(f"# TYPE {metric} {kind}")
+            for stats in stages:
+                labels = {'stage': stats.stage}
+                if stats.pipeline is not None:
+                    labels['pipeline'] = stats.pipeline
+                lines.append(f"{metric}{self._labels(labels)} {value(stats)}")
+        for name in sorted({name for name, _ in counters}):
+            metric = f"{self.prefix}_{name}"
+            lines.append(f"# TYPE {metric} counter")
+            for (counter, labels), value in counters.items():
+                if counter == name:
+                    lines.append(f"{metric}{self._labels(dict(labels))} {value}")
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, path: str = None) -> str:
+        """Atomically writes the exposition file, so a scraper never reads a partial file."""
+        path = path if path is not None else self.prometheus_path
+        temp_path = path + '.tmp'
+        with open(temp_path, 'w') as f:
+            f.write(self.prometheus())
+        os.replace(temp_path, path)
+        return path
+
+registry = Metrics()
+
+def redact_command(command: List[str]) -> str:
+    """Joins a command line for display, hiding the value of --password."""
+    shown = []
+    hide = False
+    for argument in command:
+        if hide:
+            shown.append('****')
+            hide = False
+        elif argument == '--password':
+            shown.append(argument)
+            hide = True
+        elif argument.startswith('--password='):
+            shown.append('--password=****')
+        else:
+            shown.append(argument)
+    return ' '.join(shown)
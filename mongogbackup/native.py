@@ -0,0 +1,316 @@
+import os
+import json
+import datetime
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterator, List, Tuple
+
+from bson import json_util
+from bson.raw_bson import RawBSONDocument
+from pymongo.collection import Collection
+from pymongo.errors import BulkWriteError, CollectionInvalid
+
+from mongogbackup.manifest import CorruptedDumpError
+from mongogbackup.metrics import registry
+
+_DUPLICATE_KEY = 11000
+
+def _count_documents(batch: bytes) -> int:
+    """Counts the documents of a raw BSON batch by walking their length prefixes."""
+    count = offset = 0
+    while offset < len(batch):
+        offset += int.from_bytes(batch[offset:offset + 4], 'little')
+        count += 1
+    return count
+
+class _Output:
+    """A collection's .bson file, shared by the threads dumping its partitions.
+
+    The file is opened when the first partition starts and closed when the last one is
+    done, so only the collections being dumped hold a file handle."""
+
+    def __init__(self, path: str, partitions: int) -> None:
+        self.path = path
+        self.file = None
+        self.lock = threading.Lock()
+        self.pending = partitions
+        self.bytes = 0
+
+    def partition_started(self) -> None:
+        with self.lock:
+            if self.file is None:
+                self.file = open(self.path, 'wb')
+
+    def write(self, data: bytes) -> None:
+        with self.lock:
+            self.file.write(data)
+            self.bytes += len(data)
+
+    def partition_done(self) -> None:
+        with self.lock:
+            self.pending -= 1
+            if self.pending == 0 and self.file is not None:
+                self.file.close()
+
+    def close(self) -> None:
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+
+class NativeEngine:
+    """Dumps and restores a database with PyMongo alone, without mongodump and mongorestore.
+
+    The output has the layout of mongodump --out (<dir>/<db_name>/<collection>.bson and
+    <collection>.metadata.json), so either engine can restore it. Large collections are split
+    into _id ranges that are scanned in parallel. The ranges are index bounds (min/max on
+    the _id index), so _id values of every type are included. Batches are written as the
+    raw BSON the server sends, without decoding them. Restores insert RawBSONDocuments, so
+    documents are not re-encoded either.
+
+    Like mongodump without --oplog, a dump is not a point-in-time snapshot of a database
+    that is being written to."""
+
+    def __init__(self, handler, batch_size: int = 100000, partition_size: int = 256 * 1024 * 1024,
+                 insert_batch_size: int = 1000, insert_batch_bytes: int = 16 * 1024 * 1024, ordered: bool = False) -> None:
+        """Parameters:
+            handler [type:MongoBackupHandler] -- Provides the database name and the client settings.
+            batch_size [type:int] -- Documents per cursor batch. The server caps batches at 16Mb. Defaults to 100000.
+            partition_size [type:int] -- Approximate bytes per _id range of a collection. Defaults to 256Mb.
+            insert_batch_size [type:int] -- Maximum documents per insert_many() on restore. Defaults to 1000.
+            insert_batch_bytes [type:int] -- Maximum bytes per insert_many() on restore. Defaults to 16Mb.
+            ordered [type:bool] -- Use ordered bulk inserts on restore. Defaults to False."""
+        self.handler = handler
+        self.batch_size = batch_size
+        self.partition_size = partition_size
+        self.insert_batch_size = insert_batch_size
+        self.insert_batch_bytes = insert_batch_bytes
+        self.ordered = ordered
+
+    def partitions(self, collection: Collection, size: int) -> List[Tuple]:
+        """Splits a collection into _id ranges of about partition_size bytes.
+
+        Split points are taken from a server-side sorted $sample of _id values, so the
+        collection is not scanned. Returns (min, max) pairs; None is an open end."""
+        count = size // self.partition_size
+        if count < 2:
+            return [(None, None)]
+        sample = [d['_id'] for d in collection.aggregate([
+            {'$sample': {'size': count * 16}},
+            {'$project': {'_id': 1}},
+            {'$sort': {'_id': 1}},
+        ])]
+        if not sample:
+            # the collection shrank since its size was read
+            return [(None, None)]
+        bounds = []
+        for i in range(1, count):
+            bound = sample[len(sample) * i // count]
+            if not bounds or bounds[-1] != bound:
+                bounds.append(bound)
+        return list(zip([None] + bounds, bounds + [None]))
+
+    def _scan(self, collection: Collection, lower, upper) -> Iterator[bytes]:
+        """Yields the raw BSON batches of one _id range."""
+        options = {'batch_size': self.batch_size}
+        if lower is not None or upper is not None:
+            options['hint'] = [('_id', 1)]
+        if lower is not None:
+            options['min'] = [('_id', lower)]
+        if upper is not None:
+            options['max'] = [('_id', upper)]
+        return collection.find_raw_batches({}, **options)
+
+    @staticmethod
+    def _metadata(database, name: str) -> Dict:
+        """The content of <collection>.metadata.json, as mongodump writes it."""
+        info = next(database.list_collections(filter={'name': name}), {})
+        metadata = {
+            'indexes': list(database[name].list_indexes()),
+            'collectionName': name,
+            'type': info.get('type', 'collection'),
+            'options': info.get('options', {}),
+        }
+        uuid = info.get('info', {}).get('uuid')
+        if uuid is not None:
+            metadata['uuid'] = bytes(uuid).hex()
+        return metadata
+
+    def dump(self, dir: str, workers: int = None, collections: List[str] = None) -> str:
+        """Dumps the database to <dir>/<db_name>/ and writes a manifest like backup_parallel().
+
+        Parameters:
+            dir [type:String] -- Output directory.
+            workers [type:int] -- Number of _id ranges scanned at the same time. Defaults to the number of CPUs.
+            collections [type:list] -- (Optional) Only dump these collections.
+
+        Returns:
+            str -- Path of the manifest file."""
+        targets = self.handler.list_collections()
+        if collections is not None:
+            targets = [c for c in targets if c['name'] in collections]
+        db_dir = os.path.join(dir, self.handler.db_name)
+        os.makedirs(db_dir, exist_ok=True)
+        started = datetime.datetime.now(datetime.timezone.utc)
+
+        client = self.handler._client()
+        database = client[self.handler.db_name]
+        tasks = []
+        outputs = {}
+        for target in targets:
+            name = target['name']
+            with open(os.path.join(db_dir, f"{name}.metadata.json"), 'w') as f:
+                f.write(json_util.dumps(self._metadata(database, name), json_options=json_util.CANONICAL_JSON_OPTIONS))
+            ranges = self.partitions(database[name], target['size'])
+            outputs[name] = _Output(os.path.join(db_dir, f"{name}.bson"), len(ranges))
+            tasks.extend((name, lower, upper) for lower, upper in ranges)
+
+        def dump_range(task: Tuple) -> None:
+            name, lower, upper = task
+            output = outputs[name]
+            try:
+                output.partition_started()
+                with registry.timed('dump', pipeline='native', collection=name) as stats:
+                    for batch in self._scan(database[name], lower, upper):
+                        if throttle is not None:
+                            throttle.acquire(len(batch), _count_documents(batch))
+                        output.write(batch)
+                        stats.bytes_out += len(batch)
+                        stats.chunks_out += 1
+            finally:
+                output.partition_done()
+
+        try:
+            # targets are sorted largest first and the pool starts tasks in submission order
+            with self.handler.throttle() as throttle, ThreadPoolExecutor(max_workers=workers or os.cpu_count() or 1) as executor:
+                list(executor.map(dump_range, tasks))
+        finally:
+            for output in outputs.values():
+                output.close()
+
+        manifest = {
+            'db': self.handler.db_name,
+            'created': started.isoformat(),
+            'engine': 'native',
+            'collections': [
+                {
+                    'name': c['name'],
+                    'size': outputs[c['name']].bytes,
+                    'count': c['count'],
+                    'files': [f"{c['name']}.bson", f"{c['name']}.metadata.json"],
+                    'partitions': sum(1 for task in tasks if task[0] == c['name']),
+                }
+                for c in targets
+                ],
+            }
+        manifest_path = os.path.join(db_dir, 'manifest.json')
+        with open(manifest_path, 'w') as f:
+            json.dump(manifest, f, indent=2)
+        return manifest_path
+
+    def _batches(self, path: str) -> Iterator[List[RawBSONDocument]]:
+        """Reads a .bson file as lists of RawBSONDocuments bounded by the insert batch limits."""
+        batch, batch_bytes = [], 0
+        buffer = b''
+        with open(path, 'rb') as f:
+            while True:
+                data = f.read(1 << 22)
+                if not data:
+                    break
+                buffer += data
+                offset = 0
+                while offset + 4 <= len(buffer):
+                    length = int.from_bytes(buffer[offset:offset + 4], 'little')
+                    if length < 5:
+                        raise CorruptedDumpError(path)
+                    if offset + length > len(buffer):
+                        break
+                    batch.append(RawBSONDocument(buffer[offset:offset + length]))
+                    batch_bytes += length
+                    offset += length
+                    if len(batch) >= self.insert_batch_size or batch_bytes >= self.insert_batch_bytes:
+                        yield batch
+                        batch, batch_bytes = [], 0
+                buffer = buffer[offset:]
+        if buffer:
+            raise CorruptedDumpError(path)
+        if batch:
+            yield batch
+
+    def _insert(self, collection: Collection, batch: List[RawBSONDocument]) -> int:
+        """Inserts a batch, skipping documents whose _id already exists (as mongorestore does).
+
+        Returns:
+            int -- Number of skipped duplicates."""
+        duplicates = 0
+        while batch:
+            try:
+                collection.insert_many(batch, ordered=self.ordered)
+                return duplicates
+            except BulkWriteError as e:
+                errors = e.details.get('writeErrors', [])
+                if any(error['code'] != _DUPLICATE_KEY for error in errors):
+                    raise
+                duplicates += len(errors)
+                if not self.ordered:
+                    return duplicates
+                # an ordered insert stops at the first error; continue after it
+                batch = batch[errors[0]['index'] + 1:]
+        return duplicates
+
+    @staticmethod
+    def _prepare(database, name: str, metadata_path: str, drop: bool) -> List[Dict]:
+        """Creates the collection with its dumped options and returns the indexes to build."""
+        if drop:
+            database.drop_collection(name)
+        if not os.path.exists(metadata_path):
+            return []
+        with open(metadata_path) as f:
+            metadata = json_util.loads(f.read())
+        try:
+            database.create_collection(name, **metadata.get('options', {}))
+        except CollectionInvalid:
+            pass  # already exists
+        indexes = []
+        for index in metadata.get('indexes', []):
+            if index.get('name') == '_id_':
+                continue
+            indexes.append({key: value for key, value in index.items() if key != 'ns'})
+        return indexes
+
+    def restore(self, bck_dir: str, targets: List[Dict], workers: int = None, insertion_workers: int = None, drop: bool = False) -> None:
+        """Restores .bson files with insert_many() bulk writes; indexes are built after the data.
+
+        Parameters:
+            bck_dir [type:String] -- Directory containing the dumped collection files.
+            targets [type:list] -- Collections to restore ({"name": str, ...}), in order.
+            workers [type:int] -- Number of collections restored at the same time. Defaults to the number of CPUs.
+            insertion_workers [type:int] -- Concurrent insert_many() calls per collection. Defaults to 1.
+            drop [type:bool] -- Drop each collection before restoring it. Defaults to False."""
+        client = self.handler._client()
+        database = client[self.handler.db_name]
+
+        def restore_collection(target: Dict) -> None:
+            name = target['name']
+            indexes = self._prepare(database, name, os.path.join(bck_dir, f"{name}.metadata.json"), drop)
+            collection = database[name]
+            parallel = insertion_workers or 1
+            duplicates = 0
+            with registry.timed('restore', pipeline='native', collection=name) as stats:
+                with ThreadPoolExecutor(max_workers=parallel) as inserters:
+                    # at most two batches per inserter are in memory
+                    pending = deque()
+                    for batch in self._batches(os.path.join(bck_dir, f"{name}.bson")):
+                        if len(pending) >= 2 * parallel:
+                            duplicates += pending.popleft().result()
+                        pending.append(inserters.submit(self._insert, collection, batch))
+                        stats.chunks_in += 1
+                        stats.bytes_in += sum(len(document.raw) for document in batch)
+                    duplicates += sum(future.result() for future in pending)
+                if indexes:
+                    database.command('createIndexes', name, indexes=indexes)
+            if duplicates:
+                print(f"{name}: skipped {duplicates} documents with duplicate keys")
+
+        with ThreadPoolExecutor(max_workers=workers or os.cpu_count() or 1) as executor:
+            list(executor.map(restore_collection, targets))
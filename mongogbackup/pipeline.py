@@ -0,0 +1,308 @@
+import queue
+import threading
+import time
+from typing import Callable, Dict, Iterable, Iterator, List, Optional
+
+from mongogbackup.metrics import Metrics, StageStats, registry
+
+_END = object()
+
+class PipelineError(Exception):
+    """Raised when a stage of a streaming pipeline fails."""
+    def __init__(self, stage: str, error: BaseException):
+        self.stage = stage
+        self.error = error
+    def __str__(self):
+        return f"Pipeline stage '{self.stage}' failed: {self.error!r}"
+
+class _Aborted(Exception):
+    """Raised inside a stage when another stage of the pipeline has failed."""
+
+class _Link:
+    """Bounded queue connecting two pipeline stages.
+
+    Both ends poll an abort event so that a failure in any stage unblocks the others
+    instead of leaving them waiting on a full or empty queue forever. Time spent blocked
+    is charged to the producer (stall out) or the consumer (stall in)."""
+
+    def __init__(self, maxsize: int, abort: threading.Event, producer: StageStats, consumer: StageStats) -> None:
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._abort = abort
+        self._producer = producer
+        self._consumer = consumer
+
+    def put(self, item) -> None:
+        if item is not _END:
+            self._producer.bytes_out += len(item)
+            self._producer.chunks_out += 1
+        try:
+            self._queue.put_nowait(item)
+        except queue.Full:
+            blocked = time.perf_counter()
+            while not self._abort.is_set():
+                try:
+                    self._queue.put(item, timeout=0.1)
+                    break
+                except queue.Full:
+                    continue
+            self._producer.stall_out_seconds += time.perf_counter() - blocked
+        self._producer.sample_queue(self._queue.qsize())
+
+    def __iter__(self) -> Iterator[bytes]:
+        while True:
+            if self._abort.is_set():
+                # never let a consumer mistake an aborted stream for a complete one
+                raise _Aborted()
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                waiting = time.perf_counter()
+                try:
+                    item = self._queue.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+                finally:
+                    self._consumer.stall_in_seconds += time.perf_counter() - waiting
+            if item is _END:
+                return
+            self._consumer.bytes_in += len(item)
+            self._consumer.chunks_in += 1
+            yield item
+
+class RateLimiter:
+    """Token bucket limiting the combined throughput of every stream it throttles.
+
+    One limiter can be shared by several pipelines running at the same time, e.g. to keep
+    all uploads together under the uplink bandwidth."""
+
+    def __init__(self, rate: float, burst: float = None) -> None:
+        """Parameters:
+            rate -- Bytes per second.
+            burst -- Bytes that may pass at once after an idle period. Defaults to one second's worth."""
+        if rate <= 0:
+            raise ValueError("rate must be positive")
+        self.rate = rate
+        self.burst = burst if burst is not None else rate
+        self._burst_follows_rate = burst is None
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, size: int) -> float:
+        """Takes `size` bytes from the bucket and returns the seconds to wait before they may pass.
+
+        Lets callers that must not block, e.g. coroutines, do the waiting themselves."""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= size
+            return -self._tokens / self.rate if self._tokens < 0 else 0
+
+    def acquire(self, size: int) -> None:
+        """Blocks until `size` bytes may pass. Sizes larger than the burst are let through in debt."""
+        wait = self.reserve(size)
+        if wait:
+            time.sleep(wait)
+
+    def set_rate(self, rate: float) -> None:
+        """Changes the rate of a limiter that may be in use. The default burst follows the rate."""
+        if rate <= 0:
+            raise ValueError("rate must be positive")
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self.rate = rate
+            if self._burst_follows_rate:
+                self.burst = rate
+                self._tokens = min(self._tokens, self.burst)
+
+    def throttle(self, chunks: Iterable[bytes]) -> Iterator[bytes]:
+        """Pipeline stage passing chunks through at no more than the limiter's rate."""
+        for chunk in chunks:
+            self.acquire(len(chunk))
+            yield chunk
+
+class ProgressMeter:
+    """Counts the bytes passing named points of a pipeline and reports progress and throughput.
+
+    Wrap any iterator of chunks with count(name, chunks). The callback receives a snapshot
+    (see snapshot()) at most every `interval` seconds and once more from finish()."""
+
+    def __init__(self, label: str, total: int = None, interval: float = 1.0, callback: Callable[[Dict], None] = None) -> None:
+        """Parameters:
+            label -- Name printed in progress lines.
+            total -- (Optional) Expected bytes at the first counter, to report a percentage.
+            interval -- Seconds between reports. Defaults to 1.
+            callback -- (Optional) Receives the snapshots. Defaults to printing a progress line."""
+        self.label = label
+        self.total = total
+        self.interval = interval
+        self.callback = callback if callback is not None else self._print
+        self._counts: Dict[str, int] = {}
+        self._first: Dict[str, float] = {}
+        self._started = time.monotonic()
+        self._reported = self._started
+        self._lock = threading.Lock()
+
+    def count(self, name: str, chunks: Iterable[bytes]) -> Iterator[bytes]:
+        """Passes chunks through, counting them under `name`."""
+        with self._lock:
+            self._counts.setdefault(name, 0)
+        for chunk in chunks:
+            self._add(name, len(chunk))
+            yield chunk
+
+    def _add(self, name: str, size: int) -> None:
+        now = time.monotonic()
+        report = None
+        with self._lock:
+            self._counts[name] += size
+            self._first.setdefault(name, now - self._started)
+            if now - self._reported >= self.interval:
+                self._reported = now
+                report = self._snapshot(now)
+        if report is not None:
+            self.callback(report)
+
+    def _snapshot(self, now: float) -> Dict:
+        elapsed = max(now - self._started, 1e-9)
+        snapshot = {
+            'label': self.label,
+            'elapsed': elapsed,
+            'bytes': dict(self._counts),
+            'rates': {name: count / elapsed for name, count in self._counts.items()},
+            'first_byte': dict(self._first),
+            'total': self.total,
+            'percent': None,
+        }
+        if self.total and self._counts:
+            snapshot['percent'] = 100.0 * next(iter(self._counts.values())) / self.total
+        return snapshot
+
+    def snapshot(self) -> Dict:
+        """{"label", "elapsed", "bytes": {name: int}, "rates": {name: bytes/s},
+        "first_byte": {name: seconds until the first byte}, "total", "percent"}"""
+        with self._lock:
+            return self._snapshot(time.monotonic())
+
+    def finish(self) -> Dict:
+        """Reports and returns the final snapshot."""
+        report = self.snapshot()
+        self.callback(report)
+        return report
+
+    @staticmethod
+    def _print(snapshot: Dict) -> None:
+        counters = ", ".join(
+            f"{name} {count / 1048576:.1f}Mb ({snapshot['rates'][name] / 1048576:.1f}Mb/s)"
+            for name, count in snapshot['bytes'].items()
+        )
+        percent = f" {snapshot['percent']:.0f}%" if snapshot['percent'] is not None else ""
+        print(f"{snapshot['label']}:{percent} {counters} in {snapshot['elapsed']:.0f}s")
+
+class Pipeline:
+    """Runs a chain of streaming stages concurrently, one thread per stage.
+
+    A stage is a callable that takes an iterator of byte chunks and returns an iterator
+    of byte chunks. Stages are connected by bounded queues, so at most `queue_size`
+    chunks are buffered between any two stages and memory use does not grow with the
+    size of the data. The sink consumes the output of the last stage in the calling
+    thread and its return value is returned by `run()`.
+
+    Every stage is measured (wall and thread CPU time, bytes in and out, queue depth and
+    time stalled on its neighbours). After a run the statistics are in `stats` and are
+    published to `metrics` (see metrics.Metrics). Work a stage hands to its own thread
+    pool, such as block compression, is not included in its CPU time."""
+
+    def __init__(self, source: Iterable[bytes], stages: List[tuple], sink: Callable[[Iterator[bytes]], object], queue_size: int = 8,
+                 name: str = 'pipeline', metrics: Metrics = None) -> None:
+        """Parameters:
+            source -- Iterable yielding the input byte chunks.
+            stages -- List of (name, callable) pairs applied in order.
+            sink -- Callable consuming the final iterator, run in the calling thread.
+            queue_size -- Maximum number of chunks buffered between two stages. Defaults to 8.
+            name -- Name of the pipeline in published metrics. Defaults to 'pipeline'.
+            metrics -- Where statistics are published. Defaults to metrics.registry."""
+        self.source = source
+        self.stages = stages
+        self.sink = sink
+        self.queue_size = queue_size
+        self.name = name
+        self.metrics = metrics if metrics is not None else registry
+        self.stats: List[StageStats] = []
+        self._abort = threading.Event()
+        self._error: Optional[PipelineError] = None
+        self._lock = threading.Lock()
+
+    def _fail(self, stage: str, error: BaseException) -> None:
+        with self._lock:
+            if self._error is None:
+                self._error = PipelineError(stage, error)
+        self._abort.set()
+
+    def _pump(self, name: str, stats: StageStats, chunks: Callable[[], Iterable[bytes]], out: _Link) -> None:
+        wall, cpu = time.perf_counter(), time.thread_time()
+        try:
+            for chunk in chunks():
+                if self._abort.is_set():
+                    break
+                if chunk:
+                    out.put(chunk)
+        except BaseException as e:
+            self._fail(name, e)
+        finally:
+            out.put(_END)
+            stats.wall_seconds = time.perf_counter() - wall
+            stats.cpu_seconds = time.thread_time() - cpu
+
+    def run(self):
+        """Runs every stage concurrently and returns the result of the sink."""
+        names = ['source'] + [name for name, _ in self.stages] + ['sink']
+        self.stats = [StageStats(name, self.name) for name in names]
+        for stats in self.stats:
+            stats.runs = 1
+        threads = []
+        upstream = _Link(self.queue_size, self._abort, self.stats[0], self.stats[1])
+        threads.append(threading.Thread(target=self._pump, args=('source', self.stats[0], lambda: self.source, upstream), daemon=True))
+        for position, (name, stage) in enumerate(self.stages, start=1):
+            downstream = _Link(self.queue_size, self._abort, self.stats[position], self.stats[position + 1])
+            # the stage is created inside its thread, so its set-up time is measured too
+            threads.append(threading.Thread(target=self._pump, args=(name, self.stats[position], lambda stage=stage, link=upstream: stage(iter(link)), downstream), daemon=True))
+            upstream = downstream
+
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        result = None
+        sink_stats = self.stats[-1]
+        cpu = time.thread_time()
+        try:
+            result = self.sink(iter(upstream))
+        except BaseException as e:
+            self._fail('sink', e)
+        finally:
+            sink_stats.wall_seconds = time.perf_counter() - started
+            sink_stats.cpu_seconds = time.thread_time() - cpu
+            if self._error is not None:
+                self._abort.set()
+            for thread in threads:
+                thread.join()
+            close = getattr(self.source, 'close', None)
+            if close is not None:
+                close()
+            self._publish(time.perf_counter() - started)
+
+        if self._error is not None:
+            raise self._error
+        return result
+
+    def _publish(self, wall_seconds: float) -> None:
+        error = repr(self._error) if self._error is not None else None
+        for stats in self.stats:
+            self.metrics.record_stage(stats)
+        # the bottleneck is the stage its neighbours stall on the most
+        stalls = {stats.stage: stats.stall_in_seconds + stats.stall_out_seconds for stats in self.stats}
+        bottleneck = min(stalls, key=stalls.get) if stalls else None
+        self.metrics.event('pipeline', pipeline=self.name, wall_seconds=wall_seconds, error=error, bottleneck=bottleneck)
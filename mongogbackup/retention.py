@@ -0,0 +1,354 @@
+import os
+import json
+import datetime
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from mongogbackup.files import FileEncryptor
+from mongogbackup.manifest import BackupManifest
+from mongogbackup.metrics import logger, registry
+from mongogbackup.storage import StorageBackend
+
+# rules in the order their reasons are listed, with the calendar bucket each one keeps a backup of
+_PERIODS = (
+    ('hourly', lambda t: (t.year, t.month, t.day, t.hour)),
+    ('daily', lambda t: (t.year, t.month, t.day)),
+    ('weekly', lambda t: tuple(t.isocalendar()[:2])),
+    ('monthly', lambda t: (t.year, t.month)),
+    ('yearly', lambda t: t.year),
+)
+
+def _parse_time(value: str) -> datetime.datetime:
+    """Parses an ISO 8601 time, as written by manifests and storage listings, into an aware UTC datetime."""
+    parsed = datetime.datetime.fromisoformat(value.replace('Z', '+00:00'))
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=datetime.timezone.utc)
+    return parsed.astimezone(datetime.timezone.utc)
+
+class RetentionPolicy:
+    """Which backups to keep, as grandfather-father-son rules plus age and size limits.
+
+    Backups are considered newest first. keep_last keeps the newest ones; hourly, daily,
+    weekly, monthly and yearly each keep the newest backup of that many distinct UTC hours,
+    days, ISO weeks, months and years that have a backup. A backup kept by any rule is kept.
+    max_age and max_total_size then drop kept backups, oldest first: those older than
+    max_age, and those that no longer fit in max_total_size bytes once the newer kept
+    backups are counted. The min_keep newest backups are always kept.
+
+    For example RetentionPolicy(daily=7, weekly=4, monthly=12) keeps a week of daily
+    backups, a month of weekly ones and a year of monthly ones."""
+
+    def __init__(self, hourly: int = 0, daily: int = 0, weekly: int = 0, monthly: int = 0, yearly: int = 0, keep_last: int = 1,
+                 max_age: datetime.timedelta = None, max_total_size: int = None, min_keep: int = 1) -> None:
+        """Parameters:
+            hourly [type:int] -- Number of hours to keep the newest backup of. Defaults to 0.
+            daily [type:int] -- Number of days to keep the newest backup of. Defaults to 0.
+            weekly [type:int] -- Number of ISO weeks to keep the newest backup of. Defaults to 0.
+            monthly [type:int] -- Number of months to keep the newest backup of. Defaults to 0.
+            yearly [type:int] -- Number of years to keep the newest backup of. Defaults to 0.
+            keep_last [type:int] -- Number of newest backups to keep. Defaults to 1.
+            max_age [type:timedelta] -- (Optional) Age above which a backup is deleted even if a rule keeps it.
+            max_total_size [type:int] -- (Optional) Bytes the kept backups may use together.
+            min_keep [type:int] -- Number of newest backups kept whatever the limits. At least 1. Defaults to 1."""
+        counts = {'hourly': hourly, 'daily': daily, 'weekly': weekly, 'monthly': monthly, 'yearly': yearly, 'keep_last': keep_last}
+        for rule, count in counts.items():
+            if count < 0:
+                raise ValueError(f"{rule} must not be negative, got {count}")
+        if min_keep < 1:
+            raise ValueError(f"min_keep must be at least 1, got {min_keep}")
+        self.hourly = hourly
+        self.daily = daily
+        self.weekly = weekly
+        self.monthly = monthly
+        self.yearly = yearly
+        self.keep_last = keep_last
+        self.max_age = max_age
+        self.max_total_size = max_total_size
+        self.min_keep = min_keep
+
+    def select(self, times: List[datetime.datetime], sizes: List[int], now: datetime.datetime) -> List[Tuple[bool, str]]:
+        """Decides which backups to keep.
+
+        Parameters:
+            times -- Creation times of the backups, newest first.
+            sizes -- Sizes of the backups in bytes, in the same order.
+            now -- Time the ages are measured from.
+
+        Returns:
+            list -- (keep, reason) for every backup, in the same order."""
+        rules = [[] for _ in times]
+        for position in range(min(self.keep_last, len(times))):
+            rules[position].append('last')
+        for period, bucket in _PERIODS:
+            remaining = getattr(self, period)
+            previous = None
+            for position, time in enumerate(times):
+                if remaining <= 0:
+                    break
+                key = bucket(time)
+                if key != previous:
+                    rules[position].append(period)
+                    remaining -= 1
+                    previous = key
+
+        decisions = [(True, ', '.join(r)) if r else (False, 'not kept by any rule') for r in rules]
+        total = 0
+        over_size = False
+        for position, (keep, reason) in enumerate(decisions):
+            if position < self.min_keep:
+                decisions[position] = (True, reason if keep else 'min_keep')
+                total += sizes[position]
+                continue
+            if not keep:
+                continue
+            if self.max_age is not None and now - times[position] > self.max_age:
+                decisions[position] = (False, 'older than max_age')
+            elif over_size or (self.max_total_size is not None and total + sizes[position] > self.max_total_size):
+                # everything older goes as well, so the newest backups that fit are the ones kept
+                over_size = True
+                decisions[position] = (False, 'over max_total_size')
+            else:
+                total += sizes[position]
+        return decisions
+
+class Backup:
+    """A stored backup: its archive, its manifest and what the manifest says about it."""
+
+    def __init__(self, name: str, archive: Dict, manifest: Optional[Dict], metadata: Optional[Dict]) -> None:
+        self.name = name
+        self.archive = archive
+        self.manifest = manifest
+        self.db = metadata['db'] if metadata else None
+        self.created = _parse_time(metadata['created'] if metadata else archive['createdTime'])
+        self.reason = ''
+
+    @property
+    def files(self) -> List[Dict]:
+        """The stored files of the backup, the archive first."""
+        return [self.archive] + ([self.manifest] if self.manifest is not None else [])
+
+    @property
+    def size(self) -> int:
+        return sum(int(f.get('size') or 0) for f in self.files)
+
+    def to_dict(self) -> Dict:
+        return {'name': self.name, 'id': self.archive['id'], 'db': self.db, 'created': self.created.isoformat(),
+                'size': self.size, 'reason': self.reason}
+
+class RetentionPlan:
+    """What a retention run keeps and deletes. Nothing is deleted until it is passed to Retention.apply().
+
+    orphans are manifests whose archive no longer exists, e.g. after an interrupted run;
+    they are deleted with the expired backups."""
+
+    def __init__(self, keep: List[Backup], delete: List[Backup], orphans: List[Dict], created: datetime.datetime) -> None:
+        self.keep = keep
+        self.delete = delete
+        self.orphans = orphans
+        self.created = created
+
+    @property
+    def files(self) -> List[Dict]:
+        """Files to delete, each archive before its manifest."""
+        return [f for backup in self.delete for f in backup.files] + self.orphans
+
+    @property
+    def freed(self) -> int:
+        """Bytes the deletions free."""
+        return sum(int(f.get('size') or 0) for f in self.files)
+
+    def to_dict(self) -> Dict:
+        return {
+            'keep': [backup.to_dict() for backup in self.keep],
+            'delete': [backup.to_dict() for backup in self.delete],
+            'orphans': [f['id'] for f in self.orphans],
+            'freed': self.freed,
+        }
+
+    def report(self) -> None:
+        """Prints every backup with the reason it is kept or deleted."""
+        for backup in sorted(self.keep + self.delete, key=lambda b: b.created, reverse=True):
+            action = 'keep  ' if backup in self.keep else 'delete'
+            print(f"{action} {backup.name} {backup.created.isoformat()} ({backup.size} bytes, ID: {backup.archive['id']}): {backup.reason}")
+        for file in self.orphans:
+            print(f"delete {file['name']} (ID: {file['id']}): orphaned manifest")
+        print(f"Keeping {len(self.keep)} backups, deleting {len(self.delete)} and {len(self.orphans)} orphaned manifests, freeing {self.freed} bytes")
+
+class Retention:
+    """Applies a RetentionPolicy to the backups in a storage backend.
+
+    Only backups identified by their manifest (<name>.manifest.json, see
+    manifest.BackupManifest) are managed, so other files in the same folder or bucket are
+    never deleted. The storage is listed once per run; with DriveStorage(index=True) the
+    listing comes from the folder index and usually costs a single request. Manifests are
+    immutable, so the fields read from them are kept in cache_path and each manifest is
+    downloaded only once.
+
+    plan() only decides; apply() deletes the planned files in batches. prune() does both,
+    or only plans and reports when dry_run is set."""
+
+    def __init__(self, storage: StorageBackend, policy: RetentionPolicy, names: Iterable[str] = None, db: str = None,
+                 require_manifest: bool = True, encryptor: FileEncryptor = None, cache_path: str = None, workers: int = 8) -> None:
+        """Parameters:
+            storage -- Storage backend holding the backups.
+            policy -- Rules deciding which backups to keep.
+            names -- (Optional) File names of the managed backups. Defaults to every name that has a manifest.
+            db -- (Optional) Only manage backups of this database, as recorded in their manifests.
+            require_manifest [type:bool] -- Only manage backups that have a manifest. Set to False to also manage
+                                            manifest-less versions (e.g. streaming backups) of the given names.
+                                            Defaults to True.
+            encryptor -- (Optional) Only trust manifests carrying a valid signature for this key.
+            cache_path [type:String] -- (Optional) JSON file keeping manifest metadata between runs.
+            workers [type:int] -- Number of manifests downloaded in parallel. Defaults to 8."""
+        if not require_manifest and names is None:
+            raise ValueError("require_manifest=False needs the names of the managed backups")
+        self.storage = storage
+        self.policy = policy
+        self.names = set(names) if names is not None else None
+        self.db = db
+        self.require_manifest = require_manifest
+        self.encryptor = encryptor
+        self.cache_path = cache_path
+        self.workers = workers
+        self._cache: Dict[str, Dict] = {}
+        if cache_path is not None and os.path.exists(cache_path):
+            with open(cache_path) as f:
+                self._cache = json.load(f).get('manifests', {})
+
+    def _save(self) -> None:
+        if self.cache_path is None:
+            return
+        temp_path = self.cache_path + '.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump({'manifests': self._cache}, f)
+        os.replace(temp_path, self.cache_path)
+
+    def _read_manifest(self, file: Dict) -> Optional[Dict]:
+        """The fields of a manifest that identify its backup, or None if it is not a valid manifest."""
+        try:
+            manifest = BackupManifest.from_bytes(self.storage.download_bytes(file['id']), self.encryptor)
+            archive = manifest.data['archive']
+            return {'db': manifest.data['db'], 'created': manifest.data['created'], 'size': archive['size'],
+                    'md5': archive.get('md5'), 'signed': self.encryptor is not None}
+        except Exception as e:
+            logger.warning("Ignoring manifest %s (ID: %s): %s", file['name'], file['id'], e)
+            return None
+
+    def _metadata(self, manifests: List[Dict], listed: Set[str]) -> Dict[str, Optional[Dict]]:
+        """Manifest metadata by file ID, downloading only the manifests that are not cached.
+
+        Only valid manifests are cached. Entries of files that are no longer listed are dropped."""
+        def cached(file: Dict) -> bool:
+            entry = self._cache.get(file['id'])
+            if entry is None or entry['file'] != [file.get('size'), file.get('md5Checksum')]:
+                return False
+            # a manifest read without a key is read again once signatures are checked
+            return self.encryptor is None or entry['metadata']['signed']
+        metadata = {f['id']: self._cache[f['id']]['metadata'] for f in manifests if cached(f)}
+        missing = [f for f in manifests if f['id'] not in metadata]
+        if missing:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                for file, fields in zip(missing, executor.map(self._read_manifest, missing)):
+                    metadata[file['id']] = fields
+                    if fields is not None:
+                        self._cache[file['id']] = {'file': [file.get('size'), file.get('md5Checksum')], 'metadata': fields}
+        self._cache = {file_id: entry for file_id, entry in self._cache.items() if file_id in listed}
+        self._save()
+        return metadata
+
+    @staticmethod
+    def _matches(archive: Dict, metadata: Optional[Dict]) -> bool:
+        if metadata is None or int(archive.get('size') or -1) != metadata['size']:
+            return False
+        md5 = archive.get('md5Checksum')
+        return md5 is None or metadata['md5'] is None or md5 == metadata['md5']
+
+    def _backups(self) -> Tuple[List[Backup], List[Dict]]:
+        """The managed backups, oldest first, and the orphaned manifests."""
+        by_name: Dict[str, List[Dict]] = {}
+        listed = set()
+        for file in self.storage.list_files():
+            listed.add(file['id'])
+            by_name.setdefault(file['name'], []).append(file)
+        names = self.names if self.names is not None else {
+            name[:-len(BackupManifest.SUFFIX)] for name in by_name if name.endswith(BackupManifest.SUFFIX)}
+
+        pairs = []
+        orphans = []
+        for name in sorted(names):
+            archives = by_name.get(name, [])
+            manifests = by_name.get(name + BackupManifest.SUFFIX, [])
+            if not archives and not manifests:
+                continue
+            # a manifest is uploaded right after its archive, so it is the first one before the next version
+            claimed = set()
+            for position, archive in enumerate(archives):
+                end = archives[position + 1]['createdTime'] if position + 1 < len(archives) else None
+                manifest = next((m for m in manifests if m['createdTime'] >= archive['createdTime']
+                                 and (end is None or m['createdTime'] < end)), None)
+                if manifest is not None:
+                    claimed.add(manifest['id'])
+                pairs.append((name, archive, manifest))
+            if not archives:
+                # an interrupted run deleted the last archive of the name before its manifest
+                orphans.extend(manifests)
+            else:
+                # the newest archive may still be waiting for its manifest
+                orphans.extend(m for m in manifests if m['id'] not in claimed and m['createdTime'] < archives[-1]['createdTime'])
+
+        metadata = self._metadata([m for _, _, m in pairs if m is not None] + orphans, listed)
+        backups = []
+        for name, archive, manifest in pairs:
+            fields = metadata.get(manifest['id']) if manifest is not None else None
+            if not self._matches(archive, fields):
+                if self.require_manifest or manifest is not None:
+                    continue  # not identified as a backup, or its manifest describes another file
+                fields = None
+            if self.db is not None and (fields is None or fields['db'] != self.db):
+                continue
+            backups.append(Backup(name, archive, manifest, fields))
+        orphans = [m for m in orphans if metadata.get(m['id']) is not None
+                   and (self.db is None or metadata[m['id']]['db'] == self.db)]
+        return backups, orphans
+
+    def plan(self, now: datetime.datetime = None) -> RetentionPlan:
+        """Lists the storage and decides what to keep, without deleting anything.
+
+        The policy is applied to the versions of each name separately.
+
+        Parameters:
+            now -- (Optional) Time ages are measured from. Defaults to the current time."""
+        now = now if now is not None else datetime.datetime.now(datetime.timezone.utc)
+        backups, orphans = self._backups()
+        keep, delete = [], []
+        for name in sorted({backup.name for backup in backups}):
+            versions = sorted((b for b in backups if b.name == name), key=lambda b: b.created, reverse=True)
+            decisions = self.policy.select([b.created for b in versions], [b.size for b in versions], now)
+            for backup, (kept, reason) in zip(versions, decisions):
+                backup.reason = reason
+                (keep if kept else delete).append(backup)
+        return RetentionPlan(keep, delete, orphans, now)
+
+    def apply(self, plan: RetentionPlan, batch_size: int = 100) -> int:
+        """Deletes the files of a plan, batch_size files per call to the storage.
+
+        Returns:
+            int -- Number of deleted files."""
+        files = plan.files
+        for start in range(0, len(files), batch_size):
+            batch = files[start:start + batch_size]
+            self.storage.delete_files(batch)
+            registry.increment('retention_deleted_files_total', len(batch), backend=self.storage.name)
+            registry.increment('retention_deleted_bytes_total', sum(int(f.get('size') or 0) for f in batch), backend=self.storage.name)
+        deleted = {f['id'] for f in files}
+        self._cache = {file_id: entry for file_id, entry in self._cache.items() if file_id not in deleted}
+        self._save()
+        return len(files)
+
+    def prune(self, dry_run: bool = False, batch_size: int = 100) -> RetentionPlan:
+        """Plans, prints the plan and, unless dry_run is set, applies it."""
+        plan = self.plan()
+        plan.report()
+        if not dry_run:
+            self.apply(plan, batch_size)
+        return plan
@@ -0,0 +1,144 @@
+import time
+import random
+import threading
+from typing import Callable, Optional
+
+import requests
+
+from mongogbackup.metrics import logger, registry
+
+# 403 responses with these reasons are rate limits, any other 403 is a permission error
+RATE_LIMIT_REASONS = ('userRateLimitExceeded', 'rateLimitExceeded', 'sharingRateLimitExceeded')
+
+class TransientError(Exception):
+    """Raised when a request failed in a way that may succeed if it is repeated."""
+    def __init__(self, status: Optional[int], reason: str, message: str, retry_after: float = None):
+        self.status = status
+        self.reason = reason
+        self.message = message
+        self.retry_after = retry_after
+    def __str__(self):
+        return f"Transient error ({self.reason}, HTTP {self.status}): {self.message}"
+
+# connection resets, timeouts and bodies cut short are retried like transient responses
+RETRYABLE_ERRORS = (TransientError, requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError)
+
+def classify(status: int, body: str = '') -> Optional[str]:
+    """Reason for retrying a response: 'rate_limit', 'timeout' or 'server_error'. None if it should not be retried."""
+    if status == 429 or (status == 403 and any(reason in body for reason in RATE_LIMIT_REASONS)):
+        return 'rate_limit'
+    if status == 408:
+        return 'timeout'
+    if status in (500, 502, 503, 504):
+        return 'server_error'
+    return None
+
+def raise_for_transient(response: requests.Response) -> requests.Response:
+    """Raises TransientError if the response is worth retrying, otherwise returns it."""
+    reason = classify(response.status_code, response.text)
+    if reason is None:
+        return response
+    retry_after = response.headers.get('Retry-After', '')
+    raise TransientError(response.status_code, reason, response.text, float(retry_after) if retry_after.isdigit() else None)
+
+def _reason(error: Exception) -> str:
+    if isinstance(error, TransientError):
+        return error.reason
+    if isinstance(error, requests.Timeout):
+        return 'timeout'
+    return 'connection'
+
+class RetryPolicy:
+    """How transient failures of Drive requests are retried.
+
+    Attempt n waits a random time between 0 and min(max_delay, initial_delay * multiplier**n)
+    ("full jitter"), so clients that failed together do not retry together. A Retry-After
+    header is honoured as a minimum. A rate limit also pauses the other requests made with
+    the same policy (e.g. the other parts of a parallel upload) until the wait is over,
+    instead of letting them run into the limit as well.
+
+    Every retry is counted in the retries_total metric, labelled with the operation and
+    the reason."""
+
+    def __init__(self, max_attempts: int = 8, initial_delay: float = 1.0, max_delay: float = 64.0,
+                 multiplier: float = 2.0, deadline: float = None) -> None:
+        """Parameters:
+            max_attempts [type:int] -- Attempts per request, the first one included. Defaults to 8.
+            initial_delay [type:float] -- Upper bound of the first wait in seconds. Defaults to 1.
+            max_delay [type:float] -- Upper bound of any wait in seconds. Defaults to 64.
+            multiplier [type:float] -- Growth of the bound per attempt. Defaults to 2.
+            deadline [type:float] -- (Optional) Seconds after which a request is no longer retried."""
+        self.max_attempts = max_attempts
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.multiplier = multiplier
+        self.deadline = deadline
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def delay(self, attempt: int, retry_after: float = None) -> float:
+        """Seconds to wait after the given failed attempt (0 for the first)."""
+        delay = random.uniform(0, min(self.max_delay, self.initial_delay * self.multiplier ** attempt))
+        return max(delay, retry_after or 0)
+
+    def pause(self, seconds: float) -> None:
+        """Holds back every request made with this policy for the given time."""
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    def wait_for_rate_limit(self) -> None:
+        """Blocks while a rate limit pause is in effect. Called before each request."""
+        wait = self._paused_until - time.monotonic()
+        if wait > 0:
+            time.sleep(wait)
+
+    def backoff(self, operation: str) -> 'Backoff':
+        """Attempt counter for one request, or for a sequence of requests that makes progress."""
+        return Backoff(self, operation)
+
+    def call(self, operation: str, function: Callable, *args, **kwargs):
+        """Calls function(*args, **kwargs), retrying RETRYABLE_ERRORS.
+
+        The function should turn retryable responses into a TransientError, e.g. with
+        raise_for_transient(). The last error is raised once the attempts are used up."""
+        backoff = self.backoff(operation)
+        while True:
+            self.wait_for_rate_limit()
+            try:
+                return function(*args, **kwargs)
+            except RETRYABLE_ERRORS as e:
+                if not backoff.wait(e):
+                    raise
+
+class Backoff:
+    """Counts the failed attempts of one operation and waits between them."""
+
+    def __init__(self, policy: RetryPolicy, operation: str) -> None:
+        self.policy = policy
+        self.operation = operation
+        self.attempt = 0
+        self.started = time.monotonic()
+
+    def wait(self, error: Exception) -> bool:
+        """Sleeps before the next attempt and returns True, or returns False when no attempt is left."""
+        self.attempt += 1
+        policy = self.policy
+        elapsed = time.monotonic() - self.started
+        if self.attempt >= policy.max_attempts or (policy.deadline is not None and elapsed >= policy.deadline):
+            return False
+        reason = _reason(error)
+        delay = policy.delay(self.attempt - 1, getattr(error, 'retry_after', None))
+        if policy.deadline is not None:
+            delay = min(delay, policy.deadline - elapsed)
+        registry.increment('retries_total', operation=self.operation, reason=reason)
+        logger.warning("%s failed (%s), retrying in %.1fs (attempt %d of %d)", self.operation, error, delay,
+                       self.attempt + 1, policy.max_attempts)
+        if reason == 'rate_limit':
+            policy.pause(delay)
+        time.sleep(delay)
+        return True
+
+    def reset(self) -> None:
+        """Starts counting again, after a request made progress."""
+        self.attempt = 0
+        self.started = time.monotonic()
@@ -0,0 +1,213 @@
+import os
+import json
+import time
+import datetime
+import threading
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Dict, List, Optional
+
+from mongogbackup.pipeline import RateLimiter
+
+class BackupTarget:
+    """A database to back up on a schedule.
+
+    The target is due `interval` after its last successful run started. With `at`, runs of
+    a day or longer are anchored to that local time of day, so a run that started late
+    does not push the following ones later."""
+
+    def __init__(self, name: str, backup, interval: datetime.timedelta = datetime.timedelta(days=1),
+                 at: datetime.time = None, priority: int = 0, options: Dict = None) -> None:
+        """Parameters:
+            name [type:String] -- Unique name of the target, used as its key in the run history.
+            backup [type:MongoGBackup] -- Handler for the database and its Google Drive folder.
+            interval [type:timedelta] -- Time between runs. Defaults to one day.
+            at [type:time] -- (Optional) Local time of day runs are anchored to. Needs an interval of at least a day.
+            priority [type:int] -- Targets with a higher priority start first when several are due. Defaults to 0.
+            options [type:dict] -- (Optional) Extra arguments for MongoGBackup.stream_backup(), e.g. codec or file_name."""
+        if at is not None and interval < datetime.timedelta(days=1):
+            raise ValueError("'at' requires an interval of at least one day")
+        self.name = name
+        self.backup = backup
+        self.interval = interval
+        self.at = at
+        self.priority = priority
+        self.options = options or {}
+
+    def next_due(self, last_success: Optional[datetime.datetime]) -> Optional[datetime.datetime]:
+        """Returns when the next run is due, or None if the target has never run (due immediately)."""
+        if last_success is None:
+            return None
+        due = (last_success + self.interval).astimezone()
+        if self.at is not None:
+            # the occurrence of `at` nearest to the due time, so early and late runs both snap back
+            anchored = due.replace(hour=self.at.hour, minute=self.at.minute, second=self.at.second, microsecond=0)
+            if anchored - due > datetime.timedelta(hours=12):
+                anchored -= datetime.timedelta(days=1)
+            elif due - anchored > datetime.timedelta(hours=12):
+                anchored += datetime.timedelta(days=1)
+            due = anchored
+        return due
+
+class BackupScheduler:
+    """Runs scheduled backups of many databases within global resource limits.
+
+    At most `max_concurrent` backups run at a time, so the dumps do not all hit the
+    database hosts at once. The compression threads are split between them and every
+    upload shares one bandwidth limit. When several targets are due, higher priorities
+    start first, then the most overdue.
+
+    Every run is recorded in a JSON history file. A target is due when its last successful
+    run is older than its interval, so runs missed while the scheduler was not running are
+    picked up as soon as it starts. Failed runs are retried after `retry_delay`."""
+
+    def __init__(self, targets: List[BackupTarget], history_path: str, max_concurrent: int = 2,
+                 compression_threads: int = None, upload_bandwidth: float = None,
+                 retry_delay: datetime.timedelta = datetime.timedelta(minutes=15), history_size: int = 50) -> None:
+        """Parameters:
+            targets -- Databases to back up.
+            history_path [type:String] -- JSON file recording past runs.
+            max_concurrent [type:int] -- Maximum number of backups running at the same time. Defaults to 2.
+            compression_threads [type:int] -- Compression threads shared by all running backups. Defaults to the number of CPUs.
+            upload_bandwidth [type:float] -- (Optional) Combined upload limit in bytes per second.
+            retry_delay [type:timedelta] -- Wait before retrying a failed run. Defaults to 15 minutes.
+            history_size [type:int] -- Number of runs kept per target. Defaults to 50."""
+        names = [target.name for target in targets]
+        if len(set(names)) != len(names):
+            raise ValueError("Target names must be unique")
+        self.targets = {target.name: target for target in targets}
+        self.history_path = history_path
+        self.max_concurrent = max_concurrent
+        self.compression_threads = compression_threads or os.cpu_count() or 1
+        self.rate_limiter = RateLimiter(upload_bandwidth) if upload_bandwidth else None
+        self.retry_delay = retry_delay
+        self.history_size = history_size
+        self._history = self._load_history()
+        self._lock = threading.Lock()
+        self._running: Dict[str, Future] = {}
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrent)
+
+    def _load_history(self) -> Dict:
+        if not os.path.exists(self.history_path):
+            return {}
+        with open(self.history_path) as f:
+            return json.load(f)
+
+    def _save_history(self) -> None:
+        temp_path = self.history_path + '.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump(self._history, f, indent=2)
+        os.replace(temp_path, self.history_path)
+
+    @staticmethod
+    def _parse(value: Optional[str]) -> Optional[datetime.datetime]:
+        return datetime.datetime.fromisoformat(value) if value else None
+
+    def history(self, name: str) -> List[Dict]:
+        """Returns the recorded runs of a target, oldest first."""
+        with self._lock:
+            return list(self._history.get(name, {}).get('runs', []))
+
+    def due(self, now: datetime.datetime = None) -> List[BackupTarget]:
+        """Returns the targets that are due and not running, in the order they should start."""
+        now = now or datetime.datetime.now(datetime.timezone.utc)
+        due = []
+        with self._lock:
+            for target in self.targets.values():
+                if target.name in self._running:
+                    continue
+                state = self._history.get(target.name, {})
+                next_run = target.next_due(self._parse(state.get('last_success')))
+                last_failure = self._parse(state.get('last_failure'))
+                if last_failure is not None and (next_run is None or last_failure > next_run):
+                    next_run = last_failure + self.retry_delay
+                if next_run is None or next_run <= now:
+                    due.append((target, next_run or datetime.datetime.min.replace(tzinfo=datetime.timezone.utc)))
+        due.sort(key=lambda item: (-item[0].priority, item[1]))
+        return [target for target, _ in due]
+
+    def _record(self, name: str, run: Dict) -> None:
+        with self._lock:
+            state = self._history.setdefault(name, {'runs': []})
+            state['runs'] = (state['runs'] + [run])[-self.history_size:]
+            if run['status'] == 'success':
+                state['last_success'] = run['started']
+                state.pop('last_failure', None)
+            else:
+                state['last_failure'] = run['finished']
+            self._save_history()
+
+    def _run(self, target: BackupTarget) -> Dict:
+        options = dict(target.options)
+        options.setdefault('workers', max(1, self.compression_threads // self.max_concurrent))
+        if self.rate_limiter is not None:
+            options.setdefault('rate_limit', self.rate_limiter)
+        started = datetime.datetime.now(datetime.timezone.utc)
+        run = {'started': started.isoformat()}
+        try:
+            uploaded = target.backup.stream_backup(**options)
+            run.update(status='success', file_id=uploaded.get('id'), size=int(uploaded.get('size') or 0))
+        except Exception as e:
+            run.update(status='failed', error=str(e))
+        finished = datetime.datetime.now(datetime.timezone.utc)
+        run.update(finished=finished.isoformat(), duration=(finished - started).total_seconds())
+        self._record(target.name, run)
+        print(f"Scheduled backup {target.name}: {run['status']} in {run['duration']:.1f}s")
+        return run
+
+    def _reap(self) -> Dict[str, Dict]:
+        finished = {}
+        with self._lock:
+            for name, future in list(self._running.items()):
+                if future.done():
+                    finished[name] = future.result()
+                    del self._running[name]
+        return finished
+
+    def _futures(self) -> List[Future]:
+        with self._lock:
+            return list(self._running.values())
+
+    def _dispatch(self) -> None:
+        for target in self.due():
+            with self._lock:
+                if len(self._running) >= self.max_concurrent:
+                    return
+                self._running[target.name] = self._executor.submit(self._run, target)
+
+    def run_pending(self) -> Dict[str, Dict]:
+        """Runs every due target within the limits and returns once all of them have finished.
+
+        Returns:
+            dict -- The run record of each target that ran, keyed by target name."""
+        results = {}
+        attempted = set()
+        while True:
+            results.update(self._reap())
+            attempted.update(results)
+            # a failed target is not retried within the same call
+            for target in self.due():
+                if target.name in attempted:
+                    continue
+                with self._lock:
+                    if len(self._running) >= self.max_concurrent:
+                        break
+                    attempted.add(target.name)
+                    self._running[target.name] = self._executor.submit(self._run, target)
+            running = self._futures()
+            if not running:
+                return results
+            wait(running, return_when=FIRST_COMPLETED)
+
+    def run_forever(self, poll_interval: float = 60) -> None:
+        """Starts due targets as they become due, until interrupted."""
+        try:
+            while True:
+                self._reap()
+                self._dispatch()
+                running = self._futures()
+                if running:
+                    wait(running, timeout=poll_interval, return_when=FIRST_COMPLETED)
+                else:
+                    time.sleep(poll_interval)
+        finally:
+            self._executor.shutdown(wait=True)
@@ -0,0 +1,601 @@
+import os
+import re
+import queue
+import hashlib
+import datetime
+import threading
+from abc import ABC, abstractmethod
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING, Dict, Iterable, Iterator, List
+
+from mongogbackup.metrics import registry
+
+if TYPE_CHECKING:
+    from mongogbackup.gdrive import GoogleDriveHandler
+
+_END = object()
+
+class _Failure:
+    """Carries the source's exception to the backends of a FanOutStorage."""
+    def __init__(self, error: BaseException) -> None:
+        self.error = error
+
+_STAMP = '%Y%m%dT%H%M%S%fZ'
+_STAMP_PATTERN = re.compile(r'^\d{8}T\d{12}Z$')
+
+class StorageUnavailableError(Exception):
+    """Raised when a storage backend needs a package that is not installed."""
+    def __init__(self, backend: str, package: str):
+        self.backend = backend
+        self.package = package
+    def __str__(self):
+        return f"Storage backend {self.backend} requires the '{self.package}' package. Install it with: pip install mongogbackup[{self.backend}]"
+
+class StorageError(Exception):
+    """Raised when a storage backend fails to store, read or delete a file."""
+    def __init__(self, backend: str, message: str):
+        self.backend = backend
+        self.message = message
+    def __str__(self):
+        return f"Storage error ({self.backend}): {self.message}"
+
+class BackupNotFoundError(Exception):
+    """Raised when a storage backend holds no file with the requested name."""
+    def __init__(self, name: str, backend: str):
+        self.name = name
+        self.backend = backend
+    def __str__(self):
+        return f"No file named {self.name} in storage {self.backend}"
+
+class FanOutError(Exception):
+    """Raised when some of the backends of a FanOutStorage failed.
+
+    results holds the files stored by the backends that succeeded, errors the exception of
+    each backend that failed, both keyed by backend name."""
+    def __init__(self, errors: Dict[str, BaseException], results: Dict[str, Dict]):
+        self.errors = errors
+        self.results = results
+    def __str__(self):
+        failed = ', '.join(f"{name}: {error!r}" for name, error in self.errors.items())
+        return f"Storage failed on {len(self.errors)} of {len(self.errors) + len(self.results)} backends: {failed}"
+
+def _stamp() -> str:
+    return datetime.datetime.now(datetime.timezone.utc).strftime(_STAMP)
+
+def _created_time(stamp: str) -> str:
+    """The creation time encoded in a version stamp, in the format Google Drive uses."""
+    return datetime.datetime.strptime(stamp, _STAMP).strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+
+class StorageBackend(ABC):
+    """Where backups are stored.
+
+    Files are described by dicts shaped like Google Drive file resources: 'id', 'name',
+    'size' (a string), 'createdTime' and, where the backend knows it, 'md5Checksum'.
+    Several files may share a name; each upload adds a new version, and find_latest()
+    returns the most recent one.
+
+    Subclasses implement the abstract methods upload_stream(), list_files(), size(),
+    read_range() and delete_files(); a subclass missing one of them cannot be
+    instantiated. The other methods have generic implementations built on these, which
+    subclasses may replace with faster native calls."""
+
+    name = 'storage'
+
+    @abstractmethod
+    def upload_stream(self, chunks: Iterable[bytes], name: str, chunk_size: int = None) -> Dict:
+        """Stores a stream of byte chunks of unknown length as a new file.
+
+        Parameters:
+            chunks -- Iterable yielding the bytes to store.
+            name -- Name of the file.
+            chunk_size -- (Optional) Bytes per request, for backends that use it. Defaults to the backend's setting.
+
+        Returns:
+            dict -- The stored file."""
+        raise NotImplementedError
+
+    def upload_file(self, path: str, name: str = None, chunk_size: int = None) -> Dict:
+        """Stores a local file. name defaults to the file's base name."""
+        name = name if name is not None else os.path.basename(path)
+
+        def read():
+            with open(path, 'rb') as f:
+                yield from iter(lambda: f.read(8 * 1024 * 1024), b'')
+        return self.upload_stream(read(), name, chunk_size)
+
+    def upload_bytes(self, data: bytes, name: str) -> Dict:
+        """Stores in-memory data as a new file."""
+        return self.upload_stream([data], name)
+
+    @abstractmethod
+    def list_files(self, name: str = None) -> List[Dict]:
+        """Stored files, oldest first. With a name, only the versions of that file."""
+        raise NotImplementedError
+
+    def find_latest(self, name: str) -> Dict:
+        """The most recent version of the named file. Raises BackupNotFoundError if there is none."""
+        files = self.list_files(name)
+        if not files:
+            raise BackupNotFoundError(name, self.name)
+        return files[-1]
+
+    @abstractmethod
+    def size(self, file_id: str) -> int:
+        """Size of a stored file in bytes."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def read_range(self, file_id: str, start: int, end: int) -> bytes:
+        """Reads bytes start..end (inclusive) of a stored file."""
+        raise NotImplementedError
+
+    def download_stream(self, file_id: str, chunk_size: int = 8 * 1024 * 1024, workers: int = 4, start: int = 0, end: int = None) -> Iterator[bytes]:
+        """Reads a file as a stream of chunks, fetching several ranges in parallel.
+
+        Chunks are yielded in order and at most 2 x workers chunks are held in memory.
+
+        Parameters:
+            file_id -- ID of the file to read.
+            chunk_size -- Bytes per ranged read. Defaults to 8Mb.
+            workers -- Number of concurrent ranged reads. Defaults to 4.
+            start -- Offset to start from.
+            end -- (Optional) Offset to stop at, exclusive. Defaults to the end of the file."""
+        size = end if end is not None else self.size(file_id)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            pending = deque()
+            for offset in range(start, size, chunk_size):
+                pending.append(executor.submit(self.read_range, file_id, offset, min(offset + chunk_size, size) - 1))
+                if len(pending) >= 2 * workers:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+
+    def download_bytes(self, file_id: str) -> bytes:
+        """Reads a whole file into memory."""
+        return b''.join(self.download_stream(file_id))
+
+    @abstractmethod
+    def delete_files(self, files: List[Dict]) -> None:
+        """Deletes stored files, as returned by list_files()."""
+        raise NotImplementedError
+
+class DriveStorage(StorageBackend):
+    """A Google Drive folder, through a GoogleDriveHandler.
+
+    Uploads use resumable sessions with retries and downloads use parallel ranged reads,
+    as described in gdrive.GoogleDriveHandler."""
+
+    name = 'drive'
+
+    def __init__(self, gdrive: 'GoogleDriveHandler', parent_id: str = None, chunk_size: int = 8 * 1024 * 1024,
+                 index: bool = False, cache_path: str = None) -> None:
+        """Parameters:
+            gdrive -- Google Drive handler.
+            parent_id -- ID of the folder. Defaults to the handler's parent_id.
+            chunk_size -- Upload chunk size, a multiple of 256Kb. Defaults to 8Mb.
+            index -- List the folder from its gdrive.DriveFolderIndex, refreshed from the changes feed,
+                     instead of listing every file on each call. Defaults to False.
+            cache_path -- (Optional) JSON file persisting the index between runs."""
+        self.gdrive = gdrive
+        self.parent_id = parent_id if parent_id is not None else gdrive.parent_id
+        self.chunk_size = chunk_size
+        self.index = index or cache_path is not None
+        self.cache_path = cache_path
+
+    def upload_stream(self, chunks: Iterable[bytes], name: str, chunk_size: int = None) -> Dict:
+        return self.gdrive.upload_stream(chunks, name, self.parent_id, chunk_size=chunk_size or self.chunk_size)
+
+    def upload_file(self, path: str, name: str = None, chunk_size: int = None) -> Dict:
+        return self.gdrive.upload_file(path, self.parent_id, name, chunk_size=chunk_size or self.chunk_size)
+
+    def upload_bytes(self, data: bytes, name: str) -> Dict:
+        mimetype = 'application/json' if name.endswith('.json') else 'application/octet-stream'
+        return self.gdrive.upload_bytes(data, name, self.parent_id, mimetype=mimetype)
+
+    def list_files(self, name: str = None) -> List[Dict]:
+        from mongogbackup.gdrive import quote
+        if self.index:
+            index = self.gdrive.folder_index(self.parent_id, self.cache_path)
+            index.refresh()
+            return index.find(name) if name is not None else index.files()
+        files = self.gdrive.list_files(self.parent_id, query=f"name='{quote(name)}'" if name is not None else None)
+        return sorted(files, key=lambda f: f['createdTime'])
+
+    def find_latest(self, name: str) -> Dict:
+        from mongogbackup.gdrive import FileQueryError
+        try:
+            return self.gdrive.find_latest_file(name, self.parent_id)
+        except FileQueryError:
+            raise BackupNotFoundError(name, self.name)
+
+    def size(self, file_id: str) -> int:
+        return int(self.gdrive.get_file_metadata(file_id, fields='size')['size'])
+
+    def read_range(self, file_id: str, start: int, end: int) -> bytes:
+        return self.gdrive._get_range(file_id, start, end)
+
+    def download_stream(self, file_id: str, chunk_size: int = 8 * 1024 * 1024, workers: int = 4, start: int = 0, end: int = None) -> Iterator[bytes]:
+        return self.gdrive.download_stream(file_id, chunk_size, workers, start=start, end=end)
+
+    def download_bytes(self, file_id: str) -> bytes:
+        return self.gdrive.download_bytes(file_id)
+
+    def delete_files(self, files: List[Dict]) -> None:
+        self.gdrive.delete_files(files)
+
+class LocalStorage(StorageBackend):
+    """A directory on a local or mounted file system, e.g. for fast staging or a NAS.
+
+    Each version of a file is stored as <root>/<name>/<UTC timestamp>, with its MD5 in a
+    .md5 file next to it. Data is written to a hidden temporary file and renamed once
+    complete, so a listing never shows a partial file."""
+
+    name = 'local'
+
+    def __init__(self, root: str, fsync: bool = True) -> None:
+        """Parameters:
+            root [type:String] -- Directory holding the files. Created if it does not exist.
+            fsync [type:bool] -- Flush every file to disk before it is listed. Defaults to True."""
+        self.root = os.path.abspath(root)
+        self.fsync = fsync
+        os.makedirs(self.root, exist_ok=True)
+
+    def _path(self, file_id: str) -> str:
+        path = os.path.normpath(os.path.join(self.root, file_id))
+        if os.path.commonpath([self.root, path]) != self.root or path == self.root:
+            raise ValueError(f"Invalid file name: {file_id}")
+        return path
+
+    def _entry(self, file_id: str) -> Dict:
+        path = self._path(file_id)
+        name, stamp = os.path.split(file_id)
+        entry = {'id': file_id, 'name': name, 'size': str(os.path.getsize(path)), 'createdTime': _created_time(stamp)}
+        if os.path.exists(path + '.md5'):
+            with open(path + '.md5') as f:
+                entry['md5Checksum'] = f.read().strip()
+        return entry
+
+    def upload_stream(self, chunks: Iterable[bytes], name: str, chunk_size: int = None) -> Dict:
+        directory = self._path(name)
+        os.makedirs(directory, exist_ok=True)
+        stamp = _stamp()
+        path = os.path.join(directory, stamp)
+        temp_path = os.path.join(directory, f".{stamp}.partial")
+        md5 = hashlib.md5()
+        try:
+            with open(temp_path, 'wb') as f:
+                for chunk in chunks:
+                    f.write(chunk)
+                    md5.update(chunk)
+                    registry.increment('storage_bytes_total', len(chunk), backend=self.name, direction='upload')
+                if self.fsync:
+                    f.flush()
+                    os.fsync(f.fileno())
+            with open(path + '.md5', 'w') as f:
+                f.write(md5.hexdigest())
+            os.replace(temp_path, path)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        return self._entry(os.path.relpath(path, self.root))
+
+    def list_files(self, name: str = None) -> List[Dict]:
+        top = self._path(name) if name is not None else self.root
+        files = []
+        for directory, _, file_names in os.walk(top):
+            for file_name in file_names:
+                if _STAMP_PATTERN.match(file_name):
+                    file_id = os.path.relpath(os.path.join(directory, file_name), self.root)
+                    if name is None or os.path.dirname(file_id) == os.path.normpath(name):
+                        files.append(self._entry(file_id))
+        return sorted(files, key=lambda f: f['createdTime'])
+
+    def size(self, file_id: str) -> int:
+        return os.path.getsize(self._path(file_id))
+
+    def read_range(self, file_id: str, start: int, end: int) -> bytes:
+        with open(self._path(file_id), 'rb') as f:
+            f.seek(start)
+            data = f.read(end - start + 1)
+        registry.increment('storage_bytes_total', len(data), backend=self.name, direction='download')
+        return data
+
+    def delete_files(self, files: List[Dict]) -> None:
+        for file in files:
+            path = self._path(file['id'])
+            for target in (path, path + '.md5'):
+                if os.path.exists(target):
+                    os.remove(target)
+            print(f"Deleted file: {file['name']} (ID: {file['id']})")
+
+def _boto3():
+    try:
+        import boto3
+    except ImportError:
+        raise StorageUnavailableError('s3', 'boto3')
+    return boto3
+
+class S3Storage(StorageBackend):
+    """An S3-compatible object store (AWS S3, MinIO, Ceph, Cloudflare R2, ...).
+
+    Each version of a file is stored as the object <prefix><name>/<UTC timestamp>.
+    Streams and files larger than part_size are sent as multipart uploads, with up to
+    `workers` parts in flight at a time. A stream holds at most 2 x workers parts in
+    memory. A failed multipart upload is aborted, so no orphaned parts are billed.
+    Retries are left to botocore; pass a client configured with
+    botocore.config.Config(retries={'mode': 'adaptive'}) to tune them.
+
+    Single-part objects report their MD5 (the ETag). Multipart objects do not, because
+    their ETag is not an MD5 of the content."""
+
+    name = 's3'
+    _MIN_PART_SIZE = 5 * 1024 * 1024  # S3 rejects smaller parts, except the last one
+    _MAX_PARTS = 10000
+    _DELETE_BATCH_SIZE = 1000  # maximum number of keys in one DeleteObjects request
+
+    def __init__(self, bucket: str, prefix: str = '', client=None, part_size: int = 64 * 1024 * 1024, workers: int = 4, **client_options) -> None:
+        """Parameters:
+            bucket [type:String] -- Bucket name.
+            prefix [type:String] -- Key prefix, e.g. 'backups/'. Defaults to the bucket root.
+            client -- (Optional) boto3 S3 client. By default one is created from client_options.
+            part_size [type:int] -- Bytes per multipart part, at least 5Mb. Defaults to 64Mb.
+            workers [type:int] -- Number of parts uploaded or ranges downloaded at the same time. Defaults to 4.
+            client_options -- Passed to boto3.client('s3'), e.g. endpoint_url, region_name,
+                              aws_access_key_id, aws_secret_access_key."""
+        if part_size < self._MIN_PART_SIZE:
+            raise ValueError(f"part_size must be at least {self._MIN_PART_SIZE} bytes")
+        self.bucket = bucket
+        self.prefix = prefix
+        self.part_size = part_size
+        self.workers = workers
+        self._client = client
+        self._client_options = client_options
+
+    @property
+    def client(self):
+        if self._client is None:
+            self._client = _boto3().client('s3', **self._client_options)
+        return self._client
+
+    def _entry(self, key: str, size: int, etag: str) -> Dict:
+        name, stamp = key[len(self.prefix):].rsplit('/', 1)
+        entry = {'id': key, 'name': name, 'size': str(size), 'createdTime': _created_time(stamp)}
+        etag = etag.strip('"')
+        if '-' not in etag:
+            entry['md5Checksum'] = etag
+        return entry
+
+    def _put_part(self, key: str, upload_id: str, number: int, data: bytes) -> Dict:
+        response = self.client.upload_part(Bucket=self.bucket, Key=key, UploadId=upload_id, PartNumber=number, Body=data)
+        registry.increment('storage_bytes_total', len(data), backend=self.name, direction='upload')
+        return {'PartNumber': number, 'ETag': response['ETag']}
+
+    def _multipart(self, key: str, parts: Iterable[bytes]) -> Dict:
+        """Uploads parts concurrently as one object. parts may be a generator; at most 2 x workers are pending."""
+        upload_id = self.client.create_multipart_upload(Bucket=self.bucket, Key=key)['UploadId']
+        try:
+            done = []
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                pending = deque()
+                for number, data in enumerate(parts, 1):
+                    if number > self._MAX_PARTS:
+                        raise StorageError(self.name, f"{key} needs more than {self._MAX_PARTS} parts; increase part_size")
+                    pending.append(executor.submit(self._put_part, key, upload_id, number, data))
+                    if len(pending) >= 2 * self.workers:
+                        done.append(pending.popleft().result())
+                done.extend(future.result() for future in pending)
+            response = self.client.complete_multipart_upload(Bucket=self.bucket, Key=key, UploadId=upload_id,
+                                                             MultipartUpload={'Parts': done})
+        except BaseException:
+            self.client.abort_multipart_upload(Bucket=self.bucket, Key=key, UploadId=upload_id)
+            raise
+        return response
+
+    def upload_stream(self, chunks: Iterable[bytes], name: str, chunk_size: int = None) -> Dict:
+        key = f"{self.prefix}{name}/{_stamp()}"
+        buffer = bytearray()
+        chunks = iter(chunks)
+        for chunk in chunks:
+            buffer += chunk
+            if len(buffer) > self.part_size:
+                break
+        if len(buffer) <= self.part_size:
+            data = bytes(buffer)
+            response = self.client.put_object(Bucket=self.bucket, Key=key, Body=data)
+            registry.increment('storage_bytes_total', len(data), backend=self.name, direction='upload')
+            return self._entry(key, len(data), response['ETag'])
+
+        size = 0
+
+        def parts() -> Iterator[bytes]:
+            nonlocal buffer, size
+            for chunk in chunks:
+                buffer += chunk
+                while len(buffer) >= self.part_size:
+                    part = bytes(buffer[:self.part_size])
+                    del buffer[:self.part_size]
+                    size += len(part)
+                    yield part
+            # the last part may be smaller, but never empty
+            while buffer:
+                part = bytes(buffer[:self.part_size])
+                del buffer[:self.part_size]
+                size += len(part)
+                yield part
+
+        response = self._multipart(key, parts())
+        return self._entry(key, size, response['ETag'])
+
+    def upload_file(self, path: str, name: str = None, chunk_size: int = None) -> Dict:
+        name = name if name is not None else os.path.basename(path)
+        size = os.path.getsize(path)
+        if size <= self.part_size:
+            return super().upload_file(path, name, chunk_size)
+        key = f"{self.prefix}{name}/{_stamp()}"
+
+        def parts() -> Iterator[bytes]:
+            with open(path, 'rb') as f:
+                yield from iter(lambda: f.read(self.part_size), b'')
+
+        response = self._multipart(key, parts())
+        return self._entry(key, size, response['ETag'])
+
+    def list_files(self, name: str = None) -> List[Dict]:
+        prefix = f"{self.prefix}{name}/" if name is not None else self.prefix
+        files = []
+        for page in self.client.get_paginator('list_objects_v2').paginate(Bucket=self.bucket, Prefix=prefix):
+            for item in page.get('Contents', []):
+                stamp = item['Key'].rsplit('/', 1)[-1]
+                if _STAMP_PATTERN.match(stamp) and (name is None or item['Key'].rsplit('/', 1)[0] == prefix[:-1]):
+                    files.append(self._entry(item['Key'], item['Size'], item['ETag']))
+        return sorted(files, key=lambda f: f['createdTime'])
+
+    def size(self, file_id: str) -> int:
+        return self.client.head_object(Bucket=self.bucket, Key=file_id)['ContentLength']
+
+    def read_range(self, file_id: str, start: int, end: int) -> bytes:
+        response = self.client.get_object(Bucket=self.bucket, Key=file_id, Range=f"bytes={start}-{end}")
+        data = response['Body'].read()
+        registry.increment('storage_bytes_total', len(data), backend=self.name, direction='download')
+        if len(data) != end - start + 1:
+            raise StorageError(self.name, f"expected {end - start + 1} bytes of {file_id} at offset {start}, received {len(data)}")
+        return data
+
+    def delete_files(self, files: List[Dict]) -> None:
+        for start in range(0, len(files), self._DELETE_BATCH_SIZE):
+            batch = files[start:start + self._DELETE_BATCH_SIZE]
+            response = self.client.delete_objects(Bucket=self.bucket, Delete={'Objects': [{'Key': f['id']} for f in batch], 'Quiet': True})
+            errors = response.get('Errors', [])
+            if errors:
+                raise StorageError(self.name, f"could not delete {errors[0]['Key']}: {errors[0].get('Message')}")
+            for file in batch:
+                print(f"Deleted file: {file['name']} (ID: {file['id']})")
+
+class FanOutStorage(StorageBackend):
+    """Stores every backup in several backends at once, e.g. a local staging directory and S3.
+
+    upload_stream() reads the source once and feeds each backend from its own bounded
+    queue, so a backup is dumped, compressed and encrypted a single time however many
+    copies are kept. A slow backend only holds back the others once its queue is full. A
+    backend that fails is dropped from the stream and the others finish; FanOutError is
+    then raised with the files that were stored.
+
+    Listings, downloads and deletes use the first backend. Apply retention to each backend
+    separately."""
+
+    def __init__(self, backends: List[StorageBackend], queue_size: int = 8) -> None:
+        """Parameters:
+            backends [type:list] -- StorageBackends to write to. The first one is read from.
+            queue_size [type:int] -- Maximum number of chunks buffered per backend. Defaults to 8."""
+        if not backends:
+            raise ValueError("FanOutStorage needs at least one backend")
+        self.backends = backends
+        self.queue_size = queue_size
+        self.name = '+'.join(backend.name for backend in backends)
+
+    @property
+    def primary(self) -> StorageBackend:
+        return self.backends[0]
+
+    def _names(self) -> List[str]:
+        names = [backend.name for backend in self.backends]
+        # two backends of the same kind, e.g. two buckets
+        return [name if names.count(name) == 1 else f"{name}{i}" for i, name in enumerate(names)]
+
+    def _result(self, results: Dict[str, Dict], errors: Dict[str, BaseException]) -> Dict:
+        if errors:
+            raise FanOutError(errors, results)
+        names = self._names()
+        return dict(results[names[0]], copies=results)
+
+    def _run_all(self, operation) -> Dict:
+        """Runs operation(backend) on every backend concurrently."""
+        results, errors = {}, {}
+        with ThreadPoolExecutor(max_workers=len(self.backends)) as executor:
+            futures = {name: executor.submit(operation, backend) for name, backend in zip(self._names(), self.backends)}
+            for name, future in futures.items():
+                try:
+                    results[name] = future.result()
+                except Exception as e:
+                    errors[name] = e
+        return self._result(results, errors)
+
+    def upload_stream(self, chunks: Iterable[bytes], name: str, chunk_size: int = None) -> Dict:
+        names = self._names()
+        queues = {target: queue.Queue(self.queue_size) for target in names}
+        failed = {target: threading.Event() for target in names}
+        results, errors = {}, {}
+
+        def drain(target: str) -> Iterator[bytes]:
+            while True:
+                item = queues[target].get()
+                if item is _END:
+                    return
+                if isinstance(item, _Failure):
+                    raise item.error
+                yield item
+
+        def consume(target: str, backend: StorageBackend) -> None:
+            try:
+                results[target] = backend.upload_stream(drain(target), name, chunk_size)
+            except BaseException as e:
+                errors[target] = e
+                failed[target].set()
+
+        def put(target: str, item) -> None:
+            # a failed backend no longer reads its queue; never block on it
+            while not failed[target].is_set():
+                try:
+                    queues[target].put(item, timeout=0.1)
+                    return
+                except queue.Full:
+                    continue
+
+        threads = [threading.Thread(target=consume, args=(target, backend), daemon=True) for target, backend in zip(names, self.backends)]
+        for thread in threads:
+            thread.start()
+        end = _END
+        try:
+            for chunk in chunks:
+                if all(event.is_set() for event in failed.values()):
+                    break
+                for target in names:
+                    put(target, chunk)
+        except BaseException as e:
+            # no backend may mistake the truncated stream for a complete one
+            end = _Failure(e)
+            raise
+        finally:
+            for target in names:
+                put(target, end)
+            for thread in threads:
+                thread.join()
+        return self._result(results, errors)
+
+    def upload_file(self, path: str, name: str = None, chunk_size: int = None) -> Dict:
+        return self._run_all(lambda backend: backend.upload_file(path, name, chunk_size))
+
+    def upload_bytes(self, data: bytes, name: str) -> Dict:
+        return self._run_all(lambda backend: backend.upload_bytes(data, name))
+
+    def list_files(self, name: str = None) -> List[Dict]:
+        return self.primary.list_files(name)
+
+    def find_latest(self, name: str) -> Dict:
+        return self.primary.find_latest(name)
+
+    def size(self, file_id: str) -> int:
+        return self.primary.size(file_id)
+
+    def read_range(self, file_id: str, start: int, end: int) -> bytes:
+        return self.primary.read_range(file_id, start, end)
+
+    def download_stream(self, file_id: str, chunk_size: int = 8 * 1024 * 1024, workers: int = 4, start: int = 0, end: int = None) -> Iterator[bytes]:
+        return self.primary.download_stream(file_id, chunk_size, workers, start, end)
+
+    def download_bytes(self, file_id: str) -> bytes:
+        return self.primary.download_bytes(file_id)
+
+    def delete_files(self, files: List[Dict]) -> None:
+        self.primary.delete_files(files)
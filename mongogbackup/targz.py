@@ -1,15 +1,287 @@
 import tarfile
 import os
+import io
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import BinaryIO, Iterable, Iterator, Optional
 
-def pack( source_path:str, output_path:str)  -> str:
-    """Generates a tar.gz file from a source path."""    
-    with tarfile.open(output_path, 'w:gz') as tar:
-        tar.add(source_path, arcname=os.path.basename(source_path))
+from mongogbackup.metrics import registry
+
+CODECS = ('gzip', 'zstd', 'lz4')
+_DEFAULT_LEVELS = {'gzip': 6, 'zstd': 3, 'lz4': 0}
+_MAGIC = {
+    b'\x1f\x8b': 'gzip',
+    b'\x28\xb5\x2f\xfd': 'zstd',
+    b'\x04\x22\x4d\x18': 'lz4',
+}
+_BLOCK_SIZE = 1 << 20  # 1Mb of input per independently compressed block
+
+class CodecUnavailableError(Exception):
+    """Raised when a codec needs an optional package that is not installed."""
+    def __init__(self, codec: str, package: str):
+        self.codec = codec
+        self.package = package
+    def __str__(self):
+        return f"Codec {self.codec} requires the '{self.package}' package. Install it with: pip install mongogbackup[{self.codec}]"
+
+class UnknownCodecError(Exception):
+    """Raised when a codec name or a compressed stream's format is not recognised."""
+    def __init__(self, codec: str):
+        self.codec = codec
+    def __str__(self):
+        return f"Unknown compression codec: {self.codec}. Supported codecs are {', '.join(CODECS)}."
+
+def _zstandard():
+    try:
+        import zstandard
+    except ImportError:
+        raise CodecUnavailableError('zstd', 'zstandard')
+    return zstandard
+
+def _lz4_frame():
+    try:
+        import lz4.frame
+    except ImportError:
+        raise CodecUnavailableError('lz4', 'lz4')
+    return lz4.frame
+
+def detect_codec(header: bytes) -> str:
+    """Returns the codec of a compressed stream from its first bytes."""
+    for magic, codec in _MAGIC.items():
+        if header.startswith(magic):
+            return codec
+    raise UnknownCodecError(repr(header[:4]))
+
+class _CompressWriter(io.RawIOBase):
+    """Write-only file object that compresses everything written to it into `output`.
+
+    gzip and lz4 split the input into 1Mb blocks compressed concurrently on a thread pool
+    (zlib and lz4 release the GIL) and written out in order as independent gzip members or
+    lz4 frames. Concatenated members/frames are valid streams, so the output stays readable
+    by standard gunzip and lz4. zstd uses the library's own multi-threaded compressor."""
+
+    def __init__(self, output: BinaryIO, codec: str = 'gzip', level: Optional[int] = None, workers: Optional[int] = None) -> None:
+        if codec not in CODECS:
+            raise UnknownCodecError(codec)
+        self._output = output
+        self._level = level if level is not None else _DEFAULT_LEVELS[codec]
+        self._workers = workers if workers is not None else (os.cpu_count() or 1)
+        self._buffer = bytearray()
+        self._blocks = 0
+        self._pending = deque()
+        self._executor = None
+        self._zstd = None
+        if codec == 'zstd':
+            zstandard = _zstandard()
+            threads = self._workers if self._workers > 1 else 0
+            self._zstd = zstandard.ZstdCompressor(level=self._level, threads=threads).compressobj()
+        elif codec == 'lz4':
+            frame = _lz4_frame()
+            self._compress_block = lambda block: frame.compress(block, compression_level=self._level)
+        else:
+            self._compress_block = self._gzip_member
+        if self._zstd is None and self._workers > 1:
+            self._executor = ThreadPoolExecutor(max_workers=self._workers)
+
+    def _gzip_member(self, block: bytes) -> bytes:
+        compressor = zlib.compressobj(self._level, zlib.DEFLATED, 31)
+        return compressor.compress(block) + compressor.flush()
+
+    def writable(self) -> bool:
+        return True
+
+    def _submit(self, block: bytes) -> None:
+        self._blocks += 1
+        if self._executor is None:
+            self._output.write(self._compress_block(block))
+            return
+        self._pending.append(self._executor.submit(self._compress_block, block))
+        # bound memory to two blocks in flight per worker
+        while len(self._pending) > 2 * self._workers:
+            self._output.write(self._pending.popleft().result())
+
+    def write(self, data) -> int:
+        if self._zstd is not None:
+            compressed = self._zstd.compress(bytes(data))
+            if compressed:
+                self._output.write(compressed)
+            return len(data)
+        self._buffer += data
+        while len(self._buffer) >= _BLOCK_SIZE:
+            self._submit(bytes(self._buffer[:_BLOCK_SIZE]))
+            del self._buffer[:_BLOCK_SIZE]
+        return len(data)
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        try:
+            if self._zstd is not None:
+                self._output.write(self._zstd.flush())
+            else:
+                if self._buffer or not self._blocks:
+                    self._submit(bytes(self._buffer))
+                    self._buffer.clear()
+                while self._pending:
+                    self._output.write(self._pending.popleft().result())
+        finally:
+            if self._executor is not None:
+                self._executor.shutdown(wait=True)
+            super().close()
+
+class _Decompressor:
+    """Incremental decompressor that handles concatenated gzip members, zstd and lz4 frames."""
+
+    def __init__(self, codec: str) -> None:
+        if codec not in CODECS:
+            raise UnknownCodecError(codec)
+        self._codec = codec
+        self._current = self._new()
+        self._fed = False
+
+    def _new(self):
+        if self._codec == 'zstd':
+            return _zstandard().ZstdDecompressor().decompressobj()
+        if self._codec == 'lz4':
+            return _lz4_frame().LZ4FrameDecompressor()
+        return zlib.decompressobj(31)
+
+    def decompress(self, data: bytes) -> bytes:
+        output = []
+        while data:
+            self._fed = True
+            output.append(self._current.decompress(data))
+            if not self._current.eof:
+                break
+            # the member/frame is complete, anything left over starts the next one
+            data = self._current.unused_data
+            self._current = self._new()
+            self._fed = False
+        return b''.join(output)
+
+    def check_complete(self) -> None:
+        """Raises EOFError if the input ended in the middle of a member/frame."""
+        if self._fed:
+            raise EOFError("Compressed stream ended before the end-of-stream marker was reached")
+
+class _DecompressReader(io.RawIOBase):
+    """Read-only file object that decompresses `source`, detecting the codec from its magic bytes."""
+
+    def __init__(self, source: BinaryIO, buf_size: int = _BLOCK_SIZE) -> None:
+        self._source = source
+        self._buf_size = buf_size
+        header = source.read(4)
+        self._decompressor = _Decompressor(detect_codec(header)) if header else None
+        self._pending = header
+        self._output = bytearray()
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, target) -> int:
+        while not self._output and self._decompressor is not None:
+            data = self._pending or self._source.read(self._buf_size)
+            self._pending = b''
+            if not data:
+                self._decompressor.check_complete()
+                break
+            self._output += self._decompressor.decompress(data)
+        size = min(len(target), len(self._output))
+        target[:size] = self._output[:size]
+        del self._output[:size]
+        return size
+
+class _HashingOutput:
+    """Passes writes through to `output` and feeds them to an incremental hash."""
+    def __init__(self, output: BinaryIO, digest) -> None:
+        self._output = output
+        self._digest = digest
+    def write(self, data: bytes) -> int:
+        self._digest.update(data)
+        return self._output.write(data)
+
+def pack( source_path:str, output_path:str, codec:str='gzip', level:int=None, workers:int=None, hasher=None, index:list=None)  -> str:
+    """Generates a compressed tar file from a source path.
+
+    Parameters:
+        source_path [type:String] -- File or directory to archive.
+        output_path [type:String] -- Path of the compressed tar file.
+        codec [type:String] -- One of 'gzip' (parallel, readable by gunzip), 'zstd' or 'lz4'. Defaults to 'gzip'.
+        level [type:int] -- Compression level. Defaults to the codec's default (gzip 6, zstd 3, lz4 0).
+        workers [type:int] -- Number of compression threads. Defaults to the number of CPUs.
+        hasher [type:HashVerifier] -- (Optional) Hashes the archive while it is written (see HashVerifier.last_hash()).
+        index [type:list] -- (Optional) Receives {"name", "offset", "data_offset", "size"} for every member,
+            with offsets into the uncompressed tar stream."""
+    digest = hasher.streaming() if hasher is not None else None
+    with registry.timed('pack', codec=codec) as stats, open(output_path, 'wb') as output:
+        target = _HashingOutput(output, digest) if digest is not None else output
+        with _CompressWriter(target, codec, level, workers) as writer:
+            with tarfile.open(fileobj=writer, mode='w|') as tar:
+                def record(tarinfo):
+                    # called just before the member's header is written at tar.offset
+                    if index is not None:
+                        header = len(tarinfo.tobuf(tar.format, tar.encoding, tar.errors))
+                        index.append({'name': tarinfo.name, 'offset': tar.offset, 'data_offset': tar.offset + header, 'size': tarinfo.size})
+                    return tarinfo
+                tar.add(source_path, arcname=os.path.basename(source_path), filter=record)
+                stats.bytes_in = tar.offset
+        stats.bytes_out = output.tell()
+    if digest is not None:
+        digest.finish(output_path)
     return output_path
-    
+
 def unpack(source_path:str, output_path:str) -> str:
-    """Unpacks a tar.gz file to a specified output path."""
-    with tarfile.open(source_path, 'r:gz') as tar:
-        tar.extractall(output_path)
+    """Unpacks a compressed tar file to a specified output path, detecting the codec automatically."""
+    with registry.timed('unpack') as stats, open(source_path, 'rb') as source, _DecompressReader(source) as reader:
+        with tarfile.open(fileobj=reader, mode='r|') as tar:
+            tar.extractall(output_path)
+            stats.bytes_out = tar.offset
+        stats.bytes_in = source.tell()
     return output_path
-    
\ No newline at end of file
+
+class _Collector:
+    """Minimal write-only sink that collects the compressed output between yields."""
+    def __init__(self) -> None:
+        self.parts = []
+    def write(self, data: bytes) -> int:
+        if data:
+            self.parts.append(data)
+        return len(data)
+    def drain(self) -> bytes:
+        data = b''.join(self.parts)
+        self.parts.clear()
+        return data
+
+def compress_stream(chunks:Iterable[bytes], level:int=None, codec:str='gzip', workers:int=None) -> Iterator[bytes]:
+    """Compresses a stream of byte chunks without buffering the whole input."""
+    collector = _Collector()
+    writer = _CompressWriter(collector, codec, level, workers)
+    try:
+        for chunk in chunks:
+            writer.write(chunk)
+            data = collector.drain()
+            if data:
+                yield data
+    finally:
+        writer.close()
+    yield collector.drain()
+
+def decompress_stream(chunks:Iterable[bytes]) -> Iterator[bytes]:
+    """Decompresses a stream of compressed byte chunks, detecting the codec automatically."""
+    decompressor = None
+    header = b''
+    for chunk in chunks:
+        if decompressor is None:
+            header += chunk
+            if len(header) < 4:
+                continue
+            decompressor = _Decompressor(detect_codec(header))
+            chunk, header = header, b''
+        data = decompressor.decompress(chunk)
+        if data:
+            yield data
+    if decompressor is not None:
+        decompressor.check_complete()
+    elif header:
+        raise UnknownCodecError(repr(header))
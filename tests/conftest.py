@@ -0,0 +1,40 @@
+import os
+import sys
+
+import pytest
+
+# the offline stand-ins for Drive and S3 live with the benchmarks
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks'))
+
+from fakedrive import FakeDrive, FakeDriveHandler  # noqa: E402
+from mongogbackup.files import FileEncryptor  # noqa: E402
+from mongogbackup.retry import RetryPolicy  # noqa: E402
+
+@pytest.fixture
+def drive():
+    with FakeDrive() as drive:
+        yield drive
+
+@pytest.fixture
+def gdrive(drive):
+    handler = FakeDriveHandler(drive.api_root)
+    # keep the retries of injected failures short
+    handler.retry = RetryPolicy(max_attempts=4, initial_delay=0.01, max_delay=0.05)
+    return handler
+
+@pytest.fixture
+def encryptor():
+    return FileEncryptor(generate_key=True)
+
+@pytest.fixture
+def dump_dir(tmp_path):
+    """A mongodump output directory for database 'shop' with three collections."""
+    import bson
+
+    path = tmp_path / 'dump' / 'shop'
+    path.mkdir(parents=True)
+    for name, count in [('orders', 500), ('users', 40), ('empty', 0)]:
+        documents = [bson.encode({'_id': i, 'name': f"{name}-{i}", 'pad': 'x' * (i % 50)}) for i in range(count)]
+        (path / f"{name}.bson").write_bytes(b''.join(documents))
+        (path / f"{name}.metadata.json").write_text('{"indexes": [{"v": 2, "key": {"_id": 1}, "name": "_id_"}]}')
+    return path
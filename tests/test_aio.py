@@ -0,0 +1,115 @@
+import asyncio
+import hashlib
+import os
+import threading
+
+import pytest
+
+from mongogbackup import MongoGBackup, aio, targz
+from mongogbackup.backups import UnexpectedError
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+async def chunks_of(data, size=100 * 1024):
+    for start in range(0, len(data), size):
+        await asyncio.sleep(0)
+        yield data[start:start + size]
+
+@pytest.fixture
+def handler(gdrive, encryptor):
+    handler = MongoGBackup.__new__(MongoGBackup)
+    handler.parent_id = 'root'
+    handler.file_name = 'backup'
+    handler.gdrive = gdrive
+    handler.encrypt = encryptor
+    return handler
+
+def test_backup_streams_to_drive(drive, handler, monkeypatch):
+    data = os.urandom(700 * 1024)
+    monkeypatch.setattr(aio.AsyncMongoGBackup, 'dump_stream', lambda self: chunks_of(data))
+    result = run(aio.AsyncMongoGBackup(handler, queue_size=2).backup(file_name='shop.gz.encr', chunk_size=256 * 1024))
+    stored = drive.files[result['id']]
+    assert stored['name'] == 'shop.gz.encr'
+    assert b''.join(targz.decompress_stream(handler.encrypt.decrypt_stream([stored['data']]))) == data
+
+def test_backup_hashes_the_uploaded_bytes(drive, handler, monkeypatch):
+    monkeypatch.setattr(aio.AsyncMongoGBackup, 'dump_stream', lambda self: chunks_of(os.urandom(300 * 1024)))
+    result = run(aio.AsyncMongoGBackup(handler).backup(chunk_size=256 * 1024))
+    assert handler.hash.last_hash()['hash'] == hashlib.sha256(drive.files[result['id']]['data']).hexdigest()
+
+def test_restore_stops_the_stages_when_mongorestore_fails(drive, handler, monkeypatch):
+    data = os.urandom(1024 * 1024)
+    drive.add_file('backup', b''.join(handler.encrypt.encrypt_stream(targz.compress_stream([data], codec='gzip'))))
+    closed = threading.Event()
+    decompress = targz.decompress_stream
+
+    def decompress_stream(chunks):
+        try:
+            yield from decompress(chunks)
+        finally:
+            closed.set()
+
+    async def restore_stream(self, chunks, drop=False):
+        async for _ in chunks:
+            raise UnexpectedError('mongorestore died')
+
+    async def restore():
+        with pytest.raises(UnexpectedError):
+            await aio.AsyncMongoGBackup(handler, queue_size=1).restore(chunk_size=256 * 1024)
+        # checked before asyncio.run() closes leftover generators itself
+        return await asyncio.get_running_loop().run_in_executor(None, closed.wait, 5)
+
+    monkeypatch.setattr(aio.targz, 'decompress_stream', decompress_stream)
+    monkeypatch.setattr(aio.AsyncMongoGBackup, 'restore_stream', restore_stream)
+    assert run(restore())
+
+def test_backup_fails_when_the_dump_fails(drive, handler, monkeypatch):
+    async def broken(self):
+        yield b'partial'
+        raise OSError('mongodump died')
+
+    monkeypatch.setattr(aio.AsyncMongoGBackup, 'dump_stream', broken)
+    with pytest.raises(OSError, match='mongodump died'):
+        run(aio.AsyncMongoGBackup(handler).backup(chunk_size=256 * 1024))
+    assert not drive.files
+
+def test_stage_errors_reach_the_consumer():
+    def broken(chunks):
+        for chunk in chunks:
+            raise ValueError(chunk)
+        yield b''
+
+    async def consume():
+        return [chunk async for chunk in aio._in_thread(broken, chunks_of(b'abc', 1))]
+
+    with pytest.raises(ValueError, match="b'a'"):
+        run(consume())
+
+def test_backup_many_limits_concurrency(monkeypatch):
+    running = []
+    peak = []
+
+    async def backup(self, **options):
+        running.append(self.backup_handler)
+        peak.append(len(running))
+        await asyncio.sleep(0.01)
+        running.remove(self.backup_handler)
+        return {'name': self.backup_handler, **options}
+
+    monkeypatch.setattr(aio.AsyncMongoGBackup, 'backup', backup)
+    results = run(aio.backup_many([f"db{i}" for i in range(7)], max_concurrency=3, codec='zstd'))
+    assert results == [{'name': f"db{i}", 'codec': 'zstd'} for i in range(7)]
+    assert max(peak) == 3
+
+def test_backup_many_returns_errors_in_place(monkeypatch):
+    async def backup(self, **options):
+        await asyncio.sleep(0)
+        if self.backup_handler == 'broken':
+            raise RuntimeError('dump failed')
+        return self.backup_handler
+
+    monkeypatch.setattr(aio.AsyncMongoGBackup, 'backup', backup)
+    results = run(aio.backup_many(['a', 'broken', 'c'], max_concurrency=2))
+    assert results[0] == 'a' and results[2] == 'c'
+    assert isinstance(results[1], RuntimeError)
@@ -0,0 +1,80 @@
+import gzip
+import os
+import tarfile
+
+import pytest
+
+from mongogbackup import targz
+from mongogbackup.targz import UnknownCodecError, compress_stream, decompress_stream, detect_codec, pack, unpack
+
+def available(codec):
+    if codec == 'zstd':
+        pytest.importorskip('zstandard')
+    if codec == 'lz4':
+        pytest.importorskip('lz4.frame')
+    return codec
+
+def sample(length):
+    # compressible but not trivially so
+    return (os.urandom(64) * (length // 64 + 1))[:length]
+
+@pytest.fixture(params=targz.CODECS)
+def codec(request):
+    return available(request.param)
+
+@pytest.mark.parametrize('length', [0, 10, targz._BLOCK_SIZE, 3 * targz._BLOCK_SIZE + 5])
+@pytest.mark.parametrize('workers', [1, 4])
+def test_stream_round_trip(codec, length, workers):
+    data = sample(length)
+    pieces = [data[i:i + 300000] for i in range(0, len(data), 300000)]
+    compressed = b''.join(compress_stream(pieces, codec=codec, workers=workers))
+    assert detect_codec(compressed) == codec
+    # feed the compressed stream back in small, misaligned pieces
+    assert b''.join(decompress_stream(compressed[i:i + 1001] for i in range(0, len(compressed), 1001))) == data
+
+def test_parallel_gzip_is_readable_by_gzip():
+    data = sample(3 * targz._BLOCK_SIZE)
+    compressed = b''.join(compress_stream([data], codec='gzip', workers=4))
+    assert gzip.decompress(compressed) == data
+
+def test_truncated_stream_is_rejected(codec):
+    compressed = b''.join(compress_stream([os.urandom(100000)], codec=codec, workers=1))
+    with pytest.raises(EOFError):
+        b''.join(decompress_stream([compressed[:-10]]))
+
+def test_unknown_codec_name_is_rejected():
+    with pytest.raises(UnknownCodecError):
+        b''.join(compress_stream([b'data'], codec='bzip2'))
+
+def test_unknown_stream_format_is_rejected():
+    with pytest.raises(UnknownCodecError):
+        detect_codec(b'PK\x03\x04')
+    with pytest.raises(UnknownCodecError):
+        b''.join(decompress_stream([b'not compressed at all']))
+
+def test_pack_and_unpack_round_trip(codec, tmp_path):
+    source = tmp_path / 'dump'
+    (source / 'db').mkdir(parents=True)
+    files = {'db/a.bson': sample(2 * targz._BLOCK_SIZE + 1), 'db/b.bson': b'', 'db/a.metadata.json': b'{}'}
+    for name, data in files.items():
+        (source / name).write_bytes(data)
+    index = []
+    archive = pack(str(source), str(tmp_path / 'dump.tar'), codec=codec, workers=2, index=index)
+    with open(archive, 'rb') as f:
+        assert detect_codec(f.read(4)) == codec
+    unpack(archive, str(tmp_path / 'out'))
+    for name, data in files.items():
+        assert (tmp_path / 'out' / 'dump' / name).read_bytes() == data
+    # the index points at every member's data in the uncompressed tar stream
+    with open(archive, 'rb') as f:
+        tar = b''.join(decompress_stream(iter(lambda: f.read(65536), b'')))
+    members = {entry['name']: entry for entry in index}
+    for name, data in files.items():
+        entry = members['dump/' + name]
+        assert tar[entry['data_offset']:entry['data_offset'] + entry['size']] == data
+
+def test_pack_output_is_a_standard_tar(tmp_path):
+    (tmp_path / 'file').write_bytes(b'hello')
+    archive = pack(str(tmp_path / 'file'), str(tmp_path / 'file.tar.gz'))
+    with tarfile.open(archive, 'r:gz') as tar:
+        assert tar.extractfile('file').read() == b'hello'
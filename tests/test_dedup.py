@@ -0,0 +1,173 @@
+import itertools
+import os
+import random
+import threading
+import time
+
+import bson
+import pytest
+
+from mongogbackup.dedup import ChunkIntegrityError, DedupStore, ManifestNotFoundError, content_defined_chunks
+from mongogbackup.files import HashVerifier
+from mongogbackup.storage import DriveStorage, LocalStorage
+
+SIZES = {'min_size': 4 * 1024, 'avg_size': 16 * 1024, 'max_size': 64 * 1024}
+
+def documents(count, start=0):
+    # seeded, so the chunk boundaries the tests rely on are the same on every run
+    rng = random.Random(start)
+    return [bson.encode({'_id': i, 'payload': rng.getrandbits(8 * (200 + i % 300)).to_bytes(200 + i % 300, 'little')})
+            for i in range(start, start + count)]
+
+def chunk(data, **sizes):
+    return list(content_defined_chunks([data[i:i + 5000] for i in range(0, len(data), 5000)], **dict(SIZES, **sizes)))
+
+@pytest.mark.parametrize('data', [b'', b'x', os.urandom(300 * 1024)], ids=['empty', 'byte', 'random'])
+def test_chunks_reassemble_raw_bytes(data):
+    chunks = chunk(data)
+    assert b''.join(chunks) == data
+    assert all(len(c) <= SIZES['max_size'] for c in chunks)
+
+def test_chunks_of_bson_end_on_document_boundaries():
+    docs = documents(2000)
+    data = b''.join(docs)
+    chunks = chunk(data)
+    assert b''.join(chunks) == data
+    assert len(chunks) > 5
+    ends = set(itertools.accumulate(len(d) for d in docs))
+    offset = 0
+    for c in chunks[:-1]:
+        offset += len(c)
+        assert offset in ends
+        assert len(c) >= SIZES['min_size']
+
+def test_an_inserted_document_only_changes_nearby_chunks():
+    docs = documents(3000)
+    before = set(chunk(b''.join(docs)))
+    changed = docs[:1500] + documents(1, start=10 ** 6) + docs[1500:]
+    after = chunk(b''.join(changed))
+    assert len([c for c in after if c not in before]) <= 2
+
+def test_random_bytes_are_cut_by_content_too():
+    data = os.urandom(400 * 1024)
+    before = set(chunk(data))
+    after = chunk(data[:200 * 1024] + b'inserted' + data[200 * 1024:])
+    assert len([c for c in after if c not in before]) <= 2
+
+@pytest.mark.parametrize('sizes', [
+    {'min_size': 0, 'avg_size': 10, 'max_size': 20},
+    {'min_size': 10, 'avg_size': 10, 'max_size': 20},
+    {'min_size': 10, 'avg_size': 30, 'max_size': 20},
+])
+def test_invalid_sizes_are_rejected(sizes):
+    with pytest.raises(ValueError):
+        list(content_defined_chunks([b'data'], **sizes))
+
+@pytest.fixture
+def local(tmp_path):
+    return LocalStorage(str(tmp_path / 'store'), fsync=False)
+
+@pytest.fixture
+def store(local, encryptor):
+    return DedupStore(local, encryptor, HashVerifier(), workers=2, **SIZES)
+
+def test_backup_and_restore_round_trip(store):
+    data = b''.join(documents(1000))
+    manifest = store.backup([data], 'nightly-1')
+    assert manifest['size'] == len(data)
+    assert manifest['uploaded'] == len(manifest['chunks'])
+    assert b''.join(store.restore_stream('nightly-1')) == data
+
+def test_unchanged_chunks_are_not_uploaded_again(store):
+    docs = documents(1000)
+    first = store.backup([b''.join(docs)], 'nightly-1')
+    second = store.backup([b''.join(docs[:500] + documents(1, start=10 ** 6) + docs[500:])], 'nightly-2')
+    assert second['uploaded'] <= 2
+    assert second['reused'] >= len(first['chunks']) - 2
+    assert b''.join(store.restore_stream('nightly-1')) == b''.join(docs)
+
+def test_chunks_are_packed_and_uploaded_in_parallel(local, encryptor):
+    running = []
+    peak = []
+    lock = threading.Lock()
+    upload_bytes = local.upload_bytes
+
+    def slow_upload(data, name):
+        with lock:
+            running.append(name)
+            peak.append(len(running))
+        time.sleep(0.01)
+        with lock:
+            running.remove(name)
+        return upload_bytes(data, name)
+
+    local.upload_bytes = slow_upload
+    store = DedupStore(local, encryptor, HashVerifier(), workers=3, **SIZES)
+    data = b''.join(documents(2000))
+    manifest = store.backup([data], 'nightly-1')
+    assert max(peak) == 3
+    assert b''.join(store.restore_stream('nightly-1')) == data
+    assert manifest['uploaded_bytes'] == sum(int(f['size']) for f in store.remote_index().values())
+
+def test_a_failed_upload_fails_the_backup(store, local):
+    def broken(data, name):
+        raise IOError('quota exceeded')
+
+    local.upload_bytes = broken
+    with pytest.raises(IOError):
+        store.backup([b''.join(documents(500))], 'nightly-1')
+    assert store.list_backups() == []
+
+def test_chunks_and_manifests_are_named_files(store, local):
+    store.backup([b''.join(documents(500))], 'nightly-1')
+    names = {f['name'] for f in local.list_files()}
+    assert 'nightly-1.manifest' in names
+    assert {'chunks/' + chunk_id for chunk_id in store.remote_index()} == names - {'nightly-1.manifest'}
+
+def test_chunk_names_do_not_reveal_content(store, encryptor, tmp_path):
+    other = DedupStore(LocalStorage(str(tmp_path / 'other'), fsync=False), type(encryptor)(generate_key=True), HashVerifier(), **SIZES)
+    data = b''.join(documents(200))
+    assert store.backup([data], 'a')['chunks'] != other.backup([data], 'a')['chunks']
+
+def test_missing_manifest_is_reported(store):
+    with pytest.raises(ManifestNotFoundError):
+        list(store.restore_stream('absent'))
+
+def test_missing_chunk_is_reported(store):
+    store.backup([b''.join(documents(500))], 'nightly-1')
+    chunk_file = next(iter(store.remote_index().values()))
+    store.storage.delete_files([chunk_file])
+    with pytest.raises(ChunkIntegrityError):
+        list(store.restore_stream('nightly-1'))
+
+def test_swapped_chunk_is_reported(store, local):
+    store.backup([b''.join(documents(500))], 'nightly-1')
+    first, second = list(store.remote_index().values())[:2]
+    first_path, second_path = local._path(first['id']), local._path(second['id'])
+    os.rename(first_path, first_path + '.swap')
+    os.rename(second_path, first_path)
+    os.rename(first_path + '.swap', second_path)
+    with pytest.raises(ChunkIntegrityError):
+        list(store.restore_stream('nightly-1'))
+
+def test_collect_garbage_keeps_the_chunks_of_live_backups(store):
+    docs = documents(1000)
+    store.backup([b''.join(docs)], 'nightly-1')
+    store.backup([b''.join(docs[:900])], 'nightly-2')
+    store.backup([b''.join(documents(300, start=5000))], 'nightly-3')
+    preview = store.collect_garbage(keep=2, dry_run=True)
+    assert preview['deleted_backups'] == ['nightly-1.manifest']
+    assert len(store.list_backups()) == 3
+    report = store.collect_garbage(keep=2)
+    assert report == preview
+    assert report['deleted_chunks'] >= 1
+    assert [f['name'] for f in store.list_backups()] == ['nightly-2.manifest', 'nightly-3.manifest']
+    assert b''.join(store.restore_stream('nightly-2')) == b''.join(docs[:900])
+    assert len(store.remote_index()) == report['live_chunks']
+
+def test_drive_storage(gdrive, encryptor):
+    store = DedupStore(DriveStorage(gdrive, 'root'), encryptor, HashVerifier(), **SIZES)
+    data = b''.join(documents(500))
+    store.backup([data], 'nightly-1')
+    assert b''.join(store.restore_stream('nightly-1')) == data
+    assert [f['name'] for f in store.list_backups()] == ['nightly-1.manifest']
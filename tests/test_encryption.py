@@ -0,0 +1,142 @@
+import os
+import struct
+
+import pytest
+from cryptography.fernet import Fernet
+
+from mongogbackup.files import DecryptionError, FileEncryptor
+
+CHUNK = 1024
+HEADER = struct.Struct('>4sBBI16s')
+LENGTH = struct.Struct('>I')
+
+def encrypt(encryptor, data):
+    return b''.join(encryptor.encrypt_stream([data]))
+
+def decrypt(encryptor, data, piece=None):
+    pieces = [data[i:i + piece] for i in range(0, len(data), piece)] if piece else [data]
+    return b''.join(encryptor.decrypt_stream(pieces))
+
+def records(container):
+    """Splits a container into its header and its length-prefixed chunks."""
+    header, body = container[:HEADER.size], container[HEADER.size:]
+    chunks = []
+    while body:
+        length = LENGTH.unpack_from(body)[0]
+        chunks.append(body[:LENGTH.size + length])
+        body = body[LENGTH.size + length:]
+    return header, chunks
+
+@pytest.fixture
+def encryptor():
+    return FileEncryptor(generate_key=True, chunk_size=CHUNK)
+
+@pytest.mark.parametrize('length', [0, 1, CHUNK - 1, CHUNK, CHUNK + 1, 5 * CHUNK, 5 * CHUNK + 3])
+@pytest.mark.parametrize('piece', [None, 1, 7, 4096])
+def test_round_trip(encryptor, length, piece):
+    data = os.urandom(length)
+    assert decrypt(encryptor, encrypt(encryptor, data), piece) == data
+
+def test_input_piece_sizes_do_not_change_the_chunking(encryptor):
+    data = os.urandom(3 * CHUNK + 10)
+    container = b''.join(encryptor.encrypt_stream(data[i:i + 100] for i in range(0, len(data), 100)))
+    _, chunks = records(container)
+    assert len(chunks) == 4
+    assert decrypt(encryptor, container) == data
+
+def test_same_key_decrypts_in_another_instance(encryptor):
+    container = encrypt(encryptor, b'payload')
+    assert decrypt(FileEncryptor(key=encryptor.get_key()), container) == b'payload'
+
+def test_wrong_key_is_rejected(encryptor):
+    container = encrypt(encryptor, b'payload')
+    with pytest.raises(DecryptionError):
+        decrypt(FileEncryptor(generate_key=True), container)
+
+def test_tampered_chunk_is_rejected(encryptor):
+    container = bytearray(encrypt(encryptor, os.urandom(3 * CHUNK)))
+    container[HEADER.size + LENGTH.size + 10] ^= 1
+    with pytest.raises(DecryptionError):
+        decrypt(encryptor, bytes(container))
+
+def test_tampered_header_is_rejected(encryptor):
+    container = bytearray(encrypt(encryptor, os.urandom(3 * CHUNK)))
+    container[HEADER.size - 1] ^= 1  # last salt byte
+    with pytest.raises(DecryptionError):
+        decrypt(encryptor, bytes(container))
+
+def test_reordered_chunks_are_rejected(encryptor):
+    header, chunks = records(encrypt(encryptor, os.urandom(3 * CHUNK + 1)))
+    chunks[0], chunks[1] = chunks[1], chunks[0]
+    with pytest.raises(DecryptionError):
+        decrypt(encryptor, header + b''.join(chunks))
+
+@pytest.mark.parametrize('keep', [0, 1, 2])
+def test_truncated_stream_is_rejected(encryptor, keep):
+    header, chunks = records(encrypt(encryptor, os.urandom(3 * CHUNK + 1)))
+    with pytest.raises(DecryptionError):
+        decrypt(encryptor, header + b''.join(chunks[:keep]))
+
+def test_stream_cut_inside_a_chunk_is_rejected(encryptor):
+    container = encrypt(encryptor, os.urandom(3 * CHUNK))
+    with pytest.raises(DecryptionError):
+        decrypt(encryptor, container[:-5])
+
+def test_data_after_the_end_marker_is_rejected(encryptor):
+    header, chunks = records(encrypt(encryptor, os.urandom(2 * CHUNK + 1)))
+    with pytest.raises(DecryptionError):
+        decrypt(encryptor, header + b''.join(chunks) + chunks[-1])
+
+def test_oversized_chunk_size_in_the_header_is_rejected(encryptor):
+    header, chunks = records(encrypt(encryptor, b'payload'))
+    magic, version, algorithm, _, salt = HEADER.unpack(header)
+    forged = HEADER.pack(magic, version, algorithm, FileEncryptor.MAX_CHUNK_SIZE + 1, salt)
+    with pytest.raises(DecryptionError, match='chunk size'):
+        decrypt(encryptor, forged + b''.join(chunks))
+
+def test_oversized_chunk_length_is_rejected_before_buffering(encryptor):
+    header, _ = records(encrypt(encryptor, b'payload'))
+    reads = []
+
+    def source():
+        yield header + LENGTH.pack(CHUNK * 1000)
+        while True:
+            reads.append(1)
+            yield bytes(CHUNK)
+
+    with pytest.raises(DecryptionError, match='invalid length'):
+        b''.join(encryptor.decrypt_stream(source()))
+    assert len(reads) <= 1
+
+@pytest.mark.parametrize('chunk_size', [0, -1, FileEncryptor.MAX_CHUNK_SIZE + 1])
+def test_invalid_chunk_size_is_rejected(chunk_size):
+    with pytest.raises(ValueError):
+        FileEncryptor(generate_key=True, chunk_size=chunk_size)
+
+def test_missing_key_is_rejected():
+    with pytest.raises(ValueError):
+        FileEncryptor()
+
+def test_legacy_fernet_files_still_decrypt(encryptor):
+    fernet = Fernet(encryptor.get_key())
+    assert decrypt(encryptor, fernet.encrypt(b'old backup')) == b'old backup'
+    lines = fernet.encrypt(b'first') + b'\n' + fernet.encrypt(b'second') + b'\n'
+    assert decrypt(encryptor, lines, piece=9) == b'firstsecond'
+
+def test_tampered_legacy_fernet_file_is_rejected(encryptor):
+    token = bytearray(Fernet(encryptor.get_key()).encrypt(b'old backup'))
+    token[20] = ord('A') if token[20] != ord('A') else ord('B')
+    with pytest.raises(DecryptionError):
+        decrypt(encryptor, bytes(token))
+
+def test_file_round_trip(encryptor, tmp_path):
+    data = os.urandom(4 * CHUNK + 99)
+    (tmp_path / 'plain').write_bytes(data)
+    encryptor.encrypt_file(str(tmp_path / 'plain'), str(tmp_path / 'encr'))
+    assert (tmp_path / 'encr').read_bytes()[:4] == FileEncryptor.MAGIC
+    encryptor.decrypt_file(str(tmp_path / 'encr'), str(tmp_path / 'out'))
+    assert (tmp_path / 'out').read_bytes() == data
+
+def test_parameters_describe_the_container(encryptor):
+    assert encryptor.parameters() == {'container': 'MGBK', 'version': FileEncryptor.VERSION, 'algorithm': 'AES-256-GCM',
+                                      'kdf': 'HKDF-SHA256', 'chunk_size': CHUNK}
@@ -0,0 +1,106 @@
+import json
+
+import pytest
+
+from mongogbackup.gdrive import DriveFolderIndex, FileDeletionError
+
+def names(files):
+    return [f['name'] for f in files]
+
+@pytest.fixture
+def folder(drive):
+    for name in ['a', 'b', 'c']:
+        drive.add_file(name, name.encode(), 'folder')
+    drive.add_file('elsewhere', b'x', 'other')
+    return 'folder'
+
+def test_first_refresh_lists_the_folder(drive, gdrive, folder):
+    index = DriveFolderIndex(gdrive, folder)
+    index.refresh()
+    assert names(index.files()) == ['a', 'b', 'c']
+    assert index.find('b')[0]['size'] == '1'
+
+def test_refresh_follows_the_changes_feed(drive, gdrive, folder):
+    index = DriveFolderIndex(gdrive, folder)
+    index.refresh()
+    files = {f['name']: f['id'] for f in index.files()}
+    created = drive.add_file('d', b'dd', folder)
+    drive.add_file('elsewhere', b'y', 'other')
+    drive.trash(files['a'])
+    drive.delete(files['b'])
+    requests = drive.requests
+    index.refresh()
+    assert drive.requests - requests == 1  # one page of changes, no listing
+    assert names(index.files()) == ['c', 'd']
+    assert index.get(created['id'])['md5Checksum'] == created['md5Checksum']
+    assert index.get(files['a']) is None
+
+def test_changes_feed_is_read_page_by_page(drive, gdrive, folder, monkeypatch):
+    index = DriveFolderIndex(gdrive, folder)
+    index.refresh()
+    list_changes = drive.list_changes
+    monkeypatch.setattr(drive, 'list_changes', lambda token, size: list_changes(token, 2))
+    for i in range(5):
+        drive.add_file(f"new{i}", b'', folder)
+    index.refresh()
+    assert len(index.files()) == 8
+    requests = drive.requests
+    index.refresh()
+    assert drive.requests - requests == 1
+
+def test_index_is_persisted(drive, gdrive, folder, tmp_path):
+    cache_path = str(tmp_path / 'index.json')
+    DriveFolderIndex(gdrive, folder, cache_path).refresh()
+    drive.add_file('d', b'', folder)
+    requests = drive.requests
+    index = DriveFolderIndex(gdrive, folder, cache_path)
+    index.refresh()
+    assert drive.requests - requests == 1
+    assert names(index.files()) == ['a', 'b', 'c', 'd']
+    with open(cache_path) as f:
+        assert json.load(f)['parent_id'] == folder
+
+def test_cache_of_another_folder_is_ignored(drive, gdrive, folder, tmp_path):
+    cache_path = str(tmp_path / 'index.json')
+    DriveFolderIndex(gdrive, 'other', cache_path).refresh()
+    index = DriveFolderIndex(gdrive, folder, cache_path)
+    index.refresh()
+    assert names(index.files()) == ['a', 'b', 'c']
+
+def test_delete_files_batches_and_updates_the_index(drive, gdrive, monkeypatch):
+    monkeypatch.setattr(type(gdrive), '_BATCH_SIZE', 4)
+    files = [drive.add_file(f"backup{i:02d}", b'x', 'folder') for i in range(10)]
+    index = gdrive.folder_index('folder')
+    index.refresh()
+    requests = drive.requests
+    gdrive.delete_files(files[:9])
+    assert drive.requests - requests == 3  # batches of 4, 4 and 1 deletes
+    assert list(drive.files) == [files[9]['id']]
+    assert names(index.files()) == ['backup09']
+
+def test_delete_files_retries_only_the_failed_deletes(drive, gdrive, monkeypatch):
+    monkeypatch.setattr(type(gdrive), '_BATCH_SIZE', 4)
+    files = [drive.add_file(f"backup{i:02d}", b'x', 'folder') for i in range(9)]
+    requests = drive.requests
+    drive.fail(503, count=2)  # the first two deletes of the first batch
+    gdrive.delete_files(files)
+    assert drive.requests - requests == 4  # three batches, then one with the two failed deletes
+    assert not drive.files
+
+def test_delete_files_counts_missing_files_as_deleted(drive, gdrive):
+    files = [drive.add_file(f"backup{i}", b'x', 'folder') for i in range(3)]
+    drive.delete(files[1]['id'])
+    gdrive.delete_files(files)
+    assert not drive.files
+
+def test_delete_files_reports_permanent_failures(drive, gdrive):
+    files = [drive.add_file(f"backup{i}", b'x', 'folder') for i in range(3)]
+    drive.fail(400, reason='badRequest')
+    with pytest.raises(FileDeletionError):
+        gdrive.delete_files(files)
+    assert list(drive.files) == [files[0]['id']]
+
+def test_delete_older_files_keeps_the_newest(drive, gdrive):
+    files = [drive.add_file('backup', str(i).encode(), 'folder') for i in range(5)]
+    gdrive.delete_older_files('folder', 2)
+    assert sorted(drive.files) == sorted(f['id'] for f in files[3:])
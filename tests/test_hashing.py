@@ -0,0 +1,123 @@
+import hashlib
+import os
+
+import pytest
+
+from mongogbackup import files, targz
+from mongogbackup.files import HashCache, HashVerifier
+
+LEAF = 1024
+
+@pytest.fixture(autouse=True)
+def small_tree(monkeypatch):
+    # small leaves and segments, so a few Kb cover every boundary
+    monkeypatch.setattr(files, '_TREE_LEAF', LEAF)
+    monkeypatch.setattr(files, '_TREE_SEGMENT', 3)
+
+def streamed(verifier, data, piece):
+    digest = verifier.streaming()
+    for start in range(0, len(data), piece):
+        digest.update(data[start:start + piece])
+    return digest.finish()
+
+@pytest.mark.parametrize('piece', [1000, 4096])
+def test_streaming_sha256_matches_hashlib(piece):
+    data = os.urandom(10000)
+    assert streamed(HashVerifier(), data, piece) == hashlib.sha256(data).hexdigest()
+
+@pytest.mark.parametrize('length', [0, 1, LEAF - 1, LEAF, LEAF + 1, 3 * LEAF, 3 * LEAF + 1, 10 * LEAF + 17])
+@pytest.mark.parametrize('piece', [333, LEAF, 5000])
+def test_streaming_tree_hash_matches_the_file_hash(tmp_path, length, piece):
+    data = os.urandom(length)
+    path = tmp_path / 'data'
+    path.write_bytes(data)
+    verifier = HashVerifier(mode='tree', workers=2)
+    assert streamed(verifier, data, piece) == verifier.generate_file_hash(str(path))
+    assert HashVerifier(mode='tree', workers=1).generate_file_hash(str(path)) == verifier.last_hash()['hash']
+
+def test_tree_hash_depends_on_content_and_length():
+    verifier = HashVerifier(mode='tree')
+    data = os.urandom(3 * LEAF)
+    assert streamed(verifier, data, LEAF) != streamed(verifier, data[:-1] + bytes([data[-1] ^ 1]), LEAF)
+    assert streamed(verifier, b'', LEAF) != streamed(verifier, b'\x00', LEAF)
+    assert streamed(verifier, data, LEAF) != hashlib.sha256(data).hexdigest()
+
+def test_unknown_mode_is_rejected():
+    with pytest.raises(ValueError):
+        HashVerifier(mode='md5')
+
+def test_stream_passes_chunks_through_and_records_the_hash():
+    verifier = HashVerifier()
+    chunks = [b'abc', b'def']
+    assert list(verifier.stream(chunks)) == chunks
+    assert verifier.compare_generated(hashlib.sha256(b'abcdef').hexdigest())
+
+def test_encrypt_file_hashes_its_output(tmp_path, encryptor):
+    (tmp_path / 'plain').write_bytes(os.urandom(5000))
+    verifier = HashVerifier()
+    encryptor.encrypt_file(str(tmp_path / 'plain'), str(tmp_path / 'encr'), hasher=verifier)
+    assert verifier.last_hash()['hash'] == hashlib.sha256((tmp_path / 'encr').read_bytes()).hexdigest()
+
+def test_pack_hashes_the_archive(tmp_path):
+    (tmp_path / 'dump').mkdir()
+    (tmp_path / 'dump' / 'a.bson').write_bytes(os.urandom(5000))
+    verifier = HashVerifier(mode='tree')
+    archive = targz.pack(str(tmp_path / 'dump'), str(tmp_path / 'dump.tar.gz'), hasher=verifier)
+    assert verifier.last_hash()['hash'] == HashVerifier(mode='tree').generate_file_hash(archive)
+
+def rewrite_in_place(path, data):
+    """Replaces the content of a file without changing its size or modification time."""
+    stat = os.stat(path)
+    with open(path, 'r+b') as f:
+        f.write(data)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+
+def test_cache_returns_the_hash_of_an_unchanged_file(tmp_path):
+    path = str(tmp_path / 'data')
+    with open(path, 'wb') as f:
+        f.write(b'a' * 100)
+    cache_path = str(tmp_path / 'hashes.json')
+    original = HashVerifier(cache_path=cache_path).generate_file_hash(path)
+    # the cache is trusted while size and mtime match, so a silent rewrite goes unnoticed
+    rewrite_in_place(path, b'b' * 100)
+    assert HashVerifier(cache_path=cache_path).generate_file_hash(path) == original
+
+@pytest.mark.parametrize('change', ['mtime', 'size'])
+def test_cache_is_invalidated_when_the_file_changes(tmp_path, change):
+    path = str(tmp_path / 'data')
+    with open(path, 'wb') as f:
+        f.write(b'a' * 100)
+    verifier = HashVerifier(cache_path=str(tmp_path / 'hashes.json'))
+    original = verifier.generate_file_hash(path)
+    if change == 'mtime':
+        rewrite_in_place(path, b'b' * 100)
+        stat = os.stat(path)
+        os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+        expected = hashlib.sha256(b'b' * 100).hexdigest()
+    else:
+        with open(path, 'ab') as f:
+            f.write(b'a')
+        expected = hashlib.sha256(b'a' * 101).hexdigest()
+    assert verifier.generate_file_hash(path) == expected != original
+
+def test_cache_is_kept_per_mode(tmp_path):
+    path = str(tmp_path / 'data')
+    with open(path, 'wb') as f:
+        f.write(os.urandom(5000))
+    cache = HashCache(str(tmp_path / 'hashes.json'))
+    cache.put(path, 'sha256', 'cached')
+    assert cache.get(path, 'sha256') == 'cached'
+    assert cache.get(path, 'tree') is None
+    assert cache.get(str(tmp_path / 'other'), 'sha256') is None
+
+def test_finish_stores_the_hash_of_the_written_file(tmp_path):
+    path = str(tmp_path / 'data')
+    data = os.urandom(5000)
+    with open(path, 'wb') as f:
+        f.write(data)
+    verifier = HashVerifier(mode='tree', cache_path=str(tmp_path / 'hashes.json'))
+    digest = verifier.streaming()
+    digest.update(data)
+    assert verifier.cache.get(path, 'tree') is None
+    expected = digest.finish(path)
+    assert verifier.cache.get(path, 'tree') == expected
@@ -0,0 +1,151 @@
+import datetime
+
+import bson
+import pytest
+from bson import json_util
+from bson.timestamp import Timestamp
+
+from mongogbackup.incremental import IncrementalBackupHandler
+
+TS = Timestamp(1760000000, 3)
+WALL = datetime.datetime(2026, 10, 9, 12, 0, tzinfo=datetime.timezone.utc)
+NS = {'db': 'shop', 'coll': 'orders'}
+KEY = {'_id': 7}
+DOC = {'_id': 7, 'total': 12}
+
+def change(operation, **fields):
+    return dict({'operationType': operation, 'clusterTime': TS, 'wallTime': WALL, 'ns': NS}, **fields)
+
+@pytest.mark.parametrize('event, expected', [
+    (change('insert', fullDocument=DOC, documentKey=KEY),
+     {'op': 'i', 'ns': 'shop.orders', 'o': DOC}),
+    (change('update', fullDocument=DOC, documentKey=KEY, updateDescription={'updatedFields': {'total': 12}}),
+     {'op': 'u', 'ns': 'shop.orders', 'o': DOC, 'o2': KEY}),
+    (change('replace', fullDocument=DOC, documentKey=KEY),
+     {'op': 'u', 'ns': 'shop.orders', 'o': DOC, 'o2': KEY}),
+    (change('delete', documentKey=KEY),
+     {'op': 'd', 'ns': 'shop.orders', 'o': KEY}),
+    (change('drop'),
+     {'op': 'c', 'ns': 'shop.$cmd', 'o': {'drop': 'orders'}}),
+    (change('rename', to={'db': 'shop', 'coll': 'archived'}),
+     {'op': 'c', 'ns': 'admin.$cmd', 'o': {'renameCollection': 'shop.orders', 'to': 'shop.archived'}}),
+    (change('dropDatabase', ns={'db': 'shop'}),
+     {'op': 'c', 'ns': 'shop.$cmd', 'o': {'dropDatabase': 1}}),
+], ids=['insert', 'update', 'replace', 'delete', 'drop', 'rename', 'dropDatabase'])
+def test_change_becomes_an_oplog_entry(event, expected):
+    entry = IncrementalBackupHandler._change_to_oplog(event)
+    assert entry == dict({'ts': TS, 'v': 2, 'wall': WALL}, **expected)
+    # segments are written with bson.encode
+    assert bson.decode(bson.encode(entry))['op'] == expected['op']
+
+@pytest.mark.parametrize('event', [
+    # an updateLookup that found the document gone; its delete event follows
+    change('update', fullDocument=None, documentKey=KEY, updateDescription={'updatedFields': {'total': 12}}),
+    change('replace', documentKey=KEY),
+    change('invalidate'),
+    change('createIndexes'),
+    change('modify'),
+], ids=['update-of-deleted', 'replace-of-deleted', 'invalidate', 'createIndexes', 'modify'])
+def test_ignored_changes(event):
+    assert IncrementalBackupHandler._change_to_oplog(event) is None
+
+def test_missing_wall_time_defaults_to_now():
+    event = change('insert', fullDocument=DOC, documentKey=KEY)
+    del event['wallTime']
+    entry = IncrementalBackupHandler._change_to_oplog(event)
+    assert abs(entry['wall'] - datetime.datetime.now(datetime.timezone.utc)) < datetime.timedelta(minutes=1)
+
+class FakeStream:
+    """A change stream over a fixed list of events, resumable after any of their tokens."""
+
+    def __init__(self, events, resume_after):
+        tokens = [event['_id'] for event in events]
+        self.events = events[tokens.index(resume_after) + 1:] if resume_after in tokens else list(events)
+        self.resume_token = resume_after
+        self.alive = True
+
+    def try_next(self):
+        if not self.events:
+            return None
+        event = self.events.pop(0)
+        self.resume_token = event['_id']
+        return event
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.alive = False
+
+class FakeClient:
+    def __init__(self, events, now):
+        self.events = events
+        self.admin = self
+        self.now = now
+
+    def command(self, name):
+        assert name == 'ping'
+        return {'ok': 1, 'operationTime': self.now}
+
+    def __getitem__(self, name):
+        return self
+
+    def watch(self, resume_after, **options):
+        return FakeStream(self.events, resume_after)
+
+def inserts(count, start=1):
+    return [dict(change('insert', fullDocument={'_id': i}, documentKey={'_id': i}), _id={'n': i}, clusterTime=Timestamp(100 + i, 0))
+            for i in range(start, start + count)]
+
+class StubBackups:
+    db_name = 'shop'
+
+    def __init__(self, client):
+        self.client = client
+
+    def _client(self):
+        return self.client
+
+@pytest.fixture
+def chain_dir(tmp_path):
+    with open(tmp_path / 'chain.json', 'w') as f:
+        f.write(json_util.dumps({'db': 'shop', 'mode': 'changestream', 'resume': {'token': {'n': 0}, 'ts': None}, 'segments': []}))
+    return tmp_path
+
+def segment_ids(chain_dir, segment):
+    with open(chain_dir / segment['file'], 'rb') as f:
+        return [entry['o']['_id'] for entry in bson.decode_all(f.read())]
+
+def test_changestream_segment_ends_at_the_time_it_started(chain_dir):
+    # changes keep arriving while the segment is written
+    client = FakeClient(inserts(10), now=Timestamp(106, 0))
+    handler = IncrementalBackupHandler(StubBackups(client), str(chain_dir), mode='changestream')
+    chain = handler.backup()
+    assert segment_ids(chain_dir, chain['segments'][0]) == [1, 2, 3, 4, 5, 6]
+    assert chain['resume'] == {'token': {'n': 6}, 'ts': Timestamp(106, 0)}
+    client.now = Timestamp(200, 0)
+    chain = handler.backup()
+    assert segment_ids(chain_dir, chain['segments'][1]) == [7, 8, 9, 10]
+
+def test_changestream_segment_change_limit(chain_dir):
+    client = FakeClient(inserts(10), now=Timestamp(200, 0))
+    handler = IncrementalBackupHandler(StubBackups(client), str(chain_dir), mode='changestream', max_segment_changes=4)
+    for _ in range(3):
+        chain = handler.backup()
+    assert [segment_ids(chain_dir, segment) for segment in chain['segments']] == [[1, 2, 3, 4], [5, 6, 7, 8], [9, 10]]
+
+def test_changestream_segment_byte_limit(chain_dir):
+    client = FakeClient(inserts(10), now=Timestamp(200, 0))
+    size = len(bson.encode(IncrementalBackupHandler._change_to_oplog(inserts(1)[0])))
+    handler = IncrementalBackupHandler(StubBackups(client), str(chain_dir), mode='changestream', max_segment_bytes=2 * size + 1)
+    chain = handler.backup()
+    # the limit is checked after each change, so the change crossing it is kept
+    assert segment_ids(chain_dir, chain['segments'][0]) == [1, 2, 3]
+
+def test_quiet_changestream_advances_the_resume_token(chain_dir):
+    client = FakeClient(inserts(2), now=Timestamp(200, 0))
+    handler = IncrementalBackupHandler(StubBackups(client), str(chain_dir), mode='changestream')
+    handler.backup()
+    chain = handler.backup()
+    assert len(chain['segments']) == 1
+    assert chain['resume']['token'] == {'n': 2}
@@ -0,0 +1,108 @@
+import os
+import threading
+
+import pytest
+
+from mongogbackup.indexed import (CollectionNotInBackupError, DriveArchive, LocalArchive, NotIndexedError, StorageArchive,
+                                  read_index, restore, select_segments, write_archive)
+from mongogbackup.storage import LocalStorage
+
+class FakeBackups:
+    """The part of MongoBackupHandler the indexed archive uses, with made-up mongodump output."""
+
+    db_name = 'shop'
+
+    def __init__(self):
+        self.dumps = {name: os.urandom(size) for name, size in [('orders', 300000), ('orders_2023', 5000), ('users', 1000), ('empty', 0)]}
+        self.restored = {}
+        self._lock = threading.Lock()
+
+    def list_collections(self):
+        return [{'name': name, 'size': len(data), 'count': len(data) // 100} for name, data in self.dumps.items()]
+
+    def dump_stream(self, collection):
+        data = self.dumps[collection]
+        for start in range(0, len(data), 65536):
+            yield data[start:start + 65536]
+
+    def restore_stream(self, chunks, drop=False):
+        data = b''.join(chunks)
+        name = next(name for name, dump in self.dumps.items() if dump == data)
+        with self._lock:
+            self.restored[name] = drop
+
+class CountingArchive(LocalArchive):
+    def __init__(self, path):
+        super().__init__(path, chunk_size=4096)
+        self.bytes_read = 0
+
+    def read(self, start, length):
+        self.bytes_read += length
+        return super().read(start, length)
+
+    def stream(self, start, length):
+        self.bytes_read += length
+        return super().stream(start, length)
+
+@pytest.fixture
+def backups():
+    return FakeBackups()
+
+@pytest.fixture
+def archive_path(backups, encryptor, tmp_path):
+    path = str(tmp_path / 'shop.idx.encr')
+    write_archive(backups, encryptor, path, codec='gzip', workers=1)
+    return path
+
+def test_index_lists_every_collection(archive_path, encryptor):
+    index = read_index(LocalArchive(archive_path), encryptor)
+    assert index['db'] == 'shop'
+    assert [s['name'] for s in index['segments']] == ['orders', 'orders_2023', 'users', 'empty']
+
+def test_manifest_describes_the_archive(backups, encryptor, tmp_path):
+    path = str(tmp_path / 'users.idx.encr')
+    manifest = write_archive(backups, encryptor, path, collections=['users'])
+    manifest.verify_signature(encryptor)
+    assert manifest.data['archive']['format'] == 'indexed'
+    assert manifest.data['archive']['size'] == os.path.getsize(path)
+    assert [c['name'] for c in manifest.collections] == ['users']
+    assert manifest.collection('users')['size'] == 1000
+
+def test_select_segments(archive_path, encryptor):
+    index = read_index(LocalArchive(archive_path), encryptor)
+    assert [s['name'] for s in select_segments(index, ['users', 'orders'])] == ['orders', 'users']
+    assert [s['name'] for s in select_segments(index, ns_filter='shop.orders*')] == ['orders', 'orders_2023']
+    assert select_segments(index, ns_filter='other.*') == []
+    with pytest.raises(CollectionNotInBackupError):
+        select_segments(index, ['users', 'missing'])
+
+def test_restore_reads_only_the_selected_segments(backups, archive_path, encryptor):
+    archive = CountingArchive(archive_path)
+    assert restore(backups, encryptor, archive, ['users'], drop=True) == ['users']
+    assert backups.restored == {'users': True}
+    # the trailer, the index and one small segment, not the large orders segment
+    assert archive.bytes_read < 10000 < os.path.getsize(archive_path)
+
+def test_restore_everything_in_parallel(backups, archive_path, encryptor):
+    restored = restore(backups, encryptor, LocalArchive(archive_path), workers=3)
+    assert restored == ['orders', 'orders_2023', 'users', 'empty']
+    assert set(backups.restored) == set(backups.dumps)
+
+def test_segments_are_read_from_storage_backends(backups, archive_path, encryptor, tmp_path):
+    storage = LocalStorage(str(tmp_path / 'storage'), fsync=False)
+    file = storage.upload_file(archive_path)
+    restore(backups, encryptor, StorageArchive(storage, file, chunk_size=4096), ns_filter='shop.orders_*')
+    assert list(backups.restored) == ['orders_2023']
+
+def test_segments_are_read_from_drive(backups, archive_path, encryptor, drive, gdrive):
+    with open(archive_path, 'rb') as f:
+        file = drive.add_file('shop.idx.encr', f.read())
+    restore(backups, encryptor, DriveArchive(gdrive, file, chunk_size=256 * 1024), ['orders'])
+    assert list(backups.restored) == ['orders']
+
+def test_plain_archives_are_not_indexed(tmp_path, encryptor):
+    (tmp_path / 'short').write_bytes(b'tiny')
+    (tmp_path / 'plain').write_bytes(os.urandom(1000))
+    for name in ['short', 'plain']:
+        with pytest.raises(NotIndexedError):
+            read_index(LocalArchive(str(tmp_path / name)), encryptor)
@@ -0,0 +1,156 @@
+import pytest
+
+from mongogbackup import lowimpact, pipeline
+from mongogbackup.backups import MongoBackupHandler
+from mongogbackup.lowimpact import LowImpactMode, Throttle
+from mongogbackup.metrics import Metrics
+from mongogbackup.pipeline import RateLimiter
+
+MB = 1024 * 1024
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+        self.slept = []
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.slept.append(seconds)
+        self.now += seconds
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(pipeline.time, 'monotonic', clock.monotonic)
+    monkeypatch.setattr(pipeline.time, 'sleep', clock.sleep)
+    return clock
+
+class StubHandler:
+    db_name = 'shop'
+
+HEALTHY = {'replication_lag': 1.0, 'queued_operations': 0, 'cache_fill': 0.5, 'cache_dirty': 0.01}
+
+def test_rate_limiter_lets_the_burst_through(clock):
+    limiter = RateLimiter(100)
+    assert limiter.reserve(60) == 0
+    assert limiter.reserve(40) == 0
+    assert limiter.reserve(50) == pytest.approx(0.5)
+
+def test_rate_limiter_refills_over_time(clock):
+    limiter = RateLimiter(100)
+    limiter.reserve(100)
+    clock.now += 0.25
+    assert limiter.reserve(25) == 0
+    assert limiter.reserve(50) == pytest.approx(0.5)
+    clock.now += 10
+    # the bucket never holds more than the burst
+    assert limiter.reserve(150) == pytest.approx(0.5)
+
+def test_rate_limiter_sleeps_for_its_debt(clock):
+    limiter = RateLimiter(100, burst=10)
+    assert list(limiter.throttle([b'x' * 10, b'x' * 30, b'x' * 20])) == [b'x' * 10, b'x' * 30, b'x' * 20]
+    assert clock.slept == [pytest.approx(0.3), pytest.approx(0.2)]
+
+def test_set_rate_moves_the_default_burst(clock):
+    limiter = RateLimiter(100)
+    limiter.set_rate(10)
+    assert limiter.burst == 10
+    assert limiter.reserve(20) == pytest.approx(1.0)
+    fixed = RateLimiter(100, burst=50)
+    fixed.set_rate(10)
+    assert fixed.burst == 50
+    with pytest.raises(ValueError):
+        fixed.set_rate(0)
+
+def test_invalid_read_preference_is_rejected():
+    with pytest.raises(ValueError):
+        LowImpactMode(read_preference='secondaryOnly')
+
+def test_client_options_and_mongodump_argument():
+    mode = LowImpactMode(tags=[{'use': 'backup', 'dc': 'east'}, {}])
+    assert mode.client_options() == {'readPreference': 'secondary', 'readPreferenceTags': ['use:backup,dc:east', '']}
+    assert mode.read_preference_argument() == '{"mode": "secondary", "tagSets": [{"use": "backup", "dc": "east"}, {}]}'
+
+@pytest.mark.parametrize('load, reasons', [
+    (HEALTHY, []),
+    (dict(HEALTHY, replication_lag=30.0), ['replication_lag']),
+    (dict(HEALTHY, queued_operations=50, cache_dirty=0.2), ['queued_operations', 'cache_dirty']),
+    (dict(HEALTHY, cache_fill=0.95), ['cache_fill']),
+    ({'replication_lag': None, 'queued_operations': None, 'cache_fill': None, 'cache_dirty': None}, []),
+])
+def test_pressure_names_the_signals_over_their_limit(load, reasons):
+    assert LowImpactMode().pressure(load) == reasons
+
+def test_disabled_limits_are_never_pressure():
+    mode = LowImpactMode(max_replication_lag=None)
+    assert mode.pressure(dict(HEALTHY, replication_lag=3600.0)) == []
+
+def test_adjust_halves_under_load_and_recovers(clock):
+    throttle = Throttle(LowImpactMode(max_mb_per_second=8, max_docs_per_second=1000, min_rate_fraction=0.2), StubHandler())
+    throttle.adjust(dict(HEALTHY, replication_lag=30.0), 5)
+    assert throttle.factor == 0.5
+    assert throttle.bytes.rate == 4 * MB
+    assert throttle.documents.rate == 500
+    throttle.adjust(dict(HEALTHY, queued_operations=100), 5)
+    assert throttle.factor == 0.25
+    # never below min_rate_fraction
+    throttle.adjust(dict(HEALTHY, queued_operations=100), 5)
+    assert throttle.factor == 0.2
+    assert throttle.bytes.rate == pytest.approx(1.6 * MB)
+    throttle.adjust(HEALTHY, 5)
+    assert throttle.factor == pytest.approx(0.3)
+    for _ in range(10):
+        throttle.adjust(HEALTHY, 5)
+    assert throttle.factor == 1.0
+    assert throttle.bytes.rate == 8 * MB
+
+def test_adjust_publishes_throttle_events(clock, monkeypatch):
+    metrics = Metrics()
+    events = []
+    metrics.add_callback(events.append)
+    monkeypatch.setattr(lowimpact, 'registry', metrics)
+    throttle = Throttle(LowImpactMode(max_mb_per_second=8), StubHandler())
+    throttle.adjust(HEALTHY, 5)  # already at the cap, nothing changes
+    throttle.adjust(dict(HEALTHY, cache_fill=0.99), 5)
+    throttles = [event for event in events if event['event'] == 'throttle']
+    assert len(throttles) == 1
+    assert throttles[0]['db'] == 'shop'
+    assert throttles[0]['reasons'] == ['cache_fill']
+    assert throttles[0]['mb_per_second'] == 4
+
+def test_first_load_without_a_cap_uses_the_observed_rate(clock):
+    throttle = Throttle(LowImpactMode(), StubHandler())
+    assert throttle.reserve(10 * MB) == 0
+    throttle.adjust(HEALTHY, 5)
+    assert throttle.bytes is None
+    throttle.reserve(20 * MB)
+    throttle.adjust(dict(HEALTHY, replication_lag=60.0), 10)
+    assert throttle.max_bytes == 2 * MB
+    assert throttle.bytes.rate == 1 * MB
+
+def test_reserve_uses_the_longer_of_both_waits(clock):
+    throttle = Throttle(LowImpactMode(max_mb_per_second=1, max_docs_per_second=10), StubHandler())
+    assert throttle.reserve(MB, documents=10) == 0
+    assert throttle.reserve(MB // 2, documents=30) == pytest.approx(3.0)
+    assert throttle.reserve(MB) == pytest.approx(1.5)
+
+def test_low_impact_backup_parallel_dumps_one_collection_at_a_time(tmp_path):
+    handler = MongoBackupHandler.__new__(MongoBackupHandler)
+    handler.db_name, handler.host, handler.port, handler.username, handler.password = 'shop', 'db', 27017, None, None
+    handler.engine = 'tools'
+    handler.low_impact = LowImpactMode()
+    sources = []
+    runs = []
+    handler.dump_source = lambda: sources.append(1) or ('secondary', 27018)
+    handler.list_collections = lambda: [{'name': name, 'size': 1, 'count': 1} for name in ['orders', 'users', 'items']]
+
+    def run_parallel(commands, workers):
+        runs.append(workers)
+        return [{'name': collection['name'], 'size': 1, 'count': 1, 'seconds': 0} for command, collection in commands]
+
+    handler._run_parallel = run_parallel
+    handler.backup_parallel(str(tmp_path), workers=8)
+    assert runs == [1]
+    assert len(sources) == 1
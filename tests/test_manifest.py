@@ -0,0 +1,93 @@
+import hashlib
+import json
+
+import bson
+import pytest
+
+from mongogbackup import targz
+from mongogbackup.files import FileEncryptor
+from mongogbackup.manifest import BackupManifest, CorruptedDumpError, ManifestSignatureError, bson_file_stats, create_archive
+
+def test_bson_file_stats_counts_documents(tmp_path):
+    data = b''.join(bson.encode({'_id': i}) for i in range(1000))
+    (tmp_path / 'c.bson').write_bytes(data)
+    # a small buffer makes documents straddle reads
+    assert bson_file_stats(str(tmp_path / 'c.bson'), buf_size=7) == {'size': len(data), 'count': 1000, 'sha256': hashlib.sha256(data).hexdigest()}
+
+@pytest.mark.parametrize('tail', [b'\x10\x00', b'\x00\x00\x00\x00', bson.encode({'_id': 1})[:-3]], ids=['short', 'zero-length', 'truncated'])
+def test_bson_file_stats_rejects_corrupt_files(tmp_path, tail):
+    (tmp_path / 'c.bson').write_bytes(bson.encode({'_id': 0}) + tail)
+    with pytest.raises(CorruptedDumpError):
+        bson_file_stats(str(tmp_path / 'c.bson'))
+
+@pytest.fixture
+def archive(dump_dir, tmp_path, encryptor):
+    path = tmp_path / 'shop.tar.encr'
+    return path, create_archive(str(dump_dir), str(path), encryptor, codec='gzip', workers=2)
+
+def test_create_archive_describes_the_dump(archive, dump_dir, encryptor, tmp_path):
+    path, manifest = archive
+    data = path.read_bytes()
+    assert manifest.name == 'shop.tar.encr'
+    assert manifest.data['db'] == 'shop'
+    assert manifest.data['archive']['size'] == len(data)
+    assert manifest.data['archive']['md5'] == hashlib.md5(data).hexdigest()
+    assert manifest.data['archive']['encryption']['algorithm'] == 'AES-256-GCM'
+    assert manifest.collection('orders')['count'] == 500
+    assert manifest.collection('empty')['count'] == 0
+    assert manifest.collection('missing') is None
+    # the recorded tar offsets point at the collection files
+    tar = b''.join(targz.decompress_stream(encryptor.decrypt_stream([data])))
+    orders = manifest.collection('orders')
+    start = orders['tar']['data_offset']
+    assert tar[start:start + orders['size']] == (dump_dir / 'orders.bson').read_bytes()
+
+def test_signature_round_trip(archive, encryptor):
+    _, manifest = archive
+    loaded = BackupManifest.from_bytes(manifest.to_bytes(), encryptor)
+    assert loaded.data == manifest.data
+
+def test_modified_manifest_is_rejected(archive, encryptor):
+    _, manifest = archive
+    data = json.loads(manifest.to_bytes())
+    data['collections'][0]['count'] += 1
+    with pytest.raises(ManifestSignatureError):
+        BackupManifest.from_bytes(json.dumps(data).encode(), encryptor)
+
+def test_manifest_signed_with_another_key_is_rejected(archive):
+    _, manifest = archive
+    with pytest.raises(ManifestSignatureError):
+        BackupManifest.from_bytes(manifest.to_bytes(), FileEncryptor(generate_key=True))
+
+def test_unsigned_manifest_is_rejected(encryptor):
+    with pytest.raises(ManifestSignatureError):
+        BackupManifest({'archive': {'name': 'x'}}).verify_signature(encryptor)
+
+def test_manifest_can_be_read_without_the_key(archive, tmp_path):
+    _, manifest = archive
+    manifest.save(str(tmp_path / 'm.json'))
+    assert BackupManifest.load(str(tmp_path / 'm.json')).collections == manifest.collections
+
+def test_verify_remote(archive):
+    path, manifest = archive
+    data = path.read_bytes()
+    assert manifest.verify_remote({'size': str(len(data)), 'md5Checksum': hashlib.md5(data).hexdigest()}) == {'ok': True, 'size': True, 'md5': True}
+    assert manifest.verify_remote({'size': str(len(data)), 'md5Checksum': '0' * 32})['ok'] is False
+    assert manifest.verify_remote({'size': str(len(data) - 1), 'md5Checksum': hashlib.md5(data).hexdigest()})['ok'] is False
+    # storages without an MD5 (S3 multipart uploads) are checked by size only
+    assert manifest.verify_remote({'size': str(len(data))}) == {'ok': True, 'size': True, 'md5': None}
+
+def test_verify_dump_detects_changed_collections(archive, dump_dir):
+    _, manifest = archive
+    assert manifest.verify_dump(str(dump_dir)) == {'orders': True, 'users': True, 'empty': True}
+    (dump_dir / 'users.bson').write_bytes(bson.encode({'_id': 'changed'}))
+    (dump_dir / 'orders.bson').write_bytes((dump_dir / 'orders.bson').read_bytes()[:-1])
+    assert manifest.verify_dump(str(dump_dir), ['orders', 'users', 'empty', 'missing']) == \
+        {'orders': False, 'users': False, 'empty': True, 'missing': False}
+
+def test_changed_collections(archive, dump_dir, encryptor, tmp_path):
+    _, first = archive
+    assert first.changed_collections(None) == ['empty', 'orders', 'users']
+    (dump_dir / 'users.bson').write_bytes(bson.encode({'_id': 'changed'}))
+    second = create_archive(str(dump_dir), str(tmp_path / 'second.encr'), encryptor)
+    assert second.changed_collections(first) == ['users']
@@ -0,0 +1,102 @@
+import json
+import logging
+
+import pytest
+
+from mongogbackup.metrics import Metrics, StageStats, redact_command
+from mongogbackup.pipeline import Pipeline
+
+@pytest.fixture
+def metrics():
+    return Metrics(prefix='test', log_level=logging.DEBUG)
+
+def test_redact_command_hides_passwords():
+    command = ['mongodump', '--username', 'admin', '--password', 's3cret', '--host', 'db']
+    assert redact_command(command) == 'mongodump --username admin --password **** --host db'
+    assert redact_command(['mongodump', '--password=s3cret', '--db', 'shop']) == 'mongodump --password=**** --db shop'
+    assert 's3cret' not in redact_command(['mongorestore', '--password', 's3cret', '--password=s3cret'])
+
+def test_events_reach_callbacks_and_the_log(metrics, caplog):
+    events = []
+    metrics.add_callback(events.append)
+    metrics.add_callback(lambda event: 1 / 0)  # a failing callback does not stop the others
+    with caplog.at_level(logging.DEBUG, logger='mongogbackup'):
+        record = metrics.event('upload', file='shop.gz.encr')
+    assert events == [record]
+    assert record['event'] == 'upload' and record['file'] == 'shop.gz.encr'
+    logged = [r for r in caplog.records if hasattr(r, 'mongogbackup')]
+    assert logged[0].mongogbackup == record
+    assert json.loads(logged[0].getMessage())['file'] == 'shop.gz.encr'
+
+def test_timed_records_the_stage(metrics):
+    events = []
+    metrics.add_callback(events.append)
+    with metrics.timed('pack', pipeline='archive', file='shop') as stats:
+        stats.bytes_in = 100
+        stats.bytes_out = 40
+    assert events[0]['stage'] == 'pack'
+    assert events[0]['bytes_out'] == 40
+    assert events[0]['file'] == 'shop'
+    assert 'error' not in events[0]
+    assert metrics.stages()[0]['runs'] == 1
+
+def test_timed_records_an_error(metrics):
+    events = []
+    metrics.add_callback(events.append)
+    with pytest.raises(OSError):
+        with metrics.timed('pack'):
+            raise OSError('disk full')
+    assert events[0]['error'] == "OSError('disk full')"
+    assert metrics.stages()[0]['runs'] == 1
+
+def test_stage_runs_are_accumulated(metrics):
+    for wall in [1.0, 2.0]:
+        stats = StageStats('compress', 'backup')
+        stats.runs = 1
+        stats.wall_seconds = wall
+        stats.bytes_in = 1048576
+        stats.sample_queue(4)
+        metrics.record_stage(stats)
+    total = metrics.stages()[0]
+    assert total['runs'] == 2
+    assert total['wall_seconds'] == 3.0
+    assert total['queue_depth_max'] == 4
+    assert total['mb_per_second'] == pytest.approx(2 / 3)
+
+def test_prometheus_exposition(metrics):
+    stats = StageStats('encrypt', 'backup')
+    stats.runs = 1
+    stats.bytes_out = 512
+    metrics.record_stage(stats)
+    metrics.increment('retries_total', operation='upload_chunk')
+    metrics.increment('retries_total', 2, operation='upload_chunk')
+    text = metrics.prometheus()
+    assert '# HELP test_stage_bytes_out_total Bytes produced by the stage.\n# TYPE test_stage_bytes_out_total counter\n' in text
+    assert 'test_stage_bytes_out_total{stage="encrypt",pipeline="backup"} 512\n' in text
+    assert '# TYPE test_stage_queue_depth_max gauge\n' in text
+    assert '# TYPE test_retries_total counter\ntest_retries_total{operation="upload_chunk"} 3\n' in text
+    assert text.endswith('\n')
+
+def test_prometheus_label_values_are_escaped(metrics):
+    metrics.increment('errors_total', file='C:\\dumps\\"shop"\nnext')
+    assert 'test_errors_total{file="C:\\\\dumps\\\\\\"shop\\"\\nnext"} 1\n' in metrics.prometheus()
+    assert metrics.counters() == {'errors_total{file="C:\\\\dumps\\\\\\"shop\\"\\nnext"}': 1}
+
+def test_prometheus_file_is_rewritten_after_events(tmp_path):
+    path = tmp_path / 'mongogbackup.prom'
+    metrics = Metrics(prometheus_path=str(path))
+    metrics.increment('backups_total')
+    metrics.event('backup')
+    assert 'mongogbackup_backups_total 1\n' in path.read_text()
+    assert not (tmp_path / 'mongogbackup.prom.tmp').exists()
+
+def test_pipeline_publishes_every_stage(metrics):
+    events = []
+    metrics.add_callback(events.append)
+    Pipeline([b'ab', b'cd'], [('upper', lambda chunks: (c.upper() for c in chunks))], b''.join, name='demo', metrics=metrics).run()
+    stages = {event['stage']: event for event in events if event['event'] == 'stage'}
+    assert set(stages) == {'source', 'upper', 'sink'}
+    assert stages['upper']['bytes_in'] == stages['upper']['bytes_out'] == 4
+    assert stages['sink']['bytes_in'] == 4
+    summary = next(event for event in events if event['event'] == 'pipeline')
+    assert summary['pipeline'] == 'demo' and summary['error'] is None
@@ -0,0 +1,253 @@
+import contextlib
+import json
+import os
+import threading
+
+import bson
+import pytest
+from bson import json_util
+from pymongo.errors import BulkWriteError, CollectionInvalid
+
+from mongogbackup.manifest import CorruptedDumpError, bson_file_stats
+from mongogbackup import native
+from mongogbackup.native import NativeEngine
+
+class FakeCollection:
+    """In-memory collection with the calls NativeEngine makes, keyed and ordered by integer _id."""
+
+    def __init__(self, name, documents=()):
+        self.name = name
+        self.documents = {d['_id']: d for d in documents}
+        self.indexes = [{'v': 2, 'key': {'_id': 1}, 'name': '_id_'}]
+        self.scans = []
+        self._lock = threading.Lock()
+
+    def aggregate(self, pipeline):
+        size = pipeline[0]['$sample']['size']
+        ids = sorted(self.documents)
+        step = max(len(ids) // size, 1)
+        return iter([{'_id': i} for i in ids[::step]])
+
+    def find_raw_batches(self, query, batch_size, hint=None, min=None, max=None):
+        lower = min[0][1] if min else None
+        upper = max[0][1] if max else None
+        self.scans.append((lower, upper))
+        selected = [d for i, d in sorted(self.documents.items())
+                    if (lower is None or i >= lower) and (upper is None or i < upper)]
+        for start in range(0, len(selected), 100):
+            yield b''.join(bson.encode(d) for d in selected[start:start + 100])
+
+    def list_indexes(self):
+        return iter(self.indexes)
+
+    def insert_many(self, batch, ordered):
+        errors = []
+        with self._lock:
+            for index, document in enumerate(batch):
+                document = bson.decode(document.raw)
+                if document['_id'] in self.documents:
+                    errors.append({'code': 11000, 'index': index, 'errmsg': 'duplicate key'})
+                    if ordered:
+                        break
+                else:
+                    self.documents[document['_id']] = document
+        if errors:
+            raise BulkWriteError({'writeErrors': errors})
+
+class FakeDatabase:
+    def __init__(self):
+        self.collections = {}
+        self.commands = []
+
+    def __getitem__(self, name):
+        return self.collections.setdefault(name, FakeCollection(name))
+
+    def list_collections(self, filter):
+        if filter['name'] not in self.collections:
+            return iter([])
+        return iter([{'name': filter['name'], 'type': 'collection', 'options': {},
+                      'info': {'uuid': bson.Binary(b'\x01' * 16, 4)}}])
+
+    def drop_collection(self, name):
+        self.collections.pop(name, None)
+
+    def create_collection(self, name, **options):
+        if name in self.collections:
+            raise CollectionInvalid(f"collection {name} already exists")
+        self.collections[name] = FakeCollection(name)
+
+    def command(self, *args, **kwargs):
+        self.commands.append((args, kwargs))
+
+class FakeHandler:
+    db_name = 'shop'
+
+    def __init__(self, database):
+        self.database = database
+
+    def list_collections(self):
+        # largest first, like MongoBackupHandler.list_collections()
+        entries = [{'name': c.name, 'size': sum(len(bson.encode(d)) for d in c.documents.values()), 'count': len(c.documents)}
+                   for c in self.database.collections.values()]
+        return sorted(entries, key=lambda c: c['size'], reverse=True)
+
+    def _client(self):
+        database = self.database
+
+        class Client:
+            def __getitem__(self, name):
+                return database
+
+            def close(self):
+                pass
+
+        return Client()
+
+    def throttle(self):
+        return contextlib.nullcontext()
+
+def documents(count):
+    return [{'_id': i, 'name': f"item-{i}", 'pad': 'x' * (i % 40)} for i in range(count)]
+
+@pytest.fixture
+def source():
+    database = FakeDatabase()
+    database.collections['orders'] = FakeCollection('orders', documents(2000))
+    database.collections['orders'].indexes.append({'v': 2, 'key': {'name': 1}, 'name': 'name_1', 'ns': 'shop.orders'})
+    database.collections['users'] = FakeCollection('users', documents(30))
+    database.collections['empty'] = FakeCollection('empty')
+    return database
+
+@pytest.fixture
+def engine(source):
+    return NativeEngine(FakeHandler(source), partition_size=20000, insert_batch_size=64)
+
+def read_ids(path):
+    with open(path, 'rb') as f:
+        return [d['_id'] for d in bson.decode_all(f.read())]
+
+def test_small_collections_are_one_partition(engine, source):
+    assert engine.partitions(source['users'], 1000) == [(None, None)]
+
+def test_large_collections_are_split_into_ranges(engine, source):
+    ranges = engine.partitions(source['orders'], 100000)
+    assert len(ranges) == 5
+    assert ranges[0][0] is None and ranges[-1][1] is None
+    assert all(upper == lower for (_, upper), (lower, _) in zip(ranges, ranges[1:]))
+
+def test_empty_sample_falls_back_to_one_partition(engine):
+    # the collection was emptied after its size was read
+    assert engine.partitions(FakeCollection('gone'), 100000) == [(None, None)]
+
+def test_dump_writes_mongodump_layout(engine, source, tmp_path):
+    manifest_path = engine.dump(str(tmp_path), workers=3)
+    db_dir = tmp_path / 'shop'
+    assert sorted(read_ids(str(db_dir / 'orders.bson'))) == list(range(2000))
+    assert read_ids(str(db_dir / 'users.bson')) == list(range(30))
+    assert (db_dir / 'empty.bson').read_bytes() == b''
+    metadata = json_util.loads((db_dir / 'orders.metadata.json').read_text())
+    assert metadata['collectionName'] == 'orders'
+    assert [index['name'] for index in metadata['indexes']] == ['_id_', 'name_1']
+    assert metadata['uuid'] == '01' * 16
+    manifest = json.loads(open(manifest_path).read())
+    entries = {c['name']: c for c in manifest['collections']}
+    assert manifest['engine'] == 'native'
+    assert entries['orders']['partitions'] > 1
+    assert len(source['orders'].scans) == entries['orders']['partitions']
+    assert entries['orders']['size'] == os.path.getsize(db_dir / 'orders.bson')
+    assert bson_file_stats(str(db_dir / 'orders.bson'))['count'] == 2000
+
+def test_dump_selected_collections(engine, tmp_path):
+    engine.dump(str(tmp_path), workers=1, collections=['users'])
+    assert sorted(os.listdir(tmp_path / 'shop')) == ['manifest.json', 'users.bson', 'users.metadata.json']
+
+def test_failed_scan_is_raised(engine, source, tmp_path):
+    def broken(*args, **kwargs):
+        raise RuntimeError('cursor killed')
+        yield
+
+    source['users'].find_raw_batches = broken
+    with pytest.raises(RuntimeError):
+        engine.dump(str(tmp_path), workers=2)
+
+@pytest.fixture
+def open_outputs(monkeypatch):
+    """Tracks the .bson files the engine holds open, and the most it held at once."""
+    state = {'open': set(), 'peak': 0}
+
+    class Tracked:
+        def __init__(self, path, mode):
+            self.file = open(path, mode)
+            self.path = path
+            if path.endswith('.bson'):
+                state['open'].add(path)
+                state['peak'] = max(state['peak'], len(state['open']))
+
+        def write(self, data):
+            return self.file.write(data)
+
+        def close(self):
+            state['open'].discard(self.path)
+            self.file.close()
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *exc):
+            self.close()
+
+    monkeypatch.setattr(native, 'open', Tracked, raising=False)
+    return state
+
+def test_dump_opens_outputs_one_collection_at_a_time(engine, source, tmp_path, open_outputs):
+    for i in range(10):
+        source.collections[f"extra{i}"] = FakeCollection(f"extra{i}", documents(5))
+    engine.dump(str(tmp_path), workers=1)
+    assert open_outputs['peak'] == 1
+    assert open_outputs['open'] == set()
+
+def test_failed_dump_closes_its_outputs(engine, source, tmp_path, open_outputs):
+    def broken(*args, **kwargs):
+        yield bson.encode({'_id': 0})
+        raise RuntimeError('cursor killed')
+
+    source['orders'].find_raw_batches = broken
+    with pytest.raises(RuntimeError):
+        engine.dump(str(tmp_path), workers=2)
+    assert open_outputs['open'] == set()
+
+def test_restore_round_trip(engine, source, tmp_path):
+    engine.dump(str(tmp_path), workers=2)
+    target = FakeDatabase()
+    restorer = NativeEngine(FakeHandler(target), insert_batch_size=64)
+    restorer.restore(str(tmp_path / 'shop'), [{'name': 'orders'}, {'name': 'users'}, {'name': 'empty'}], workers=2, insertion_workers=3)
+    assert target['orders'].documents == source['orders'].documents
+    assert target['users'].documents == source['users'].documents
+    assert target['empty'].documents == {}
+    # secondary indexes are built after the data, without the legacy ns field
+    assert target.commands == [(('createIndexes', 'orders'), {'indexes': [{'v': 2, 'key': {'name': 1}, 'name': 'name_1'}]})]
+
+@pytest.mark.parametrize('ordered', [False, True])
+def test_restore_skips_duplicate_keys(engine, source, tmp_path, capsys, ordered):
+    engine.dump(str(tmp_path), workers=1, collections=['orders'])
+    target = FakeDatabase()
+    target.collections['orders'] = FakeCollection('orders', [{'_id': 5, 'name': 'kept'}, {'_id': 70, 'name': 'kept'}])
+    NativeEngine(FakeHandler(target), insert_batch_size=64, ordered=ordered).restore(str(tmp_path / 'shop'), [{'name': 'orders'}])
+    assert sorted(target['orders'].documents) == list(range(2000))
+    assert target['orders'].documents[5]['name'] == 'kept'
+    assert 'orders: skipped 2 documents with duplicate keys' in capsys.readouterr().out
+
+def test_restore_with_drop_replaces_the_collection(engine, tmp_path):
+    engine.dump(str(tmp_path), workers=1, collections=['users'])
+    target = FakeDatabase()
+    target.collections['users'] = FakeCollection('users', [{'_id': 'stale'}])
+    NativeEngine(FakeHandler(target)).restore(str(tmp_path / 'shop'), [{'name': 'users'}], drop=True)
+    assert sorted(target['users'].documents) == list(range(30))
+
+@pytest.mark.parametrize('tail', [b'\x10\x00', b'\x00\x00\x00\x00'], ids=['truncated', 'zero-length'])
+def test_restore_rejects_corrupt_files(engine, tmp_path, tail):
+    engine.dump(str(tmp_path), workers=1, collections=['users'])
+    with open(tmp_path / 'shop' / 'users.bson', 'ab') as f:
+        f.write(tail)
+    with pytest.raises(CorruptedDumpError):
+        NativeEngine(FakeHandler(FakeDatabase())).restore(str(tmp_path / 'shop'), [{'name': 'users'}])
@@ -0,0 +1,143 @@
+import os
+
+import pytest
+
+from mongogbackup.gdrive import FileDownloadError, FileQueryError
+
+CHUNK = 256 * 1024
+
+def write(path, data):
+    path.write_bytes(data)
+    return str(path)
+
+def test_upload_parts_and_download_parts_round_trip(drive, gdrive, tmp_path):
+    data = os.urandom(5 * CHUNK + 11)
+    results = gdrive.upload_parts(write(tmp_path / 'backup.encr', data), 'root', part_size=2 * CHUNK, chunk_size=CHUNK, workers=3)
+    assert [r['name'] for r in results] == ['backup.encr.part0001', 'backup.encr.part0002', 'backup.encr.part0003']
+    assert not list(tmp_path.glob('*.upload-session'))
+    gdrive.download_parts('backup.encr', 'root', str(tmp_path / 'joined'), chunk_size=CHUNK)
+    assert (tmp_path / 'joined').read_bytes() == data
+
+def test_empty_file_is_one_empty_part(drive, gdrive, tmp_path):
+    results = gdrive.upload_parts(write(tmp_path / 'empty', b''), 'root', chunk_size=CHUNK)
+    assert len(results) == 1
+    gdrive.download_parts('empty', 'root', str(tmp_path / 'joined'))
+    assert (tmp_path / 'joined').read_bytes() == b''
+
+@pytest.mark.parametrize('sizes', [(5, 2), (2, 5)], ids=['fewer-parts', 'more-parts'])
+def test_download_parts_uses_only_the_latest_upload(drive, gdrive, tmp_path, sizes):
+    # uploads with the same name must not be mixed, whichever has more parts
+    first, second = (os.urandom(n * CHUNK) for n in sizes)
+    gdrive.upload_parts(write(tmp_path / 'first', first), 'root', file_name='backup.encr', part_size=CHUNK, chunk_size=CHUNK)
+    gdrive.upload_parts(write(tmp_path / 'second', second), 'root', file_name='backup.encr', part_size=CHUNK, chunk_size=CHUNK)
+    gdrive.download_parts('backup.encr', 'root', str(tmp_path / 'joined'), chunk_size=CHUNK)
+    assert (tmp_path / 'joined').read_bytes() == second
+
+def test_incomplete_upload_falls_back_to_the_previous_one(drive, gdrive, tmp_path):
+    first, second = os.urandom(3 * CHUNK), os.urandom(3 * CHUNK)
+    gdrive.upload_parts(write(tmp_path / 'first', first), 'root', file_name='backup.encr', part_size=CHUNK, chunk_size=CHUNK)
+    parts = gdrive.upload_parts(write(tmp_path / 'second', second), 'root', file_name='backup.encr', part_size=CHUNK, chunk_size=CHUNK)
+    del drive.files[parts[1]['id']]
+    gdrive.download_parts('backup.encr', 'root', str(tmp_path / 'joined'), chunk_size=CHUNK)
+    assert (tmp_path / 'joined').read_bytes() == first
+
+def test_missing_parts_are_reported(drive, gdrive, tmp_path):
+    parts = gdrive.upload_parts(write(tmp_path / 'backup.encr', os.urandom(3 * CHUNK)), 'root', part_size=CHUNK, chunk_size=CHUNK)
+    del drive.files[parts[0]['id']]
+    with pytest.raises(FileQueryError):
+        gdrive.download_parts('backup.encr', 'root', str(tmp_path / 'joined'))
+    with pytest.raises(FileQueryError):
+        gdrive.download_parts('absent', 'root', str(tmp_path / 'joined'))
+
+def test_parts_without_a_run_are_still_joined(drive, gdrive, tmp_path):
+    # parts written before uploads recorded their run
+    drive.add_file('old.encr.part0002', b'world')
+    drive.add_file('old.encr.part0001', b'hello ')
+    drive.add_file('old.encr.partial', b'not a part')
+    gdrive.download_parts('old.encr', 'root', str(tmp_path / 'joined'))
+    assert (tmp_path / 'joined').read_bytes() == b'hello world'
+
+def test_upload_parts_survives_transient_failures(drive, gdrive, tmp_path):
+    data = os.urandom(4 * CHUNK)
+    drive.fail(503, count=3)
+    gdrive.upload_parts(write(tmp_path / 'backup.encr', data), 'root', part_size=2 * CHUNK, chunk_size=CHUNK, workers=1)
+    gdrive.download_parts('backup.encr', 'root', str(tmp_path / 'joined'))
+    assert (tmp_path / 'joined').read_bytes() == data
+
+def interrupt_after(gdrive, chunks):
+    """Makes the handler fail like a crashed process after `chunks` data chunks were sent."""
+    put_chunk = gdrive._put_chunk
+    sent = []
+
+    def put(session_uri, data, offset, total):
+        if data and len(sent) >= chunks:
+            raise RuntimeError('interrupted')
+        sent.append(offset)
+        return put_chunk(session_uri, data, offset, total)
+
+    gdrive._put_chunk = put
+    return put_chunk
+
+def test_upload_file_resumes_an_interrupted_session(drive, gdrive, tmp_path, capsys):
+    data = os.urandom(4 * CHUNK + 3)
+    path = write(tmp_path / 'backup.encr', data)
+    put_chunk = interrupt_after(gdrive, 2)
+    with pytest.raises(RuntimeError):
+        gdrive.upload_file(path, 'root', chunk_size=CHUNK)
+    assert os.path.exists(path + '.upload-session')
+    sent = []
+    gdrive._put_chunk = lambda uri, chunk, offset, total: sent.append(offset) or put_chunk(uri, chunk, offset, total)
+    result = gdrive.upload_file(path, 'root', chunk_size=CHUNK)
+    assert 'Resuming upload of backup.encr at byte 524288' in capsys.readouterr().out
+    assert min(offset for offset in sent if offset) == 2 * CHUNK
+    assert drive.files[result['id']]['data'] == data
+    assert not os.path.exists(path + '.upload-session')
+
+def test_upload_file_starts_over_when_the_file_changed(drive, gdrive, tmp_path):
+    path = write(tmp_path / 'backup.encr', os.urandom(4 * CHUNK))
+    interrupt_after(gdrive, 1)
+    with pytest.raises(RuntimeError):
+        gdrive.upload_file(path, 'root', chunk_size=CHUNK)
+    del gdrive._put_chunk
+    data = os.urandom(4 * CHUNK)
+    write(tmp_path / 'backup.encr', data)
+    os.utime(path, ns=(1, 1))
+    result = gdrive.upload_file(path, 'root', chunk_size=CHUNK)
+    assert drive.files[result['id']]['data'] == data
+
+def test_upload_parts_resumes_interrupted_parts(drive, gdrive, tmp_path, capsys):
+    data = os.urandom(4 * CHUNK)
+    path = write(tmp_path / 'backup.encr', data)
+    interrupt_after(gdrive, 3)
+    with pytest.raises(RuntimeError):
+        gdrive.upload_parts(path, 'root', part_size=2 * CHUNK, chunk_size=CHUNK, workers=1)
+    del gdrive._put_chunk
+    gdrive.upload_parts(path, 'root', part_size=2 * CHUNK, chunk_size=CHUNK, workers=1)
+    assert 'Resuming upload of backup.encr.part0002 at byte 262144' in capsys.readouterr().out
+    gdrive.download_parts('backup.encr', 'root', str(tmp_path / 'joined'))
+    assert (tmp_path / 'joined').read_bytes() == data
+
+def test_download_file_resumes_missing_ranges(drive, gdrive, tmp_path):
+    data = os.urandom(6 * CHUNK)
+    file_id = drive.add_file('backup.encr', data)['id']
+    destination = str(tmp_path / 'backup.encr')
+    fetch_range = gdrive._fetch_range
+    fetched = []
+
+    def flaky(file_id, start, end):
+        if len(fetched) == 3:
+            raise FileDownloadError(file_id, 'connection lost')
+        fetched.append(start)
+        return fetch_range(file_id, start, end)
+
+    gdrive._fetch_range = flaky
+    with pytest.raises(FileDownloadError):
+        gdrive.download_file(file_id, destination, chunk_size=CHUNK, workers=1)
+    assert not os.path.exists(destination)
+    del gdrive._fetch_range
+    requests = drive.requests
+    gdrive.download_file(file_id, destination, chunk_size=CHUNK, workers=1)
+    assert (tmp_path / 'backup.encr').read_bytes() == data
+    # one metadata request and the three missing ranges
+    assert drive.requests - requests == 4
+    assert not os.path.exists(destination + '.progress')
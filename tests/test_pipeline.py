@@ -0,0 +1,60 @@
+import os
+
+import pytest
+
+from mongogbackup import targz
+from mongogbackup.pipeline import Pipeline, PipelineError
+
+def test_stages_run_in_order():
+    pipeline = Pipeline(
+        source=[b'a', b'b', b'c'],
+        stages=[('upper', lambda chunks: (c.upper() for c in chunks)), ('twice', lambda chunks: (c * 2 for c in chunks))],
+        sink=lambda chunks: b''.join(chunks),
+        queue_size=1,
+    )
+    assert pipeline.run() == b'AABBCC'
+
+def test_failing_stage_stops_the_pipeline():
+    def source():
+        while True:
+            yield b'x' * 1024
+
+    def broken(chunks):
+        for i, chunk in enumerate(chunks):
+            if i == 5:
+                raise ValueError('broken stage')
+            yield chunk
+
+    with pytest.raises(PipelineError) as error:
+        Pipeline(source(), [('broken', broken)], sink=lambda chunks: sum(map(len, chunks)), queue_size=2).run()
+    assert error.value.stage == 'broken'
+    assert isinstance(error.value.error, ValueError)
+
+def test_failing_sink_closes_the_source():
+    closed = []
+
+    def source():
+        try:
+            while True:
+                yield b'x'
+        finally:
+            closed.append(True)
+
+    def sink(chunks):
+        next(iter(chunks))
+        raise OSError('disk full')
+
+    with pytest.raises(PipelineError) as error:
+        Pipeline(source(), [], sink).run()
+    assert error.value.stage == 'sink'
+    assert closed
+
+def test_compress_encrypt_round_trip(encryptor):
+    data = os.urandom(300 * 1024) + b'\x00' * 700 * 1024
+    pieces = [data[i:i + 65536] for i in range(0, len(data), 65536)]
+    encrypted = Pipeline(
+        source=pieces,
+        stages=[('compress', targz.compress_stream), ('encrypt', encryptor.encrypt_stream)],
+        sink=list,
+    ).run()
+    assert b''.join(targz.decompress_stream(encryptor.decrypt_stream(encrypted))) == data
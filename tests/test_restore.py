@@ -0,0 +1,117 @@
+import os
+
+import pytest
+
+from mongogbackup import MongoGBackup, pipeline
+from mongogbackup.files import HashVerifier
+from mongogbackup.pipeline import PipelineError, ProgressMeter
+
+class StubBackups:
+    """The part of MongoBackupHandler the streaming pipelines use, with made-up mongodump output."""
+
+    def __init__(self, data):
+        self.data = data
+        self.restored = None
+        self.drop = None
+
+    def dump_stream(self, **options):
+        for start in range(0, len(self.data), 100 * 1024):
+            yield self.data[start:start + 100 * 1024]
+
+    def restore_stream(self, chunks, drop=False):
+        self.restored = b''.join(chunks)
+        self.drop = drop
+
+@pytest.fixture
+def data():
+    return os.urandom(200 * 1024) + b'\x00' * 800 * 1024
+
+@pytest.fixture
+def handler(gdrive, encryptor, data):
+    handler = MongoGBackup.__new__(MongoGBackup)
+    handler.parent_id = 'root'
+    handler.file_name = 'shop.gz.encr'
+    handler.gdrive = gdrive
+    handler.encrypt = encryptor
+    handler.hash = HashVerifier()
+    handler.backups = StubBackups(data)
+    return handler
+
+def test_stream_backup_then_stream_restore(drive, handler, data):
+    uploaded = handler.stream_backup(chunk_size=256 * 1024)
+    stored = drive.files[uploaded['id']]['data']
+    reports = []
+    meter = ProgressMeter('Restore', interval=0, callback=reports.append)
+    snapshot = handler.stream_restore(chunk_size=256 * 1024, workers=2, drop=True, progress=meter)
+    assert handler.backups.restored == data
+    assert handler.backups.drop is True
+    assert snapshot['bytes'] == {'downloaded': len(stored), 'restored': len(data)}
+    assert snapshot['total'] == len(stored)
+    assert snapshot['percent'] == 100.0
+    assert reports[-1] is snapshot
+
+def test_stream_restore_from_a_local_copy(drive, handler, data, tmp_path):
+    uploaded = handler.stream_backup(chunk_size=256 * 1024)
+    local_path = tmp_path / 'shop.gz.encr'
+    local_path.write_bytes(drive.files[uploaded['id']]['data'])
+    requests = drive.requests
+    snapshot = handler.stream_restore(local_path=str(local_path), chunk_size=4096, progress=ProgressMeter('Restore', callback=lambda s: None))
+    assert handler.backups.restored == data
+    assert snapshot['total'] == local_path.stat().st_size
+    assert drive.requests == requests
+
+def test_corrupt_backup_fails_the_restore(drive, handler):
+    uploaded = handler.stream_backup(chunk_size=256 * 1024)
+    stored = drive.files[uploaded['id']]
+    stored['data'] = stored['data'][:-100]
+    with pytest.raises(PipelineError):
+        handler.stream_restore(progress=ProgressMeter('Restore', callback=lambda s: None))
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(pipeline.time, 'monotonic', clock)
+    return clock
+
+def test_progress_rates_and_percent(clock):
+    reports = []
+    meter = ProgressMeter('Restore', total=1000, interval=5, callback=reports.append)
+    downloaded = meter.count('downloaded', iter([b'x' * 100] * 4))
+    restored = meter.count('restored', iter([b'y' * 300] * 2))
+    clock.now += 2
+    next(downloaded)
+    clock.now += 2
+    next(downloaded)
+    next(restored)
+    assert reports == []  # nothing before the interval
+    clock.now += 1
+    next(downloaded)
+    assert len(reports) == 1
+    report = reports[0]
+    assert report['elapsed'] == 5
+    assert report['bytes'] == {'downloaded': 300, 'restored': 300}
+    assert report['rates'] == {'downloaded': 60.0, 'restored': 60.0}
+    assert report['first_byte'] == {'downloaded': 2, 'restored': 4}
+    # the percentage follows the first counter
+    assert report['percent'] == 30.0
+    clock.now += 5
+    list(downloaded)
+    final = meter.finish()
+    assert final['percent'] == 40.0
+    assert final['rates']['downloaded'] == 40.0
+    assert reports[-1] is final
+
+def test_progress_without_a_total(clock, capsys):
+    meter = ProgressMeter('Restore')
+    list(meter.count('restored', [b'x' * 1048576] * 3))
+    clock.now += 2
+    snapshot = meter.finish()
+    assert snapshot['percent'] is None
+    assert capsys.readouterr().out == "Restore: restored 3.0Mb (1.5Mb/s) in 2s\n"
@@ -0,0 +1,171 @@
+import datetime
+import hashlib
+import os
+
+import pytest
+
+from mongogbackup.files import FileEncryptor
+from mongogbackup.manifest import BackupManifest
+from mongogbackup.retention import Retention, RetentionPolicy
+from mongogbackup.storage import LocalStorage
+
+NOW = datetime.datetime(2026, 3, 15, 12, 0, tzinfo=datetime.timezone.utc)
+DAY = datetime.timedelta(days=1)
+
+def keeps(policy, times, sizes=None):
+    decisions = policy.select(times, sizes or [1] * len(times), NOW)
+    return [time for time, (keep, _) in zip(times, decisions) if keep]
+
+def test_keep_last():
+    times = [NOW - i * DAY for i in range(5)]
+    assert keeps(RetentionPolicy(keep_last=3), times) == times[:3]
+
+def test_daily_keeps_the_newest_backup_of_each_day():
+    # four backups a day for five days, newest first
+    times = [NOW - datetime.timedelta(hours=6 * i) for i in range(20)]
+    kept = keeps(RetentionPolicy(daily=3, keep_last=0), times)
+    assert kept == [NOW, NOW - datetime.timedelta(hours=18), NOW - datetime.timedelta(hours=42)]
+
+def test_grandfather_father_son():
+    times = [NOW - i * DAY for i in range(400)]
+    kept = keeps(RetentionPolicy(daily=7, weekly=4, monthly=12, keep_last=0), times)
+    assert kept[:7] == times[:7]
+    assert len({(t.year, t.month) for t in kept}) == 12
+    assert len(kept) < 7 + 4 + 12
+    assert kept[-1] > NOW - 366 * DAY
+
+def test_reasons_name_every_rule():
+    decisions = RetentionPolicy(daily=1, monthly=1, keep_last=1).select([NOW, NOW - DAY], [1, 1], NOW)
+    assert decisions == [(True, 'last, daily, monthly'), (False, 'not kept by any rule')]
+
+def test_max_age_overrides_rules_but_not_min_keep():
+    times = [NOW - i * 10 * DAY for i in range(5)]
+    policy = RetentionPolicy(keep_last=5, max_age=datetime.timedelta(days=25), min_keep=1)
+    assert keeps(policy, times) == times[:3]
+    # everything is too old, the newest one is still kept
+    assert keeps(policy, [t - 100 * DAY for t in times]) == [times[0] - 100 * DAY]
+
+def test_max_total_size_keeps_the_newest_that_fit():
+    times = [NOW - i * DAY for i in range(5)]
+    policy = RetentionPolicy(keep_last=5, max_total_size=250, min_keep=2)
+    assert keeps(policy, times, [100, 100, 40, 20, 10]) == times[:3]
+    # min_keep applies even above the limit
+    assert keeps(policy, times, [1000, 1000, 1, 1, 1]) == times[:2]
+
+@pytest.mark.parametrize('options', [{'daily': -1}, {'keep_last': -1}, {'min_keep': 0}])
+def test_invalid_policies_are_rejected(options):
+    with pytest.raises(ValueError):
+        RetentionPolicy(**options)
+
+@pytest.fixture
+def storage(tmp_path):
+    return LocalStorage(str(tmp_path / 'backups'), fsync=False)
+
+def store(storage, encryptor, name, created, db='shop', manifest=True):
+    """Stores an archive and its signed manifest, recording `created` as the backup time."""
+    data = os.urandom(100)
+    archive = storage.upload_bytes(data, name)
+    if manifest:
+        storage.upload_bytes(BackupManifest({
+            'version': BackupManifest.VERSION,
+            'db': db,
+            'created': created.isoformat(),
+            'archive': {'name': name, 'size': len(data), 'md5': hashlib.md5(data).hexdigest()},
+        }).sign(encryptor).to_bytes(), name + BackupManifest.SUFFIX)
+    return archive
+
+def stored_names(storage):
+    return sorted(f['name'] for f in storage.list_files())
+
+@pytest.fixture
+def nightly(storage, encryptor):
+    """Ten nightly backups, newest last."""
+    return [store(storage, encryptor, 'shop.encr', NOW - i * DAY) for i in reversed(range(10))]
+
+def test_plan_and_apply(storage, encryptor, nightly):
+    other = storage.upload_bytes(b'notes', 'notes.txt')
+    retention = Retention(storage, RetentionPolicy(daily=3), encryptor=encryptor)
+    plan = retention.plan(NOW)
+    assert [b.archive['id'] for b in plan.keep] == [f['id'] for f in nightly[-3:]][::-1]
+    assert len(plan.delete) == 7 and not plan.orphans
+    assert plan.freed == sum(b.size for b in plan.delete) > 0
+    assert retention.apply(plan, batch_size=3) == 14
+    assert [f['id'] for f in storage.list_files('shop.encr')] == [f['id'] for f in nightly[-3:]]
+    assert len(storage.list_files('shop.encr' + BackupManifest.SUFFIX)) == 3
+    assert storage.list_files('notes.txt') == [other]
+
+def test_dry_run_deletes_nothing(storage, encryptor, nightly, capsys):
+    before = storage.list_files()
+    plan = Retention(storage, RetentionPolicy(daily=3), encryptor=encryptor).prune(dry_run=True)
+    assert storage.list_files() == before
+    output = capsys.readouterr().out
+    assert output.count('delete ') == len(plan.delete) == 7
+    assert 'Keeping 3 backups, deleting 7' in output
+
+def test_backups_without_a_manifest_are_not_managed(storage, encryptor, nightly):
+    stream = [store(storage, encryptor, 'stream.encr', NOW, manifest=False) for _ in range(3)]
+    Retention(storage, RetentionPolicy(keep_last=1)).prune()
+    assert storage.list_files('stream.encr') == stream
+    # unless they are named explicitly
+    plan = Retention(storage, RetentionPolicy(keep_last=1), names=['stream.encr'], require_manifest=False).plan(NOW)
+    assert [b.archive['id'] for b in plan.delete] == [f['id'] for f in stream[:2]][::-1]
+
+def test_policy_applies_to_each_name_and_db(storage, encryptor, nightly):
+    store(storage, encryptor, 'users.encr', NOW - DAY, db='accounts')
+    store(storage, encryptor, 'users.encr', NOW, db='accounts')
+    plan = Retention(storage, RetentionPolicy(keep_last=1)).plan(NOW)
+    assert sorted(b.name for b in plan.keep) == ['shop.encr', 'users.encr']
+    plan = Retention(storage, RetentionPolicy(keep_last=1), db='accounts').plan(NOW)
+    assert [b.name for b in plan.keep + plan.delete] == ['users.encr', 'users.encr']
+
+def test_manifests_signed_with_another_key_are_ignored(storage, encryptor, nightly):
+    plan = Retention(storage, RetentionPolicy(keep_last=1), encryptor=FileEncryptor(generate_key=True)).plan(NOW)
+    assert plan.keep == plan.delete == plan.orphans == []
+
+def test_manifests_of_another_file_are_ignored(storage, encryptor, nightly):
+    # an archive replaced after its manifest was written no longer matches its size and MD5
+    os.remove(os.path.join(storage.root, nightly[0]['id']))
+    with open(os.path.join(storage.root, nightly[0]['id']), 'wb') as f:
+        f.write(b'different')
+    plan = Retention(storage, RetentionPolicy(keep_last=1)).plan(NOW)
+    assert nightly[0]['id'] not in {b.archive['id'] for b in plan.keep + plan.delete}
+
+def test_orphaned_manifests_are_deleted(storage, encryptor, nightly):
+    storage.delete_files([nightly[0]])
+    plan = Retention(storage, RetentionPolicy(keep_last=10)).plan(NOW)
+    assert len(plan.orphans) == 1 and not plan.delete
+    assert plan.orphans[0]['createdTime'] < nightly[1]['createdTime']
+
+def test_manifests_of_a_name_without_archives_are_orphans(storage, encryptor):
+    # an interrupted run deleted every archive of the name before their manifests
+    archives = [store(storage, encryptor, 'gone.encr', NOW - i * DAY) for i in range(2)]
+    storage.delete_files(archives)
+    retention = Retention(storage, RetentionPolicy(keep_last=1))
+    plan = retention.plan(NOW)
+    assert len(plan.orphans) == 2
+    retention.apply(plan)
+    assert storage.list_files() == []
+
+def test_the_newest_manifest_may_still_be_uploading(storage, encryptor, nightly):
+    store(storage, encryptor, 'shop.encr', NOW, manifest=False)
+    plan = Retention(storage, RetentionPolicy(keep_last=10)).plan(NOW)
+    assert not plan.orphans and len(plan.keep) == 10
+
+def test_cache_avoids_downloading_manifests_again(storage, encryptor, nightly, tmp_path, monkeypatch):
+    downloads = []
+    download_bytes = storage.download_bytes
+    monkeypatch.setattr(storage, 'download_bytes', lambda file_id: downloads.append(file_id) or download_bytes(file_id))
+    cache_path = str(tmp_path / 'retention.json')
+    retention = Retention(storage, RetentionPolicy(daily=3), encryptor=encryptor, cache_path=cache_path)
+    retention.apply(retention.plan(NOW))
+    assert len(downloads) == 10
+    plan = Retention(storage, RetentionPolicy(daily=3), encryptor=encryptor, cache_path=cache_path).plan(NOW)
+    assert len(downloads) == 10 and len(plan.keep) == 3
+    # entries read without a key are not trusted once signatures are checked
+    Retention(storage, RetentionPolicy(daily=3), cache_path=str(tmp_path / 'unsigned.json')).plan(NOW)
+    Retention(storage, RetentionPolicy(daily=3), encryptor=encryptor, cache_path=str(tmp_path / 'unsigned.json')).plan(NOW)
+    assert len(downloads) == 16
+
+def test_manifest_less_backups_need_names(storage):
+    with pytest.raises(ValueError):
+        Retention(storage, RetentionPolicy(), require_manifest=False)
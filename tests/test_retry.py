@@ -0,0 +1,159 @@
+import os
+import time
+
+import pytest
+import requests
+
+from mongogbackup import retry
+from mongogbackup.gdrive import FileDownloadError
+from mongogbackup.metrics import registry
+from mongogbackup.retry import RetryPolicy, TransientError, classify, raise_for_transient
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    """Records the waits of the retry module instead of sleeping."""
+    waits = []
+    monkeypatch.setattr(retry.time, 'sleep', waits.append)
+    return waits
+
+def response(status, body='', headers=None):
+    result = requests.Response()
+    result.status_code = status
+    result._content = body.encode()
+    result.headers.update(headers or {})
+    return result
+
+def retries(operation):
+    return sum(value for key, value in registry.counters().items()
+               if key.startswith('retries_total{') and f'operation="{operation}"' in key)
+
+@pytest.mark.parametrize('status, body, reason', [
+    (429, '', 'rate_limit'),
+    (403, '{"reason": "userRateLimitExceeded"}', 'rate_limit'),
+    (403, '{"reason": "insufficientPermissions"}', None),
+    (408, '', 'timeout'),
+    (500, '', 'server_error'),
+    (503, '', 'server_error'),
+    (400, '', None),
+    (404, '', None),
+    (200, '', None),
+])
+def test_classify(status, body, reason):
+    assert classify(status, body) == reason
+
+def test_raise_for_transient_reads_retry_after():
+    with pytest.raises(TransientError) as error:
+        raise_for_transient(response(429, 'slow down', {'Retry-After': '7'}))
+    assert (error.value.status, error.value.reason, error.value.retry_after) == (429, 'rate_limit', 7)
+    ok = response(404)
+    assert raise_for_transient(ok) is ok
+
+def test_call_retries_until_success(sleeps):
+    attempts = []
+
+    def flaky():
+        attempts.append(1)
+        if len(attempts) < 3:
+            raise TransientError(503, 'server_error', 'unavailable')
+        return 'done'
+
+    before = retries('test_flaky')
+    assert RetryPolicy(initial_delay=0.5).call('test_flaky', flaky) == 'done'
+    assert len(attempts) == 3
+    assert len(sleeps) == 2
+    assert retries('test_flaky') - before == 2
+
+def test_call_gives_up_after_max_attempts(sleeps):
+    attempts = []
+
+    def failing():
+        attempts.append(1)
+        raise requests.ConnectionError('reset')
+
+    with pytest.raises(requests.ConnectionError):
+        RetryPolicy(max_attempts=4).call('test_failing', failing)
+    assert len(attempts) == 4
+
+def test_other_errors_are_not_retried(sleeps):
+    attempts = []
+
+    def broken():
+        attempts.append(1)
+        raise ValueError('bug')
+
+    with pytest.raises(ValueError):
+        RetryPolicy().call('test_broken', broken)
+    assert len(attempts) == 1 and not sleeps
+
+def test_delays_grow_and_are_capped():
+    policy = RetryPolicy(initial_delay=1, max_delay=10, multiplier=2)
+    for attempt in range(8):
+        assert all(0 <= policy.delay(attempt) <= min(10, 2 ** attempt) for _ in range(50))
+
+def test_retry_after_is_a_minimum(sleeps):
+    attempts = []
+
+    def limited():
+        attempts.append(1)
+        if len(attempts) == 1:
+            raise TransientError(429, 'rate_limit', 'slow down', retry_after=5)
+        return 'done'
+
+    RetryPolicy(initial_delay=0.01).call('test_limited', limited)
+    assert sleeps[0] == 5
+
+def test_rate_limit_pauses_other_requests():
+    policy = RetryPolicy()
+    policy.pause(0.2)
+    started = time.monotonic()
+    policy.wait_for_rate_limit()
+    assert time.monotonic() - started >= 0.15
+
+def test_deadline_stops_retrying(sleeps):
+    attempts = []
+
+    def failing():
+        attempts.append(1)
+        raise TransientError(500, 'server_error', 'boom')
+
+    with pytest.raises(TransientError):
+        RetryPolicy(deadline=0).call('test_deadline', failing)
+    assert len(attempts) == 1
+
+@pytest.mark.parametrize('status, reason', [(503, None), (500, None), (429, None), (403, 'userRateLimitExceeded')])
+def test_drive_requests_survive_transient_errors(drive, gdrive, status, reason):
+    data = os.urandom(600 * 1024)
+    file_id = drive.add_file('backup.encr', data)['id']
+    drive.fail(status, count=2, reason=reason, retry_after=0)
+    assert gdrive.get_file_metadata(file_id)['size'] == str(len(data))
+    drive.fail(status, count=3, reason=reason)
+    assert b''.join(gdrive.download_stream(file_id, chunk_size=256 * 1024, workers=2)) == data
+
+def test_drive_permission_errors_are_not_retried(drive, gdrive):
+    file_id = drive.add_file('backup.encr', b'data')['id']
+    drive.fail(403, reason='insufficientPermissions')
+    requests_before = drive.requests
+    with pytest.raises(FileDownloadError):
+        gdrive.get_file_metadata(file_id)
+    assert drive.requests - requests_before == 1
+
+def test_drive_gives_up_after_max_attempts(drive, gdrive):
+    file_id = drive.add_file('backup.encr', b'data')['id']
+    drive.fail(503, count=gdrive.retry.max_attempts)
+    with pytest.raises(FileDownloadError):
+        gdrive.get_file_metadata(file_id)
+    assert gdrive.get_file_metadata(file_id)['size'] == '4'
+
+def test_failed_upload_chunk_is_counted_once(drive, gdrive):
+    chunk = 256 * 1024
+    data = os.urandom(3 * chunk)
+
+    def failing():
+        yield data[:2 * chunk]
+        drive.fail(503)
+        yield data[2 * chunk:]
+
+    before = retries('upload_chunk')
+    result = gdrive.upload_stream(failing(), 'stream.gz.encr', 'root', chunk_size=chunk)
+    assert drive.files[result['id']]['data'] == data
+    assert retries('upload_chunk') - before == 1
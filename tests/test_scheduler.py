@@ -0,0 +1,138 @@
+import datetime
+import threading
+import time
+
+import pytest
+
+from mongogbackup.scheduler import BackupScheduler, BackupTarget
+
+UTC = datetime.timezone.utc
+DAY = datetime.timedelta(days=1)
+
+def local(*args):
+    return datetime.datetime(*args).astimezone()
+
+class StubBackup:
+    """Stands in for MongoGBackup.stream_backup(); fails while `failures` is positive."""
+
+    def __init__(self, failures=0, delay=0):
+        self.failures = failures
+        self.delay = delay
+        self.calls = []
+        self.running = 0
+        self.peak = 0
+        self._lock = threading.Lock()
+
+    def stream_backup(self, **options):
+        with self._lock:
+            self.calls.append(options)
+            self.running += 1
+            self.peak = max(self.peak, self.running)
+        try:
+            time.sleep(self.delay)
+            if self.failures:
+                self.failures -= 1
+                raise RuntimeError('dump failed')
+            return {'id': f"file{len(self.calls)}", 'size': '10'}
+        finally:
+            with self._lock:
+                self.running -= 1
+
+@pytest.fixture
+def history_path(tmp_path):
+    return str(tmp_path / 'history.json')
+
+def test_never_run_target_is_due_immediately():
+    assert BackupTarget('shop', StubBackup()).next_due(None) is None
+
+def test_next_run_follows_the_interval():
+    target = BackupTarget('shop', StubBackup(), interval=datetime.timedelta(hours=6))
+    last = datetime.datetime(2026, 3, 10, 1, 15, tzinfo=UTC)
+    assert target.next_due(last) == last + datetime.timedelta(hours=6)
+
+def test_late_run_does_not_push_the_next_one_later():
+    target = BackupTarget('shop', StubBackup(), at=datetime.time(2, 0))
+    assert target.next_due(local(2026, 3, 10, 2, 40)) == local(2026, 3, 11, 2, 0)
+
+def test_early_run_is_not_due_again_the_same_day():
+    target = BackupTarget('shop', StubBackup(), at=datetime.time(2, 0))
+    assert target.next_due(local(2026, 3, 10, 1, 0)) == local(2026, 3, 11, 2, 0)
+
+def test_at_crosses_midnight():
+    target = BackupTarget('shop', StubBackup(), at=datetime.time(23, 30))
+    assert target.next_due(local(2026, 3, 10, 0, 15)) == local(2026, 3, 10, 23, 30)
+    assert target.next_due(local(2026, 3, 10, 23, 10)) == local(2026, 3, 11, 23, 30)
+
+def test_at_needs_an_interval_of_a_day():
+    with pytest.raises(ValueError):
+        BackupTarget('shop', StubBackup(), interval=datetime.timedelta(hours=12), at=datetime.time(2, 0))
+
+def test_target_names_must_be_unique(history_path):
+    with pytest.raises(ValueError):
+        BackupScheduler([BackupTarget('shop', StubBackup()), BackupTarget('shop', StubBackup())], history_path)
+
+def test_due_orders_by_priority_then_lateness(history_path):
+    now = datetime.datetime(2026, 3, 10, 12, 0, tzinfo=UTC)
+    targets = [
+        BackupTarget('recent', StubBackup()),
+        BackupTarget('old', StubBackup()),
+        BackupTarget('urgent', StubBackup(), priority=5),
+        BackupTarget('fresh', StubBackup()),
+    ]
+    scheduler = BackupScheduler(targets, history_path)
+    scheduler._history = {
+        'recent': {'runs': [], 'last_success': (now - 1.5 * DAY).isoformat()},
+        'old': {'runs': [], 'last_success': (now - 3 * DAY).isoformat()},
+        'urgent': {'runs': [], 'last_success': (now - 1.1 * DAY).isoformat()},
+        'fresh': {'runs': [], 'last_success': (now - 0.5 * DAY).isoformat()},
+    }
+    assert [target.name for target in scheduler.due(now)] == ['urgent', 'old', 'recent']
+
+def test_failed_target_waits_for_the_retry_delay(history_path):
+    now = datetime.datetime(2026, 3, 10, 12, 0, tzinfo=UTC)
+    scheduler = BackupScheduler([BackupTarget('shop', StubBackup())], history_path, retry_delay=datetime.timedelta(minutes=15))
+    scheduler._history = {'shop': {'runs': [], 'last_failure': (now - datetime.timedelta(minutes=10)).isoformat()}}
+    assert scheduler.due(now) == []
+    assert [target.name for target in scheduler.due(now + datetime.timedelta(minutes=5))] == ['shop']
+
+def test_run_pending_records_runs(history_path):
+    backup = StubBackup()
+    scheduler = BackupScheduler([BackupTarget('shop', backup, options={'codec': 'zstd'})], history_path,
+                                max_concurrent=2, compression_threads=8, upload_bandwidth=1e6)
+    results = scheduler.run_pending()
+    assert results['shop']['status'] == 'success'
+    assert results['shop']['file_id'] == 'file1'
+    assert backup.calls[0]['codec'] == 'zstd'
+    assert backup.calls[0]['workers'] == 4
+    assert backup.calls[0]['rate_limit'] is scheduler.rate_limiter
+    # nothing is due until the interval has passed
+    assert scheduler.run_pending() == {}
+    assert len(backup.calls) == 1
+
+def test_run_pending_does_not_retry_within_one_call(history_path):
+    backup = StubBackup(failures=1)
+    scheduler = BackupScheduler([BackupTarget('shop', backup)], history_path, retry_delay=datetime.timedelta(0))
+    results = scheduler.run_pending()
+    assert results['shop']['status'] == 'failed'
+    assert results['shop']['error'] == 'dump failed'
+    assert len(backup.calls) == 1
+    # the next call retries it
+    assert scheduler.run_pending()['shop']['status'] == 'success'
+
+def test_run_pending_respects_max_concurrent(history_path):
+    backup = StubBackup(delay=0.05)
+    targets = [BackupTarget(f"db{i}", backup) for i in range(5)]
+    results = BackupScheduler(targets, history_path, max_concurrent=2).run_pending()
+    assert len(results) == 5
+    assert backup.peak == 2
+
+def test_history_is_trimmed_and_persisted(history_path):
+    backup = StubBackup(failures=3)
+    scheduler = BackupScheduler([BackupTarget('shop', backup)], history_path, retry_delay=datetime.timedelta(0), history_size=2)
+    for _ in range(4):
+        scheduler.run_pending()
+    runs = scheduler.history('shop')
+    assert [run['status'] for run in runs] == ['failed', 'success']
+    reloaded = BackupScheduler([BackupTarget('shop', StubBackup())], history_path)
+    assert reloaded.history('shop') == runs
+    assert reloaded.due() == []
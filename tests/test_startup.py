@@ -0,0 +1,99 @@
+import json
+import os
+import stat
+import subprocess
+import sys
+
+import pytest
+
+from mongogbackup import MongoConfig, MongoGBackup, backups
+
+HEAVY = ('pymongo', 'googleapiclient', 'cryptography')
+
+def loaded_modules(code):
+    script = f"import sys\n{code}\nprint(' '.join(m for m in {HEAVY!r} if m in sys.modules))"
+    result = subprocess.run([sys.executable, '-c', script], capture_output=True, text=True, check=True)
+    return result.stdout.split()
+
+def test_import_loads_no_client_libraries():
+    assert loaded_modules('import mongogbackup') == []
+    assert loaded_modules('from mongogbackup import targz') == []
+    assert 'pymongo' in loaded_modules('from mongogbackup import backups')
+
+def test_handlers_are_created_on_first_use():
+    handler = MongoGBackup(MongoConfig('shop'), 'missing-credentials.json', 'root', 'backup', 'key')
+    assert 'gdrive' not in vars(handler) and 'backups' not in vars(handler)
+    handler.gdrive = stub = object()
+    assert handler.gdrive is stub
+
+def runs(tool):
+    log = tool.parent.parent / 'runs'
+    return len(log.read_text().splitlines()) if log.exists() else 0
+
+@pytest.fixture
+def tool(tmp_path, monkeypatch):
+    """A fake mongodump on PATH that counts how often it runs."""
+    binary = tmp_path / 'bin' / 'mongodump'
+    binary.parent.mkdir()
+    binary.write_text(f"#!/bin/sh\necho run >> {tmp_path / 'runs'}\necho 'mongodump version: 100.9.4'\n")
+    binary.chmod(binary.stat().st_mode | stat.S_IEXEC)
+    monkeypatch.setenv('PATH', str(binary.parent), prepend=os.pathsep)
+    monkeypatch.setattr(backups, '_TOOL_CACHE', str(tmp_path / 'cache' / 'tools.json'))
+    monkeypatch.setattr(backups, '_tool_versions', {})
+    return binary
+
+def test_tool_version_is_probed_once(tool):
+    assert backups.tool_version('mongodump') == 'mongodump version: 100.9.4'
+    assert backups.tool_version('mongodump') == 'mongodump version: 100.9.4'
+    assert runs(tool) == 1
+
+def test_tool_version_cache_survives_the_process(tool, monkeypatch):
+    backups.tool_version('mongodump')
+    monkeypatch.setattr(backups, '_tool_versions', {})
+    assert backups.tool_version('mongodump') == 'mongodump version: 100.9.4'
+    assert runs(tool) == 1
+
+def test_a_changed_binary_is_probed_again(tool):
+    backups.tool_version('mongodump')
+    tool.write_text(tool.read_text().replace('100.9.4', '100.10.0'))
+    assert backups.tool_version('mongodump') == 'mongodump version: 100.10.0'
+    assert runs(tool) == 2
+
+def test_missing_tool_is_none(tool):
+    assert backups.tool_version('mongogbackup-no-such-tool') is None
+
+def test_clients_are_pooled_per_settings(monkeypatch):
+    created = []
+
+    class StubClient:
+        def __init__(self, **settings):
+            created.append(settings)
+
+    monkeypatch.setattr(backups, 'MongoClient', StubClient)
+    monkeypatch.setattr(backups, '_clients', {})
+    handler = backups.MongoBackupHandler.__new__(backups.MongoBackupHandler)
+    handler.host, handler.port, handler.username, handler.password, handler.auth_db, handler.low_impact = 'db', 27017, None, None, 'admin', None
+    assert handler._client() is handler._client()
+    direct = handler._client(host='secondary', directConnection=True)
+    assert direct is not handler._client()
+    assert created == [{'host': 'db', 'port': 27017}, {'host': 'secondary', 'port': 27017, 'directConnection': True}]
+
+def test_failed_probes_are_not_cached(tool):
+    script = tool.read_text()
+    tool.write_text(script.replace("echo 'mongodump", "exit 1\necho 'mongodump"))
+    assert backups.tool_version('mongodump') is None
+    assert not os.path.exists(backups._TOOL_CACHE)
+    tool.write_text(script)
+    assert backups.tool_version('mongodump') == 'mongodump version: 100.9.4'
+    assert runs(tool) == 2
+
+def test_a_cached_failure_is_probed_again(tool):
+    backups.tool_version('mongodump')
+    with open(backups._TOOL_CACHE) as f:
+        cache = json.load(f)
+    with open(backups._TOOL_CACHE, 'w') as f:
+        json.dump({key: None for key in cache}, f)
+    backups._tool_versions.clear()
+    assert backups.tool_version('mongodump') == 'mongodump version: 100.9.4'
+    assert runs(tool) == 2
+    assert os.listdir(os.path.dirname(backups._TOOL_CACHE)) == ['tools.json']
@@ -0,0 +1,178 @@
+import hashlib
+import os
+
+import pytest
+
+from mongogbackup.storage import (BackupNotFoundError, DriveStorage, FanOutError, FanOutStorage, LocalStorage, S3Storage,
+                                  StorageBackend)
+
+MB = 1024 * 1024
+
+def pieces(data, size=100000):
+    for start in range(0, len(data), size):
+        yield data[start:start + size]
+
+@pytest.fixture
+def local(tmp_path):
+    return LocalStorage(str(tmp_path / 'local'), fsync=False)
+
+def test_backends_must_implement_every_primitive():
+    class Incomplete(StorageBackend):
+        name = 'incomplete'
+
+        def upload_stream(self, chunks, name, chunk_size=None):
+            return {}
+
+    with pytest.raises(TypeError):
+        Incomplete()
+
+def test_local_round_trip(local):
+    data = os.urandom(MB + 5)
+    stored = local.upload_stream(pieces(data), 'shop.encr')
+    assert stored['name'] == 'shop.encr'
+    assert stored['size'] == str(len(data))
+    assert stored['md5Checksum'] == hashlib.md5(data).hexdigest()
+    assert b''.join(local.download_stream(stored['id'], chunk_size=65536, workers=3)) == data
+    assert b''.join(local.download_stream(stored['id'], start=10, end=20)) == data[10:20]
+    assert local.read_range(stored['id'], 5, 9) == data[5:10]
+    assert local.size(stored['id']) == len(data)
+
+def test_local_versions(local, tmp_path):
+    first = local.upload_bytes(b'first', 'shop.encr')
+    (tmp_path / 'second').write_bytes(b'second')
+    second = local.upload_file(str(tmp_path / 'second'), 'shop.encr')
+    other = local.upload_bytes(b'other', 'nested/other.encr')
+    assert [f['id'] for f in local.list_files('shop.encr')] == [first['id'], second['id']]
+    assert local.find_latest('shop.encr')['id'] == second['id']
+    assert local.download_bytes(local.find_latest('nested/other.encr')['id']) == b'other'
+    assert {f['id'] for f in local.list_files()} == {first['id'], second['id'], other['id']}
+    local.delete_files([second])
+    assert local.find_latest('shop.encr')['id'] == first['id']
+    with pytest.raises(BackupNotFoundError):
+        local.find_latest('absent')
+
+def test_local_failed_upload_leaves_nothing(local):
+    def failing():
+        yield b'partial'
+        raise IOError('source failed')
+
+    with pytest.raises(IOError):
+        local.upload_stream(failing(), 'shop.encr')
+    assert local.list_files() == []
+    assert os.listdir(os.path.join(local.root, 'shop.encr')) == []
+
+@pytest.mark.parametrize('name', ['../outside', '/etc/passwd', '.', 'a/../../b'])
+def test_local_rejects_paths_outside_the_root(local, name):
+    with pytest.raises(ValueError):
+        local.upload_bytes(b'data', name)
+
+@pytest.fixture
+def s3():
+    pytest.importorskip('boto3')
+    from fakes3 import FakeS3
+    with FakeS3(bucket='backups') as server:
+        yield server
+
+@pytest.fixture
+def bucket(s3):
+    return S3Storage('backups', prefix='db/', client=s3.client(), part_size=5 * MB, workers=3)
+
+def test_s3_single_part_round_trip(s3, bucket):
+    data = os.urandom(MB)
+    stored = bucket.upload_stream(pieces(data), 'shop.encr')
+    assert stored['md5Checksum'] == hashlib.md5(data).hexdigest()
+    assert list(s3.objects) == [stored['id']]
+    assert stored['id'].startswith('db/shop.encr/')
+    assert bucket.download_bytes(stored['id']) == data
+
+def test_s3_multipart_round_trip(s3, bucket, tmp_path):
+    data = os.urandom(11 * MB + 3)
+    streamed = bucket.upload_stream(pieces(data, MB), 'shop.encr')
+    # multipart ETags are not MD5s of the content
+    assert 'md5Checksum' not in streamed
+    assert streamed['size'] == str(len(data))
+    (tmp_path / 'backup').write_bytes(data)
+    uploaded = bucket.upload_file(str(tmp_path / 'backup'), 'shop.encr')
+    for stored in (streamed, uploaded):
+        assert b''.join(bucket.download_stream(stored['id'], chunk_size=2 * MB)) == data
+    assert [f['id'] for f in bucket.list_files('shop.encr')] == [streamed['id'], uploaded['id']]
+    assert not s3.uploads
+
+def test_s3_failed_stream_aborts_the_multipart_upload(s3, bucket):
+    def failing():
+        yield os.urandom(12 * MB)
+        raise IOError('source failed')
+
+    with pytest.raises(IOError):
+        bucket.upload_stream(failing(), 'shop.encr')
+    assert not s3.objects
+    assert not s3.uploads
+
+def test_s3_retries_throttled_requests(s3, bucket):
+    s3.fail(503, count=1, code='SlowDown')
+    stored = bucket.upload_bytes(b'data', 'shop.encr')
+    assert bucket.download_bytes(stored['id']) == b'data'
+
+def test_s3_delete(s3, bucket):
+    files = [bucket.upload_bytes(str(i).encode(), 'shop.encr') for i in range(3)]
+    bucket.delete_files(files[:2])
+    assert bucket.list_files('shop.encr') == [files[2]]
+    assert list(s3.objects) == [files[2]['id']]
+
+def test_s3_rejects_small_parts():
+    with pytest.raises(ValueError):
+        S3Storage('backups', part_size=MB)
+
+class BrokenStorage(LocalStorage):
+    name = 'broken'
+
+    def upload_stream(self, chunks, name, chunk_size=None):
+        next(iter(chunks))
+        raise IOError('disk full')
+
+def test_fan_out_stores_every_copy(local, tmp_path):
+    mirror = LocalStorage(str(tmp_path / 'mirror'), fsync=False)
+    storage = FanOutStorage([local, mirror], queue_size=2)
+    data = os.urandom(MB)
+    stored = storage.upload_stream(pieces(data), 'shop.encr')
+    assert set(stored['copies']) == {'local0', 'local1'}
+    for backend in (local, mirror):
+        assert backend.download_bytes(backend.find_latest('shop.encr')['id']) == data
+    assert storage.find_latest('shop.encr')['id'] == stored['id']
+
+def test_fan_out_reports_failed_backends(local, tmp_path):
+    storage = FanOutStorage([local, BrokenStorage(str(tmp_path / 'broken'))], queue_size=1)
+    data = os.urandom(MB)
+    with pytest.raises(FanOutError) as error:
+        storage.upload_stream(pieces(data, 1000), 'shop.encr')
+    assert set(error.value.errors) == {'broken'}
+    assert set(error.value.results) == {'local'}
+    # the healthy backend still has a complete copy
+    assert local.download_bytes(local.find_latest('shop.encr')['id']) == data
+
+def test_fan_out_never_stores_a_truncated_stream(local, tmp_path):
+    mirror = LocalStorage(str(tmp_path / 'mirror'), fsync=False)
+
+    def failing():
+        yield b'partial'
+        raise IOError('source failed')
+
+    with pytest.raises(IOError):
+        FanOutStorage([local, mirror]).upload_stream(failing(), 'shop.encr')
+    assert local.list_files() == mirror.list_files() == []
+
+def test_drive_round_trip(drive, gdrive):
+    storage = DriveStorage(gdrive, chunk_size=256 * 1024)
+    data = os.urandom(600 * 1024)
+    stored = storage.upload_stream(pieces(data), "o'brien\\shop.encr")
+    drive.add_file('unrelated.encr', b'x')
+    files = storage.list_files("o'brien\\shop.encr")
+    assert [f['id'] for f in files] == [stored['id']]
+    assert storage.find_latest("o'brien\\shop.encr")['id'] == stored['id']
+    assert storage.size(stored['id']) == len(data)
+    assert storage.read_range(stored['id'], 3, 7) == data[3:8]
+    assert b''.join(storage.download_stream(stored['id'], chunk_size=256 * 1024)) == data
+
+def test_drive_find_latest_of_a_missing_file(drive, gdrive):
+    with pytest.raises(BackupNotFoundError):
+        DriveStorage(gdrive).find_latest('shop.encr')
@@ -0,0 +1,76 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from mongogbackup.gdrive import FileUploadError
+
+CHUNK = 256 * 1024
+
+def pieces(data, size):
+    for start in range(0, len(data), size):
+        yield data[start:start + size]
+
+@pytest.mark.parametrize('length', [0, 1, CHUNK, 3 * CHUNK + 17])
+def test_upload_stream_round_trip(drive, gdrive, length):
+    data = os.urandom(length)
+    result = gdrive.upload_stream(pieces(data, 100 * 1024), 'stream.gz.encr', 'root', chunk_size=CHUNK)
+    assert drive.files[result['id']]['data'] == data
+    assert b''.join(gdrive.download_stream(result['id'], chunk_size=CHUNK)) == data
+
+def test_upload_stream_retries_failed_chunks(drive, gdrive):
+    data = os.urandom(2 * CHUNK + 5)
+    chunks = pieces(data, CHUNK)
+
+    def failing():
+        yield next(chunks)
+        drive.fail(503, count=2)
+        yield from chunks
+
+    result = gdrive.upload_stream(failing(), 'stream.gz.encr', 'root', chunk_size=CHUNK)
+    assert drive.files[result['id']]['data'] == data
+
+def test_upload_stream_gives_up_after_max_attempts(drive, gdrive):
+    drive.fail(503, count=10)
+    with pytest.raises(FileUploadError):
+        gdrive.upload_stream([b'data'], 'stream.gz.encr', 'root', chunk_size=CHUNK)
+    assert not drive.files
+
+def test_upload_stream_rejects_unaligned_chunk_size(gdrive):
+    with pytest.raises(ValueError):
+        gdrive.upload_stream([b'data'], 'stream.gz.encr', 'root', chunk_size=1000)
+
+def test_upload_stream_refuses_to_rewind_past_confirmed_bytes(drive, gdrive, monkeypatch):
+    # a session that forgets committed bytes (a 308 without a Range header) cannot be continued,
+    # because the confirmed bytes are no longer buffered
+    put_chunk = type(gdrive)._put_chunk
+    calls = []
+
+    def forgetful(self, session_uri, data, offset, total):
+        response = put_chunk(self, session_uri, data, offset, total)
+        calls.append(offset)
+        if len(calls) == 2 and response.status_code == 308:
+            del response.headers['Range']
+        return response
+
+    monkeypatch.setattr(type(gdrive), '_put_chunk', forgetful)
+    with pytest.raises(FileUploadError):
+        gdrive.upload_stream(pieces(os.urandom(4 * CHUNK), CHUNK), 'stream.gz.encr', 'root', chunk_size=CHUNK)
+    assert not drive.files
+
+def test_upload_bytes_round_trip(drive, gdrive):
+    data = os.urandom(1000) + b'\r\n--'
+    result = gdrive.upload_bytes(data, 'blob', 'root')
+    assert result['name'] == 'blob'
+    assert drive.files[result['id']]['data'] == data
+
+def test_upload_bytes_from_several_threads(drive, gdrive):
+    blobs = {f"blob-{i}": os.urandom(10_000) for i in range(16)}
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(lambda name: gdrive.upload_bytes(blobs[name], name, 'root'), blobs))
+    assert {file['name']: file['data'] for file in drive.files.values()} == blobs
+
+def test_upload_bytes_retries_transient_errors(drive, gdrive):
+    drive.fail(503, count=2)
+    result = gdrive.upload_bytes(b'data', 'blob', 'root')
+    assert drive.files[result['id']]['data'] == b'data'